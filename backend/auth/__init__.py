@@ -2,16 +2,27 @@
 Authentication module
 """
 
-from .jwt_handler import create_access_token, verify_token, get_current_user
-from .dependencies import get_current_active_user, require_role
-from .password import hash_password, verify_password
+from .jwt_handler import create_access_token, verify_token
+from .dependencies import get_current_user, get_current_active_user, get_current_principal, authenticate_token, require_role
+from .principal import Principal, invalidate_principal
+from .token_state import bump_security_version, get_token_state
+from .password import hash_password, verify_password, hash_password_async, verify_password_async, get_password_hasher
 
 __all__ = [
     "create_access_token",
     "verify_token", 
     "get_current_user",
     "get_current_active_user",
+    "get_current_principal",
+    "authenticate_token",
     "require_role",
+    "Principal",
+    "invalidate_principal",
+    "bump_security_version",
+    "get_token_state",
     "hash_password",
-    "verify_password"
+    "verify_password",
+    "hash_password_async",
+    "verify_password_async",
+    "get_password_hasher"
 ]
\ No newline at end of file
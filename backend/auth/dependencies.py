@@ -2,44 +2,159 @@
 Authentication dependencies
 """
 
-from typing import List
-from fastapi import Depends, HTTPException, status
+from typing import List, Optional
+from uuid import UUID
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
-from .jwt_handler import get_current_user
+from .jwt_handler import verify_token
+from .principal import Principal, principal_cache, load_principal, token_key
+from .token_state import get_token_state, is_token_revoked
 from ..database import get_db
 from ..models.users import User
 
 security = HTTPBearer()
 
-async def get_current_active_user(
+def _credentials_error(detail: str = "Không thể xác thực thông tin đăng nhập") -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+def _parse_user_id(user_id: str) -> UUID:
+    try:
+        return UUID(user_id)
+    except ValueError:
+        raise _credentials_error()
+
+def _stateless_principal(token_data, db: Session) -> Principal:
+    """
+    Token có jti và claim sv: dựng principal từ claim, chỉ kiểm tra danh
+    sách thu hồi và phiên bản bảo mật trong bộ nhớ (TokenState) nên thường
+    không có truy vấn database nào. Khi trạng thái chưa sẵn sàng hoặc người
+    dùng vừa thay đổi thì so với database.
+    """
+    if is_token_revoked(db, token_data.jti):
+        raise _credentials_error("Phiên đăng nhập đã kết thúc")
+
+    state = get_token_state()
+    valid = state.check_version(token_data.user_id, token_data.security_version) if state is not None else None
+    if valid is None:
+        principal = load_principal(db, _parse_user_id(token_data.user_id))
+        if principal is not None and principal.security_version == token_data.security_version:
+            return principal
+        valid = False
+
+    if not valid:
+        raise _credentials_error("Phiên đăng nhập đã hết hiệu lực, vui lòng đăng nhập lại")
+    return Principal.from_token(token_data)
+
+def authenticate_token(token: str, db: Session) -> Principal:
+    """
+    Principal của access token. Token mang claim sv được xác thực từ claim
+    và TokenState (danh sách thu hồi, phiên bản bảo mật); token cũ dùng
+    principal cache theo token với TTL ngắn. Dùng chung cho request HTTP
+    và bắt tay WebSocket.
+    """
+    token_data = verify_token(token)
+
+    if token_data.jti and token_data.security_version is not None:
+        return _stateless_principal(token_data, db)
+
+    # Token cũ (không có claim sv): principal từ cache theo token hoặc database
+    key = token_key(token)
+    principal = principal_cache.get(key)
+    if principal is None or str(principal.user_id) != token_data.user_id:
+        principal = load_principal(db, _parse_user_id(token_data.user_id))
+        if principal is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Không tìm thấy người dùng"
+            )
+        principal_cache.set(key, principal)
+    return principal
+
+async def get_current_principal(
+    request: Request,
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
-) -> User:
-    """Lấy người dùng hiện tại đang hoạt động"""
-    
-    # Verify token
-    current_user_data = await get_current_user(credentials.credentials)
-    
-    # Get user from database
-    user = db.query(User).filter(
-        User.id == current_user_data["user_id"],
-        User.is_active == True,
-        User.deleted_at.is_(None)
-    ).first()
-    
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Không tìm thấy người dùng"
-        )
-    
-    return user
+) -> Principal:
+    """
+    Xác định principal một lần cho mỗi request (FastAPI cache dependency
+    trong request; kết quả cũng được gắn vào request.state.principal).
+    """
+    request.state.principal = authenticate_token(credentials.credentials, db)
+    return request.state.principal
+
+class CurrentUser:
+    """
+    Người dùng hiện tại của request. id, username và vai trò lấy từ
+    Principal (đã kiểm tra đang hoạt động) nên không cần truy vấn; bản ghi
+    User chỉ được tải (một lần mỗi request) khi route đọc hoặc gán thuộc
+    tính khác, hoặc gọi load().
+    """
+
+    __slots__ = ("_principal", "_db", "_user")
+
+    def __init__(self, principal: Principal, db: Session):
+        object.__setattr__(self, "_principal", principal)
+        object.__setattr__(self, "_db", db)
+        object.__setattr__(self, "_user", None)
+
+    @property
+    def principal(self) -> Principal:
+        return self._principal
+
+    @property
+    def id(self):
+        return self._principal.user_id
+
+    @property
+    def username(self) -> Optional[str]:
+        return self._principal.username
+
+    @property
+    def role(self) -> str:
+        return self._principal.role
+
+    vai_tro = role
+
+    def load(self) -> User:
+        """Bản ghi User (ORM) của người dùng hiện tại"""
+        if self._user is None:
+            user = self._db.get(User, self._principal.user_id)
+            if not user:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Không tìm thấy người dùng"
+                )
+            object.__setattr__(self, "_user", user)
+        return self._user
+
+    def __getattr__(self, name: str):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(self.load(), name, value)
+
+async def get_current_active_user(
+    principal: Principal = Depends(get_current_principal),
+    db: Session = Depends(get_db)
+) -> CurrentUser:
+    """Lấy người dùng hiện tại đang hoạt động (bản ghi User tải khi cần)"""
+    return CurrentUser(principal, db)
+
+# Tên cũ: các route import get_current_user từ đây cũng đi qua kiểm tra thu hồi và phiên bản bảo mật
+get_current_user = get_current_active_user
 
 def require_role(allowed_roles: List[str]):
-    """Decorator yêu cầu vai trò cụ thể"""
-    def role_checker(current_user: User = Depends(get_current_active_user)):
-        if current_user.role not in allowed_roles:
+    """Decorator yêu cầu vai trò cụ thể (kiểm tra trên Principal, không truy vấn nguoi_dung)"""
+    def role_checker(
+        principal: Principal = Depends(get_current_principal),
+        current_user: CurrentUser = Depends(get_current_active_user)
+    ) -> CurrentUser:
+        if principal.role not in allowed_roles:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Không có quyền truy cập"
@@ -47,8 +162,45 @@ def require_role(allowed_roles: List[str]):
         return current_user
     return role_checker
 
+def require_principal_role(allowed_roles: List[str]):
+    """Như require_role nhưng trả về Principal, không tải bản ghi người dùng"""
+    def role_checker(principal: Principal = Depends(get_current_principal)) -> Principal:
+        if principal.role not in allowed_roles:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Không có quyền truy cập"
+            )
+        return principal
+    return role_checker
+
+async def get_current_agent_principal(
+    principal: Principal = Depends(require_principal_role(["dai_ly"]))
+) -> Principal:
+    """Principal của đại lý; agent_id đã có sẵn, không cần truy vấn bảng đại lý"""
+    if not principal.agent_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Không tìm thấy thông tin đại lý"
+        )
+    return principal
+
+async def get_current_customer_principal(
+    principal: Principal = Depends(require_principal_role(["khach_the"]))
+) -> Principal:
+    """Principal của khách hàng; customer_id đã có sẵn"""
+    if not principal.customer_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Không tìm thấy thông tin khách hàng"
+        )
+    return principal
+
 # Pre-defined role dependencies
 require_admin = require_role(["admin"])
 require_staff = require_role(["admin", "nhan_vien"])
 require_agent = require_role(["admin", "nhan_vien", "dai_ly"])
-require_customer = require_role(["admin", "nhan_vien", "khach_the"])
\ No newline at end of file
+require_customer = require_role(["admin", "nhan_vien", "khach_the"])
+
+get_current_admin_user = require_admin
+get_current_agent_user = require_role(["dai_ly"])
+get_current_customer_user = require_role(["khach_the"])
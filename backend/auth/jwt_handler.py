@@ -2,6 +2,7 @@
 JWT Token handling
 """
 
+import uuid
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 from jose import JWTError, jwt
@@ -17,6 +18,13 @@ class TokenData(BaseModel):
     user_id: Optional[str] = None
     username: Optional[str] = None
     role: Optional[str] = None
+    # Token mới mang jti, phiên bản bảo mật và id liên kết để xác thực không cần database
+    jti: Optional[str] = None
+    security_version: Optional[int] = None
+    agent_id: Optional[str] = None
+    customer_id: Optional[str] = None
+    staff_id: Optional[str] = None
+    expires_at: Optional[datetime] = None
 
 def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
     """Tạo JWT access token"""
@@ -28,6 +36,7 @@ def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta]
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
     to_encode.update({"exp": expire})
+    to_encode.setdefault("jti", uuid.uuid4().hex)
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     
     return encoded_jwt
@@ -49,18 +58,19 @@ def verify_token(token: str) -> TokenData:
         if user_id is None:
             raise credentials_exception
             
-        token_data = TokenData(user_id=user_id, username=username, role=role)
+        exp = payload.get("exp")
+        token_data = TokenData(
+            user_id=user_id,
+            username=username,
+            role=role,
+            jti=payload.get("jti"),
+            security_version=payload.get("sv"),
+            agent_id=payload.get("agent_id"),
+            customer_id=payload.get("customer_id"),
+            staff_id=payload.get("staff_id"),
+            expires_at=datetime.utcfromtimestamp(exp) if exp is not None else None
+        )
         return token_data
         
     except JWTError:
         raise credentials_exception
-
-async def get_current_user(token: str) -> Dict[str, Any]:
-    """Lấy thông tin người dùng hiện tại từ token"""
-    token_data = verify_token(token)
-    
-    return {
-        "user_id": token_data.user_id,
-        "username": token_data.username,
-        "role": token_data.role
-    }
\ No newline at end of file
@@ -2,20 +2,168 @@
 Password hashing and verification
 """
 
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
 import bcrypt
 
-def hash_password(password: str) -> str:
+# Configuration
+# Cost factor của bcrypt (mỗi bậc tăng gấp đôi thời gian băm); đổi giá trị thì hash cũ được băm lại khi đăng nhập
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Số thao tác tối đa đang chạy hoặc chờ trong pool; vượt quá thì từ chối ngay thay vì xếp hàng vô hạn
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+class PasswordHasherBusyError(RuntimeError):
+    """Hàng đợi băm mật khẩu đã đầy"""
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
     """Mã hóa mật khẩu"""
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=rounds)
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
+# Tên cũ vẫn được các service tạo người dùng gọi
+get_password_hash = hash_password
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Xác thực mật khẩu"""
     try:
         return bcrypt.checkpw(
-            plain_password.encode('utf-8'), 
+            plain_password.encode('utf-8'),
             hashed_password.encode('utf-8')
         )
     except Exception:
-        return False
\ No newline at end of file
+        return False
+
+def hash_rounds(hashed_password: str) -> Optional[int]:
+    """Cost factor trong hash dạng $2b$12$..."""
+    parts = (hashed_password or "").split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+def needs_rehash(hashed_password: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    return hash_rounds(hashed_password) != rounds
+
+class PasswordHasher:
+    """
+    Chạy bcrypt trên thread pool riêng thay vì trong event loop. bcrypt nhả
+    GIL khi băm nên PASSWORD_HASH_WORKERS luồng dùng được bấy nhiêu lõi CPU.
+    Pool riêng (không dùng pool mặc định của run_in_executor) để đợt đăng
+    nhập dồn dập không chiếm hết luồng của các thao tác database. Số thao
+    tác đang chờ bị chặn ở max_queue: quá ngưỡng thì báo
+    PasswordHasherBusyError để trả 503 ngay.
+    """
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+        rounds: int = BCRYPT_ROUNDS
+    ):
+        self.workers = workers
+        self.max_queue = max(max_queue, workers)
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self.stats = {"completed": 0, "rejected": 0, "rehashed": 0, "wait_ms_total": 0.0, "run_ms_total": 0.0, "max_pending": 0}
+
+    def _timed(self, submitted: float, fn, *args):
+        started = time.perf_counter()
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args)
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                self._running -= 1
+                self.stats["wait_ms_total"] += (started - submitted) * 1000
+                self.stats["run_ms_total"] += (finished - started) * 1000
+
+    async def _submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise PasswordHasherBusyError("Hệ thống đang bận, vui lòng thử lại sau")
+            self._pending += 1
+            self.stats["max_pending"] = max(self.stats["max_pending"], self._pending)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._timed, time.perf_counter(), fn, *args
+            )
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self.stats["completed"] += 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(hash_password, password, self.rounds)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit(verify_password, plain_password, hashed_password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """
+        Xác thực mật khẩu; nếu đúng mà hash dùng cost factor khác cấu hình
+        hiện tại thì trả kèm hash mới để lưu lại (None nếu không cần).
+        """
+        if not await self.verify(plain_password, hashed_password):
+            return False, None
+        if not needs_rehash(hashed_password, self.rounds):
+            return True, None
+        new_hash = await self.hash(plain_password)
+        self.stats["rehashed"] += 1
+        return True, new_hash
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            completed = self.stats["completed"] or 1
+            return {
+                "workers": self.workers,
+                "rounds": self.rounds,
+                "queue_depth": self._pending - self._running,
+                "running": self._running,
+                "max_queue": self.max_queue,
+                "completed": self.stats["completed"],
+                "rejected": self.stats["rejected"],
+                "rehashed": self.stats["rehashed"],
+                "max_pending": self.stats["max_pending"],
+                "avg_wait_ms": round(self.stats["wait_ms_total"] / completed, 2),
+                "avg_run_ms": round(self.stats["run_ms_total"] / completed, 2)
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+_password_hasher: Optional[PasswordHasher] = None
+_hasher_lock = threading.Lock()
+
+def get_password_hasher() -> PasswordHasher:
+    """Password hasher dùng chung (khởi tạo lần đầu khi dùng)"""
+    global _password_hasher
+    if _password_hasher is None:
+        with _hasher_lock:
+            if _password_hasher is None:
+                _password_hasher = PasswordHasher()
+    return _password_hasher
+
+def shutdown_password_hasher():
+    global _password_hasher
+    if _password_hasher is not None:
+        _password_hasher.shutdown()
+        _password_hasher = None
+
+async def hash_password_async(password: str) -> str:
+    """Mã hóa mật khẩu trên pool riêng (dùng trong handler async)"""
+    return await get_password_hasher().hash(password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Xác thực mật khẩu trên pool riêng (dùng trong handler async)"""
+    return await get_password_hasher().verify(plain_password, hashed_password)
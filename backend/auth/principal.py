@@ -0,0 +1,232 @@
+"""
+Principal - danh tính đã xác thực của một request (người dùng, vai trò, đại lý/khách hàng liên kết)
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from uuid import UUID
+from typing import Optional, Dict, Set, Tuple, Any
+from pydantic import BaseModel
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from ..cache import get_redis
+from ..models.users import User, Staff
+from ..models.agents import Agent
+from ..models.customers import Customer
+
+# Configuration
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "50000"))
+
+class Principal(BaseModel):
+    """Người dùng đang đăng nhập cùng các id liên kết, đủ cho phần lớn route mà không cần truy vấn thêm"""
+    user_id: UUID
+    username: Optional[str] = None
+    role: str
+    agent_id: Optional[UUID] = None
+    customer_id: Optional[UUID] = None
+    staff_id: Optional[UUID] = None
+    security_version: int = 1
+
+    def has_role(self, *roles: str) -> bool:
+        return self.role in roles
+
+    def to_claims(self) -> Dict[str, Any]:
+        """Claim JWT đủ để dựng lại principal mà không truy vấn database"""
+        return {
+            "sub": str(self.user_id),
+            "username": self.username,
+            "role": self.role,
+            "sv": self.security_version,
+            "agent_id": str(self.agent_id) if self.agent_id else None,
+            "customer_id": str(self.customer_id) if self.customer_id else None,
+            "staff_id": str(self.staff_id) if self.staff_id else None
+        }
+
+    @classmethod
+    def from_token(cls, token_data: Any) -> "Principal":
+        return cls(
+            user_id=token_data.user_id,
+            username=token_data.username,
+            role=token_data.role,
+            agent_id=token_data.agent_id,
+            customer_id=token_data.customer_id,
+            staff_id=token_data.staff_id,
+            security_version=token_data.security_version
+        )
+
+def token_key(token: str) -> str:
+    """Không lưu token gốc làm khóa cache"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class PrincipalCache:
+    """
+    Cache principal theo token với TTL ngắn (Redis nếu có, nếu không thì bộ nhớ).
+
+    Mỗi người dùng có một tập các token đang được cache để khi người dùng
+    bị cập nhật, đổi vai trò hoặc vô hiệu hóa thì xóa được toàn bộ. Không có
+    Redis thì chỉ xóa được trong tiến trình hiện tại; các worker khác tự hết
+    hạn sau tối đa PRINCIPAL_CACHE_TTL giây.
+    """
+
+    def __init__(self, ttl_seconds: int = PRINCIPAL_CACHE_TTL, max_local_entries: int = PRINCIPAL_CACHE_MAX_ENTRIES):
+        self.ttl = ttl_seconds
+        self.max_local_entries = max_local_entries
+        self.redis = get_redis()
+        self._local: Dict[str, Tuple[float, Principal]] = {}
+        self._user_tokens: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _token_redis_key(key: str) -> str:
+        return f"principal:token:{key}"
+
+    @staticmethod
+    def _user_redis_key(user_id: str) -> str:
+        return f"principal:user:{user_id}"
+
+    def get(self, key: str) -> Optional[Principal]:
+        if self.ttl <= 0:
+            return None
+
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(self._token_redis_key(key))
+            except Exception:
+                return None
+            return Principal(**json.loads(raw)) if raw is not None else None
+
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expires_at, principal = entry
+            if expires_at < time.monotonic():
+                self._drop_local(key, str(principal.user_id))
+                return None
+            return principal
+
+    def set(self, key: str, principal: Principal):
+        if self.ttl <= 0:
+            return
+
+        if self.redis is not None:
+            try:
+                user_key = self._user_redis_key(str(principal.user_id))
+                pipe = self.redis.pipeline()
+                pipe.set(self._token_redis_key(key), principal.json(), ex=self.ttl)
+                pipe.sadd(user_key, key)
+                pipe.expire(user_key, self.ttl)
+                pipe.execute()
+            except Exception:
+                pass
+            return
+
+        with self._lock:
+            if len(self._local) >= self.max_local_entries:
+                self._local.clear()
+                self._user_tokens.clear()
+            self._local[key] = (time.monotonic() + self.ttl, principal)
+            self._user_tokens.setdefault(str(principal.user_id), set()).add(key)
+
+    def _drop_local(self, key: str, user_id: str):
+        self._local.pop(key, None)
+        tokens = self._user_tokens.get(user_id)
+        if tokens is not None:
+            tokens.discard(key)
+            if not tokens:
+                del self._user_tokens[user_id]
+
+    def invalidate_user(self, user_id: Any):
+        """Xóa mọi principal đang cache của một người dùng"""
+        user_id = str(user_id)
+
+        if self.redis is not None:
+            try:
+                user_key = self._user_redis_key(user_id)
+                keys = self.redis.smembers(user_key)
+                self.redis.delete(user_key, *[self._token_redis_key(key) for key in keys])
+            except Exception:
+                pass
+            return
+
+        with self._lock:
+            for key in self._user_tokens.pop(user_id, set()):
+                self._local.pop(key, None)
+
+principal_cache = PrincipalCache()
+
+def load_principal(db: Session, user_id: Any) -> Optional[Principal]:
+    """Một truy vấn duy nhất: người dùng đang hoạt động cùng id đại lý/khách hàng/nhân viên liên kết"""
+    row = db.query(
+        User.id, User.username, User.role, User.security_version, Agent.id, Customer.id, Staff.id
+    ).outerjoin(
+        Agent, Agent.user_id == User.id
+    ).outerjoin(
+        Customer, Customer.user_id == User.id
+    ).outerjoin(
+        Staff, Staff.user_id == User.id
+    ).filter(
+        User.id == user_id,
+        User.is_active == True,
+        User.deleted_at.is_(None)
+    ).first()
+
+    if row is None:
+        return None
+
+    user_id, username, role, security_version, agent_id, customer_id, staff_id = row
+    return Principal(
+        user_id=user_id,
+        username=username,
+        role=getattr(role, "value", role),
+        agent_id=agent_id,
+        customer_id=customer_id,
+        staff_id=staff_id,
+        security_version=security_version or 1
+    )
+
+def invalidate_principal(user_id: Any):
+    """
+    Gọi sau các cập nhật hàng loạt (update() không qua ORM) làm thay đổi
+    người dùng hoặc liên kết đại lý/khách hàng của họ.
+    """
+    principal_cache.invalidate_user(user_id)
+
+# Thay đổi qua ORM được phát hiện tự động: thu thập trong flush, xóa cache sau commit
+LINKED_MODELS = (Agent, Customer, Staff)
+# Chỉ các cột này của bảng liên kết ảnh hưởng tới principal (tránh xóa cache mỗi lần cập nhật doanh số đại lý)
+LINKED_ATTRIBUTES = ("user_id", "is_active", "deleted_at")
+
+def _linked_changed(instance) -> bool:
+    state = inspect(instance)
+    return any(state.attrs[name].history.has_changes() for name in LINKED_ATTRIBUTES)
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_principals(session, flush_context):
+    changed = set()
+    for instance in session.dirty:
+        if isinstance(instance, User) and session.is_modified(instance):
+            changed.add(str(instance.id))
+        elif isinstance(instance, LINKED_MODELS) and instance.user_id and _linked_changed(instance):
+            changed.add(str(instance.user_id))
+    for instance in list(session.new) + list(session.deleted):
+        if isinstance(instance, User):
+            changed.add(str(instance.id))
+        elif isinstance(instance, LINKED_MODELS) and instance.user_id:
+            changed.add(str(instance.user_id))
+    if changed:
+        session.info.setdefault("principal_invalidate", set()).update(changed)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_principals_after_commit(session):
+    for user_id in session.info.pop("principal_invalidate", ()):
+        principal_cache.invalidate_user(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def _clear_principals_after_rollback(session):
+    session.info.pop("principal_invalidate", None)
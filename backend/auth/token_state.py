@@ -0,0 +1,376 @@
+"""
+Token state - phiên bản bảo mật của người dùng và danh sách token thu hồi, giữ trong bộ nhớ để xác thực JWT không cần database
+"""
+
+import os
+import math
+import time
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import event, inspect, or_, update, func
+from sqlalchemy.orm import Session
+
+from ..cache import get_redis
+from ..models.users import User, RevokedToken
+from .principal import LINKED_MODELS, LINKED_ATTRIBUTES
+
+# Configuration
+TOKEN_STATE_ENABLED = os.getenv("TOKEN_STATE_ENABLED", "true").lower() == "true"
+# Đăng xuất/vô hiệu hóa ở worker khác có hiệu lực sau tối đa chừng này giây
+TOKEN_STATE_REFRESH_SECONDS = float(os.getenv("TOKEN_STATE_REFRESH_SECONDS", "5"))
+# Đọc lùi lại một khoảng để không lỡ các commit đến muộn hoặc lệch đồng hồ giữa các máy
+TOKEN_STATE_OVERLAP_SECONDS = float(os.getenv("TOKEN_STATE_OVERLAP_SECONDS", "30"))
+# Dựng lại toàn bộ (thu gọn bản đồ phiên bản, dọn token hết hạn)
+TOKEN_STATE_REBUILD_SECONDS = float(os.getenv("TOKEN_STATE_REBUILD_SECONDS", "3600"))
+TOKEN_REVOCATION_BLOOM_CAPACITY = int(os.getenv("TOKEN_REVOCATION_BLOOM_CAPACITY", "100000"))
+TOKEN_REVOCATION_BLOOM_ERROR_RATE = float(os.getenv("TOKEN_REVOCATION_BLOOM_ERROR_RATE", "0.01"))
+
+DEFAULT_SECURITY_VERSION = 1
+# Giá trị trong bản đồ phiên bản: người dùng bị vô hiệu hóa hoặc đã xóa
+INACTIVE = 0
+# Thuộc tính của User mà khi đổi thì token cũ hết hiệu lực
+SECURITY_ATTRIBUTES = ("role", "is_active", "deleted_at")
+SECURITY_CHANGED_KEY = "security_version_changed"
+REVOKED_PENDING_KEY = "revoked_tokens_pending"
+
+class BloomFilter:
+    """Bộ lọc Bloom: không có âm tính giả, dương tính giả khoảng error_rate khi đầy capacity"""
+
+    def __init__(self, capacity: int, error_rate: float = TOKEN_REVOCATION_BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Băm kép: vị trí thứ i = h1 + i * h2
+        digest = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+def _revoked_in_db(db: Session, jti: str) -> bool:
+    return db.query(RevokedToken.id).filter(
+        RevokedToken.jti == jti,
+        RevokedToken.expires_at > datetime.utcnow()
+    ).first() is not None
+
+class TokenState:
+    """
+    Trạng thái dùng để chấp nhận JWT mà không truy vấn database:
+
+    * Bản đồ phiên bản bảo mật: chỉ giữ người dùng có phiên bản khác mặc
+      định hoặc bị vô hiệu hóa (người dùng vắng mặt = phiên bản 1, đang hoạt
+      động). Token mang claim sv; lệch phiên bản thì bị từ chối.
+    * Danh sách thu hồi: bộ lọc Bloom trong bộ nhớ đứng trước danh sách
+      chính xác (Redis nếu có, nếu không thì bảng token_thu_hoi). Token không
+      có trong bộ lọc, tức gần như mọi request, được chấp nhận ngay; chỉ khi
+      bộ lọc báo có (token đã thu hồi hoặc dương tính giả) mới tra danh sách
+      chính xác.
+
+    Cả hai được làm mới từ database mỗi TOKEN_STATE_REFRESH_SECONDS giây
+    (đọc tăng dần theo updated_at/created_at) và dựng lại toàn bộ định kỳ.
+    Thay đổi trong tiến trình hiện tại có hiệu lực ngay sau commit. Người
+    dùng vừa thay đổi được đánh dấu "chưa rõ" cho tới lần làm mới kế tiếp;
+    khi đó request của họ được kiểm tra với database.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        refresh_seconds: float = TOKEN_STATE_REFRESH_SECONDS,
+        rebuild_seconds: float = TOKEN_STATE_REBUILD_SECONDS
+    ):
+        self.session_factory = session_factory
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.redis = get_redis()
+        self.ready = False
+        self._versions: Dict[str, Optional[int]] = {}
+        self._bloom = BloomFilter(TOKEN_REVOCATION_BLOOM_CAPACITY)
+        self._lock = threading.Lock()
+        # Thay đổi xảy ra trong lúc dựng lại, áp dụng lại sau khi thay bản mới
+        self._rebuild_log: Optional[List[Tuple[str, Any]]] = None
+        self._users_since: Optional[datetime] = None
+        self._revoked_since: Optional[datetime] = None
+        self._rebuilt_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats = {"refreshes": 0, "rebuilds": 0, "bloom_hits": 0, "revoked_hits": 0, "stale_checks": 0}
+
+    @staticmethod
+    def _revoked_redis_key(jti: str) -> str:
+        return f"auth:revoked:{jti}"
+
+    # Kiểm tra (gọi trên mỗi request)
+
+    def check_version(self, user_id: str, security_version: int) -> Optional[bool]:
+        """True/False nếu biết chắc; None nếu chưa có trạng thái hoặc người dùng vừa thay đổi"""
+        if not self.ready:
+            return None
+        version = self._versions.get(user_id, DEFAULT_SECURITY_VERSION)
+        if version is None:
+            self.stats["stale_checks"] += 1
+            return None
+        return version != INACTIVE and version == security_version
+
+    def is_revoked(self, db: Session, jti: str) -> bool:
+        if not self.ready:
+            return _revoked_in_db(db, jti)
+        if jti not in self._bloom:
+            return False
+
+        self.stats["bloom_hits"] += 1
+        if self.redis is not None:
+            try:
+                if self.redis.exists(self._revoked_redis_key(jti)):
+                    self.stats["revoked_hits"] += 1
+                    return True
+            except Exception:
+                pass
+        revoked = _revoked_in_db(db, jti)
+        if revoked:
+            self.stats["revoked_hits"] += 1
+        return revoked
+
+    # Cập nhật trong tiến trình (sau commit)
+
+    def mark_stale(self, user_id: str):
+        with self._lock:
+            self._versions[user_id] = None
+            if self._rebuild_log is not None:
+                self._rebuild_log.append(("stale", user_id))
+
+    def add_revoked(self, jti: str, expires_at: Optional[datetime]):
+        with self._lock:
+            self._bloom.add(jti)
+            if self._rebuild_log is not None:
+                self._rebuild_log.append(("revoked", jti))
+        if self.redis is not None and expires_at is not None:
+            ttl = int((expires_at - datetime.utcnow()).total_seconds())
+            if ttl > 0:
+                try:
+                    self.redis.set(self._revoked_redis_key(jti), "1", ex=ttl)
+                except Exception:
+                    pass
+
+    # Làm mới từ database
+
+    @staticmethod
+    def _version_of(security_version: Optional[int], is_active: bool, deleted_at: Optional[datetime]) -> int:
+        if not is_active or deleted_at is not None:
+            return INACTIVE
+        return security_version or DEFAULT_SECURITY_VERSION
+
+    def rebuild(self):
+        """Nạp lại toàn bộ: người dùng khác mặc định và token thu hồi chưa hết hạn; xóa token đã hết hạn"""
+        with self._lock:
+            self._rebuild_log = []
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            users_since = db.query(func.max(User.updated_at)).scalar()
+            revoked_since = db.query(func.max(RevokedToken.created_at)).scalar()
+
+            versions: Dict[str, Optional[int]] = {}
+            rows = db.query(User.id, User.security_version, User.is_active, User.deleted_at).filter(
+                or_(
+                    User.security_version != DEFAULT_SECURITY_VERSION,
+                    User.is_active == False,
+                    User.deleted_at.isnot(None)
+                )
+            )
+            for user_id, security_version, is_active, deleted_at in rows:
+                versions[str(user_id)] = self._version_of(security_version, is_active, deleted_at)
+
+            db.query(RevokedToken).filter(RevokedToken.expires_at <= now).delete(synchronize_session=False)
+            db.commit()
+            jtis = [jti for (jti,) in db.query(RevokedToken.jti).filter(RevokedToken.expires_at > now)]
+            bloom = BloomFilter(max(TOKEN_REVOCATION_BLOOM_CAPACITY, len(jtis) * 2))
+            for jti in jtis:
+                bloom.add(jti)
+        except Exception:
+            with self._lock:
+                self._rebuild_log = None
+            raise
+        finally:
+            db.close()
+
+        with self._lock:
+            for kind, value in self._rebuild_log:
+                if kind == "stale":
+                    versions[value] = None
+                else:
+                    bloom.add(value)
+            self._rebuild_log = None
+            self._versions = versions
+            self._bloom = bloom
+            self._users_since = users_since or now
+            self._revoked_since = revoked_since or now
+            self._rebuilt_at = time.monotonic()
+            self.ready = True
+        self.stats["rebuilds"] += 1
+
+    def refresh(self):
+        """Đọc tăng dần người dùng vừa cập nhật và token vừa thu hồi"""
+        overlap = timedelta(seconds=TOKEN_STATE_OVERLAP_SECONDS)
+        db = self.session_factory()
+        try:
+            users = db.query(
+                User.id, User.security_version, User.is_active, User.deleted_at, User.updated_at
+            ).filter(User.updated_at >= self._users_since - overlap).all()
+            revoked = db.query(RevokedToken.jti, RevokedToken.created_at).filter(
+                RevokedToken.created_at >= self._revoked_since - overlap,
+                RevokedToken.expires_at > datetime.utcnow()
+            ).all()
+        finally:
+            db.close()
+
+        with self._lock:
+            for user_id, security_version, is_active, deleted_at, updated_at in users:
+                self._versions[str(user_id)] = self._version_of(security_version, is_active, deleted_at)
+                self._users_since = max(self._users_since, updated_at)
+            for jti, created_at in revoked:
+                if jti not in self._bloom:
+                    self._bloom.add(jti)
+                self._revoked_since = max(self._revoked_since, created_at)
+        self.stats["refreshes"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "ready": self.ready,
+            "tracked_users": len(self._versions),
+            "revoked_in_filter": self._bloom.count,
+            "filter_bytes": len(self._bloom._bits)
+        }
+
+    async def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                if not self.ready or time.monotonic() - self._rebuilt_at >= self.rebuild_seconds:
+                    await loop.run_in_executor(None, self.rebuild)
+                else:
+                    await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                print(f"Token state refresh error: {str(e)}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refresh_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+token_state: Optional[TokenState] = None
+
+def get_token_state() -> Optional[TokenState]:
+    """Get token state (None if disabled)"""
+    return token_state
+
+def is_token_revoked(db: Session, jti: str) -> bool:
+    state = get_token_state()
+    if state is not None:
+        return state.is_revoked(db, jti)
+    return _revoked_in_db(db, jti)
+
+def bump_security_version(db: Session, user_id: Any):
+    """
+    Làm mọi token đang có của người dùng hết hiệu lực (đăng xuất mọi phiên,
+    đổi mật khẩu, thay đổi hàng loạt không qua ORM). Có hiệu lực khi commit.
+    """
+    db.execute(
+        update(User).where(User.id == user_id).values(
+            security_version=User.security_version + 1,
+            updated_at=datetime.utcnow()
+        )
+    )
+    db.info.setdefault(SECURITY_CHANGED_KEY, set()).add(str(user_id))
+
+async def start_token_state(session_factory: Callable[[], Session]):
+    global token_state
+    if TOKEN_STATE_ENABLED:
+        token_state = TokenState(session_factory)
+        await token_state.start()
+        print("✅ Token state started")
+
+async def stop_token_state():
+    global token_state
+    if token_state is not None:
+        await token_state.stop()
+        token_state = None
+
+# Thay đổi qua ORM: tăng phiên bản trong flush, cập nhật trạng thái trong bộ nhớ sau commit
+
+def _security_changed(instance, attributes) -> bool:
+    state = inspect(instance)
+    return any(state.attrs[name].history.has_changes() for name in attributes)
+
+@event.listens_for(Session, "before_flush")
+def _bump_security_versions(session, flush_context, instances):
+    changed = session.info.setdefault(SECURITY_CHANGED_KEY, set())
+    linked_users = set()
+    for instance in session.dirty:
+        if isinstance(instance, User) and _security_changed(instance, SECURITY_ATTRIBUTES):
+            instance.security_version = (instance.security_version or DEFAULT_SECURITY_VERSION) + 1
+            changed.add(str(instance.id))
+        elif isinstance(instance, LINKED_MODELS) and instance.user_id and _security_changed(instance, LINKED_ATTRIBUTES):
+            linked_users.add(str(instance.user_id))
+    for instance in list(session.new) + list(session.deleted):
+        if isinstance(instance, LINKED_MODELS) and instance.user_id:
+            linked_users.add(str(instance.user_id))
+
+    # id đại lý/khách hàng/nhân viên nằm trong token nên đổi liên kết cũng cần token mới
+    for user_id in linked_users - changed:
+        bump_security_version(session, user_id)
+    if not changed:
+        session.info.pop(SECURITY_CHANGED_KEY, None)
+
+@event.listens_for(Session, "after_flush")
+def _collect_revoked_tokens(session, flush_context):
+    revoked = [(instance.jti, instance.expires_at) for instance in session.new if isinstance(instance, RevokedToken)]
+    if revoked:
+        session.info.setdefault(REVOKED_PENDING_KEY, []).extend(revoked)
+
+@event.listens_for(Session, "after_commit")
+def _apply_token_state_after_commit(session):
+    changed = session.info.pop(SECURITY_CHANGED_KEY, ())
+    revoked = session.info.pop(REVOKED_PENDING_KEY, ())
+    state = get_token_state()
+    if state is None:
+        return
+    for user_id in changed:
+        state.mark_stale(user_id)
+    for jti, expires_at in revoked:
+        state.add_revoked(jti, expires_at)
+
+@event.listens_for(Session, "after_rollback")
+def _clear_token_state_after_rollback(session):
+    session.info.pop(SECURITY_CHANGED_KEY, None)
+    session.info.pop(REVOKED_PENDING_KEY, None)
@@ -0,0 +1,135 @@
+"""
+Benchmark: thông lượng INSERT giao dịch theo kích thước cửa sổ group-commit
+
+Chạy:
+    python benchmarks/group_commit_benchmark.py
+    DATABASE_URL=postgresql://... python benchmarks/group_commit_benchmark.py --rows 20000
+
+Mỗi "request" ghi một dòng giao dịch và một dòng nhật ký. Cột "per-row"
+là cách hiện tại (mỗi request một lần INSERT + COMMIT); các cột còn lại
+dùng GroupCommitWriter với cửa sổ tương ứng.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+from datetime import datetime
+from sqlalchemy import create_engine, event, Column, String, Numeric, DateTime, Text
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import QueuePool
+
+# Nạp trực tiếp module writer (không kéo theo toàn bộ package services)
+_spec = importlib.util.spec_from_file_location(
+    "group_commit_service",
+    os.path.join(os.path.dirname(__file__), "..", "services", "group_commit_service.py")
+)
+group_commit_service = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(group_commit_service)
+GroupCommitWriter = group_commit_service.GroupCommitWriter
+
+BenchBase = declarative_base()
+
+class BenchTransaction(BenchBase):
+    __tablename__ = "bench_giao_dich"
+    id = Column(String(36), primary_key=True)
+    ma_giao_dich = Column(String(50), nullable=False)
+    so_tien = Column(Numeric(15, 2), nullable=False)
+    trang_thai = Column(String(20), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class BenchAudit(BenchBase):
+    __tablename__ = "bench_nhat_ky"
+    id = Column(String(36), primary_key=True)
+    target_id = Column(String(36), nullable=False)
+    action_description = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+def make_engine(url: str):
+    if url.startswith("sqlite"):
+        engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=QueuePool, pool_size=8)
+
+        @event.listens_for(engine, "connect")
+        def _pragmas(conn, _):
+            # fsync mỗi lần commit như production
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute("PRAGMA busy_timeout=30000")
+        return engine
+    return create_engine(url, pool_size=20, max_overflow=20)
+
+def make_rows(i: int):
+    tx_id = str(uuid.uuid4())
+    tx = {"id": tx_id, "ma_giao_dich": f"BENCH_{i}", "so_tien": 100000, "trang_thai": "dang_xu_ly"}
+    audit = {"id": str(uuid.uuid4()), "target_id": tx_id, "action_description": "Tạo giao dịch"}
+    return tx, audit
+
+async def run_per_row(engine, rows: int, concurrency: int) -> float:
+    """Cách hiện tại: mỗi request một transaction riêng"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    def insert_one(i):
+        tx, audit = make_rows(i)
+        with engine.begin() as conn:
+            conn.execute(BenchTransaction.__table__.insert(), [tx])
+            conn.execute(BenchAudit.__table__.insert(), [audit])
+
+    async def request(i):
+        async with semaphore:
+            await loop.run_in_executor(None, insert_one, i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(rows)))
+    return time.perf_counter() - started
+
+async def run_group_commit(engine, rows: int, concurrency: int, window_ms: float):
+    writer = GroupCommitWriter(engine, window_ms=window_ms)
+    await writer.start()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(i):
+        async with semaphore:
+            tx, audit = make_rows(i)
+            await writer.write_many([(BenchTransaction, tx), (BenchAudit, audit)])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(rows)))
+    elapsed = time.perf_counter() - started
+    await writer.stop()
+    return elapsed, writer.stats
+
+async def main():
+    parser = argparse.ArgumentParser(description="Group-commit benchmark")
+    parser.add_argument("--rows", type=int, default=5000, help="Số request mô phỏng")
+    parser.add_argument("--concurrency", type=int, default=200, help="Số request đồng thời")
+    parser.add_argument("--windows", default="0.5,1,2,5,10,20", help="Các cửa sổ (ms), phân tách bằng dấu phẩy")
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if not url or not url.startswith(("postgresql", "sqlite")):
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+
+    engine = make_engine(url)
+    BenchBase.metadata.drop_all(engine)
+    BenchBase.metadata.create_all(engine)
+
+    print(f"Database: {engine.url.get_backend_name()}  rows={args.rows}  concurrency={args.concurrency}")
+    print(f"{'mode':<18}{'seconds':>10}{'req/s':>12}{'batches':>10}{'avg batch':>12}")
+
+    elapsed = await run_per_row(engine, args.rows, args.concurrency)
+    print(f"{'per-row commit':<18}{elapsed:>10.2f}{args.rows / elapsed:>12.0f}{args.rows:>10}{1:>12.1f}")
+
+    for window in [float(w) for w in args.windows.split(",")]:
+        elapsed, stats = await run_group_commit(engine, args.rows, args.concurrency, window)
+        avg_batch = stats["rows"] / max(stats["batches"], 1) / 2
+        label = f"window {window:g}ms"
+        print(f"{label:<18}{elapsed:>10.2f}{args.rows / elapsed:>12.0f}{stats['batches']:>10}{avg_batch:>12.1f}")
+
+    BenchBase.metadata.drop_all(engine)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+"""
+Benchmark: trừ ví đồng thời - kiểm tra không bị âm/vượt số dư
+
+Chạy:
+    python benchmarks/wallet_debit_benchmark.py
+    DATABASE_URL=postgresql://... python benchmarks/wallet_debit_benchmark.py --payments 50000 --workers 64
+
+Mỗi ví bắt đầu với số dư đủ cho đúng --capacity lần thanh toán, nhưng số
+lần thanh toán gửi tới lớn hơn nhiều. Cột "conditional" dùng cùng dạng câu
+lệnh với LedgerService._apply_balance:
+
+    UPDATE ... SET balance = balance - :amt WHERE id = :id AND balance >= :amt RETURNING balance
+
+Cột "read-check-write" là cách cũ (đọc số dư, so sánh trong Python rồi ghi
+giá trị mới). Benchmark kiểm tra: số dư cuối không âm và số lần trừ thành
+công * số tiền == số dư đầu - số dư cuối cho từng ví.
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+import tempfile
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event, select, update, Column, String, Numeric
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import QueuePool
+
+BenchBase = declarative_base()
+
+class BenchWallet(BenchBase):
+    __tablename__ = "bench_vi"
+    id = Column(String(36), primary_key=True)
+    balance = Column(Numeric(18, 2), nullable=False)
+
+def make_engine(url: str, workers: int):
+    if url.startswith("sqlite"):
+        engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=QueuePool,
+                               pool_size=workers, max_overflow=0)
+
+        @event.listens_for(engine, "connect")
+        def _pragmas(conn, _):
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+        return engine
+    return create_engine(url, pool_size=workers, max_overflow=0)
+
+def reset_wallets(engine, wallets: int, opening: Decimal):
+    ids = [str(uuid.uuid4()) for _ in range(wallets)]
+    with engine.begin() as conn:
+        conn.execute(BenchWallet.__table__.delete())
+        conn.execute(BenchWallet.__table__.insert(), [{"id": wallet_id, "balance": opening} for wallet_id in ids])
+    return ids
+
+def debit_conditional(engine, wallet_id: str, amount: Decimal) -> bool:
+    """Một câu UPDATE có điều kiện: kiểm tra và trừ là một thao tác nguyên tử"""
+    with engine.begin() as conn:
+        balance = conn.execute(
+            update(BenchWallet)
+            .where(BenchWallet.id == wallet_id, BenchWallet.balance >= amount)
+            .values(balance=BenchWallet.balance - amount)
+            .returning(BenchWallet.balance)
+        ).scalar()
+    return balance is not None
+
+def debit_read_check_write(engine, wallet_id: str, amount: Decimal) -> bool:
+    """Cách cũ: đọc số dư, kiểm tra trong Python rồi ghi lại giá trị đã tính"""
+    with engine.connect() as conn:
+        balance = conn.execute(select(BenchWallet.balance).where(BenchWallet.id == wallet_id)).scalar()
+        conn.commit()
+    if balance < amount:
+        return False
+    # Khoảng trống giữa đọc và ghi tương ứng phần còn lại của request
+    time.sleep(0)
+    with engine.begin() as conn:
+        conn.execute(update(BenchWallet).where(BenchWallet.id == wallet_id).values(balance=balance - amount))
+    return True
+
+def run(engine, debit, wallet_ids, payments: int, workers: int, amount: Decimal, opening: Decimal):
+    rng = random.Random(42)
+    targets = [rng.choice(wallet_ids) for _ in range(payments)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        outcomes = list(pool.map(lambda wallet_id: debit(engine, wallet_id, amount), targets))
+    elapsed = time.perf_counter() - started
+
+    succeeded = {wallet_id: 0 for wallet_id in wallet_ids}
+    for wallet_id, ok in zip(targets, outcomes):
+        if ok:
+            succeeded[wallet_id] += 1
+
+    with engine.connect() as conn:
+        balances = dict(conn.execute(select(BenchWallet.id, BenchWallet.balance)).all())
+
+    negative = sum(1 for balance in balances.values() if balance < 0)
+    # Tiền đã "chi" vượt quá số dư đầu (thanh toán thành công nhưng không thực sự bị trừ)
+    overdrawn = sum(
+        max(Decimal(succeeded[wallet_id]) * amount - (opening - balances[wallet_id]), Decimal(0))
+        for wallet_id in wallet_ids
+    )
+    consistent = all(
+        Decimal(succeeded[wallet_id]) * amount == opening - balances[wallet_id] for wallet_id in wallet_ids
+    )
+    return {
+        "seconds": elapsed,
+        "succeeded": sum(succeeded.values()),
+        "negative": negative,
+        "overdrawn": overdrawn,
+        "consistent": consistent
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Wallet debit concurrency benchmark")
+    parser.add_argument("--payments", type=int, default=20000, help="Số lần thanh toán gửi tới")
+    parser.add_argument("--workers", type=int, default=32, help="Số luồng thanh toán song song")
+    parser.add_argument("--wallets", type=int, default=20, help="Số ví (ít ví = tranh chấp cao)")
+    parser.add_argument("--capacity", type=int, default=200, help="Số lần thanh toán mỗi ví đủ tiền")
+    parser.add_argument("--amount", type=Decimal, default=Decimal("50000"), help="Số tiền mỗi lần thanh toán")
+    parser.add_argument("--skip-naive", action="store_true", help="Bỏ qua chế độ read-check-write")
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if not url or not url.startswith(("postgresql", "sqlite")):
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+
+    engine = make_engine(url, args.workers)
+    BenchBase.metadata.drop_all(engine)
+    BenchBase.metadata.create_all(engine)
+
+    opening = args.amount * args.capacity
+    print(f"Database: {engine.url.get_backend_name()}  payments={args.payments}  workers={args.workers}  "
+          f"wallets={args.wallets}  capacity={args.capacity}/ví")
+    print(f"{'mode':<18}{'seconds':>10}{'pay/s':>10}{'succeeded':>11}{'max ok':>9}{'negative':>10}{'overdrawn':>16}  ok")
+
+    modes = [("conditional", debit_conditional)]
+    if not args.skip_naive:
+        modes.append(("read-check-write", debit_read_check_write))
+
+    failed = False
+    for label, debit in modes:
+        wallet_ids = reset_wallets(engine, args.wallets, opening)
+        stats = run(engine, debit, wallet_ids, args.payments, args.workers, args.amount, opening)
+        ok = stats["negative"] == 0 and stats["overdrawn"] == 0 and stats["consistent"]
+        print(f"{label:<18}{stats['seconds']:>10.2f}{args.payments / stats['seconds']:>10.0f}"
+              f"{stats['succeeded']:>11}{args.wallets * args.capacity:>9}{stats['negative']:>10}"
+              f"{stats['overdrawn']:>16,.0f}  {'✅' if ok else '❌'}")
+        if label == "conditional" and not ok:
+            failed = True
+
+    BenchBase.metadata.drop_all(engine)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""
+Redis cache configuration and connection
+"""
+
+import os
+
+# Redis configuration
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Redis là tùy chọn: nếu không có thư viện hoặc không kết nối được thì dùng database
+try:
+    import redis
+
+    redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=1, decode_responses=True)
+    redis_client.ping()
+    print("✅ Connected to Redis")
+except Exception as e:
+    print(f"⚠️ Redis connection failed: {e}")
+    print("🔄 Falling back to database-backed storage")
+    redis_client = None
+
+def get_redis():
+    """Get Redis client (None if Redis is not available)"""
+    return redis_client
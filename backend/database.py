@@ -6,7 +6,11 @@ import os
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.pool import StaticPool
-from models.base import Base
+try:
+    from .models.base import Base
+except ImportError:
+    # Chạy trực tiếp từ thư mục backend (uvicorn main:app)
+    from models.base import Base
 
 # Database configuration
 DATABASE_URL = os.getenv(
@@ -20,11 +20,22 @@ from routers import (
     bill_router,
     transaction_router,
     approval_router,
-    file_router
+    file_router,
+    events_router
 )
 
 # Import database
-from database import init_database
+from database import init_database, engine, SessionLocal
+from services.group_commit_service import start_group_commit_writer, stop_group_commit_writer
+from services.outbox_service import start_outbox_dispatcher, stop_outbox_dispatcher
+from services.approval_sla_service import start_approval_sla_scheduler, stop_approval_sla_scheduler
+from services.download_counter_service import start_download_counter, stop_download_counter
+from services.document_processing_service import start_document_processor, stop_document_processor
+from services.partition_service import ensure_transaction_partitions
+from auth.password import shutdown_password_hasher
+from auth.token_state import start_token_state, stop_token_state
+from services.resource_version_service import ResourceVersionService
+from models.outbox import OutboxEvent
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -33,9 +44,24 @@ async def lifespan(app: FastAPI):
     print("🚀 Starting 7tỷ.vn Backend System...")
     init_database()
     print("✅ Database initialized")
+    ensure_transaction_partitions(engine)
+    # Dòng outbox ghi qua group-commit cũng tăng phiên bản danh sách (ETag) trong cùng lô
+    await start_group_commit_writer(engine, hooks=[(OutboxEvent, ResourceVersionService.bump_outbox_rows)])
+    await start_outbox_dispatcher(SessionLocal)
+    await start_approval_sla_scheduler(SessionLocal)
+    await start_download_counter(SessionLocal)
+    await start_document_processor(SessionLocal)
+    await start_token_state(SessionLocal)
     yield
     # Shutdown
     print("🛑 Shutting down 7tỷ.vn Backend System...")
+    await stop_token_state()
+    await stop_document_processor()
+    await stop_download_counter()
+    await stop_approval_sla_scheduler()
+    await stop_outbox_dispatcher()
+    await stop_group_commit_writer()
+    shutdown_password_hasher()
 
 # FastAPI application
 app = FastAPI(
@@ -65,6 +91,7 @@ app.include_router(bill_router, prefix="/api/bills", tags=["⚡ Hóa đơn đi
 app.include_router(transaction_router, prefix="/api/transactions", tags=["💰 Giao dịch"])
 app.include_router(approval_router, prefix="/api/approvals", tags=["✅ Phê duyệt"])
 app.include_router(file_router, prefix="/api/files", tags=["📁 Tệp tin"])
+app.include_router(events_router, prefix="/api/events", tags=["📡 Sự kiện"])
 
 # Health check endpoint
 @app.get("/health")
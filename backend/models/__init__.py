@@ -4,23 +4,34 @@ SQLAlchemy models for the complete system
 """
 
 from .base import Base
-from .users import User, Staff
-from .agents import Agent, AgentWallet
+from .users import User, Staff, RevokedToken
+from .agents import Agent, AgentWallet, AgentAggregate
 from .customers import Customer, CreditCard
-from .bills import ElectricBill, Provider
-from .transactions import Transaction, Commission
-from .approvals import Approval, ApprovalStep
-from .files import FileUpload
+from .bills import ElectricBill, Bill, Provider
+from .transactions import Transaction, Commission, CommissionRuleSet
+from .approvals import Approval, ApprovalStep, ApprovalCounter, AutoApprovalRule
+from .files import FileRecord, FileUpload
 from .audit import AuditLog
+from .idempotency import IdempotencyKey
+from .ledger import LedgerEntry
+from .outbox import OutboxEvent
+from .settlement import SettlementRun, SettlementPartition, SettlementAgent
+from .versions import ResourceVersion
 
 __all__ = [
     "Base",
-    "User", "Staff",
-    "Agent", "AgentWallet", 
+    "User", "Staff", "RevokedToken",
+    "Agent", "AgentWallet", "AgentAggregate",
     "Customer", "CreditCard",
-    "ElectricBill", "Provider",
-    "Transaction", "Commission",
-    "Approval", "ApprovalStep",
+    "ElectricBill", "Bill", "Provider",
+    "Transaction", "Commission", "CommissionRuleSet",
+    "Approval", "ApprovalStep", "ApprovalCounter", "AutoApprovalRule",
+    "FileRecord",
     "FileUpload",
-    "AuditLog"
+    "AuditLog",
+    "IdempotencyKey",
+    "LedgerEntry",
+    "OutboxEvent",
+    "SettlementRun", "SettlementPartition", "SettlementAgent",
+    "ResourceVersion"
 ]
\ No newline at end of file
@@ -2,7 +2,7 @@
 Agent and Agent Wallet models
 """
 
-from sqlalchemy import Column, String, Numeric, Integer, ForeignKey, Text, JSON, Enum
+from sqlalchemy import Column, String, Numeric, Integer, BigInteger, ForeignKey, Text, JSON, Enum, UniqueConstraint
 from sqlalchemy.orm import relationship
 from .base import BaseModel
 import enum
@@ -30,6 +30,7 @@ class Agent(BaseModel):
     # Thông tin kinh doanh
     region = Column(String(50), default="mien_nam", comment="Khu vực")
     commission_rate = Column(Numeric(5,2), default=1.0, comment="Tỷ lệ hoa hồng (%)")
+    level = Column(String(20), default="basic", nullable=False, comment="Cấp đại lý (basic/silver/gold/platinum), khóa level_rates của bộ quy tắc hoa hồng")
     status = Column(Enum(AgentStatus), default=AgentStatus.PENDING, comment="Trạng thái")
     
     # Thông tin pháp nhân
@@ -62,8 +63,8 @@ class AgentWallet(BaseModel):
     
     agent_id = Column(String, ForeignKey("dai_ly.id"), unique=True, nullable=False)
     
-    # Số dư
-    balance = Column(String(20), default="0", comment="Số dư hiện tại (VND)")
+    # Số dư (cập nhật nguyên tử cùng bút toán sổ cái, xem LedgerService)
+    balance = Column(Numeric(18, 2), default=0, nullable=False, comment="Số dư hiện tại (VND)")
     available_balance = Column(String(20), default="0", comment="Số dư khả dụng")
     frozen_balance = Column(String(20), default="0", comment="Số dư bị đóng băng")
     
@@ -72,13 +73,35 @@ class AgentWallet(BaseModel):
     lifetime_points = Column(Integer, default=0, comment="Tổng điểm tích lũy")
     
     # Thống kê giao dịch
-    total_deposits = Column(String(20), default="0", comment="Tổng nạp tiền")
-    total_withdrawals = Column(String(20), default="0", comment="Tổng rút tiền")
-    total_commissions = Column(String(20), default="0", comment="Tổng hoa hồng nhận")
+    total_deposits = Column(Numeric(18, 2), default=0, nullable=False, comment="Tổng nạp tiền")
+    total_withdrawals = Column(Numeric(18, 2), default=0, nullable=False, comment="Tổng rút tiền")
+    total_commissions = Column(Numeric(18, 2), default=0, nullable=False, comment="Tổng hoa hồng nhận")
     
     # Cài đặt ví
     daily_limit = Column(String(20), default="50000000", comment="Hạn mức giao dịch hàng ngày")
     monthly_limit = Column(String(20), default="1000000000", comment="Hạn mức giao dịch hàng tháng")
     
     # Relationships
-    agent = relationship("Agent", back_populates="wallet")
\ No newline at end of file
+    agent = relationship("Agent", back_populates="wallet")
+
+class AgentAggregate(BaseModel):
+    """
+    Bảng tổng hợp đại lý theo khu vực / nhân viên phụ trách / tỉnh thành,
+    cập nhật tăng dần cùng transaction nghiệp vụ (xem AgentAggregateService).
+    Mỗi nhóm được chia thành nhiều dòng (stripe) để các giao dịch đồng thời
+    trong cùng khu vực không tranh nhau một dòng; giá trị nhóm là tổng các stripe.
+    """
+    __tablename__ = "tong_hop_dai_ly"
+    __table_args__ = (
+        UniqueConstraint("dimension", "dimension_key", "stripe", name="uq_tong_hop_dai_ly_nhom_stripe"),
+    )
+
+    dimension = Column(String(20), nullable=False, comment="Chiều tổng hợp (khu_vuc, nhan_vien, tinh_thanh, dai_ly)")
+    dimension_key = Column(String(100), nullable=False, comment="Giá trị của chiều (mã khu vực, ID nhân viên...)")
+    stripe = Column(Integer, default=0, nullable=False, comment="Dòng con của nhóm")
+
+    customers = Column(Integer, default=0, nullable=False, comment="Số khách hàng")
+    transactions = Column(BigInteger, default=0, nullable=False, comment="Số giao dịch thành công")
+    sales = Column(Numeric(18, 2), default=0, nullable=False, comment="Doanh số giao dịch thành công")
+    commission = Column(Numeric(18, 2), default=0, nullable=False, comment="Hoa hồng giao dịch thành công")
+    pending_bills = Column(Integer, default=0, nullable=False, comment="Số hóa đơn chưa thanh toán")
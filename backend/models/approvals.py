@@ -2,7 +2,7 @@
 Approval and Approval Step models
 """
 
-from sqlalchemy import Column, String, Integer, ForeignKey, Text, JSON, Enum
+from sqlalchemy import Column, String, Integer, BigInteger, Date, DateTime, ForeignKey, Text, JSON, Enum, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from .base import BaseModel
 import enum
@@ -31,6 +31,11 @@ class StepStatus(str, enum.Enum):
 class Approval(BaseModel):
     """Bảng phê duyệt"""
     __tablename__ = "phe_duyet"
+    __table_args__ = (
+        # Keyset cho hộp duyệt và danh sách yêu cầu của người gửi
+        Index("idx_phe_duyet_inbox", "status", "created_at", "id"),
+        Index("idx_phe_duyet_requester_inbox", "requester_id", "status", "created_at", "id"),
+    )
     
     # Thông tin cơ bản
     approval_code = Column(String(20), unique=True, nullable=False, comment="Mã phê duyệt")
@@ -65,7 +70,8 @@ class Approval(BaseModel):
     final_notes = Column(Text, nullable=True, comment="Ghi chú cuối cùng")
     
     # Metadata
-    metadata = Column(JSON, default={}, comment="Thông tin bổ sung")
+    # Thuộc tính metadata bị Declarative API dành riêng; cột trong database vẫn tên "metadata"
+    metadata_ = Column("metadata", JSON, default={}, comment="Thông tin bổ sung")
     
     # Relationships
     requester = relationship("User")
@@ -74,6 +80,10 @@ class Approval(BaseModel):
 class ApprovalStep(BaseModel):
     """Bảng bước phê duyệt"""
     __tablename__ = "buoc_phe_duyet"
+    __table_args__ = (
+        # Hàng đợi hạn xử lý của bộ lập lịch SLA (ApprovalSlaScheduler)
+        Index("idx_buoc_phe_duyet_han_xu_ly", "status", "due_at"),
+    )
     
     approval_id = Column(String, ForeignKey("phe_duyet.id"), nullable=False)
     
@@ -101,6 +111,41 @@ class ApprovalStep(BaseModel):
     can_skip = Column(String(10), default="false", comment="Có thể bỏ qua")
     timeout_hours = Column(Integer, default=24, comment="Thời gian timeout (giờ)")
     
+    # SLA: hạn xử lý = assigned_at + timeout_hours; NULL khi bước đã xử lý hoặc hết cấp leo thang
+    due_at = Column(DateTime, nullable=True, comment="Hạn xử lý")
+    escalation_level = Column(Integer, default=0, nullable=False, comment="Số lần đã leo thang")
+    
     # Relationships
     approval = relationship("Approval", back_populates="steps")
-    approver = relationship("User")
\ No newline at end of file
+    approver = relationship("User")
+
+class ApprovalCounter(BaseModel):
+    """Bảng đếm phê duyệt theo ngày tạo và trạng thái (xem ApprovalInboxService)"""
+    __tablename__ = "dem_phe_duyet"
+    __table_args__ = (
+        UniqueConstraint("bucket_date", "status", name="uq_dem_phe_duyet_ngay_trang_thai"),
+    )
+
+    bucket_date = Column(Date, nullable=False, comment="Ngày tạo yêu cầu")
+    status = Column(String(20), nullable=False, comment="Trạng thái hiện tại")
+    count = Column(BigInteger, default=0, nullable=False, comment="Số yêu cầu")
+
+class AutoApprovalRule(BaseModel):
+    """Quy tắc tự động duyệt (được biên dịch và cache trong AutoApprovalService)"""
+    __tablename__ = "quy_tac_tu_duyet"
+
+    name = Column(String(100), unique=True, nullable=False, comment="Tên quy tắc")
+    description = Column(Text, nullable=True, comment="Mô tả")
+    approval_type = Column(String(50), nullable=False, comment="Loại phê duyệt áp dụng")
+    priority = Column(Integer, default=100, nullable=False, comment="Thứ tự đánh giá (nhỏ trước)")
+
+    # Điều kiện: max_amount, min_agent_tenure_days, max_daily_count,
+    # max_daily_amount, allowed_fields (xem AUTO_APPROVAL_CONDITIONS)
+    conditions = Column(JSON, nullable=False, default={}, comment="Điều kiện tự duyệt")
+
+    # Quy tắc duyệt thay nhân viên này nên không vượt quá quyền hạn của họ
+    # (can_approve_agents, can_approve_transactions, max_approval_amount)
+    acting_staff_id = Column(String, ForeignKey("nhan_vien.id"), nullable=False, comment="Nhân viên ủy quyền")
+    version = Column(Integer, nullable=False, default=1, comment="Phiên bản, tăng mỗi lần cập nhật")
+
+    acting_staff = relationship("Staff")
@@ -56,7 +56,8 @@ class AuditLog(BaseModel):
     duration_ms = Column(String(10), nullable=True, comment="Thời gian xử lý (ms)")
     
     # Metadata
-    metadata = Column(JSON, default={}, comment="Thông tin bổ sung")
+    # Thuộc tính metadata bị Declarative API dành riêng; cột trong database vẫn tên "metadata"
+    metadata_ = Column("metadata", JSON, default={}, comment="Thông tin bổ sung")
     
     # Relationships
     user = relationship("User")
\ No newline at end of file
@@ -1,8 +1,8 @@
 """
-Electric Bill and Provider models
+Electric Bill, Bill and Provider models
 """
 
-from sqlalchemy import Column, String, Date, ForeignKey, Text, JSON, Enum
+from sqlalchemy import Column, String, Date, DateTime, Numeric, ForeignKey, Text, JSON, Enum
 from sqlalchemy.orm import relationship
 from .base import BaseModel
 import enum
@@ -92,7 +92,22 @@ class ElectricBill(BaseModel):
     notes = Column(Text, nullable=True, comment="Ghi chú")
     
     # Metadata
-    metadata = Column(JSON, default={}, comment="Thông tin bổ sung")
+    # Thuộc tính metadata bị Declarative API dành riêng; cột trong database vẫn tên "metadata"
+    metadata_ = Column("metadata", JSON, default={}, comment="Thông tin bổ sung")
     
     # Relationships
-    provider = relationship("Provider", back_populates="bills")
\ No newline at end of file
+    provider = relationship("Provider", back_populates="bills")
+
+class Bill(BaseModel):
+    """Bảng hóa đơn của khách hàng (thanh toán qua ví hoặc đại lý thu hộ)"""
+    __tablename__ = "hoa_don"
+    
+    khach_hang_id = Column(String, ForeignKey("khach_the.id"), nullable=False, index=True, comment="Khách hàng")
+    provider_code = Column(String(10), nullable=True, comment="Mã nhà cung cấp")
+    ky_hoa_don = Column(Date, nullable=True, comment="Kỳ hóa đơn")
+    so_tien = Column(Numeric(15, 2), nullable=False, comment="Số tiền")
+    
+    # Trạng thái thanh toán (chua_thanh_toan/da_thanh_toan)
+    trang_thai = Column(String(20), default="chua_thanh_toan", nullable=False, index=True, comment="Trạng thái")
+    thoi_gian_thanh_toan = Column(DateTime, nullable=True, comment="Thời gian thanh toán")
+    phuong_thuc_thanh_toan = Column(String(30), nullable=True, comment="Phương thức thanh toán")
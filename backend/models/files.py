@@ -1,9 +1,9 @@
 """
-File Upload model
+File Record and File Upload models
 """
 
-from sqlalchemy import Column, String, Integer, ForeignKey, Text, JSON, Enum
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Integer, ForeignKey, Text, JSON, Enum, DateTime
+from sqlalchemy.orm import relationship, synonym
 from .base import BaseModel
 import enum
 
@@ -23,6 +23,33 @@ class FileStatus(str, enum.Enum):
     FAILED = "that_bai"
     DELETED = "da_xoa"
 
+class FileRecord(BaseModel):
+    """Bảng tệp tin quản lý qua API /files"""
+    __tablename__ = "tep_tin"
+    
+    # Thông tin tệp tin
+    ten_file = Column(String(255), nullable=False, comment="Tên tệp")
+    ten_file_goc = Column(String(255), nullable=False, comment="Tên tệp gốc")
+    # Khóa trong kho lưu trữ (ab/cd/<sha256>), nhiều bản ghi có thể dùng chung một nội dung
+    duong_dan = Column(String(500), nullable=False, comment="Khóa tệp trong kho lưu trữ")
+    ma_bam = Column(String(64), nullable=True, index=True, comment="SHA-256 nội dung")
+    kho_luu_tru = Column(String(20), default="local", comment="Kho lưu trữ")
+    kich_thuoc = Column(Integer, nullable=False, comment="Kích thước tệp (bytes)")
+    loai_file = Column(String(100), nullable=True, comment="Loại tệp")
+    mo_ta = Column(Text, nullable=True, comment="Mô tả tệp")
+    
+    # Người tạo và trạng thái
+    nguoi_tao_id = Column(String, ForeignKey("nguoi_dung.id"), nullable=False, index=True)
+    trang_thai = Column(String(20), default="hoat_dong", comment="Trạng thái (hoat_dong/da_xoa)")
+    nguoi_xoa_id = Column(String, nullable=True, comment="Người xóa")
+    thoi_gian_xoa = Column(DateTime, nullable=True, comment="Thời gian xóa")
+    
+    # Lượt tải (DownloadCounter ghi dồn)
+    so_lan_tai = Column(Integer, default=0, comment="Số lần tải")
+    lan_tai_cuoi = Column(DateTime, nullable=True, comment="Lần tải cuối")
+    
+    thoi_gian_tao = synonym("created_at")
+
 class FileUpload(BaseModel):
     """Bảng tải lên tệp tin"""
     __tablename__ = "tai_len_tep"
@@ -31,6 +58,9 @@ class FileUpload(BaseModel):
     original_filename = Column(String(255), nullable=False, comment="Tên tệp gốc")
     stored_filename = Column(String(255), nullable=False, comment="Tên tệp lưu trữ")
     file_path = Column(String(500), nullable=False, comment="Đường dẫn tệp")
+    # Khóa trong kho lưu trữ là mã băm nội dung: các tệp giống nhau dùng chung một bản lưu
+    content_hash = Column(String(64), nullable=True, index=True, comment="SHA-256 nội dung")
+    storage_backend = Column(String(20), default="local", comment="Kho lưu trữ")
     file_url = Column(String(500), nullable=True, comment="URL truy cập tệp")
     
     # Thông tin kỹ thuật
@@ -62,7 +92,8 @@ class FileUpload(BaseModel):
     access_permissions = Column(JSON, default=[], comment="Quyền truy cập")
     
     # Metadata
-    metadata = Column(JSON, default={}, comment="Thông tin bổ sung")
+    # Thuộc tính metadata bị Declarative API dành riêng; cột trong database vẫn tên "metadata"
+    metadata_ = Column("metadata", JSON, default={}, comment="Thông tin bổ sung")
     
     # Relationships
     owner = relationship("User")
\ No newline at end of file
@@ -0,0 +1,26 @@
+"""
+Idempotency Key model
+"""
+
+from sqlalchemy import Column, String, Integer, DateTime, JSON, UniqueConstraint
+from .base import BaseModel
+
+class IdempotencyKey(BaseModel):
+    """Bảng khóa idempotency cho các yêu cầu thanh toán"""
+    __tablename__ = "khoa_idempotency"
+    __table_args__ = (
+        UniqueConstraint("user_id", "idempotency_key", name="uq_khoa_idempotency_user_key"),
+    )
+
+    # Khóa do client gửi lên qua header Idempotency-Key
+    idempotency_key = Column(String(100), nullable=False, comment="Giá trị header Idempotency-Key")
+    user_id = Column(String, nullable=False, comment="Người gửi yêu cầu")
+    request_path = Column(String(200), nullable=False, comment="Endpoint được gọi")
+    request_hash = Column(String(64), nullable=False, comment="SHA-256 nội dung yêu cầu")
+
+    # Phản hồi đã lưu để phát lại
+    response_code = Column(Integer, nullable=True, comment="Mã HTTP của phản hồi")
+    response_body = Column(JSON, nullable=True, comment="Nội dung phản hồi")
+
+    # Thời hạn
+    expires_at = Column(DateTime, nullable=False, index=True, comment="Thời điểm hết hạn")
@@ -0,0 +1,35 @@
+"""
+Ledger model - sổ cái kế toán kép (chỉ ghi thêm)
+"""
+
+from sqlalchemy import Column, String, Numeric, Text, Enum, Index
+from .base import BaseModel
+import enum
+
+class LedgerAccountType(str, enum.Enum):
+    AGENT = "dai_ly"
+    CUSTOMER = "khach_the"
+    SYSTEM = "he_thong"
+
+class LedgerEntry(BaseModel):
+    """Bảng bút toán sổ cái"""
+    __tablename__ = "so_cai"
+    __table_args__ = (
+        Index("idx_so_cai_tai_khoan", "account_type", "account_id", "created_at"),
+    )
+
+    # Mỗi sự kiện tài chính là một chứng từ gồm nhiều bút toán có tổng bằng 0
+    journal_id = Column(String(36), nullable=False, index=True, comment="Mã chứng từ")
+    entry_type = Column(String(30), nullable=False, comment="Loại nghiệp vụ (nap_tien, thanh_toan, ...)")
+
+    # Tài khoản ghi sổ
+    account_type = Column(Enum(LedgerAccountType), nullable=False, comment="Loại tài khoản")
+    account_id = Column(String, nullable=False, comment="ID đại lý/khách hàng hoặc mã tài khoản hệ thống")
+
+    # Số tiền: dương = ghi có (tăng số dư), âm = ghi nợ (giảm số dư)
+    amount = Column(Numeric(15, 2), nullable=False, comment="Số tiền bút toán")
+    balance_after = Column(Numeric(15, 2), nullable=True, comment="Số dư tài khoản sau bút toán")
+
+    # Liên kết
+    transaction_id = Column(String, nullable=True, index=True, comment="Giao dịch phát sinh")
+    description = Column(Text, nullable=True, comment="Diễn giải")
@@ -0,0 +1,36 @@
+"""
+Outbox model - sự kiện thay đổi ghi cùng transaction nghiệp vụ
+"""
+
+from sqlalchemy import Column, String, Integer, Text, JSON, Enum, DateTime, Index
+from .base import BaseModel
+import enum
+
+class OutboxStatus(str, enum.Enum):
+    PENDING = "cho_gui"
+    DELIVERED = "da_gui"
+    DEAD = "loi"
+
+class OutboxEvent(BaseModel):
+    """Bảng hộp thư đi (transactional outbox)"""
+    __tablename__ = "hop_thu_di"
+    __table_args__ = (
+        Index("idx_hop_thu_di_cho_gui", "status", "created_at"),
+        Index("idx_hop_thu_di_doi_tuong", "aggregate_type", "aggregate_id", "created_at"),
+    )
+
+    # Đối tượng phát sinh sự kiện; thứ tự giao được giữ theo từng đối tượng
+    aggregate_type = Column(String(30), nullable=False, comment="Loại đối tượng (giao_dich, hoa_don, phe_duyet)")
+    aggregate_id = Column(String, nullable=False, comment="ID đối tượng")
+    event_type = Column(String(50), nullable=False, comment="Loại sự kiện")
+    payload = Column(JSON, default={}, comment="Dữ liệu sự kiện")
+    recipients = Column(JSON, nullable=True, comment="ID người dùng được nhận qua WebSocket (ngoài nhân viên)")
+
+    # Trạng thái giao
+    status = Column(Enum(OutboxStatus), default=OutboxStatus.PENDING, nullable=False, comment="Trạng thái")
+    attempts = Column(Integer, default=0, nullable=False, comment="Số lần giao")
+    next_attempt_at = Column(DateTime, nullable=True, comment="Thời điểm thử lại")
+    locked_until = Column(DateTime, nullable=True, comment="Hết hạn giữ của dispatcher")
+    locked_by = Column(String(50), nullable=True, comment="Dispatcher đang giữ")
+    delivered_at = Column(DateTime, nullable=True, comment="Thời điểm giao thành công")
+    last_error = Column(Text, nullable=True, comment="Lỗi lần giao gần nhất")
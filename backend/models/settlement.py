@@ -0,0 +1,67 @@
+"""
+Settlement models - kỳ quyết toán hoa hồng cuối tháng và điểm khôi phục theo phân vùng
+"""
+
+from sqlalchemy import Column, String, Integer, Text, JSON, Enum, DateTime, Date, Numeric, Index
+from .base import BaseModel
+import enum
+
+class SettlementStatus(str, enum.Enum):
+    PENDING = "cho_xu_ly"
+    RUNNING = "dang_xu_ly"
+    COMPLETED = "hoan_thanh"
+    FAILED = "loi"
+
+class SettlementRun(BaseModel):
+    """Bảng kỳ quyết toán (mỗi tháng một dòng)"""
+    __tablename__ = "ky_quyet_toan"
+
+    period = Column(Date, unique=True, nullable=False, comment="Tháng quyết toán (ngày đầu tháng)")
+    status = Column(Enum(SettlementStatus), default=SettlementStatus.PENDING, nullable=False, comment="Trạng thái")
+    partitions = Column(Integer, nullable=False, comment="Số phân vùng đại lý")
+    ruleset = Column(String(50), nullable=True, comment="Bộ quy tắc hoa hồng")
+
+    started_at = Column(DateTime, nullable=True, comment="Bắt đầu lần chạy gần nhất")
+    finished_at = Column(DateTime, nullable=True, comment="Thời gian hoàn thành")
+    attempts = Column(Integer, default=0, nullable=False, comment="Số lần chạy (kể cả chạy lại)")
+
+    # Tổng hợp sau khi mọi phân vùng hoàn thành
+    total_agents = Column(Integer, default=0, nullable=False, comment="Số đại lý được quyết toán")
+    total_transactions = Column(Integer, default=0, nullable=False, comment="Số giao dịch tính hoa hồng")
+    total_commission = Column(Numeric(18, 2), default=0, nullable=False, comment="Tổng hoa hồng chi trả")
+    timings = Column(JSON, default={}, comment="Thời gian từng giai đoạn (giây)")
+
+class SettlementPartition(BaseModel):
+    """Bảng phân vùng quyết toán; last_agent_id là điểm khôi phục sau mỗi khối đại lý"""
+    __tablename__ = "quyet_toan_phan_vung"
+    __table_args__ = (
+        Index("idx_quyet_toan_phan_vung_ky", "run_id", "partition_no", unique=True),
+    )
+
+    run_id = Column(String, nullable=False, comment="Kỳ quyết toán")
+    partition_no = Column(Integer, nullable=False, comment="Số thứ tự phân vùng")
+    status = Column(Enum(SettlementStatus), default=SettlementStatus.PENDING, nullable=False, comment="Trạng thái")
+
+    # Điểm khôi phục: đại lý đã xử lý xong gần nhất (theo thứ tự id)
+    last_agent_id = Column(String, nullable=True, comment="Đại lý cuối cùng đã quyết toán")
+    processed_agents = Column(Integer, default=0, nullable=False, comment="Số đại lý đã quyết toán")
+    total_transactions = Column(Integer, default=0, nullable=False, comment="Số giao dịch tính hoa hồng")
+    total_commission = Column(Numeric(18, 2), default=0, nullable=False, comment="Tổng hoa hồng")
+
+    timings = Column(JSON, default={}, comment="Thời gian từng giai đoạn (giây)")
+    error = Column(Text, nullable=True, comment="Lỗi lần chạy gần nhất")
+    finished_at = Column(DateTime, nullable=True, comment="Thời gian hoàn thành")
+
+class SettlementAgent(BaseModel):
+    """Bảng kết quả quyết toán theo đại lý, ghi cùng transaction với điểm khôi phục"""
+    __tablename__ = "quyet_toan_dai_ly"
+    __table_args__ = (
+        Index("idx_quyet_toan_dai_ly_ky", "run_id", "agent_id", unique=True),
+    )
+
+    run_id = Column(String, nullable=False, comment="Kỳ quyết toán")
+    agent_id = Column(String, nullable=False, comment="Đại lý")
+    partition_no = Column(Integer, nullable=False, comment="Phân vùng")
+    transactions = Column(Integer, default=0, nullable=False, comment="Số giao dịch tính hoa hồng")
+    volume = Column(Numeric(18, 2), default=0, nullable=False, comment="Doanh số trong kỳ")
+    commission = Column(Numeric(18, 2), default=0, nullable=False, comment="Hoa hồng chi trả")
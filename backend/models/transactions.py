@@ -2,7 +2,7 @@
 Transaction and Commission models
 """
 
-from sqlalchemy import Column, String, ForeignKey, Text, JSON, Enum
+from sqlalchemy import Column, String, ForeignKey, Text, JSON, Enum, Integer, Boolean
 from sqlalchemy.orm import relationship
 from .base import BaseModel
 import enum
@@ -71,7 +71,8 @@ class Transaction(BaseModel):
     completed_at = Column(String(50), nullable=True, comment="Thời gian hoàn thành")
     
     # Thông tin bổ sung
-    metadata = Column(JSON, default={}, comment="Thông tin bổ sung")
+    # Thuộc tính metadata bị Declarative API dành riêng; cột trong database vẫn tên "metadata"
+    metadata_ = Column("metadata", JSON, default={}, comment="Thông tin bổ sung")
     
     # Relationships
     user = relationship("User")
@@ -103,4 +104,17 @@ class Commission(BaseModel):
     
     # Relationships
     transaction = relationship("Transaction", back_populates="commissions")
-    recipient = relationship("User")
\ No newline at end of file
+    recipient = relationship("User")
+
+class CommissionRuleSet(BaseModel):
+    """Bộ quy tắc tính hoa hồng (được biên dịch và cache trong CommissionService)"""
+    __tablename__ = "bo_quy_tac_hoa_hong"
+    
+    name = Column(String(50), unique=True, nullable=False, comment="Tên bộ quy tắc")
+    description = Column(Text, nullable=True, comment="Mô tả")
+    
+    # Quy tắc: tỷ lệ mặc định, theo cấp đại lý, bậc số tiền, nhà cung cấp,
+    # loại giao dịch, thưởng theo doanh số tháng, mức tối thiểu/tối đa
+    rules = Column(JSON, nullable=False, default={}, comment="Nội dung quy tắc")
+    version = Column(Integer, nullable=False, default=1, comment="Phiên bản, tăng mỗi lần cập nhật")
+    is_default = Column(Boolean, nullable=False, default=False, comment="Bộ quy tắc mặc định")
@@ -2,7 +2,7 @@
 User and Staff models
 """
 
-from sqlalchemy import Column, String, Enum, Text, JSON, ForeignKey
+from sqlalchemy import Column, String, Enum, Text, JSON, ForeignKey, Integer, DateTime
 from sqlalchemy.orm import relationship
 from .base import BaseModel
 import enum
@@ -32,9 +32,12 @@ class User(BaseModel):
     id_issued_place = Column(String(100), nullable=True, comment="Nơi cấp CMND/CCCD")
     
     # Metadata và cài đặt
-    metadata = Column(JSON, default={}, comment="Thông tin bổ sung")
+    # Thuộc tính metadata bị Declarative API dành riêng; cột trong database vẫn tên "metadata"
+    metadata_ = Column("metadata", JSON, default={}, comment="Thông tin bổ sung")
     settings = Column(JSON, default={}, comment="Cài đặt cá nhân")
     last_login = Column(String(50), nullable=True, comment="Lần đăng nhập cuối")
+    # Ghi vào token (claim sv); tăng khi đổi vai trò, vô hiệu hóa hoặc đăng xuất mọi phiên để token cũ hết hiệu lực
+    security_version = Column(Integer, nullable=False, default=1, comment="Phiên bản bảo mật")
     
     # Relationships
     staff = relationship("Staff", back_populates="user", uselist=False)
@@ -63,4 +66,12 @@ class Staff(BaseModel):
     # Relationships
     user = relationship("User", back_populates="staff")
     manager = relationship("Staff", remote_side=[BaseModel.id])
-    subordinates = relationship("Staff", back_populates="manager")
\ No newline at end of file
+    subordinates = relationship("Staff", back_populates="manager")
+
+class RevokedToken(BaseModel):
+    """Token bị thu hồi trước hạn (đăng xuất); dòng hết hạn được dọn định kỳ"""
+    __tablename__ = "token_thu_hoi"
+
+    jti = Column(String(64), unique=True, nullable=False, index=True, comment="Mã token")
+    user_id = Column(String, ForeignKey("nguoi_dung.id"), nullable=False, comment="Người dùng")
+    expires_at = Column(DateTime, nullable=False, index=True, comment="Thời điểm token hết hạn")
@@ -0,0 +1,18 @@
+"""
+Resource version model - bộ đếm phiên bản danh sách theo chủ sở hữu, dùng làm ETag
+"""
+
+from sqlalchemy import Column, String, BigInteger, UniqueConstraint
+from .base import BaseModel
+
+class ResourceVersion(BaseModel):
+    """Bảng phiên bản tài nguyên; tăng trong cùng transaction với mỗi thay đổi"""
+    __tablename__ = "phien_ban_tai_nguyen"
+    __table_args__ = (
+        UniqueConstraint("scope", "owner_id", name="uq_phien_ban_tai_nguyen_scope_owner"),
+    )
+
+    # Ví dụ: scope "khach_hang.hoa_don" + owner_id là ID khách hàng
+    scope = Column(String(50), nullable=False, comment="Loại danh sách")
+    owner_id = Column(String, nullable=False, comment="Chủ sở hữu danh sách")
+    version = Column(BigInteger, default=0, nullable=False, comment="Số lần danh sách thay đổi")
@@ -10,6 +10,7 @@ from .bills import router as bill_router
 from .transactions import router as transaction_router
 from .approvals import router as approval_router
 from .files import router as file_router
+from .events import router as events_router
 
 __all__ = [
     "auth_router",
@@ -19,5 +20,6 @@ __all__ = [
     "bill_router",
     "transaction_router",
     "approval_router",
-    "file_router"
+    "file_router",
+    "events_router"
 ]
\ No newline at end of file
@@ -15,9 +15,15 @@ from ..models.agents import Agent
 from ..models.customers import Customer
 from ..models.transactions import Transaction
 from ..models.bills import Bill
-from ..models.audit import AuditLog
-from ..auth.dependencies import get_current_admin_user
-from ..auth.password import get_password_hash
+from ..models.audit import AuditLog, AuditAction
+from ..models.approvals import AutoApprovalRule
+from ..auth.dependencies import get_current_admin_user, require_role
+from ..auth.password import hash_password_async, get_password_hasher
+from ..auth.token_state import bump_security_version, get_token_state
+from ..services.ledger_service import LedgerService
+from ..services.partition_service import created_range
+from ..services.agent_aggregate_service import AgentAggregateService, GROUP_DIMENSIONS
+from ..services.auto_approval_service import AutoApprovalService, AUTO_APPROVAL_CONDITIONS
 
 router = APIRouter()
 
@@ -39,6 +45,14 @@ class UserCreate(BaseModel):
     vai_tro: str
     mat_khau: str
 
+class AutoApprovalRuleSave(BaseModel):
+    ten: str
+    loai_duyet: str
+    dieu_kien: Dict[str, Any]
+    nhan_vien_uy_quyen_id: str
+    uu_tien: int = 100
+    mo_ta: Optional[str] = None
+
 class UserUpdate(BaseModel):
     email: Optional[str] = None
     ho_ten: Optional[str] = None
@@ -61,11 +75,11 @@ async def get_admin_stats(
             total_transactions=db.query(Transaction).count(),
             total_bills=db.query(Bill).count(),
             today_transactions=db.query(Transaction).filter(
-                func.date(Transaction.thoi_gian_tao) == today
+                *created_range(Transaction.created_at, today, today)
             ).count(),
             today_revenue=db.query(func.sum(Transaction.so_tien)).filter(
                 and_(
-                    func.date(Transaction.thoi_gian_tao) == today,
+                    *created_range(Transaction.created_at, today, today),
                     Transaction.trang_thai == 'thanh_cong'
                 )
             ).scalar() or 0.0
@@ -147,7 +161,7 @@ async def create_user(
             ho_ten=user_data.ho_ten,
             so_dien_thoai=user_data.so_dien_thoai,
             vai_tro=user_data.vai_tro,
-            mat_khau_hash=get_password_hash(user_data.mat_khau),
+            mat_khau_hash=await hash_password_async(user_data.mat_khau),
             trang_thai='hoat_dong'
         )
         
@@ -186,6 +200,10 @@ async def update_user(
         for field, value in update_data.items():
             setattr(user, field, value)
         
+        # Đổi trạng thái (khóa/mở khóa) làm token đang dùng hết hiệu lực trong vài giây
+        if "trang_thai" in update_data:
+            bump_security_version(db, user.id)
+        
         db.commit()
         db.refresh(user)
         
@@ -217,6 +235,7 @@ async def delete_user(
         # Soft delete
         user.trang_thai = 'da_xoa'
         user.thoi_gian_cap_nhat = datetime.utcnow()
+        bump_security_version(db, user.id)
         
         db.commit()
         
@@ -294,7 +313,7 @@ async def get_system_health(
         failed_transactions = db.query(func.count(Transaction.id)).filter(
             and_(
                 Transaction.trang_thai == 'that_bai',
-                func.date(Transaction.thoi_gian_tao) == date.today()
+                *created_range(Transaction.created_at, date.today(), date.today())
             )
         ).scalar() or 0
         
@@ -302,10 +321,227 @@ async def get_system_health(
             "database": db_status,
             "pending_approvals": pending_approvals,
             "failed_transactions_today": failed_transactions,
+            "password_hasher": get_password_hasher().snapshot(),
+            "token_state": get_token_state().snapshot() if get_token_state() is not None else None,
             "timestamp": datetime.utcnow()
         }
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi kiểm tra tình trạng hệ thống: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+@router.get("/ledger/reconcile")
+async def reconcile_ledger(
+    current_user: User = Depends(get_current_admin_user),
+    db: Session = Depends(get_db)
+):
+    """Đối soát sổ cái với số dư ví"""
+    try:
+        return LedgerService.reconcile(db)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi đối soát sổ cái: {str(e)}"
+        )
+
+@router.post("/ledger/opening-balances")
+async def backfill_ledger_opening_balances(
+    current_user: User = Depends(get_current_admin_user),
+    db: Session = Depends(get_db)
+):
+    """Ghi số dư đầu kỳ vào sổ cái cho các ví đã có số dư"""
+    try:
+        created = LedgerService.backfill_opening_balances(db)
+        return {"message": f"Đã ghi số dư đầu kỳ cho {created} tài khoản"}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi ghi số dư đầu kỳ: {str(e)}"
+        )
+
+@router.get("/aggregates/{dimension}")
+async def get_agent_aggregates(
+    dimension: str,
+    sort_by: str = Query("sales", regex="^(customers|transactions|sales|commission|pending_bills)$"),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(require_role(["admin", "quan_ly"])),
+    db: Session = Depends(get_db)
+):
+    """Tổng hợp đại lý theo khu vực (khu_vuc), nhân viên phụ trách (nhan_vien) hoặc tỉnh thành (tinh_thanh)"""
+    if dimension not in GROUP_DIMENSIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"dimension phải là một trong {', '.join(GROUP_DIMENSIONS)}"
+        )
+    try:
+        return {
+            "dimension": dimension,
+            "groups": AgentAggregateService.groups(db, dimension, sort_by, limit)
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi lấy số liệu tổng hợp: {str(e)}"
+        )
+
+@router.get("/aggregates/{dimension}/{key}")
+async def get_agent_aggregate_detail(
+    dimension: str,
+    key: str,
+    top_agents: int = Query(20, ge=1, le=200),
+    current_user: User = Depends(require_role(["admin", "quan_ly"])),
+    db: Session = Depends(get_db)
+):
+    """Tổng hợp một nhóm và các đại lý có doanh số cao nhất trong nhóm"""
+    if dimension not in GROUP_DIMENSIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"dimension phải là một trong {', '.join(GROUP_DIMENSIONS)}"
+        )
+    try:
+        return AgentAggregateService.group_detail(db, dimension, key, top_agents)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi lấy số liệu tổng hợp: {str(e)}"
+        )
+
+@router.post("/aggregates/rebuild")
+async def rebuild_agent_aggregates(
+    current_user: User = Depends(get_current_admin_user),
+    db: Session = Depends(get_db)
+):
+    """Tính lại bảng tổng hợp đại lý từ dữ liệu gốc (khởi tạo hoặc sửa sai lệch)"""
+    try:
+        result = AgentAggregateService.rebuild(db)
+        return {"message": f"Đã tổng hợp lại {result['agents']} đại lý ({result['rows']} dòng)", **result}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi tổng hợp lại số liệu: {str(e)}"
+        )
+
+def _rule_audit_values(current_user: User, action: AuditAction, rule: AutoApprovalRule,
+                       old_values: Optional[Dict[str, Any]], new_values: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Nhật ký kiểm toán khi quy tắc tự duyệt thay đổi"""
+    return {
+        "user_id": current_user.id,
+        "user_name": current_user.ho_ten,
+        "user_role": current_user.vai_tro,
+        "action": action,
+        "action_description": "Cấu hình quy tắc tự duyệt",
+        "target_type": "quy_tac_tu_duyet",
+        "target_id": str(rule.id),
+        "target_name": rule.name,
+        "old_values": old_values,
+        "new_values": new_values,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+@router.get("/auto-approval/rules")
+async def get_auto_approval_rules(
+    current_user: User = Depends(require_role(["admin", "quan_ly"])),
+    db: Session = Depends(get_db)
+):
+    """Danh sách quy tắc tự duyệt đang hoạt động và các điều kiện được hỗ trợ"""
+    try:
+        rules = db.query(AutoApprovalRule).filter(
+            AutoApprovalRule.is_active == True,
+            AutoApprovalRule.deleted_at.is_(None)
+        ).order_by(AutoApprovalRule.approval_type, AutoApprovalRule.priority, AutoApprovalRule.name).all()
+        compiled = {
+            rule.rule_id for rules_of_type in AutoApprovalService.get_rules(db).values() for rule in rules_of_type
+        }
+        return {
+            "conditions": list(AUTO_APPROVAL_CONDITIONS),
+            "rules": [
+                {**AutoApprovalService.rule_values(rule), "compiled": str(rule.id) in compiled}
+                for rule in rules
+            ]
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi lấy quy tắc tự duyệt: {str(e)}"
+        )
+
+@router.put("/auto-approval/rules")
+async def save_auto_approval_rule(
+    rule_data: AutoApprovalRuleSave,
+    current_user: User = Depends(get_current_admin_user),
+    db: Session = Depends(get_db)
+):
+    """Tạo hoặc cập nhật quy tắc tự duyệt theo tên (phiên bản tăng mỗi lần cập nhật)"""
+    try:
+        rule, old_values = AutoApprovalService.save_rule(
+            db,
+            rule_data.ten,
+            rule_data.loai_duyet,
+            rule_data.dieu_kien,
+            rule_data.nhan_vien_uy_quyen_id,
+            priority=rule_data.uu_tien,
+            description=rule_data.mo_ta
+        )
+        db.flush()
+        db.add(AuditLog(**_rule_audit_values(
+            current_user,
+            AuditAction.UPDATE if old_values else AuditAction.CREATE,
+            rule, old_values, AutoApprovalService.rule_values(rule)
+        )))
+        db.commit()
+        AutoApprovalService.invalidate_rules()
+        
+        return {
+            "message": f"Đã lưu quy tắc {rule.name} (phiên bản {rule.version})",
+            "rule_id": rule.id,
+            "version": rule.version
+        }
+    except (ValueError, ArithmeticError) as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Quy tắc không hợp lệ: {str(e)}"
+        )
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi lưu quy tắc tự duyệt: {str(e)}"
+        )
+
+@router.delete("/auto-approval/rules/{rule_id}")
+async def delete_auto_approval_rule(
+    rule_id: str,
+    current_user: User = Depends(get_current_admin_user),
+    db: Session = Depends(get_db)
+):
+    """Tắt quy tắc tự duyệt (xóa mềm)"""
+    try:
+        rule = db.query(AutoApprovalRule).filter(
+            AutoApprovalRule.id == rule_id,
+            AutoApprovalRule.deleted_at.is_(None)
+        ).with_for_update().first()
+        if not rule:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Không tìm thấy quy tắc tự duyệt"
+            )
+        
+        old_values = AutoApprovalService.rule_values(rule)
+        rule.soft_delete()
+        db.add(AuditLog(**_rule_audit_values(current_user, AuditAction.DELETE, rule, old_values, None)))
+        db.commit()
+        AutoApprovalService.invalidate_rules()
+        
+        return {"message": f"Đã tắt quy tắc {rule.name}"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi xóa quy tắc tự duyệt: {str(e)}"
+        )
@@ -3,7 +3,8 @@ Agent API endpoints for 7tỷ.vn system
 """
 
 from typing import List, Optional, Dict, Any
-from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func
 from pydantic import BaseModel
@@ -16,7 +17,15 @@ from ..models.agents import Agent
 from ..models.customers import Customer
 from ..models.transactions import Transaction
 from ..models.bills import Bill
-from ..auth.dependencies import get_current_agent_user
+from ..auth.dependencies import get_current_agent_user, get_current_agent_principal
+from ..auth.principal import Principal
+from ..services.ledger_service import LedgerService
+from ..services.partition_service import created_range
+from ..services.dashboard_service import AgentDashboardService
+from ..services.commission_report_service import CommissionReportService
+from ..services.resource_version_service import ResourceVersionService, AGENT_TRANSACTIONS
+from ..services.agent_aggregate_service import AgentAggregateService, DIMENSION_PROVINCE
+from ..services.outbox_service import OutboxService
 
 router = APIRouter()
 
@@ -60,7 +69,7 @@ async def get_agent_profile(
             )
         
         return {
-            "user_info": current_user,
+            "user_info": current_user.load(),
             "agent_info": agent
         }
     except HTTPException:
@@ -90,6 +99,9 @@ async def update_agent_profile(
         current_user.ho_ten = profile_data.ho_ten
         current_user.so_dien_thoai = profile_data.so_dien_thoai
         
+        # Đổi tỉnh thành: chuyển số liệu tổng hợp của đại lý sang nhóm mới
+        AgentAggregateService.move_agent(db, agent.id, DIMENSION_PROVINCE, profile_data.tinh_thanh)
+        
         # Cập nhật thông tin agent
         agent.dia_chi = profile_data.dia_chi
         agent.tinh_thanh = profile_data.tinh_thanh
@@ -109,12 +121,13 @@ async def update_agent_profile(
             detail=f"Lỗi cập nhật hồ sơ: {str(e)}"
         )
 
-@router.get("/stats", response_model=AgentStats)
-async def get_agent_stats(
+@router.get("/dashboard")
+async def get_agent_dashboard(
+    transactions_limit: int = Query(10, ge=1, le=50),
     current_user: User = Depends(get_current_agent_user),
     db: Session = Depends(get_db)
 ):
-    """Lấy thống kê của đại lý"""
+    """Dữ liệu khởi động PWA (hồ sơ, thống kê, ví, giao dịch gần đây) trong một lần gọi"""
     try:
         agent = db.query(Agent).filter(Agent.nguoi_dung_id == current_user.id).first()
         if not agent:
@@ -123,18 +136,36 @@ async def get_agent_stats(
                 detail="Không tìm thấy thông tin đại lý"
             )
         
+        return await AgentDashboardService.build(current_user, agent, transactions_limit)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi lấy dashboard: {str(e)}"
+        )
+
+@router.get("/stats", response_model=AgentStats)
+async def get_agent_stats(
+    principal: Principal = Depends(get_current_agent_principal),
+    db: Session = Depends(get_db)
+):
+    """Lấy thống kê của đại lý"""
+    try:
+        agent_id = principal.agent_id
+        
         # Thống kê khách hàng
-        total_customers = db.query(Customer).filter(Customer.dai_ly_id == agent.id).count()
+        total_customers = db.query(Customer).filter(Customer.dai_ly_id == agent_id).count()
         
         # Thống kê giao dịch
         total_transactions = db.query(Transaction).filter(
-            Transaction.dai_ly_id == agent.id
+            Transaction.dai_ly_id == agent_id
         ).count()
         
         # Tổng hoa hồng
         total_commission = db.query(func.sum(Transaction.hoa_hong)).filter(
             and_(
-                Transaction.dai_ly_id == agent.id,
+                Transaction.dai_ly_id == agent_id,
                 Transaction.trang_thai == 'thanh_cong'
             )
         ).scalar() or Decimal('0')
@@ -143,16 +174,16 @@ async def get_agent_stats(
         current_month = datetime.now().replace(day=1)
         monthly_revenue = db.query(func.sum(Transaction.so_tien)).filter(
             and_(
-                Transaction.dai_ly_id == agent.id,
+                Transaction.dai_ly_id == agent_id,
                 Transaction.trang_thai == 'thanh_cong',
-                Transaction.thoi_gian_tao >= current_month
+                Transaction.created_at >= current_month
             )
         ).scalar() or Decimal('0')
         
         # Hóa đơn chờ xử lý
         pending_bills = db.query(Bill).join(Customer).filter(
             and_(
-                Customer.dai_ly_id == agent.id,
+                Customer.dai_ly_id == agent_id,
                 Bill.trang_thai == 'chua_thanh_toan'
             )
         ).count()
@@ -177,19 +208,14 @@ async def get_agent_customers(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     search: Optional[str] = Query(None),
-    current_user: User = Depends(get_current_agent_user),
+    principal: Principal = Depends(get_current_agent_principal),
     db: Session = Depends(get_db)
 ):
     """Lấy danh sách khách hàng của đại lý"""
     try:
-        agent = db.query(Agent).filter(Agent.nguoi_dung_id == current_user.id).first()
-        if not agent:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Không tìm thấy thông tin đại lý"
-            )
+        agent_id = principal.agent_id
         
-        query = db.query(Customer).filter(Customer.dai_ly_id == agent.id)
+        query = db.query(Customer).filter(Customer.dai_ly_id == agent_id)
         
         if search:
             query = query.filter(
@@ -259,8 +285,14 @@ async def register_customer(
         )
         
         db.add(new_customer)
+        db.flush()
+        OutboxService.record(
+            db, "khach_hang", new_customer.id, "khach_hang.tao_moi",
+            {"id": new_customer.id, "dai_ly_id": agent.id}
+        )
         db.commit()
         db.refresh(new_customer)
+        AgentDashboardService.invalidate(agent.id, ["stats"])
         
         return {
             "message": "Đăng ký khách hàng thành công",
@@ -277,36 +309,33 @@ async def register_customer(
 
 @router.get("/transactions")
 async def get_agent_transactions(
+    request: Request,
+    response: Response,
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
     status: Optional[str] = Query(None),
-    current_user: User = Depends(get_current_agent_user),
+    principal: Principal = Depends(get_current_agent_principal),
     db: Session = Depends(get_db)
 ):
-    """Lấy danh sách giao dịch của đại lý"""
+    """Lấy danh sách giao dịch của đại lý (hỗ trợ If-None-Match)"""
     try:
-        agent = db.query(Agent).filter(Agent.nguoi_dung_id == current_user.id).first()
-        if not agent:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Không tìm thấy thông tin đại lý"
-            )
+        agent_id = principal.agent_id
         
-        query = db.query(Transaction).filter(Transaction.dai_ly_id == agent.id)
+        not_modified = ResourceVersionService.conditional(db, AGENT_TRANSACTIONS, agent_id, request, response)
+        if not_modified is not None:
+            return not_modified
         
-        if from_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) >= from_date)
+        query = db.query(Transaction).filter(Transaction.dai_ly_id == agent_id)
         
-        if to_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) <= to_date)
+        query = query.filter(*created_range(Transaction.created_at, from_date, to_date))
         
         if status:
             query = query.filter(Transaction.trang_thai == status)
         
         total = query.count()
-        transactions = query.order_by(Transaction.thoi_gian_tao.desc()).offset(skip).limit(limit).all()
+        transactions = query.order_by(Transaction.created_at.desc()).offset(skip).limit(limit).all()
         
         return {
             "total": total,
@@ -324,51 +353,32 @@ async def get_agent_transactions(
 
 @router.get("/wallet")
 async def get_wallet_info(
-    current_user: User = Depends(get_current_agent_user),
+    principal: Principal = Depends(get_current_agent_principal),
     db: Session = Depends(get_db)
 ):
     """Lấy thông tin ví của đại lý"""
     try:
-        agent = db.query(Agent).filter(Agent.nguoi_dung_id == current_user.id).first()
-        if not agent:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Không tìm thấy thông tin đại lý"
-            )
-        
-        # Tính toán số dư hiện tại
-        total_income = db.query(func.sum(Transaction.hoa_hong)).filter(
-            and_(
-                Transaction.dai_ly_id == agent.id,
-                Transaction.trang_thai == 'thanh_cong',
-                Transaction.loai_giao_dich.in_(['hoa_hong', 'nap_tien'])
-            )
-        ).scalar() or Decimal('0')
-        
-        total_expense = db.query(func.sum(Transaction.so_tien)).filter(
-            and_(
-                Transaction.dai_ly_id == agent.id,
-                Transaction.trang_thai == 'thanh_cong',
-                Transaction.loai_giao_dich.in_(['rut_tien', 'thanh_toan'])
-            )
-        ).scalar() or Decimal('0')
-        
-        current_balance = total_income - total_expense
-        
-        # Cập nhật số dư trong database
-        agent.so_du_hien_tai = current_balance
-        db.commit()
+        agent_id = principal.agent_id
+        
+        # Số dư được duy trì cùng sổ cái, chỉ cần đọc một dòng ví
+        wallet = LedgerService.get_agent_wallet(db, agent_id)
+        if not wallet:
+            return {
+                "current_balance": Decimal('0'),
+                "total_income": Decimal('0'),
+                "total_expense": Decimal('0'),
+                "last_updated": None
+            }
         
         return {
-            "current_balance": current_balance,
-            "total_income": total_income,
-            "total_expense": total_expense,
-            "last_updated": datetime.utcnow()
+            "current_balance": wallet.balance,
+            "total_income": wallet.total_deposits + wallet.total_commissions,
+            "total_expense": wallet.total_withdrawals,
+            "last_updated": wallet.updated_at
         }
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi lấy thông tin ví: {str(e)}"
@@ -378,48 +388,52 @@ async def get_wallet_info(
 async def get_commission_report(
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
-    current_user: User = Depends(get_current_agent_user),
+    group_by: str = Query("day", regex="^(day|week|month)$"),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None),
+    principal: Principal = Depends(get_current_agent_principal),
     db: Session = Depends(get_db)
 ):
-    """Lấy báo cáo hoa hồng"""
+    """
+    Lấy báo cáo hoa hồng: tổng hợp theo kỳ và loại giao dịch (trang đầu)
+    cùng danh sách giao dịch phân trang bằng cursor
+    """
     try:
-        agent = db.query(Agent).filter(Agent.nguoi_dung_id == current_user.id).first()
-        if not agent:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Không tìm thấy thông tin đại lý"
-            )
-        
-        query = db.query(Transaction).filter(
-            and_(
-                Transaction.dai_ly_id == agent.id,
-                Transaction.trang_thai == 'thanh_cong',
-                Transaction.hoa_hong > 0
-            )
-        )
-        
-        if from_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) >= from_date)
-        
-        if to_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) <= to_date)
+        agent_id = principal.agent_id
         
-        transactions = query.order_by(Transaction.thoi_gian_tao.desc()).all()
-        
-        total_commission = sum(t.hoa_hong for t in transactions)
-        total_transactions = len(transactions)
+        # Trang tiếp theo chỉ cần chi tiết, không tính lại tổng hợp
+        report = {} if cursor else CommissionReportService.summary(db, agent_id, from_date, to_date, group_by)
+        page = CommissionReportService.transactions_page(db, agent_id, from_date, to_date, limit, cursor)
         
         return {
-            "total_commission": total_commission,
-            "total_transactions": total_transactions,
-            "transactions": transactions,
+            **report,
+            **page,
             "from_date": from_date,
             "to_date": to_date
         }
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi lấy báo cáo hoa hồng: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+@router.get("/commission-report/export")
+async def export_commission_report(
+    from_date: Optional[date] = Query(None),
+    to_date: Optional[date] = Query(None),
+    principal: Principal = Depends(get_current_agent_principal)
+):
+    """Xuất toàn bộ giao dịch hoa hồng trong kỳ ra CSV (truyền theo luồng)"""
+    filename = f"hoa_hong_{from_date or 'dau'}_{to_date or 'nay'}.csv"
+    return StreamingResponse(
+        CommissionReportService.stream_csv(principal.agent_id, from_date, to_date),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
\ No newline at end of file
@@ -2,23 +2,33 @@
 Approval API endpoints for 7tỷ.vn system
 """
 
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set, Tuple
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from datetime import datetime, date
 from decimal import Decimal
 
 from ..database import get_db
 from ..models.users import User
-from ..models.approvals import Approval
+from ..models.approvals import Approval, StepStatus
 from ..models.transactions import Transaction
 from ..models.agents import Agent
-from ..auth.dependencies import get_current_user
+from ..models.audit import AuditLog
+from ..auth.dependencies import get_current_active_user
+from ..services.ledger_service import LedgerService, InsufficientFundsError
+from ..services.outbox_service import OutboxService
+from ..services.approval_inbox_service import ApprovalInboxService
+from ..services.approval_sla_service import ApprovalSlaService
+from ..services.auto_approval_service import AutoApprovalService
+from ..services.partition_service import created_range
 
 router = APIRouter()
 
+# Giới hạn số yêu cầu cho mỗi lần duyệt/từ chối hàng loạt
+MAX_BULK_APPROVALS = 200
+
 # Pydantic models
 class ApprovalCreate(BaseModel):
     loai_duyet: str
@@ -31,15 +41,41 @@ class ApprovalUpdate(BaseModel):
     trang_thai: str
     ghi_chu_duyet: Optional[str] = None
 
+class BulkApprovalAction(BaseModel):
+    approval_ids: List[str]
+    note: Optional[str] = None
+    
+    @validator('approval_ids')
+    def validate_ids(cls, v):
+        if not v:
+            raise ValueError('Danh sách yêu cầu không được để trống')
+        if len(v) > MAX_BULK_APPROVALS:
+            raise ValueError(f'Chỉ được xử lý tối đa {MAX_BULK_APPROVALS} yêu cầu mỗi lần')
+        return v
+
+class BulkApprovalReject(BulkApprovalAction):
+    reason: str
+
 class ApprovalStats(BaseModel):
     total_pending: int
     total_approved: int
     total_rejected: int
     today_pending: int
 
+def _approval_snapshot(approval: Approval) -> Dict[str, Any]:
+    """Dữ liệu phê duyệt gửi kèm sự kiện"""
+    return {
+        "id": approval.id,
+        "loai_duyet": approval.loai_duyet,
+        "doi_tuong_id": approval.doi_tuong_id,
+        "trang_thai": approval.trang_thai,
+        "nguoi_gui_id": approval.nguoi_gui_id,
+        "nguoi_duyet_id": approval.nguoi_duyet_id
+    }
+
 @router.get("/stats", response_model=ApprovalStats)
 async def get_approval_stats(
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy thống kê phê duyệt"""
@@ -50,21 +86,8 @@ async def get_approval_stats(
                 detail="Không có quyền xem thống kê phê duyệt"
             )
         
-        today = date.today()
-        
-        stats = ApprovalStats(
-            total_pending=db.query(Approval).filter(Approval.trang_thai == 'cho_duyet').count(),
-            total_approved=db.query(Approval).filter(Approval.trang_thai == 'da_duyet').count(),
-            total_rejected=db.query(Approval).filter(Approval.trang_thai == 'tu_choi').count(),
-            today_pending=db.query(Approval).filter(
-                and_(
-                    Approval.trang_thai == 'cho_duyet',
-                    func.date(Approval.thoi_gian_tao) == today
-                )
-            ).count()
-        )
-        
-        return stats
+        # Một truy vấn GROUP BY trên bảng đếm, không quét phe_duyet
+        return ApprovalStats(**ApprovalInboxService.stats(db))
     except HTTPException:
         raise
     except Exception as e:
@@ -75,20 +98,21 @@ async def get_approval_stats(
 
 @router.get("/")
 async def get_approvals(
-    skip: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=1000),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor của trang trước"),
     status: Optional[str] = Query(None),
     approval_type: Optional[str] = Query(None),
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Lấy danh sách phê duyệt"""
+    """Lấy danh sách phê duyệt (phân trang keyset theo trạng thái, thời gian tạo)"""
     try:
         if current_user.vai_tro not in ['admin', 'quan_ly']:
+            # Tham số truy vấn "status" che module fastapi.status trong hàm này
             raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
+                status_code=403,
                 detail="Không có quyền xem danh sách phê duyệt"
             )
         
@@ -100,33 +124,77 @@ async def get_approvals(
         if approval_type:
             query = query.filter(Approval.loai_duyet == approval_type)
         
-        if from_date:
-            query = query.filter(func.date(Approval.thoi_gian_tao) >= from_date)
+        query = query.filter(*created_range(Approval.thoi_gian_tao, from_date, to_date))
         
-        if to_date:
-            query = query.filter(func.date(Approval.thoi_gian_tao) <= to_date)
+        return ApprovalInboxService.page(query, limit, cursor)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Lỗi lấy danh sách phê duyệt: {str(e)}"
+        )
+
+@router.get("/my-requests")
+async def get_my_approval_requests(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor của trang trước"),
+    status: Optional[str] = Query(None),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Lấy danh sách yêu cầu phê duyệt của tôi (phân trang keyset)"""
+    try:
+        query = db.query(Approval).filter(Approval.nguoi_gui_id == current_user.id)
         
-        total = query.count()
-        approvals = query.order_by(Approval.thoi_gian_tao.desc()).offset(skip).limit(limit).all()
+        if status:
+            query = query.filter(Approval.trang_thai == status)
         
-        return {
-            "total": total,
-            "approvals": approvals,
-            "skip": skip,
-            "limit": limit
-        }
+        return ApprovalInboxService.page(query, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Lỗi lấy danh sách yêu cầu: {str(e)}"
+        )
+
+@router.post("/stats/rebuild")
+async def rebuild_approval_stats(
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Tính lại bảng đếm phê duyệt từ dữ liệu gốc"""
+    try:
+        if current_user.vai_tro != 'admin':
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Không có quyền tính lại thống kê"
+            )
+        
+        groups = ApprovalInboxService.rebuild(db)
+        return {"message": f"Đã tính lại {groups} nhóm (ngày, trạng thái)"}
     except HTTPException:
         raise
     except Exception as e:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Lỗi lấy danh sách phê duyệt: {str(e)}"
+            detail=f"Lỗi tính lại thống kê: {str(e)}"
         )
 
 @router.get("/{approval_id}")
 async def get_approval_detail(
     approval_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy chi tiết phê duyệt"""
@@ -156,7 +224,7 @@ async def get_approval_detail(
 @router.post("/")
 async def create_approval(
     approval_data: ApprovalCreate,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Tạo yêu cầu phê duyệt"""
@@ -173,12 +241,47 @@ async def create_approval(
         )
         
         db.add(new_approval)
+        db.flush()
+        
+        # Bước duyệt có hạn xử lý; bộ lập lịch SLA leo thang nếu quá hạn
+        ApprovalSlaService.open_step(db, new_approval.id)
+        
+        OutboxService.record(
+            db, "phe_duyet", new_approval.id, "phe_duyet.tao_moi",
+            _approval_snapshot(new_approval), recipients=[current_user.id]
+        )
+        
+        # Quy tắc tự duyệt (predicate đã biên dịch sẵn trong bộ nhớ)
+        decision = AutoApprovalService.evaluate(db, new_approval)
+        if decision:
+            try:
+                await _process_approved_request(new_approval, db)
+            except InsufficientFundsError:
+                # Ví đại lý không đủ: giữ yêu cầu chờ duyệt thủ công
+                decision = None
+        if decision:
+            rule = decision["rule"]
+            new_approval.trang_thai = 'da_duyet'
+            new_approval.ghi_chu_duyet = f"Tự động duyệt theo quy tắc {rule.name} (v{rule.version})"
+            new_approval.nguoi_duyet_id = rule.acting_user_id
+            new_approval.thoi_gian_duyet = datetime.utcnow()
+            
+            ApprovalSlaService.close_steps(db, [new_approval.id], StepStatus.APPROVED, rule.acting_user_id, rule.acting_name)
+            db.add(AuditLog(**AutoApprovalService.audit_values(new_approval, decision)))
+            
+            OutboxService.record(
+                db, "phe_duyet", new_approval.id, "phe_duyet.da_duyet",
+                _approval_snapshot(new_approval), recipients=[current_user.id]
+            )
+        
         db.commit()
         db.refresh(new_approval)
         
         return {
             "message": "Tạo yêu cầu phê duyệt thành công",
-            "approval_id": new_approval.id
+            "approval_id": new_approval.id,
+            "auto_approved": decision is not None,
+            "auto_approval_rule": decision["rule"].name if decision else None
         }
     except Exception as e:
         db.rollback()
@@ -191,7 +294,7 @@ async def create_approval(
 async def update_approval(
     approval_id: str,
     approval_data: ApprovalUpdate,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Cập nhật trạng thái phê duyệt"""
@@ -207,7 +310,7 @@ async def update_approval(
                 Approval.id == approval_id,
                 Approval.trang_thai == 'cho_duyet'
             )
-        ).first()
+        ).with_for_update().first()
         
         if not approval:
             raise HTTPException(
@@ -223,8 +326,18 @@ async def update_approval(
         
         # Xử lý logic nghiệp vụ dựa trên loại phê duyệt
         if approval_data.trang_thai == 'da_duyet':
-            await _process_approved_request(approval, db)
+            await _process_approved_request_or_400(approval, db)
         
+        ApprovalSlaService.close_steps(
+            db, [approval.id],
+            StepStatus.APPROVED if approval_data.trang_thai == 'da_duyet' else StepStatus.REJECTED,
+            current_user.id, current_user.ho_ten
+        )
+        
+        OutboxService.record(
+            db, "phe_duyet", approval.id, f"phe_duyet.{approval.trang_thai}",
+            _approval_snapshot(approval), recipients=[approval.nguoi_gui_id]
+        )
         db.commit()
         
         return {"message": "Cập nhật phê duyệt thành công"}
@@ -241,7 +354,7 @@ async def update_approval(
 async def approve_request(
     approval_id: str,
     note: Optional[str] = Query(None, description="Ghi chú phê duyệt"),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Phê duyệt yêu cầu"""
@@ -257,7 +370,7 @@ async def approve_request(
                 Approval.id == approval_id,
                 Approval.trang_thai == 'cho_duyet'
             )
-        ).first()
+        ).with_for_update().first()
         
         if not approval:
             raise HTTPException(
@@ -272,8 +385,13 @@ async def approve_request(
         approval.thoi_gian_duyet = datetime.utcnow()
         
         # Xử lý logic nghiệp vụ
-        await _process_approved_request(approval, db)
+        await _process_approved_request_or_400(approval, db)
+        ApprovalSlaService.close_steps(db, [approval.id], StepStatus.APPROVED, current_user.id, current_user.ho_ten)
         
+        OutboxService.record(
+            db, "phe_duyet", approval.id, "phe_duyet.da_duyet",
+            _approval_snapshot(approval), recipients=[approval.nguoi_gui_id]
+        )
         db.commit()
         
         return {"message": "Phê duyệt thành công"}
@@ -290,7 +408,7 @@ async def approve_request(
 async def reject_request(
     approval_id: str,
     reason: str = Query(..., description="Lý do từ chối"),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Từ chối yêu cầu phê duyệt"""
@@ -306,7 +424,7 @@ async def reject_request(
                 Approval.id == approval_id,
                 Approval.trang_thai == 'cho_duyet'
             )
-        ).first()
+        ).with_for_update().first()
         
         if not approval:
             raise HTTPException(
@@ -319,7 +437,12 @@ async def reject_request(
         approval.ghi_chu_duyet = reason
         approval.nguoi_duyet_id = current_user.id
         approval.thoi_gian_duyet = datetime.utcnow()
+        ApprovalSlaService.close_steps(db, [approval.id], StepStatus.REJECTED, current_user.id, current_user.ho_ten)
         
+        OutboxService.record(
+            db, "phe_duyet", approval.id, "phe_duyet.tu_choi",
+            _approval_snapshot(approval), recipients=[approval.nguoi_gui_id]
+        )
         db.commit()
         
         return {"message": "Từ chối phê duyệt thành công"}
@@ -332,34 +455,225 @@ async def reject_request(
             detail=f"Lỗi từ chối phê duyệt: {str(e)}"
         )
 
-@router.get("/my-requests")
-async def get_my_approval_requests(
-    skip: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=1000),
-    status: Optional[str] = Query(None),
-    current_user: User = Depends(get_current_user),
+def _lock_approvals_for_bulk(db: Session, approval_ids: List[str]) -> Dict[str, Approval]:
+    """Khóa các yêu cầu theo thứ tự ID cố định để các lô chạy song song không deadlock"""
+    approvals = db.query(Approval).filter(
+        Approval.id.in_(sorted(set(approval_ids)))
+    ).order_by(Approval.id).with_for_update().all()
+    return {str(a.id): a for a in approvals}
+
+def _bulk_approval_outcomes(approval_ids: List[str], locked: Dict[str, Approval], done_status: str):
+    """Phân loại kết quả cho từng ID theo thứ tự client gửi lên"""
+    results = []
+    eligible = {}
+    for approval_id in approval_ids:
+        approval = locked.get(approval_id)
+        if approval is None:
+            results.append({"approval_id": approval_id, "status": "not_found",
+                            "detail": "Không tìm thấy yêu cầu phê duyệt"})
+        elif approval_id in eligible:
+            results.append({"approval_id": approval_id, "status": "duplicate",
+                            "detail": "ID bị lặp trong yêu cầu"})
+        elif approval.trang_thai != 'cho_duyet':
+            results.append({"approval_id": approval_id, "status": "invalid_status",
+                            "detail": f"Yêu cầu đang ở trạng thái {approval.trang_thai}"})
+        else:
+            eligible[approval_id] = approval
+            results.append({"approval_id": approval_id, "status": done_status, "detail": None})
+    return results, eligible
+
+def _apply_bulk_decision(
+    db: Session,
+    eligible: Dict[str, Approval],
+    new_status: str,
+    note: Optional[str],
+    current_user: User
+):
+    """Chuyển trạng thái cả lô bằng một câu UPDATE, cập nhật bảng đếm và đóng các bước SLA"""
+    db.query(Approval).filter(
+        Approval.id.in_(list(eligible))
+    ).update({
+        Approval.trang_thai: new_status,
+        Approval.ghi_chu_duyet: note,
+        Approval.nguoi_duyet_id: current_user.id,
+        Approval.thoi_gian_duyet: datetime.utcnow()
+    }, synchronize_session=False)
+    
+    # Câu UPDATE không qua ORM nên ghi nhận chuyển trạng thái cho bảng đếm trực tiếp
+    for approval in eligible.values():
+        ApprovalInboxService.transition(db, approval.thoi_gian_tao, 'cho_duyet', new_status)
+    
+    ApprovalSlaService.close_steps(
+        db, list(eligible),
+        StepStatus.APPROVED if new_status == 'da_duyet' else StepStatus.REJECTED,
+        current_user.id, current_user.ho_ten
+    )
+
+def _record_bulk_decision(db: Session, eligible: Dict[str, Approval], new_status: str, current_user: User):
+    """Sự kiện thay đổi (đối tượng ORM chưa được đồng bộ nên ghi rõ trạng thái mới)"""
+    for approval in eligible.values():
+        snapshot = _approval_snapshot(approval)
+        snapshot.update({"trang_thai": new_status, "nguoi_duyet_id": current_user.id})
+        OutboxService.record(
+            db, "phe_duyet", approval.id, f"phe_duyet.{new_status}",
+            snapshot, recipients=[approval.nguoi_gui_id]
+        )
+
+def _process_approved_requests(approvals: List[Approval], db: Session) -> Tuple[Dict[str, str], Set[str]]:
+    """
+    Xử lý nghiệp vụ cho cả lô yêu cầu đã duyệt bằng vài câu IN/UPDATE.
+    Trả về ghi chú theo ID phê duyệt cho các yêu cầu không xử lý trọn vẹn,
+    và ID các yêu cầu rút tiền phải giữ chờ duyệt vì ví đại lý không đủ số dư.
+    """
+    notes = {}
+    held = set()
+    now = datetime.utcnow()
+    
+    # Kích hoạt tài khoản đại lý: một câu UPDATE
+    agent_ids = sorted({a.doi_tuong_id for a in approvals if a.loai_duyet == 'dang_ky_dai_ly'})
+    if agent_ids:
+        db.query(Agent).filter(
+            Agent.id.in_(agent_ids)
+        ).update({
+            Agent.trang_thai: 'hoat_dong',
+            Agent.thoi_gian_kich_hoat: now
+        }, synchronize_session=False)
+    
+    # Rút tiền: tải mọi giao dịch bằng một truy vấn IN, duyệt bằng một câu UPDATE
+    withdrawals = {str(a.doi_tuong_id): str(a.id) for a in approvals if a.loai_duyet == 'rut_tien'}
+    if withdrawals:
+        transactions = db.query(Transaction).filter(
+            Transaction.id.in_(sorted(withdrawals))
+        ).order_by(Transaction.id).with_for_update().all()
+        found = {str(t.id) for t in transactions}
+        for transaction_id, approval_id in withdrawals.items():
+            if transaction_id not in found:
+                notes[approval_id] = "Không tìm thấy giao dịch rút tiền"
+        
+        if transactions:
+            # Mỗi ví đại lý chỉ bị trừ bằng một câu UPDATE cho cả lô; nếu ví nào không đủ
+            # số dư thì ghi sổ lại theo từng ví, giao dịch của ví đó giữ nguyên trạng thái
+            by_agent = {}
+            for transaction in transactions:
+                if transaction.dai_ly_id:
+                    by_agent.setdefault(str(transaction.dai_ly_id), []).append(transaction)
+            try:
+                with db.begin_nested():
+                    LedgerService.post_transactions(db, [t for group in by_agent.values() for t in group])
+            except InsufficientFundsError:
+                for agent_id in sorted(by_agent):
+                    try:
+                        with db.begin_nested():
+                            LedgerService.post_transactions(db, by_agent[agent_id])
+                    except InsufficientFundsError:
+                        held.update(withdrawals[str(transaction.id)] for transaction in by_agent[agent_id])
+            
+            debited = [t for t in transactions if withdrawals[str(t.id)] not in held]
+            if debited:
+                db.query(Transaction).filter(
+                    Transaction.id.in_(sorted(str(t.id) for t in debited))
+                ).update({Transaction.trang_thai: 'da_duyet'}, synchronize_session=False)
+            for transaction in debited:
+                OutboxService.record_transaction(db, transaction, "giao_dich.da_duyet", trang_thai='da_duyet')
+    
+    return notes, held
+
+@router.post("/bulk-approve")
+async def bulk_approve_requests(
+    bulk_data: BulkApprovalAction,
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Lấy danh sách yêu cầu phê duyệt của tôi"""
+    """Phê duyệt hàng loạt yêu cầu trong một transaction"""
     try:
-        query = db.query(Approval).filter(Approval.nguoi_gui_id == current_user.id)
+        if current_user.vai_tro not in ['admin', 'quan_ly']:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Không có quyền phê duyệt"
+            )
         
-        if status:
-            query = query.filter(Approval.trang_thai == status)
+        locked = _lock_approvals_for_bulk(db, bulk_data.approval_ids)
+        results, eligible = _bulk_approval_outcomes(bulk_data.approval_ids, locked, 'approved')
+        
+        if eligible:
+            # Trừ ví trước; yêu cầu nào ví không đủ thì giữ chờ duyệt, không đổi trạng thái
+            notes, held = _process_approved_requests(list(eligible.values()), db)
+            for result in results:
+                if result["status"] != 'approved':
+                    continue
+                if result["approval_id"] in held:
+                    result["status"] = 'insufficient_funds'
+                    result["detail"] = "Số dư ví đại lý không đủ, yêu cầu vẫn chờ duyệt"
+                elif result["approval_id"] in notes:
+                    result["detail"] = notes[result["approval_id"]]
+            eligible = {approval_id: a for approval_id, a in eligible.items() if approval_id not in held}
+        
+        if eligible:
+            _apply_bulk_decision(db, eligible, 'da_duyet', bulk_data.note, current_user)
+            _record_bulk_decision(db, eligible, 'da_duyet', current_user)
         
-        total = query.count()
-        approvals = query.order_by(Approval.thoi_gian_tao.desc()).offset(skip).limit(limit).all()
+        db.commit()
         
         return {
-            "total": total,
-            "approvals": approvals,
-            "skip": skip,
-            "limit": limit
+            "message": f"Đã phê duyệt {len(eligible)}/{len(bulk_data.approval_ids)} yêu cầu",
+            "approved": len(eligible),
+            "results": results
         }
+    except HTTPException:
+        raise
     except Exception as e:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Lỗi lấy danh sách yêu cầu: {str(e)}"
+            detail=f"Lỗi phê duyệt hàng loạt: {str(e)}"
+        )
+
+@router.post("/bulk-reject")
+async def bulk_reject_requests(
+    bulk_data: BulkApprovalReject,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Từ chối hàng loạt yêu cầu trong một transaction"""
+    try:
+        if current_user.vai_tro not in ['admin', 'quan_ly']:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Không có quyền từ chối phê duyệt"
+            )
+        
+        locked = _lock_approvals_for_bulk(db, bulk_data.approval_ids)
+        results, eligible = _bulk_approval_outcomes(bulk_data.approval_ids, locked, 'rejected')
+        
+        if eligible:
+            _apply_bulk_decision(db, eligible, 'tu_choi', bulk_data.reason, current_user)
+            _record_bulk_decision(db, eligible, 'tu_choi', current_user)
+        
+        db.commit()
+        
+        return {
+            "message": f"Đã từ chối {len(eligible)}/{len(bulk_data.approval_ids)} yêu cầu",
+            "rejected": len(eligible),
+            "results": results
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi từ chối hàng loạt: {str(e)}"
+        )
+
+async def _process_approved_request_or_400(approval: Approval, db: Session):
+    """Như _process_approved_request; số dư ví không đủ thì hủy phê duyệt với lỗi 400"""
+    try:
+        await _process_approved_request(approval, db)
+    except InsufficientFundsError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Số dư ví đại lý không đủ để duyệt yêu cầu rút tiền"
         )
 
 async def _process_approved_request(approval: Approval, db: Session):
@@ -374,14 +688,15 @@ async def _process_approved_request(approval: Approval, db: Session):
         
         elif approval.loai_duyet == 'rut_tien':
             # Xử lý yêu cầu rút tiền
-            transaction = db.query(Transaction).filter(Transaction.id == approval.doi_tuong_id).first()
+            transaction = db.query(Transaction).filter(Transaction.id == approval.doi_tuong_id).with_for_update().first()
             if transaction:
-                transaction.trang_thai = 'da_duyet'
-                # Cập nhật số dư đại lý
+                # Trừ số dư ví đại lý qua sổ cái trước; số dư không đủ thì
+                # InsufficientFundsError được ném lên và giao dịch giữ nguyên trạng thái
                 if transaction.dai_ly_id:
-                    agent = db.query(Agent).filter(Agent.id == transaction.dai_ly_id).first()
-                    if agent and agent.so_du_hien_tai >= transaction.so_tien:
-                        agent.so_du_hien_tai -= transaction.so_tien
+                    with db.begin_nested():
+                        LedgerService.post_transaction(db, transaction)
+                transaction.trang_thai = 'da_duyet'
+                OutboxService.record_transaction(db, transaction, "giao_dich.da_duyet")
         
         elif approval.loai_duyet == 'cap_nhat_thong_tin':
             # Áp dụng thay đổi thông tin
@@ -389,6 +704,8 @@ async def _process_approved_request(approval: Approval, db: Session):
                 # Logic cập nhật thông tin dựa trên du_lieu_moi
                 pass
         
+    except InsufficientFundsError:
+        raise
     except Exception as e:
         # Log error nhưng không raise để không ảnh hưởng đến việc phê duyệt
         print(f"Error processing approved request: {str(e)}")
\ No newline at end of file
@@ -2,18 +2,21 @@
 Authentication API endpoints
 """
 
-from datetime import timedelta
+from datetime import datetime, timedelta
 from typing import Dict, Any
 from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.security import OAuth2PasswordRequestForm, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from pydantic import BaseModel
 
 from ..database import get_db
-from ..models.users import User
-from ..auth.jwt_handler import create_access_token
-from ..auth.password import verify_password
-from ..auth.dependencies import get_current_active_user
+from ..models.users import User, RevokedToken
+from ..auth.jwt_handler import create_access_token, verify_token
+from ..auth.password import get_password_hasher, PasswordHasherBusyError
+from ..auth.dependencies import get_current_active_user, get_current_principal, security
+from ..auth.principal import Principal, load_principal
+from ..auth.token_state import bump_security_version
 
 router = APIRouter()
 
@@ -52,29 +55,41 @@ async def login(
             detail="Tên đăng nhập hoặc mật khẩu không chính xác"
         )
     
-    # Verify password
-    if not verify_password(form_data.password, user.password_hash):
+    # Verify password (bcrypt chạy trên pool riêng, không chặn event loop)
+    try:
+        verified, new_hash = await get_password_hasher().verify_and_update(form_data.password, user.password_hash)
+    except PasswordHasherBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "1"}
+        )
+    
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Tên đăng nhập hoặc mật khẩu không chính xác"
         )
     
-    # Create access token
+    # Update last login; hash theo cost factor cũ được thay trong cùng commit
+    user.last_login = str(datetime.utcnow())
+    if new_hash:
+        user.password_hash = new_hash
+    db.commit()
+    
+    # Create access token: mang phiên bản bảo mật và id liên kết để các request sau không cần database
+    principal = load_principal(db, user.id)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Tên đăng nhập hoặc mật khẩu không chính xác"
+        )
     access_token_expires = timedelta(minutes=1440)  # 24 hours
     access_token = create_access_token(
-        data={
-            "sub": str(user.id),
-            "username": user.username,
-            "role": user.role,
-            "full_name": user.full_name
-        },
+        data={**principal.to_claims(), "full_name": user.full_name},
         expires_delta=access_token_expires
     )
     
-    # Update last login
-    user.last_login = str(datetime.utcnow())
-    db.commit()
-    
     return LoginResponse(
         access_token=access_token,
         token_type="bearer",
@@ -107,17 +122,48 @@ async def get_current_user_info(
 
 @router.post("/logout")
 async def logout(
-    current_user: User = Depends(get_current_active_user)
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    principal: Principal = Depends(get_current_principal),
+    db: Session = Depends(get_db)
 ):
-    """Đăng xuất hệ thống"""
+    """Đăng xuất hệ thống (thu hồi token hiện tại)"""
+    
+    token_data = verify_token(credentials.credentials)
+    if token_data.jti and token_data.expires_at:
+        db.add(RevokedToken(
+            jti=token_data.jti,
+            user_id=str(principal.user_id),
+            expires_at=token_data.expires_at
+        ))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Token đã được thu hồi bởi một request song song
+            db.rollback()
     
     return {
         "message": "Đăng xuất thành công",
-        "user": current_user.username
+        "user": principal.username
+    }
+
+@router.post("/logout-all")
+async def logout_all(
+    principal: Principal = Depends(get_current_principal),
+    db: Session = Depends(get_db)
+):
+    """Đăng xuất mọi phiên (mọi token đã cấp của người dùng hết hiệu lực)"""
+    
+    bump_security_version(db, principal.user_id)
+    db.commit()
+    
+    return {
+        "message": "Đã đăng xuất khỏi tất cả thiết bị",
+        "user": principal.username
     }
 
 @router.post("/refresh-token")
 async def refresh_token(
+    principal: Principal = Depends(get_current_principal),
     current_user: User = Depends(get_current_active_user)
 ):
     """Làm mới token"""
@@ -125,12 +171,7 @@ async def refresh_token(
     # Create new access token
     access_token_expires = timedelta(minutes=1440)  # 24 hours
     access_token = create_access_token(
-        data={
-            "sub": str(current_user.id),
-            "username": current_user.username,
-            "role": current_user.role,
-            "full_name": current_user.full_name
-        },
+        data={**principal.to_claims(), "full_name": current_user.full_name},
         expires_delta=access_token_expires
     )
     
@@ -3,22 +3,33 @@ Customer API endpoints for 7tỷ.vn system
 """
 
 from typing import List, Optional, Dict, Any
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Header, Request, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, func
+from sqlalchemy import and_, or_, func, update, insert
 from pydantic import BaseModel, validator
 from datetime import datetime, date
 from decimal import Decimal
+import uuid
 
 from ..database import get_db
 from ..models.users import User
 from ..models.customers import Customer
 from ..models.transactions import Transaction
 from ..models.bills import Bill
-from ..auth.dependencies import get_current_customer_user
+from ..auth.dependencies import get_current_customer_user, get_current_customer_principal
+from ..auth.principal import Principal
+from ..services.idempotency_service import IdempotencyService
+from ..services.ledger_service import LedgerService, InsufficientFundsError, SYSTEM_BILL_COLLECTION, SYSTEM_CASH_IN
+from ..models.ledger import LedgerAccountType
+from ..services.outbox_service import OutboxService
+from ..services.partition_service import created_range
+from ..services.resource_version_service import ResourceVersionService, CUSTOMER_BILLS, CUSTOMER_TRANSACTIONS
 
 router = APIRouter()
 
+# Số hóa đơn tối đa trong một lần thanh toán gộp
+MAX_BATCH_BILLS = 50
+
 # Pydantic models
 class CustomerProfile(BaseModel):
     ho_ten: str
@@ -34,6 +45,22 @@ class BillPayment(BaseModel):
     phuong_thuc_thanh_toan: str
     ghi_chu: Optional[str] = None
 
+class BatchBillPayment(BaseModel):
+    bill_ids: List[str]
+    tong_tien: Decimal
+    phuong_thuc_thanh_toan: str
+    ghi_chu: Optional[str] = None
+    
+    @validator('bill_ids')
+    def validate_bill_ids(cls, v):
+        if not v:
+            raise ValueError('Cần ít nhất một hóa đơn')
+        if len(v) > MAX_BATCH_BILLS:
+            raise ValueError(f'Tối đa {MAX_BATCH_BILLS} hóa đơn mỗi lần thanh toán')
+        if len(set(v)) != len(v):
+            raise ValueError('Danh sách hóa đơn bị lặp')
+        return v
+
 class WalletTopUp(BaseModel):
     so_tien: Decimal
     phuong_thuc_nap: str
@@ -68,7 +95,7 @@ async def get_customer_profile(
             )
         
         return {
-            "user_info": current_user,
+            "user_info": current_user.load(),
             "customer_info": customer
         }
     except HTTPException:
@@ -187,24 +214,25 @@ async def get_customer_stats(
 
 @router.get("/bills")
 async def get_customer_bills(
+    request: Request,
+    response: Response,
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     status: Optional[str] = Query(None),
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
-    current_user: User = Depends(get_current_customer_user),
+    principal: Principal = Depends(get_current_customer_principal),
     db: Session = Depends(get_db)
 ):
-    """Lấy danh sách hóa đơn của khách hàng"""
+    """Lấy danh sách hóa đơn của khách hàng (hỗ trợ If-None-Match)"""
     try:
-        customer = db.query(Customer).filter(Customer.nguoi_dung_id == current_user.id).first()
-        if not customer:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Không tìm thấy thông tin khách hàng"
-            )
+        customer_id = principal.customer_id
         
-        query = db.query(Bill).filter(Bill.khach_hang_id == customer.id)
+        not_modified = ResourceVersionService.conditional(db, CUSTOMER_BILLS, customer_id, request, response)
+        if not_modified is not None:
+            return not_modified
+        
+        query = db.query(Bill).filter(Bill.khach_hang_id == customer_id)
         
         if status:
             query = query.filter(Bill.trang_thai == status)
@@ -235,22 +263,17 @@ async def get_customer_bills(
 @router.get("/bills/{bill_id}")
 async def get_bill_detail(
     bill_id: str,
-    current_user: User = Depends(get_current_customer_user),
+    principal: Principal = Depends(get_current_customer_principal),
     db: Session = Depends(get_db)
 ):
     """Lấy chi tiết hóa đơn"""
     try:
-        customer = db.query(Customer).filter(Customer.nguoi_dung_id == current_user.id).first()
-        if not customer:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Không tìm thấy thông tin khách hàng"
-            )
+        customer_id = principal.customer_id
         
         bill = db.query(Bill).filter(
             and_(
                 Bill.id == bill_id,
-                Bill.khach_hang_id == customer.id
+                Bill.khach_hang_id == customer_id
             )
         ).first()
         
@@ -273,24 +296,42 @@ async def get_bill_detail(
 async def pay_bill(
     bill_id: str,
     payment_data: BillPayment,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     current_user: User = Depends(get_current_customer_user),
     db: Session = Depends(get_db)
 ):
     """Thanh toán hóa đơn"""
+    idempotency = None
     try:
-        customer = db.query(Customer).filter(Customer.nguoi_dung_id == current_user.id).first()
+        # Yêu cầu gửi lại với cùng Idempotency-Key nhận lại phản hồi cũ
+        idempotency = IdempotencyService(db, idempotency_key, current_user.id, f"POST /api/customer/bills/{bill_id}/pay")
+        replay = idempotency.begin(payment_data.dict())
+        if replay is not None:
+            return replay
+        
+        customer = db.query(Customer.id, Customer.dai_ly_id, Customer.so_du_vi).filter(
+            Customer.nguoi_dung_id == current_user.id
+        ).first()
         if not customer:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Không tìm thấy thông tin khách hàng"
             )
         
-        bill = db.query(Bill).filter(
-            and_(
+        # Chuyển trạng thái hóa đơn bằng một câu UPDATE có điều kiện: hai yêu cầu
+        # đồng thời cho cùng hóa đơn chỉ có một yêu cầu cập nhật được dòng
+        paid_at = datetime.utcnow()
+        bill = db.execute(
+            update(Bill).where(
                 Bill.id == bill_id,
                 Bill.khach_hang_id == customer.id,
                 Bill.trang_thai == 'chua_thanh_toan'
-            )
+            ).values(
+                trang_thai='da_thanh_toan',
+                thoi_gian_thanh_toan=paid_at,
+                phuong_thuc_thanh_toan=payment_data.phuong_thuc_thanh_toan
+            ).returning(Bill.id, Bill.so_tien, Bill.trang_thai),
+            execution_options={"synchronize_session": False}
         ).first()
         
         if not bill:
@@ -299,29 +340,13 @@ async def pay_bill(
                 detail="Không tìm thấy hóa đơn hoặc hóa đơn đã được thanh toán"
             )
         
-        # Kiểm tra số tiền
+        # Kiểm tra số tiền (rollback sẽ hoàn lại trạng thái hóa đơn)
         if payment_data.so_tien != bill.so_tien:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Số tiền thanh toán không khớp với số tiền hóa đơn"
             )
         
-        # Kiểm tra số dư ví nếu thanh toán bằng ví
-        if payment_data.phuong_thuc_thanh_toan == 'vi_dien_tu':
-            if customer.so_du_vi < payment_data.so_tien:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Số dư ví không đủ để thanh toán"
-                )
-            
-            # Trừ tiền từ ví
-            customer.so_du_vi -= payment_data.so_tien
-        
-        # Cập nhật trạng thái hóa đơn
-        bill.trang_thai = 'da_thanh_toan'
-        bill.thoi_gian_thanh_toan = datetime.utcnow()
-        bill.phuong_thuc_thanh_toan = payment_data.phuong_thuc_thanh_toan
-        
         # Tạo giao dịch
         transaction = Transaction(
             khach_hang_id=customer.id,
@@ -332,21 +357,213 @@ async def pay_bill(
             phuong_thuc_thanh_toan=payment_data.phuong_thuc_thanh_toan,
             trang_thai='thanh_cong',
             ghi_chu=payment_data.ghi_chu,
-            ma_giao_dich=f"PAY_{datetime.now().strftime('%Y%m%d%H%M%S')}_{customer.id}"
+            ma_giao_dich=f"PAY_{paid_at.strftime('%Y%m%d%H%M%S')}_{customer.id}"
         )
         
         db.add(transaction)
-        db.commit()
+        db.flush()
         
-        return {
+        remaining_balance = customer.so_du_vi
+        if payment_data.phuong_thuc_thanh_toan == 'vi_dien_tu':
+            # Trừ tiền từ ví qua sổ cái: UPDATE ... WHERE so_du_vi >= :so_tien RETURNING,
+            # không đọc số dư trước nên không có khoảng trống giữa kiểm tra và trừ tiền
+            balances = LedgerService.post(
+                db,
+                'thanh_toan_hoa_don',
+                [
+                    (LedgerAccountType.CUSTOMER, customer.id, -payment_data.so_tien),
+                    (LedgerAccountType.SYSTEM, SYSTEM_BILL_COLLECTION, payment_data.so_tien)
+                ],
+                transaction_id=transaction.id,
+                description=transaction.ma_giao_dich
+            )
+            remaining_balance = balances[str(customer.id)]
+        
+        # Sự kiện thay đổi ghi trong cùng transaction
+        OutboxService.record(
+            db, "hoa_don", bill.id, "hoa_don.da_thanh_toan",
+            {"id": bill.id, "trang_thai": bill.trang_thai, "giao_dich_id": transaction.id, "khach_hang_id": customer.id},
+            recipients=[current_user.id]
+        )
+        OutboxService.record_transaction(db, transaction, "giao_dich.thanh_cong", recipients=[current_user.id])
+        
+        response = {
             "message": "Thanh toán hóa đơn thành công",
             "transaction_id": transaction.id,
-            "remaining_balance": customer.so_du_vi
+            "remaining_balance": remaining_balance
         }
+        idempotency.save_response(response)
+        db.commit()
+        
+        return response
     except HTTPException:
+        db.rollback()
+        if idempotency is not None:
+            idempotency.release()
         raise
+    except InsufficientFundsError:
+        db.rollback()
+        if idempotency is not None:
+            idempotency.release()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Số dư ví không đủ để thanh toán"
+        )
     except Exception as e:
         db.rollback()
+        if idempotency is not None:
+            idempotency.release()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi thanh toán hóa đơn: {str(e)}"
+        )
+
+@router.post("/bills/pay-batch")
+async def pay_bills_batch(
+    payment_data: BatchBillPayment,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: User = Depends(get_current_customer_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Thanh toán nhiều hóa đơn trong một yêu cầu: khóa và kiểm tra tất cả hóa
+    đơn cùng lúc, trừ ví một lần, ghi mọi giao dịch bằng một câu INSERT nhiều
+    dòng trong cùng transaction và trả về biên nhận gộp. Tất cả hoặc không.
+    """
+    idempotency = None
+    try:
+        idempotency = IdempotencyService(db, idempotency_key, current_user.id, "POST /api/customer/bills/pay-batch")
+        replay = idempotency.begin(payment_data.dict())
+        if replay is not None:
+            return replay
+        
+        customer = db.query(Customer.id, Customer.dai_ly_id, Customer.so_du_vi).filter(
+            Customer.nguoi_dung_id == current_user.id
+        ).first()
+        if not customer:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Không tìm thấy thông tin khách hàng"
+            )
+        
+        # Khóa các hóa đơn theo thứ tự ID cố định để các lô chồng nhau không deadlock
+        bills = db.query(Bill.id, Bill.so_tien).filter(
+            Bill.id.in_(sorted(payment_data.bill_ids)),
+            Bill.khach_hang_id == customer.id,
+            Bill.trang_thai == 'chua_thanh_toan'
+        ).order_by(Bill.id).with_for_update().all()
+        
+        amounts = {str(bill.id): bill.so_tien for bill in bills}
+        missing = [bill_id for bill_id in payment_data.bill_ids if bill_id not in amounts]
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Không tìm thấy hóa đơn hoặc hóa đơn đã được thanh toán: {', '.join(missing)}"
+            )
+        
+        total = sum(amounts.values(), Decimal('0'))
+        if payment_data.tong_tien != total:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Tổng tiền thanh toán không khớp với tổng các hóa đơn ({total})"
+            )
+        
+        paid_at = datetime.utcnow()
+        receipt_code = f"PAYB_{paid_at.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8].upper()}"
+        
+        db.query(Bill).filter(
+            Bill.id.in_(sorted(payment_data.bill_ids))
+        ).update({
+            Bill.trang_thai: 'da_thanh_toan',
+            Bill.thoi_gian_thanh_toan: paid_at,
+            Bill.phuong_thuc_thanh_toan: payment_data.phuong_thuc_thanh_toan
+        }, synchronize_session=False)
+        
+        # Mọi giao dịch của lô trong một câu INSERT nhiều dòng
+        transaction_rows = [
+            {
+                "id": uuid.uuid4(),
+                "khach_hang_id": customer.id,
+                "dai_ly_id": customer.dai_ly_id,
+                "hoa_don_id": bill_id,
+                "loai_giao_dich": 'thanh_toan_hoa_don',
+                "so_tien": amounts[bill_id],
+                "phuong_thuc_thanh_toan": payment_data.phuong_thuc_thanh_toan,
+                "trang_thai": 'thanh_cong',
+                "ghi_chu": payment_data.ghi_chu,
+                "ma_giao_dich": f"{receipt_code}_{index:02d}",
+                "nguoi_tao_id": current_user.id
+            }
+            for index, bill_id in enumerate(payment_data.bill_ids, start=1)
+        ]
+        db.execute(insert(Transaction).values(transaction_rows))
+        
+        remaining_balance = customer.so_du_vi
+        if payment_data.phuong_thuc_thanh_toan == 'vi_dien_tu':
+            # Trừ ví một lần cho cả lô (UPDATE có điều kiện, không đọc số dư trước)
+            balances = LedgerService.post(
+                db,
+                'thanh_toan_hoa_don',
+                [
+                    (LedgerAccountType.CUSTOMER, customer.id, -total),
+                    (LedgerAccountType.SYSTEM, SYSTEM_BILL_COLLECTION, total)
+                ],
+                description=receipt_code
+            )
+            remaining_balance = balances[str(customer.id)]
+        
+        for row in transaction_rows:
+            OutboxService.record(
+                db, "hoa_don", row["hoa_don_id"], "hoa_don.da_thanh_toan",
+                {"id": row["hoa_don_id"], "trang_thai": 'da_thanh_toan', "giao_dich_id": row["id"],
+                 "khach_hang_id": customer.id},
+                recipients=[current_user.id]
+            )
+            OutboxService.record(
+                db, "giao_dich", row["id"], "giao_dich.thanh_cong",
+                OutboxService.transaction_snapshot(row), recipients=[current_user.id]
+            )
+        
+        response = {
+            "message": f"Thanh toán thành công {len(transaction_rows)} hóa đơn",
+            "receipt": {
+                "receipt_code": receipt_code,
+                "paid_at": paid_at,
+                "phuong_thuc_thanh_toan": payment_data.phuong_thuc_thanh_toan,
+                "total_amount": total,
+                "items": [
+                    {
+                        "bill_id": row["hoa_don_id"],
+                        "transaction_id": row["id"],
+                        "transaction_code": row["ma_giao_dich"],
+                        "so_tien": row["so_tien"]
+                    }
+                    for row in transaction_rows
+                ]
+            },
+            "remaining_balance": remaining_balance
+        }
+        idempotency.save_response(response)
+        db.commit()
+        
+        return response
+    except HTTPException:
+        db.rollback()
+        if idempotency is not None:
+            idempotency.release()
+        raise
+    except InsufficientFundsError:
+        db.rollback()
+        if idempotency is not None:
+            idempotency.release()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Số dư ví không đủ để thanh toán"
+        )
+    except Exception as e:
+        db.rollback()
+        if idempotency is not None:
+            idempotency.release()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi thanh toán hóa đơn: {str(e)}"
@@ -372,7 +589,7 @@ async def get_wallet_info(
                 Transaction.khach_hang_id == customer.id,
                 Transaction.loai_giao_dich.in_(['nap_vi', 'thanh_toan_hoa_don'])
             )
-        ).order_by(Transaction.thoi_gian_tao.desc()).limit(10).all()
+        ).order_by(Transaction.created_at.desc()).limit(10).all()
         
         return {
             "balance": customer.so_du_vi or Decimal('0'),
@@ -402,11 +619,6 @@ async def topup_wallet(
                 detail="Không tìm thấy thông tin khách hàng"
             )
         
-        # Cập nhật số dư ví
-        if customer.so_du_vi is None:
-            customer.so_du_vi = Decimal('0')
-        
-        customer.so_du_vi += topup_data.so_tien
         customer.thoi_gian_cap_nhat = datetime.utcnow()
         
         # Tạo giao dịch nạp tiền
@@ -422,12 +634,26 @@ async def topup_wallet(
         )
         
         db.add(transaction)
+        db.flush()
+        
+        # Cộng số dư ví qua sổ cái trong cùng transaction
+        balances = LedgerService.post(
+            db,
+            'nap_vi',
+            [
+                (LedgerAccountType.CUSTOMER, customer.id, topup_data.so_tien),
+                (LedgerAccountType.SYSTEM, SYSTEM_CASH_IN, -topup_data.so_tien)
+            ],
+            transaction_id=transaction.id,
+            description=transaction.ma_giao_dich
+        )
+        OutboxService.record_transaction(db, transaction, "giao_dich.thanh_cong", recipients=[current_user.id])
         db.commit()
         
         return {
             "message": "Nạp tiền thành công",
             "transaction_id": transaction.id,
-            "new_balance": customer.so_du_vi
+            "new_balance": balances[str(customer.id)]
         }
     except HTTPException:
         raise
@@ -440,36 +666,33 @@ async def topup_wallet(
 
 @router.get("/transactions")
 async def get_customer_transactions(
+    request: Request,
+    response: Response,
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     transaction_type: Optional[str] = Query(None),
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
-    current_user: User = Depends(get_current_customer_user),
+    principal: Principal = Depends(get_current_customer_principal),
     db: Session = Depends(get_db)
 ):
-    """Lấy lịch sử giao dịch của khách hàng"""
+    """Lấy lịch sử giao dịch của khách hàng (hỗ trợ If-None-Match)"""
     try:
-        customer = db.query(Customer).filter(Customer.nguoi_dung_id == current_user.id).first()
-        if not customer:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Không tìm thấy thông tin khách hàng"
-            )
+        customer_id = principal.customer_id
+        
+        not_modified = ResourceVersionService.conditional(db, CUSTOMER_TRANSACTIONS, customer_id, request, response)
+        if not_modified is not None:
+            return not_modified
         
-        query = db.query(Transaction).filter(Transaction.khach_hang_id == customer.id)
+        query = db.query(Transaction).filter(Transaction.khach_hang_id == customer_id)
         
         if transaction_type:
             query = query.filter(Transaction.loai_giao_dich == transaction_type)
         
-        if from_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) >= from_date)
-        
-        if to_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) <= to_date)
+        query = query.filter(*created_range(Transaction.created_at, from_date, to_date))
         
         total = query.count()
-        transactions = query.order_by(Transaction.thoi_gian_tao.desc()).offset(skip).limit(limit).all()
+        transactions = query.order_by(Transaction.created_at.desc()).offset(skip).limit(limit).all()
         
         return {
             "total": total,
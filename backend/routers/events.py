@@ -0,0 +1,72 @@
+"""
+Realtime event API (WebSocket) for 7tỷ.vn system
+"""
+
+from typing import Optional
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Query
+import os
+import asyncio
+
+from ..auth.dependencies import authenticate_token
+from ..database import SessionLocal
+from ..services.event_hub import EventConnection, get_event_hub
+
+router = APIRouter()
+
+# Configuration
+# Chu kỳ kiểm tra lại token của kết nối đang mở (thu hồi, đổi phiên bản bảo mật, hết hạn)
+EVENT_TOKEN_RECHECK_SECONDS = float(os.getenv("EVENT_TOKEN_RECHECK_SECONDS", "30"))
+
+def _token_is_valid(token: str) -> bool:
+    db = SessionLocal()
+    try:
+        authenticate_token(token, db)
+        return True
+    except HTTPException:
+        return False
+    finally:
+        db.close()
+
+async def _recheck_token(connection: EventConnection, token: str):
+    """Đóng kết nối với mã 1008 khi token không còn hợp lệ"""
+    while True:
+        await asyncio.sleep(EVENT_TOKEN_RECHECK_SECONDS)
+        if not _token_is_valid(token):
+            get_event_hub().unregister(connection)
+            await connection.websocket.close(code=1008)
+            return
+
+@router.websocket("/ws")
+async def event_stream(
+    websocket: WebSocket,
+    token: str = Query(..., description="JWT access token"),
+    topics: Optional[str] = Query(None, description="Loại đối tượng cần nhận, phân tách bằng dấu phẩy (giao_dich,hoa_don,phe_duyet)")
+):
+    """Nhận sự kiện thay đổi theo thời gian thực thay cho polling các endpoint /stats"""
+    # Cùng kiểm tra như request HTTP: chữ ký, danh sách thu hồi và phiên bản bảo mật;
+    # kiểm tra lại định kỳ để token bị thu hồi không tiếp tục nhận sự kiện
+    db = SessionLocal()
+    try:
+        principal = authenticate_token(token, db)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    finally:
+        db.close()
+
+    await websocket.accept()
+
+    connection = EventConnection(
+        websocket,
+        user_id=principal.user_id,
+        role=principal.role,
+        topics={t.strip() for t in topics.split(",") if t.strip()} if topics else None
+    )
+
+    watcher = asyncio.create_task(_recheck_token(connection, token))
+    try:
+        await get_event_hub().serve(connection)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        watcher.cancel()
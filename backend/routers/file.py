@@ -3,29 +3,39 @@ File management API endpoints for 7tỷ.vn system
 """
 
 from typing import List, Optional, Dict, Any
-from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File, Form, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func
 from pydantic import BaseModel
 from datetime import datetime, date
 import os
+import asyncio
 import uuid
-import shutil
+import mimetypes
 from pathlib import Path
+from urllib.parse import quote
 
 from ..database import get_db
 from ..models.users import User
-from ..models.files import FileRecord
-from ..auth.dependencies import get_current_user
+from ..models.files import FileRecord, FileUpload, FileType, FileStatus
+from ..auth.dependencies import get_current_active_user
+from ..services.file_storage_service import FileStorageService, FileTooLargeError, LocalFileStorage, get_file_storage
+from ..services.download_counter_service import get_download_counter
+from ..services.document_processing_service import PROCESSABLE_MIME_PREFIXES, get_document_processor
+from ..services.resource_version_service import ResourceVersionService
 
 router = APIRouter()
 
 # Configuration
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.txt'}
+# Số file tối đa mỗi lần upload nhiều file và số file xử lý đồng thời trong một yêu cầu
+MAX_FILES_PER_UPLOAD = 10
+FILE_UPLOAD_CONCURRENCY = int(os.getenv("FILE_UPLOAD_CONCURRENCY", "4"))
+# Location internal của nginx trỏ vào thư mục kho (vd "/_protected_files/"); rỗng = Python tự gửi file
+FILE_ACCEL_REDIRECT_PREFIX = os.getenv("FILE_ACCEL_REDIRECT_PREFIX", "")
 
 # Pydantic models
 class FileInfo(BaseModel):
@@ -43,12 +53,40 @@ class FileUploadResponse(BaseModel):
     file_url: str
     file_info: FileInfo
 
+def _processing_job(file_id: str, file: UploadFile, stored: Dict[str, Any], current_user: User) -> Optional[FileUpload]:
+    """Bản ghi tai_len_tep (da_tai_len) để DocumentProcessor nhận xử lý; None nếu loại tệp không cần xử lý"""
+    mime_type = file.content_type or mimetypes.guess_type(file.filename)[0] or ""
+    if not mime_type.startswith(PROCESSABLE_MIME_PREFIXES):
+        return None
+    return FileUpload(
+        original_filename=file.filename,
+        stored_filename=Path(stored["key"]).name,
+        file_path=stored["key"],
+        content_hash=stored["sha256"],
+        storage_backend=stored["backend"],
+        file_size=stored["size"],
+        file_type=FileType.IMAGE if mime_type.startswith("image/") else FileType.DOCUMENT,
+        mime_type=mime_type,
+        file_extension=Path(file.filename).suffix.lower(),
+        owner_id=str(current_user.id),
+        owner_type=current_user.vai_tro,
+        related_id=file_id,
+        related_type=FileRecord.__tablename__,
+        status=FileStatus.UPLOADED
+    )
+
+def _notify_document_processor():
+    """Báo worker nền có tệp mới; OCR và trích xuất không chạy trên worker phục vụ request"""
+    processor = get_document_processor()
+    if processor is not None:
+        processor.notify()
+
 @router.post("/upload", response_model=FileUploadResponse)
 async def upload_file(
     file: UploadFile = File(...),
     mo_ta: Optional[str] = Form(None),
     loai_file: Optional[str] = Form(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Upload file lên hệ thống"""
@@ -68,30 +106,26 @@ async def upload_file(
                 detail=f"Định dạng file không được hỗ trợ. Chỉ chấp nhận: {', '.join(ALLOWED_EXTENSIONS)}"
             )
         
-        # Kiểm tra kích thước file
-        file_content = await file.read()
-        if len(file_content) > MAX_FILE_SIZE:
+        # Đọc theo từng khối, băm và ghi ngoài event loop; nội dung trùng chỉ lưu một lần
+        try:
+            stored = await FileStorageService.save_upload(file, MAX_FILE_SIZE)
+        except FileTooLargeError as e:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"File quá lớn. Kích thước tối đa: {MAX_FILE_SIZE // (1024*1024)}MB"
+                detail=str(e)
             )
         
-        # Tạo tên file unique
         file_id = str(uuid.uuid4())
-        new_filename = f"{file_id}{file_ext}"
-        file_path = UPLOAD_DIR / new_filename
-        
-        # Lưu file
-        with open(file_path, "wb") as buffer:
-            buffer.write(file_content)
         
         # Lưu thông tin file vào database
         file_record = FileRecord(
             id=file_id,
             ten_file=file.filename,
             ten_file_goc=file.filename,
-            duong_dan=str(file_path),
-            kich_thuoc=len(file_content),
+            duong_dan=stored["key"],
+            ma_bam=stored["sha256"],
+            kho_luu_tru=stored["backend"],
+            kich_thuoc=stored["size"],
             loai_file=loai_file or file.content_type or 'unknown',
             mo_ta=mo_ta,
             nguoi_tao_id=current_user.id,
@@ -99,8 +133,13 @@ async def upload_file(
         )
         
         db.add(file_record)
+        job = _processing_job(file_id, file, stored, current_user)
+        if job is not None:
+            db.add(job)
         db.commit()
         db.refresh(file_record)
+        if job is not None:
+            _notify_document_processor()
         
         file_info = FileInfo(
             id=file_record.id,
@@ -122,9 +161,7 @@ async def upload_file(
     except HTTPException:
         raise
     except Exception as e:
-        # Xóa file nếu có lỗi
-        if 'file_path' in locals() and file_path.exists():
-            file_path.unlink()
+        # Nội dung trong kho có thể đang được bản ghi khác dùng chung nên không xóa
         db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -137,7 +174,7 @@ async def get_files(
     limit: int = Query(100, ge=1, le=1000),
     search: Optional[str] = Query(None),
     file_type: Optional[str] = Query(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy danh sách file"""
@@ -177,7 +214,7 @@ async def get_files(
 @router.get("/{file_id}")
 async def get_file_info(
     file_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy thông tin file"""
@@ -209,13 +246,48 @@ async def get_file_info(
             detail=f"Lỗi lấy thông tin file: {str(e)}"
         )
 
+def _parse_range(header: str, size: int):
+    """
+    Khoảng byte (start, end) của header Range một khoảng; None nếu header
+    không hợp lệ hoặc nhiều khoảng (trả cả file), False nếu không thỏa được.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        elif last:
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+def _content_disposition(filename: str) -> str:
+    """Content-Disposition giữ được tên tiếng Việt (RFC 5987)"""
+    return f"attachment; filename*=utf-8''{quote(filename or 'download')}"
+
 @router.get("/{file_id}/download")
 async def download_file(
     file_id: str,
-    current_user: User = Depends(get_current_user),
+    request: Request,
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Download file"""
+    """
+    Download file: hỗ trợ Range/If-Range, ETag/If-None-Match. Với kho cục bộ
+    và FILE_ACCEL_REDIRECT_PREFIX, nginx gửi file (X-Accel-Redirect). Lượt
+    tải được đếm trong bộ nhớ và ghi theo lô, không mở transaction ghi.
+    """
     try:
         query = db.query(FileRecord).filter(
             and_(
@@ -235,22 +307,66 @@ async def download_file(
                 detail="Không tìm thấy file"
             )
         
-        file_path = Path(file_record.duong_dan)
-        if not file_path.exists():
+        storage = get_file_storage()
+        key = file_record.duong_dan
+        try:
+            size = await run_in_threadpool(storage.size, key)
+        except (FileNotFoundError, OSError):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="File không tồn tại trên hệ thống"
             )
         
-        # Cập nhật số lần tải
-        file_record.so_lan_tai = (file_record.so_lan_tai or 0) + 1
-        file_record.lan_tai_cuoi = datetime.utcnow()
-        db.commit()
+        # Khóa lưu trữ là mã băm nội dung nên ETag mạnh không đổi theo thời gian
+        etag = f'"{file_record.ma_bam}"' if file_record.ma_bam else f'"{file_record.id}-{size}"'
+        headers = {
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "private, max-age=0",
+            "Content-Disposition": _content_disposition(file_record.ten_file_goc)
+        }
+        if ResourceVersionService.not_modified(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        
+        byte_range = None
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range.strip() == etag):
+            byte_range = _parse_range(range_header, size)
+            if byte_range is False:
+                return Response(
+                    status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                    headers={**headers, "Content-Range": f"bytes */{size}"}
+                )
         
-        return FileResponse(
-            path=file_path,
-            filename=file_record.ten_file_goc,
-            media_type='application/octet-stream'
+        # Chỉ đếm lượt tải bắt đầu từ đầu file (các yêu cầu nối tiếp của trình tải không tính thêm)
+        counter = get_download_counter()
+        if counter is not None and (byte_range is None or byte_range[0] == 0):
+            counter.record(str(file_record.id))
+        
+        file_path = storage.local_path(key)
+        if FILE_ACCEL_REDIRECT_PREFIX and file_path is not None and isinstance(storage, LocalFileStorage):
+            try:
+                relative = file_path.resolve().relative_to(storage.root.resolve())
+            except ValueError:
+                relative = None
+            if relative is not None:
+                # nginx tự xử lý Range, giữ Content-Disposition/Cache-Control của phản hồi này
+                return Response(
+                    media_type='application/octet-stream',
+                    headers={**headers, "X-Accel-Redirect": FILE_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + relative.as_posix()}
+                )
+        
+        start, end = byte_range or (0, size - 1)
+        headers["Content-Length"] = str(max(end - start + 1, 0))
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        
+        return StreamingResponse(
+            storage.iter_range(key, start, end) if size else iter(()),
+            status_code=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+            media_type='application/octet-stream',
+            headers=headers
         )
         
     except HTTPException:
@@ -264,7 +380,7 @@ async def download_file(
 @router.delete("/{file_id}")
 async def delete_file(
     file_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Xóa file"""
@@ -300,84 +416,104 @@ async def delete_file(
             detail=f"Lỗi xóa file: {str(e)}"
         )
 
+async def _store_upload(index: int, file: UploadFile, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Kiểm tra, băm và lưu một file; lỗi được trả về như kết quả của file đó"""
+    result = {"index": index, "filename": file.filename, "status": "uploaded", "detail": None}
+    if not file.filename:
+        return {**result, "status": "invalid", "detail": "Không có tên file"}
+    
+    file_ext = Path(file.filename).suffix.lower()
+    if file_ext not in ALLOWED_EXTENSIONS:
+        return {**result, "status": "invalid",
+                "detail": f"Định dạng file không được hỗ trợ. Chỉ chấp nhận: {', '.join(ALLOWED_EXTENSIONS)}"}
+    
+    async with semaphore:
+        try:
+            stored = await FileStorageService.save_upload(file, MAX_FILE_SIZE)
+        except FileTooLargeError as e:
+            return {**result, "status": "too_large", "detail": str(e)}
+        except Exception as e:
+            return {**result, "status": "error", "detail": f"Lỗi lưu file: {str(e)}"}
+    return {**result, "stored": stored}
+
 @router.post("/upload-multiple")
 async def upload_multiple_files(
     files: List[UploadFile] = File(...),
     mo_ta: Optional[str] = Form(None),
     loai_file: Optional[str] = Form(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Upload nhiều file cùng lúc"""
+    """
+    Upload nhiều file cùng lúc: các file được kiểm tra, băm và lưu đồng thời
+    (tối đa FILE_UPLOAD_CONCURRENCY file), bản ghi được thêm trong một lần
+    commit, kết quả trả về cho từng file.
+    """
     try:
-        if len(files) > 10:
+        if len(files) > MAX_FILES_PER_UPLOAD:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Chỉ được upload tối đa 10 file cùng lúc"
+                detail=f"Chỉ được upload tối đa {MAX_FILES_PER_UPLOAD} file cùng lúc"
             )
         
-        uploaded_files = []
+        semaphore = asyncio.Semaphore(FILE_UPLOAD_CONCURRENCY)
+        results = await asyncio.gather(*[
+            _store_upload(index, file, semaphore) for index, file in enumerate(files)
+        ])
         
-        for file in files:
-            if not file.filename:
-                continue
-                
-            # Kiểm tra extension
-            file_ext = Path(file.filename).suffix.lower()
-            if file_ext not in ALLOWED_EXTENSIONS:
-                continue
-            
-            # Kiểm tra kích thước
-            file_content = await file.read()
-            if len(file_content) > MAX_FILE_SIZE:
+        file_records = []
+        jobs = []
+        uploaded_files = []
+        for file, result in zip(files, results):
+            stored = result.pop("stored", None)
+            if stored is None:
                 continue
             
-            # Tạo tên file unique
             file_id = str(uuid.uuid4())
-            new_filename = f"{file_id}{file_ext}"
-            file_path = UPLOAD_DIR / new_filename
-            
-            # Lưu file
-            with open(file_path, "wb") as buffer:
-                buffer.write(file_content)
-            
-            # Lưu vào database
-            file_record = FileRecord(
+            file_records.append(FileRecord(
                 id=file_id,
                 ten_file=file.filename,
                 ten_file_goc=file.filename,
-                duong_dan=str(file_path),
-                kich_thuoc=len(file_content),
+                duong_dan=stored["key"],
+                ma_bam=stored["sha256"],
+                kho_luu_tru=stored["backend"],
+                kich_thuoc=stored["size"],
                 loai_file=loai_file or file.content_type or 'unknown',
                 mo_ta=mo_ta,
                 nguoi_tao_id=current_user.id,
                 trang_thai='hoat_dong'
-            )
-            
-            db.add(file_record)
+            ))
+            job = _processing_job(file_id, file, stored, current_user)
+            if job is not None:
+                jobs.append(job)
+            result.update({"file_id": file_id, "size": stored["size"], "deduplicated": stored["deduplicated"]})
             uploaded_files.append({
                 "file_id": file_id,
                 "filename": file.filename,
-                "size": len(file_content),
+                "size": stored["size"],
                 "url": f"/api/files/{file_id}/download"
             })
         
-        db.commit()
+        # Một lần INSERT nhiều dòng và một commit cho cả lô
+        if file_records:
+            db.add_all(file_records + jobs)
+            db.commit()
+            if jobs:
+                _notify_document_processor()
         
+        failed = len(files) - len(uploaded_files)
         return {
-            "message": f"Upload thành công {len(uploaded_files)} file",
-            "uploaded_files": uploaded_files
+            "message": f"Upload thành công {len(uploaded_files)}/{len(files)} file",
+            "uploaded_files": uploaded_files,
+            "failed": failed,
+            "results": results
         }
         
     except HTTPException:
         raise
     except Exception as e:
+        # Nội dung trong kho có thể đang được bản ghi khác dùng chung nên không xóa
         db.rollback()
-        # Cleanup uploaded files on error
-        for file_info in uploaded_files:
-            file_path = UPLOAD_DIR / f"{file_info['file_id']}{Path(file_info['filename']).suffix}"
-            if file_path.exists():
-                file_path.unlink()
         
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -386,7 +522,7 @@ async def upload_multiple_files(
 
 @router.get("/stats/summary")
 async def get_file_stats(
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy thống kê file"""
@@ -431,4 +567,34 @@ async def get_file_stats(
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi lấy thống kê file: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+@router.get("/processing/stats")
+async def get_processing_stats(
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Độ dài hàng đợi xử lý tệp theo trạng thái và tình trạng process pool"""
+    if current_user.vai_tro not in ['admin', 'quan_ly']:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Không có quyền xem hàng đợi xử lý"
+        )
+    
+    try:
+        counts = db.query(
+            FileUpload.status,
+            func.count(FileUpload.id)
+        ).filter(FileUpload.deleted_at.is_(None)).group_by(FileUpload.status).all()
+        
+        processor = get_document_processor()
+        return {
+            "queue": {file_status.value: count for file_status, count in counts},
+            "processor": processor.snapshot() if processor is not None else None
+        }
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi lấy thống kê xử lý file: {str(e)}"
+        )
@@ -3,12 +3,14 @@ Transaction API endpoints for 7tỷ.vn system
 """
 
 from typing import List, Optional, Dict, Any
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Header
+from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func
 from pydantic import BaseModel, validator
 from datetime import datetime, date
 from decimal import Decimal
+import uuid
 
 from ..database import get_db
 from ..models.users import User
@@ -16,10 +18,21 @@ from ..models.transactions import Transaction
 from ..models.customers import Customer
 from ..models.agents import Agent
 from ..models.bills import Bill
-from ..auth.dependencies import get_current_user
+from ..models.audit import AuditLog, AuditAction
+from ..auth.dependencies import get_current_active_user
+from ..services.idempotency_service import IdempotencyService
+from ..services.ledger_service import LedgerService, InsufficientFundsError
+from ..services.group_commit_service import get_group_commit_writer
+from ..services.outbox_service import OutboxService, get_outbox_dispatcher
+from ..services.partition_service import created_range
+from ..services.agent_aggregate_service import PENDING_BILL_STATUS
+from ..models.outbox import OutboxEvent
 
 router = APIRouter()
 
+# Giới hạn số giao dịch cho mỗi yêu cầu xác nhận/hủy hàng loạt
+MAX_BULK_TRANSACTIONS = 1000
+
 # Pydantic models
 class TransactionCreate(BaseModel):
     khach_hang_id: Optional[str] = None
@@ -40,6 +53,20 @@ class TransactionUpdate(BaseModel):
     trang_thai: Optional[str] = None
     ghi_chu: Optional[str] = None
 
+class BulkTransactionAction(BaseModel):
+    transaction_ids: List[str]
+    
+    @validator('transaction_ids')
+    def validate_ids(cls, v):
+        if not v:
+            raise ValueError('Danh sách giao dịch không được để trống')
+        if len(v) > MAX_BULK_TRANSACTIONS:
+            raise ValueError(f'Chỉ được xử lý tối đa {MAX_BULK_TRANSACTIONS} giao dịch mỗi lần')
+        return v
+
+class BulkTransactionCancel(BulkTransactionAction):
+    reason: str
+
 class TransactionStats(BaseModel):
     total_transactions: int
     successful_transactions: int
@@ -53,18 +80,14 @@ class TransactionStats(BaseModel):
 async def get_transaction_stats(
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy thống kê giao dịch"""
     try:
         query = db.query(Transaction)
         
-        if from_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) >= from_date)
-        
-        if to_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) <= to_date)
+        query = query.filter(*created_range(Transaction.created_at, from_date, to_date))
         
         # Thống kê tổng quan
         total_transactions = query.count()
@@ -78,7 +101,7 @@ async def get_transaction_stats(
         
         # Thống kê hôm nay
         today = date.today()
-        today_query = query.filter(func.date(Transaction.thoi_gian_tao) == today)
+        today_query = query.filter(*created_range(Transaction.created_at, today, today))
         today_transactions = today_query.count()
         today_amount = today_query.filter(Transaction.trang_thai == 'thanh_cong').with_entities(
             func.sum(Transaction.so_tien)
@@ -109,7 +132,7 @@ async def get_transactions(
     status: Optional[str] = Query(None),
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy danh sách giao dịch với bộ lọc"""
@@ -129,11 +152,7 @@ async def get_transactions(
         if status:
             query = query.filter(Transaction.trang_thai == status)
         
-        if from_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) >= from_date)
-        
-        if to_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) <= to_date)
+        query = query.filter(*created_range(Transaction.created_at, from_date, to_date))
         
         # Phân quyền: chỉ admin mới xem được tất cả giao dịch
         if current_user.vai_tro not in ['admin', 'quan_ly']:
@@ -153,7 +172,7 @@ async def get_transactions(
                     query = query.filter(Transaction.id == None)  # Không có giao dịch nào
         
         total = query.count()
-        transactions = query.order_by(Transaction.thoi_gian_tao.desc()).offset(skip).limit(limit).all()
+        transactions = query.order_by(Transaction.created_at.desc()).offset(skip).limit(limit).all()
         
         return {
             "total": total,
@@ -170,7 +189,7 @@ async def get_transactions(
 @router.get("/{transaction_id}")
 async def get_transaction_detail(
     transaction_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Lấy chi tiết giao dịch"""
@@ -204,13 +223,31 @@ async def get_transaction_detail(
             detail=f"Lỗi lấy chi tiết giao dịch: {str(e)}"
         )
 
+def _transaction_audit_values(current_user: User, transaction_values: Dict[str, Any]) -> Dict[str, Any]:
+    """Dữ liệu nhật ký kiểm toán cho giao dịch mới tạo"""
+    return {
+        "id": uuid.uuid4(),
+        "user_id": current_user.id,
+        "user_name": current_user.ho_ten,
+        "user_role": current_user.vai_tro,
+        "action": AuditAction.CREATE,
+        "action_description": "Tạo giao dịch",
+        "target_type": "giao_dich",
+        "target_id": str(transaction_values["id"]),
+        "target_name": transaction_values["ma_giao_dich"],
+        "new_values": jsonable_encoder(transaction_values),
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
 @router.post("/")
 async def create_transaction(
     transaction_data: TransactionCreate,
-    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Tạo giao dịch mới"""
+    idempotency = None
     try:
         # Kiểm tra quyền tạo giao dịch
         if current_user.vai_tro not in ['admin', 'quan_ly', 'dai_ly']:
@@ -219,36 +256,76 @@ async def create_transaction(
                 detail="Không có quyền tạo giao dịch"
             )
         
+        # Yêu cầu gửi lại với cùng Idempotency-Key nhận lại phản hồi cũ
+        idempotency = IdempotencyService(db, idempotency_key, current_user.id, "POST /api/transactions/")
+        replay = idempotency.begin(transaction_data.dict())
+        if replay is not None:
+            return replay
+        
         # Tạo mã giao dịch
         ma_giao_dich = f"{transaction_data.loai_giao_dich.upper()}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{current_user.id}"
         
         # Tạo giao dịch mới
-        new_transaction = Transaction(
-            khach_hang_id=transaction_data.khach_hang_id,
-            dai_ly_id=transaction_data.dai_ly_id,
-            hoa_don_id=transaction_data.hoa_don_id,
-            loai_giao_dich=transaction_data.loai_giao_dich,
-            so_tien=transaction_data.so_tien,
-            phuong_thuc_thanh_toan=transaction_data.phuong_thuc_thanh_toan,
-            trang_thai='dang_xu_ly',
-            ghi_chu=transaction_data.ghi_chu,
-            ma_giao_dich=ma_giao_dich,
-            nguoi_tao_id=current_user.id
-        )
-        
-        db.add(new_transaction)
-        db.commit()
-        db.refresh(new_transaction)
+        transaction_values = {
+            "id": uuid.uuid4(),
+            "khach_hang_id": transaction_data.khach_hang_id,
+            "dai_ly_id": transaction_data.dai_ly_id,
+            "hoa_don_id": transaction_data.hoa_don_id,
+            "loai_giao_dich": transaction_data.loai_giao_dich,
+            "so_tien": transaction_data.so_tien,
+            "phuong_thuc_thanh_toan": transaction_data.phuong_thuc_thanh_toan,
+            "trang_thai": 'dang_xu_ly',
+            "ghi_chu": transaction_data.ghi_chu,
+            "ma_giao_dich": ma_giao_dich,
+            "nguoi_tao_id": current_user.id
+        }
+        audit_values = _transaction_audit_values(current_user, transaction_values)
+        transaction = Transaction(**transaction_values)
         
-        return {
+        response = {
             "message": "Tạo giao dịch thành công",
-            "transaction_id": new_transaction.id,
+            "transaction_id": transaction_values["id"],
             "transaction_code": ma_giao_dich
         }
+        
+        # Giờ cao điểm: gom INSERT giao dịch + nhật ký vào lô group-commit.
+        # Yêu cầu có Idempotency-Key vẫn đi đường ORM vì khóa phải nằm
+        # trong cùng transaction với giao dịch.
+        writer = get_group_commit_writer()
+        if writer is not None and idempotency_key is None:
+            outbox_values = OutboxService.outbox_values(
+                "giao_dich",
+                transaction_values["id"],
+                "giao_dich.tao_moi",
+                OutboxService.transaction_snapshot(transaction),
+                recipients=[current_user.id]
+            )
+            # Ba dòng là một đơn vị: không bao giờ có giao dịch thiếu nhật ký/outbox hoặc ngược lại
+            await writer.write_many([
+                (Transaction, transaction_values),
+                (AuditLog, audit_values),
+                (OutboxEvent, outbox_values)
+            ])
+            dispatcher = get_outbox_dispatcher()
+            if dispatcher is not None:
+                dispatcher.notify()
+            return response
+        
+        db.add(transaction)
+        db.add(AuditLog(**audit_values))
+        OutboxService.record_transaction(db, transaction, "giao_dich.tao_moi")
+        db.flush()
+        
+        idempotency.save_response(response)
+        db.commit()
+        
+        return response
     except HTTPException:
         raise
     except Exception as e:
         db.rollback()
+        if idempotency is not None:
+            idempotency.release()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi tạo giao dịch: {str(e)}"
@@ -258,7 +335,7 @@ async def create_transaction(
 async def update_transaction(
     transaction_id: str,
     transaction_data: TransactionUpdate,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Cập nhật giao dịch"""
@@ -285,6 +362,7 @@ async def update_transaction(
         transaction.thoi_gian_cap_nhat = datetime.utcnow()
         transaction.nguoi_cap_nhat_id = current_user.id
         
+        OutboxService.record_transaction(db, transaction, "giao_dich.cap_nhat")
         db.commit()
         
         return {"message": "Cập nhật giao dịch thành công"}
@@ -300,7 +378,7 @@ async def update_transaction(
 @router.post("/{transaction_id}/confirm")
 async def confirm_transaction(
     transaction_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Xác nhận giao dịch thành công"""
@@ -316,7 +394,7 @@ async def confirm_transaction(
                 Transaction.id == transaction_id,
                 Transaction.trang_thai == 'dang_xu_ly'
             )
-        ).first()
+        ).with_for_update().first()
         
         if not transaction:
             raise HTTPException(
@@ -329,18 +407,36 @@ async def confirm_transaction(
         transaction.thoi_gian_hoan_thanh = datetime.utcnow()
         transaction.nguoi_cap_nhat_id = current_user.id
         
+        # Ghi sổ cái và cập nhật số dư ví đại lý trong cùng transaction
+        LedgerService.post_transaction(db, transaction)
+        
         # Cập nhật hóa đơn nếu có
         if transaction.hoa_don_id:
-            bill = db.query(Bill).filter(Bill.id == transaction.hoa_don_id).first()
-            if bill:
+            bill = db.query(Bill).filter(Bill.id == transaction.hoa_don_id).with_for_update().first()
+            # Chỉ hóa đơn còn chờ thanh toán mới chuyển trạng thái (pending_bills giảm đúng một lần)
+            if bill and bill.trang_thai == PENDING_BILL_STATUS:
                 bill.trang_thai = 'da_thanh_toan'
                 bill.thoi_gian_thanh_toan = datetime.utcnow()
+                OutboxService.record(
+                    db, "hoa_don", bill.id, "hoa_don.da_thanh_toan",
+                    {"id": bill.id, "trang_thai": bill.trang_thai, "giao_dich_id": transaction.id,
+                     "khach_hang_id": bill.khach_hang_id}
+                )
+        
+        # Sự kiện thay đổi ghi trong cùng transaction
+        OutboxService.record_transaction(db, transaction, "giao_dich.thanh_cong")
         
         db.commit()
         
         return {"message": "Xác nhận giao dịch thành công"}
     except HTTPException:
         raise
+    except InsufficientFundsError as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Lỗi xác nhận giao dịch: số dư ví đại lý {e.account_id} không đủ"
+        )
     except Exception as e:
         db.rollback()
         raise HTTPException(
@@ -348,11 +444,166 @@ async def confirm_transaction(
             detail=f"Lỗi xác nhận giao dịch: {str(e)}"
         )
 
+def _lock_transactions_for_bulk(db: Session, transaction_ids: List[str]) -> Dict[str, Transaction]:
+    """Khóa các giao dịch theo thứ tự ID cố định để các lô chạy song song không deadlock"""
+    ordered_ids = sorted(set(transaction_ids))
+    transactions = db.query(Transaction).filter(
+        Transaction.id.in_(ordered_ids)
+    ).order_by(Transaction.id).with_for_update().all()
+    return {str(t.id): t for t in transactions}
+
+def _bulk_outcomes(transaction_ids: List[str], locked: Dict[str, Transaction], allowed_statuses: List[str], done_status: str):
+    """Phân loại kết quả cho từng ID theo thứ tự client gửi lên"""
+    results = []
+    eligible = {}
+    for transaction_id in transaction_ids:
+        transaction = locked.get(transaction_id)
+        if transaction is None:
+            results.append({"transaction_id": transaction_id, "status": "not_found",
+                            "detail": "Không tìm thấy giao dịch"})
+        elif transaction_id in eligible:
+            results.append({"transaction_id": transaction_id, "status": "duplicate",
+                            "detail": "ID bị lặp trong yêu cầu"})
+        elif transaction.trang_thai not in allowed_statuses:
+            results.append({"transaction_id": transaction_id, "status": "invalid_status",
+                            "detail": f"Giao dịch đang ở trạng thái {transaction.trang_thai}"})
+        else:
+            eligible[transaction_id] = transaction
+            results.append({"transaction_id": transaction_id, "status": done_status, "detail": None})
+    return results, eligible
+
+@router.post("/bulk-confirm")
+async def bulk_confirm_transactions(
+    bulk_data: BulkTransactionAction,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Xác nhận hàng loạt giao dịch trong một transaction"""
+    try:
+        if current_user.vai_tro not in ['admin', 'quan_ly']:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Không có quyền xác nhận giao dịch"
+            )
+        
+        locked = _lock_transactions_for_bulk(db, bulk_data.transaction_ids)
+        results, eligible = _bulk_outcomes(bulk_data.transaction_ids, locked, ['dang_xu_ly'], 'confirmed')
+        
+        if eligible:
+            now = datetime.utcnow()
+            
+            # Cập nhật trạng thái bằng một câu lệnh cho cả lô
+            db.query(Transaction).filter(
+                Transaction.id.in_(list(eligible))
+            ).update({
+                Transaction.trang_thai: 'thanh_cong',
+                Transaction.thoi_gian_hoan_thanh: now,
+                Transaction.nguoi_cap_nhat_id: current_user.id
+            }, synchronize_session=False)
+            
+            # Cập nhật các hóa đơn liên quan
+            bill_customers = {t.hoa_don_id: t.khach_hang_id for t in eligible.values() if t.hoa_don_id}
+            bill_ids = set(bill_customers)
+            if bill_ids:
+                bill_ids = {
+                    bill_id for bill_id, in db.query(Bill.id).filter(
+                        Bill.id.in_(sorted(bill_ids)),
+                        Bill.trang_thai == PENDING_BILL_STATUS
+                    ).order_by(Bill.id).with_for_update()
+                }
+            if bill_ids:
+                db.query(Bill).filter(
+                    Bill.id.in_(sorted(bill_ids))
+                ).update({
+                    Bill.trang_thai: 'da_thanh_toan',
+                    Bill.thoi_gian_thanh_toan: now
+                }, synchronize_session=False)
+            
+            # Ghi sổ cái, mỗi ví đại lý chỉ cập nhật một lần
+            LedgerService.post_transactions(db, list(eligible.values()))
+            
+            # Sự kiện thay đổi (đối tượng ORM chưa được đồng bộ nên ghi rõ trạng thái mới)
+            for transaction in eligible.values():
+                OutboxService.record_transaction(db, transaction, "giao_dich.thanh_cong", trang_thai='thanh_cong')
+            for bill_id in sorted(bill_ids):
+                OutboxService.record(db, "hoa_don", bill_id, "hoa_don.da_thanh_toan",
+                                     {"id": bill_id, "trang_thai": 'da_thanh_toan', "khach_hang_id": bill_customers[bill_id]})
+        
+        db.commit()
+        
+        return {
+            "message": f"Đã xác nhận {len(eligible)}/{len(bulk_data.transaction_ids)} giao dịch",
+            "confirmed": len(eligible),
+            "results": results
+        }
+    except HTTPException:
+        raise
+    except InsufficientFundsError as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Lỗi xác nhận hàng loạt: số dư ví đại lý {e.account_id} không đủ"
+        )
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi xác nhận hàng loạt: {str(e)}"
+        )
+
+@router.post("/bulk-cancel")
+async def bulk_cancel_transactions(
+    bulk_data: BulkTransactionCancel,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Hủy hàng loạt giao dịch trong một transaction"""
+    try:
+        if current_user.vai_tro not in ['admin', 'quan_ly']:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Không có quyền hủy giao dịch"
+            )
+        
+        locked = _lock_transactions_for_bulk(db, bulk_data.transaction_ids)
+        results, eligible = _bulk_outcomes(
+            bulk_data.transaction_ids, locked, ['dang_xu_ly', 'cho_duyet'], 'cancelled'
+        )
+        
+        if eligible:
+            db.query(Transaction).filter(
+                Transaction.id.in_(list(eligible))
+            ).update({
+                Transaction.trang_thai: 'da_huy',
+                Transaction.thoi_gian_cap_nhat: datetime.utcnow(),
+                Transaction.nguoi_cap_nhat_id: current_user.id,
+                Transaction.ghi_chu: func.coalesce(Transaction.ghi_chu, '') + f"\nLý do hủy: {bulk_data.reason}"
+            }, synchronize_session=False)
+            
+            for transaction in eligible.values():
+                OutboxService.record_transaction(db, transaction, "giao_dich.da_huy", trang_thai='da_huy')
+        
+        db.commit()
+        
+        return {
+            "message": f"Đã hủy {len(eligible)}/{len(bulk_data.transaction_ids)} giao dịch",
+            "cancelled": len(eligible),
+            "results": results
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Lỗi hủy hàng loạt: {str(e)}"
+        )
+
 @router.post("/{transaction_id}/cancel")
 async def cancel_transaction(
     transaction_id: str,
     reason: str = Query(..., description="Lý do hủy giao dịch"),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Hủy giao dịch"""
@@ -368,7 +619,7 @@ async def cancel_transaction(
                 Transaction.id == transaction_id,
                 Transaction.trang_thai.in_(['dang_xu_ly', 'cho_duyet'])
             )
-        ).first()
+        ).with_for_update().first()
         
         if not transaction:
             raise HTTPException(
@@ -382,6 +633,7 @@ async def cancel_transaction(
         transaction.nguoi_cap_nhat_id = current_user.id
         transaction.ghi_chu = f"{transaction.ghi_chu or ''}\nLý do hủy: {reason}"
         
+        OutboxService.record_transaction(db, transaction, "giao_dich.da_huy")
         db.commit()
         
         return {"message": "Hủy giao dịch thành công"}
@@ -399,7 +651,7 @@ async def export_transactions_csv(
     from_date: Optional[date] = Query(None),
     to_date: Optional[date] = Query(None),
     status: Optional[str] = Query(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Xuất danh sách giao dịch ra CSV"""
@@ -412,16 +664,12 @@ async def export_transactions_csv(
         
         query = db.query(Transaction)
         
-        if from_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) >= from_date)
-        
-        if to_date:
-            query = query.filter(func.date(Transaction.thoi_gian_tao) <= to_date)
+        query = query.filter(*created_range(Transaction.created_at, from_date, to_date))
         
         if status:
             query = query.filter(Transaction.trang_thai == status)
         
-        transactions = query.order_by(Transaction.thoi_gian_tao.desc()).all()
+        transactions = query.order_by(Transaction.created_at.desc()).all()
         
         # Tạo CSV data
         csv_data = []
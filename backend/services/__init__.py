@@ -2,14 +2,37 @@
 Business logic services
 """
 
-from .bill_service import BillService
-from .excel_service import ExcelService
-from .approval_service import ApprovalService
-from .commission_service import CommissionService
-
-__all__ = [
-    "BillService",
-    "ExcelService", 
-    "ApprovalService",
-    "CommissionService"
-]
\ No newline at end of file
+from importlib import import_module
+
+# Tên -> module; module chỉ được import khi dùng tới để import một service
+# (hoặc chạy test của nó) không kéo theo models và database của mọi service khác
+_EXPORTS = {
+    "BillService": "bill_service",
+    "ExcelService": "excel_service",
+    "ApprovalService": "approval_service",
+    "CommissionService": "commission_service",
+    "IdempotencyService": "idempotency_service",
+    "LedgerService": "ledger_service",
+    "GroupCommitWriter": "group_commit_service",
+    "OutboxService": "outbox_service",
+    "OutboxDispatcher": "outbox_service",
+    "PartitionService": "partition_service",
+    "AgentDashboardService": "dashboard_service",
+    "CommissionReportService": "commission_report_service",
+    "SettlementService": "settlement_service",
+    "ResourceVersionService": "resource_version_service",
+    "AgentAggregateService": "agent_aggregate_service",
+    "ApprovalInboxService": "approval_inbox_service",
+    "ApprovalSlaService": "approval_sla_service",
+    "AutoApprovalService": "auto_approval_service",
+    "DocumentProcessor": "document_processing_service"
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,324 @@
+"""
+Agent aggregate service - tổng hợp đại lý theo khu vực, nhân viên phụ trách và tỉnh thành, cập nhật tăng dần
+"""
+
+import os
+import uuid
+import zlib
+from collections import defaultdict
+from decimal import Decimal
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import event, func, text, cast, String
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from ..models.agents import Agent, AgentAggregate
+from ..models.customers import Customer
+from ..models.transactions import Transaction
+from ..models.bills import Bill
+
+# Configuration
+AGENT_AGGREGATE_STRIPES = int(os.getenv("AGENT_AGGREGATE_STRIPES", "8"))
+
+# Chiều tổng hợp -> thuộc tính của đại lý
+DIMENSION_REGION = "khu_vuc"
+DIMENSION_STAFF = "nhan_vien"
+DIMENSION_PROVINCE = "tinh_thanh"
+DIMENSION_AGENT = "dai_ly"
+GROUP_DIMENSIONS = {
+    DIMENSION_REGION: "region",
+    DIMENSION_STAFF: "staff_id",
+    DIMENSION_PROVINCE: "tinh_thanh"
+}
+DIMENSIONS = (*GROUP_DIMENSIONS, DIMENSION_AGENT)
+
+# Giá trị nhóm khi đại lý chưa được gán khu vực / nhân viên / tỉnh
+UNASSIGNED = "chua_phan_bo"
+
+MEASURES = ("customers", "transactions", "sales", "commission", "pending_bills")
+
+# pending_bills đếm hóa đơn (bảng hoa_don) ở trạng thái này: +1 khi tạo, -1 khi thanh toán, rebuild đếm lại
+PENDING_BILL_STATUS = "chua_thanh_toan"
+
+UPSERT_CHUNK_SIZE = 2000
+
+# Delta chờ ghi khi session commit: (loại chủ sở hữu, ID) -> {chỉ số: delta}
+PENDING_KEY = "agent_aggregates_pending"
+
+def stripe_of(agent_id: Any, stripes: int = AGENT_AGGREGATE_STRIPES) -> int:
+    """Stripe cố định của đại lý trong mọi nhóm"""
+    return zlib.crc32(str(agent_id).encode()) % stripes
+
+def _empty() -> Dict[str, Any]:
+    return {"customers": 0, "transactions": 0, "sales": Decimal("0"), "commission": Decimal("0"), "pending_bills": 0}
+
+class AgentAggregateService:
+    """
+    Bảng tong_hop_dai_ly giữ sẵn số khách hàng, số giao dịch, doanh số, hoa
+    hồng và hóa đơn chờ thanh toán cho từng khu vực, nhân viên phụ trách,
+    tỉnh thành (và từng đại lý). Delta được suy ra từ các sự kiện outbox
+    trong cùng transaction và ghi bằng một câu INSERT ... ON CONFLICT ngay
+    trước khi commit, nên dashboard quản lý chỉ đọc vài dòng mỗi nhóm bất
+    kể kích thước bảng giao dịch.
+    """
+
+    @staticmethod
+    def project_event(db: Session, event_type: str, payload: Optional[Dict[str, Any]]):
+        """Chuyển một sự kiện nghiệp vụ thành delta tổng hợp (gọi từ OutboxService.record)"""
+        payload = payload or {}
+
+        if event_type == "giao_dich.thanh_cong" and payload.get("dai_ly_id"):
+            AgentAggregateService.add(
+                db, "agent", payload["dai_ly_id"],
+                transactions=1,
+                sales=Decimal(str(payload.get("so_tien") or 0)),
+                commission=Decimal(str(payload.get("hoa_hong") or 0))
+            )
+        elif event_type == "hoa_don.da_thanh_toan" and payload.get("khach_hang_id"):
+            AgentAggregateService.add(db, "customer", payload["khach_hang_id"], pending_bills=-1)
+        elif event_type == "khach_hang.tao_moi" and payload.get("dai_ly_id"):
+            AgentAggregateService.add(db, "agent", payload["dai_ly_id"], customers=1)
+
+    @staticmethod
+    def add(db: Session, owner_type: str, owner_id: Any, **deltas):
+        """Cộng dồn delta cho đại lý (owner_type="agent") hoặc đại lý của khách hàng ("customer")"""
+        pending = db.info.setdefault(PENDING_KEY, {})
+        totals = pending.setdefault((owner_type, str(owner_id)), _empty())
+        for measure, delta in deltas.items():
+            totals[measure] += delta
+
+    @staticmethod
+    def _upsert(connection: Any, rows: Dict[Tuple[str, str, int], Dict[str, Any]]):
+        """Cộng delta vào các dòng (chiều, nhóm, stripe) bằng một câu lệnh, khóa theo thứ tự cố định"""
+        if not rows:
+            return
+
+        now = datetime.utcnow()
+        values = [
+            {
+                "id": uuid.uuid4(),
+                "dimension": dimension,
+                "dimension_key": key,
+                "stripe": stripe,
+                **deltas,
+                "created_at": now,
+                "updated_at": now,
+                "is_active": True
+            }
+            for (dimension, key, stripe), deltas in sorted(rows.items())
+        ]
+        # Chia khối để không vượt giới hạn tham số của một câu lệnh (chỉ xảy ra khi rebuild)
+        for start in range(0, len(values), UPSERT_CHUNK_SIZE):
+            stmt = insert(AgentAggregate).values(values[start:start + UPSERT_CHUNK_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[AgentAggregate.dimension, AgentAggregate.dimension_key, AgentAggregate.stripe],
+                set_={
+                    **{measure: getattr(AgentAggregate, measure) + stmt.excluded[measure] for measure in MEASURES},
+                    "updated_at": now
+                }
+            )
+            connection.execute(stmt)
+
+    @staticmethod
+    def _group_rows(agent_deltas: Dict[str, Dict[str, Any]], agents: Dict[str, Any]) -> Dict[Tuple[str, str, int], Dict[str, Any]]:
+        """Dàn delta của từng đại lý ra các nhóm khu vực / nhân viên / tỉnh và dòng của chính đại lý"""
+        rows = defaultdict(_empty)
+        for agent_id, deltas in agent_deltas.items():
+            agent = agents.get(agent_id)
+            if agent is None or not any(deltas.values()):
+                continue
+            stripe = stripe_of(agent_id)
+            keys = [(dimension, str(getattr(agent, attribute) or UNASSIGNED), stripe)
+                    for dimension, attribute in GROUP_DIMENSIONS.items()]
+            keys.append((DIMENSION_AGENT, agent_id, 0))
+            for key in keys:
+                for measure in MEASURES:
+                    rows[key][measure] += deltas[measure]
+        return rows
+
+    @staticmethod
+    def _agent_dimensions(db: Session, agent_ids: List[str], lock: bool = False) -> Dict[str, Any]:
+        query = db.query(Agent.id, Agent.region, Agent.staff_id, Agent.tinh_thanh).filter(Agent.id.in_(sorted(agent_ids)))
+        if lock:
+            # Khóa chia sẻ: chặn việc chuyển nhóm của đại lý cho tới khi delta đã ghi
+            query = query.order_by(Agent.id).with_for_update(read=True)
+        return {str(row.id): row for row in query.all()}
+
+    @staticmethod
+    def apply(db: Session, pending: Dict[Tuple[str, str], Dict[str, Any]]):
+        """Ghi các delta đang chờ vào bảng tổng hợp (trong transaction hiện tại)"""
+        agent_deltas = defaultdict(_empty)
+
+        customer_ids = [owner_id for owner_type, owner_id in pending if owner_type == "customer"]
+        customer_agents = {}
+        if customer_ids:
+            customer_agents = {
+                str(customer_id): str(agent_id)
+                for customer_id, agent_id in db.query(Customer.id, Customer.dai_ly_id).filter(
+                    Customer.id.in_(customer_ids), Customer.dai_ly_id.isnot(None)
+                ).all()
+            }
+
+        for (owner_type, owner_id), deltas in pending.items():
+            agent_id = owner_id if owner_type == "agent" else customer_agents.get(owner_id)
+            if agent_id is None:
+                continue
+            for measure in MEASURES:
+                agent_deltas[agent_id][measure] += deltas[measure]
+
+        if not agent_deltas:
+            return
+
+        agents = AgentAggregateService._agent_dimensions(db, list(agent_deltas), lock=True)
+        AgentAggregateService._upsert(db, AgentAggregateService._group_rows(agent_deltas, agents))
+
+    @staticmethod
+    def move_agent(db: Session, agent_id: Any, dimension: str, new_key: Any):
+        """
+        Chuyển số liệu đã tổng hợp của đại lý sang nhóm mới khi đổi khu vực /
+        nhân viên / tỉnh. Gọi trước khi gán thuộc tính mới, trong cùng transaction.
+        """
+        attribute = GROUP_DIMENSIONS[dimension]
+        agent = db.query(Agent).filter(Agent.id == agent_id).with_for_update().first()
+        if agent is None:
+            return
+
+        old_key = str(getattr(agent, attribute) or UNASSIGNED)
+        new_key = str(new_key or UNASSIGNED)
+        if old_key == new_key:
+            return
+
+        totals = db.query(*[func.coalesce(func.sum(getattr(AgentAggregate, measure)), 0) for measure in MEASURES]).filter(
+            AgentAggregate.dimension == DIMENSION_AGENT,
+            AgentAggregate.dimension_key == str(agent_id)
+        ).one()
+        totals = dict(zip(MEASURES, totals))
+        if not any(totals.values()):
+            return
+
+        stripe = stripe_of(agent_id)
+        AgentAggregateService._upsert(db, {
+            (dimension, old_key, stripe): {measure: -value for measure, value in totals.items()},
+            (dimension, new_key, stripe): totals
+        })
+
+    @staticmethod
+    def rebuild(db: Session) -> Dict[str, int]:
+        """
+        Tính lại toàn bộ bảng tổng hợp từ dữ liệu gốc (khởi tạo lần đầu hoặc
+        sửa sai lệch). Khóa EXCLUSIVE chặn delta đồng thời nhưng vẫn cho đọc;
+        delta của transaction đang chạy được cộng sau khi rebuild commit.
+        """
+        db.execute(text(f"LOCK TABLE {AgentAggregate.__tablename__} IN EXCLUSIVE MODE"))
+
+        agent_deltas = defaultdict(_empty)
+        for agent_id, count in db.query(Customer.dai_ly_id, func.count(Customer.id)).filter(
+            Customer.dai_ly_id.isnot(None)
+        ).group_by(Customer.dai_ly_id):
+            agent_deltas[str(agent_id)]["customers"] = count
+
+        for agent_id, count, sales, commission in db.query(
+            Transaction.dai_ly_id,
+            func.count(Transaction.id),
+            func.coalesce(func.sum(Transaction.so_tien), 0),
+            func.coalesce(func.sum(Transaction.hoa_hong), 0)
+        ).filter(
+            Transaction.dai_ly_id.isnot(None),
+            Transaction.trang_thai == 'thanh_cong'
+        ).group_by(Transaction.dai_ly_id):
+            agent_deltas[str(agent_id)].update(transactions=count, sales=Decimal(sales), commission=Decimal(commission))
+
+        for agent_id, count in db.query(Customer.dai_ly_id, func.count(Bill.id)).join(
+            Customer, Bill.khach_hang_id == Customer.id
+        ).filter(
+            Customer.dai_ly_id.isnot(None),
+            Bill.trang_thai == PENDING_BILL_STATUS
+        ).group_by(Customer.dai_ly_id):
+            agent_deltas[str(agent_id)]["pending_bills"] = count
+
+        agents = AgentAggregateService._agent_dimensions(db, list(agent_deltas))
+        rows = AgentAggregateService._group_rows(agent_deltas, agents)
+
+        db.query(AgentAggregate).delete(synchronize_session=False)
+        AgentAggregateService._upsert(db, rows)
+        db.commit()
+
+        return {"agents": len(agents), "rows": len(rows)}
+
+    @staticmethod
+    def _totals_columns():
+        return [func.coalesce(func.sum(getattr(AgentAggregate, measure)), 0).label(measure) for measure in MEASURES]
+
+    @staticmethod
+    def groups(db: Session, dimension: str, sort_by: str = "sales", limit: int = 100) -> List[Dict[str, Any]]:
+        """Tổng hợp của mọi nhóm trong một chiều (cộng các stripe)"""
+        columns = AgentAggregateService._totals_columns()
+        sort_column = next(column for column in columns if column.name == sort_by)
+        rows = db.query(AgentAggregate.dimension_key, *columns).filter(
+            AgentAggregate.dimension == dimension
+        ).group_by(
+            AgentAggregate.dimension_key
+        ).order_by(
+            sort_column.desc(), AgentAggregate.dimension_key
+        ).limit(limit).all()
+        return [{"key": row.dimension_key, **{measure: getattr(row, measure) for measure in MEASURES}} for row in rows]
+
+    @staticmethod
+    def group_detail(db: Session, dimension: str, key: str, top_agents: int = 20) -> Dict[str, Any]:
+        """Tổng hợp một nhóm và các đại lý có doanh số cao nhất trong nhóm"""
+        totals = db.query(*AgentAggregateService._totals_columns()).filter(
+            AgentAggregate.dimension == dimension,
+            AgentAggregate.dimension_key == key
+        ).one()
+
+        attribute = getattr(Agent, GROUP_DIMENSIONS[dimension])
+        member = attribute.is_(None) if key == UNASSIGNED else attribute == key
+        agents = db.query(
+            Agent.id, Agent.agent_code, Agent.agent_name,
+            *[getattr(AgentAggregate, measure) for measure in MEASURES]
+        ).join(
+            AgentAggregate, cast(Agent.id, String) == AgentAggregate.dimension_key
+        ).filter(
+            AgentAggregate.dimension == DIMENSION_AGENT,
+            member
+        ).order_by(
+            AgentAggregate.sales.desc()
+        ).limit(top_agents).all()
+
+        return {
+            "dimension": dimension,
+            "key": key,
+            **{measure: getattr(totals, measure) for measure in MEASURES},
+            "top_agents": [
+                {
+                    "agent_id": row.id,
+                    "agent_code": row.agent_code,
+                    "agent_name": row.agent_name,
+                    **{measure: getattr(row, measure) for measure in MEASURES}
+                }
+                for row in agents
+            ]
+        }
+
+@event.listens_for(Session, "before_flush")
+def _count_new_pending_bills(session, flush_context, instances):
+    """Hóa đơn mới chờ thanh toán (không đi qua outbox) được cộng vào pending_bills của đại lý quản lý khách hàng"""
+    for obj in session.new:
+        if isinstance(obj, Bill) and obj.khach_hang_id and obj.trang_thai == PENDING_BILL_STATUS:
+            AgentAggregateService.add(session, "customer", obj.khach_hang_id, pending_bills=1)
+
+@event.listens_for(Session, "before_commit")
+def _apply_aggregates_before_commit(session):
+    """Ghi delta tổng hợp trong cùng transaction với thay đổi nghiệp vụ"""
+    # Flush trước để delta của hóa đơn mới (before_flush) có mặt khi ghi
+    if session.new:
+        session.flush()
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        AgentAggregateService.apply(session, pending)
+
+@event.listens_for(Session, "after_transaction_end")
+def _clear_aggregates_after_transaction(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(PENDING_KEY, None)
@@ -8,11 +8,13 @@ from sqlalchemy import and_, or_, func
 from decimal import Decimal
 from datetime import datetime, date
 
-from ..models.agents import Agent
+from ..models.agents import Agent, AgentWallet
 from ..models.users import User
 from ..models.customers import Customer
 from ..models.transactions import Transaction
 from ..auth.password import get_password_hash
+from .ledger_service import LedgerService
+from .commission_service import CommissionService
 
 class AgentService:
     
@@ -46,6 +48,10 @@ class AgentService:
         )
         
         db.add(new_agent)
+        db.flush()
+        
+        # Ví đại lý giữ số dư chạy theo sổ cái
+        db.add(AgentWallet(agent_id=new_agent.id))
         return new_agent
     
     @staticmethod
@@ -69,7 +75,7 @@ class AgentService:
             and_(
                 Transaction.dai_ly_id == agent.id,
                 Transaction.trang_thai == 'thanh_cong',
-                Transaction.thoi_gian_tao >= current_month
+                Transaction.created_at >= current_month
             )
         ).scalar() or Decimal('0')
         
@@ -82,37 +88,11 @@ class AgentService:
     
     @staticmethod
     def calculate_commission(transaction_amount: Decimal, agent_level: str = 'basic') -> Decimal:
-        """Tính hoa hồng cho đại lý"""
-        commission_rates = {
-            'basic': Decimal('0.02'),  # 2%
-            'silver': Decimal('0.025'),  # 2.5%
-            'gold': Decimal('0.03'),  # 3%
-            'platinum': Decimal('0.035')  # 3.5%
-        }
-        
-        rate = commission_rates.get(agent_level, commission_rates['basic'])
-        return transaction_amount * rate
+        """Tính hoa hồng cho đại lý theo bộ quy tắc mặc định"""
+        return CommissionService.calculate(transaction_amount, level=agent_level)
     
     @staticmethod
     def update_agent_balance(db: Session, agent: Agent) -> Decimal:
-        """Cập nhật số dư đại lý"""
-        total_income = db.query(func.sum(Transaction.hoa_hong)).filter(
-            and_(
-                Transaction.dai_ly_id == agent.id,
-                Transaction.trang_thai == 'thanh_cong',
-                Transaction.loai_giao_dich.in_(['hoa_hong', 'nap_tien'])
-            )
-        ).scalar() or Decimal('0')
-        
-        total_expense = db.query(func.sum(Transaction.so_tien)).filter(
-            and_(
-                Transaction.dai_ly_id == agent.id,
-                Transaction.trang_thai == 'thanh_cong',
-                Transaction.loai_giao_dich.in_(['rut_tien', 'thanh_toan'])
-            )
-        ).scalar() or Decimal('0')
-        
-        current_balance = total_income - total_expense
-        agent.so_du_hien_tai = current_balance
-        
-        return current_balance
\ No newline at end of file
+        """Lấy số dư đại lý (được cập nhật cùng sổ cái, không tính lại từ lịch sử)"""
+        wallet = LedgerService.get_agent_wallet(db, agent.id)
+        return wallet.balance if wallet else Decimal('0')
\ No newline at end of file
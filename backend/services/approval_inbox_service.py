@@ -0,0 +1,171 @@
+"""
+Approval inbox service - thống kê phê duyệt từ bảng đếm và phân trang keyset cho hộp duyệt
+"""
+
+import json
+import uuid
+import base64
+from collections import defaultdict
+from typing import Any, Dict, Optional, Tuple
+from datetime import date, datetime
+from sqlalchemy import event, func, case, inspect, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, Query
+
+from ..models.approvals import Approval, ApprovalCounter
+
+# Delta chờ ghi khi session commit: (ngày tạo, trạng thái) -> delta
+PENDING_KEY = "approval_counters_pending"
+
+def _status_value(value: Any) -> Optional[str]:
+    return getattr(value, "value", value)
+
+def encode_cursor(status: Any, created_at: datetime, approval_id: Any) -> str:
+    """Cursor keyset (trang_thai, thoi_gian_tao, id) của dòng cuối trang"""
+    raw = json.dumps([_status_value(status), created_at.isoformat(), str(approval_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, datetime, uuid.UUID]:
+    """Giải mã cursor; ValueError nếu cursor không hợp lệ"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        status, created_at, approval_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return status, datetime.fromisoformat(created_at), uuid.UUID(approval_id)
+    except Exception:
+        raise ValueError("Cursor không hợp lệ")
+
+class ApprovalInboxService:
+    """
+    Bảng dem_phe_duyet giữ số yêu cầu theo (ngày tạo, trạng thái hiện tại),
+    cập nhật trong cùng transaction khi phê duyệt được tạo hoặc đổi trạng
+    thái, nên thống kê chỉ là một truy vấn GROUP BY trên vài dòng mỗi ngày.
+    Danh sách phân trang theo (trang_thai, thoi_gian_tao, id) giảm dần, khớp
+    index idx_phe_duyet_inbox, nên trang sâu tốn như trang đầu.
+    """
+
+    @staticmethod
+    def add(db: Session, created_on: date, status: Any, delta: int):
+        """Cộng dồn delta cho (ngày tạo, trạng thái); ghi khi session commit"""
+        pending = db.info.setdefault(PENDING_KEY, defaultdict(int))
+        pending[(created_on, _status_value(status))] += delta
+
+    @staticmethod
+    def transition(db: Session, created_at: Optional[datetime], old_status: Any, new_status: Any, count: int = 1):
+        """Ghi nhận yêu cầu chuyển trạng thái (dùng cho các câu UPDATE hàng loạt không qua ORM)"""
+        created_on = (created_at or datetime.utcnow()).date()
+        if old_status is not None:
+            ApprovalInboxService.add(db, created_on, old_status, -count)
+        if new_status is not None:
+            ApprovalInboxService.add(db, created_on, new_status, count)
+
+    @staticmethod
+    def apply(connection: Any, pending: Dict[Tuple[date, str], int]):
+        """Cộng các delta vào bảng đếm bằng một câu INSERT ... ON CONFLICT"""
+        rows = sorted((key, delta) for key, delta in pending.items() if delta)
+        if not rows:
+            return
+
+        now = datetime.utcnow()
+        stmt = insert(ApprovalCounter).values([
+            {
+                "id": uuid.uuid4(),
+                "bucket_date": created_on,
+                "status": status,
+                "count": delta,
+                "created_at": now,
+                "updated_at": now,
+                "is_active": True
+            }
+            for (created_on, status), delta in rows
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ApprovalCounter.bucket_date, ApprovalCounter.status],
+            set_={"count": ApprovalCounter.count + stmt.excluded.count, "updated_at": now}
+        )
+        connection.execute(stmt)
+
+    @staticmethod
+    def rebuild(db: Session) -> int:
+        """
+        Tính lại bảng đếm từ phe_duyet (khởi tạo lần đầu hoặc sửa sai lệch).
+        Khóa EXCLUSIVE chặn delta đồng thời ghi vào bảng đếm giữa lúc đếm và lúc ghi lại.
+        """
+        db.execute(text(f"LOCK TABLE {ApprovalCounter.__tablename__} IN EXCLUSIVE MODE"))
+        created_on = func.date(Approval.thoi_gian_tao)
+        rows = db.query(created_on, Approval.trang_thai, func.count(Approval.id)).group_by(
+            created_on, Approval.trang_thai
+        ).all()
+
+        db.query(ApprovalCounter).delete(synchronize_session=False)
+        ApprovalInboxService.apply(db, {(day, _status_value(status)): count for day, status, count in rows})
+        db.commit()
+        return len(rows)
+
+    @staticmethod
+    def stats(db: Session) -> Dict[str, int]:
+        """Tổng theo trạng thái và số yêu cầu chờ duyệt tạo hôm nay, trong một truy vấn"""
+        today = datetime.utcnow().date()
+        rows = db.query(
+            ApprovalCounter.status,
+            func.coalesce(func.sum(ApprovalCounter.count), 0),
+            func.coalesce(func.sum(case((ApprovalCounter.bucket_date == today, ApprovalCounter.count), else_=0)), 0)
+        ).group_by(ApprovalCounter.status).all()
+
+        totals = {status: (int(total), int(today_total)) for status, total, today_total in rows}
+        return {
+            "total_pending": totals.get('cho_duyet', (0, 0))[0],
+            "total_approved": totals.get('da_duyet', (0, 0))[0],
+            "total_rejected": totals.get('tu_choi', (0, 0))[0],
+            "today_pending": totals.get('cho_duyet', (0, 0))[1]
+        }
+
+    @staticmethod
+    def page(query: Query, limit: int = 50, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """Một trang phê duyệt theo (trang_thai, thoi_gian_tao, id) giảm dần; next_cursor là None ở trang cuối"""
+        key = tuple_(Approval.trang_thai, Approval.thoi_gian_tao, Approval.id)
+        if cursor:
+            query = query.filter(key < tuple_(*decode_cursor(cursor)))
+
+        approvals = query.order_by(
+            Approval.trang_thai.desc(), Approval.thoi_gian_tao.desc(), Approval.id.desc()
+        ).limit(limit + 1).all()
+
+        has_more = len(approvals) > limit
+        approvals = approvals[:limit]
+        last = approvals[-1] if approvals else None
+
+        return {
+            "approvals": approvals,
+            "next_cursor": encode_cursor(last.trang_thai, last.thoi_gian_tao, last.id) if has_more else None,
+            "limit": limit
+        }
+
+@event.listens_for(Session, "before_flush")
+def _collect_approval_transitions(session, flush_context, instances):
+    """Suy ra delta bảng đếm từ các phê duyệt được thêm, đổi trạng thái hoặc xóa qua ORM"""
+    for obj in session.new:
+        if isinstance(obj, Approval):
+            ApprovalInboxService.transition(session, obj.thoi_gian_tao, None, obj.trang_thai or 'cho_duyet')
+
+    for obj in session.dirty:
+        if isinstance(obj, Approval):
+            history = inspect(obj).attrs.trang_thai.history
+            if history.added and history.deleted:
+                ApprovalInboxService.transition(session, obj.thoi_gian_tao, history.deleted[0], history.added[0])
+
+    for obj in session.deleted:
+        if isinstance(obj, Approval):
+            ApprovalInboxService.transition(session, obj.thoi_gian_tao, obj.trang_thai, None)
+
+@event.listens_for(Session, "before_commit")
+def _apply_approval_counters_before_commit(session):
+    # Flush trước để before_flush thu thập các thay đổi chưa ghi
+    session.flush()
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        ApprovalInboxService.apply(session, pending)
+
+@event.listens_for(Session, "after_transaction_end")
+def _clear_approval_counters_after_transaction(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(PENDING_KEY, None)
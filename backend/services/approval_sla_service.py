@@ -0,0 +1,365 @@
+"""
+Approval SLA service - bộ lập lịch theo hạn xử lý, leo thang các bước phê duyệt quá hạn theo lô
+"""
+
+import os
+import uuid
+import heapq
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+from sqlalchemy import event, func, case, literal, null, select, update, DateTime
+from sqlalchemy.orm import Session
+
+from ..models.approvals import ApprovalStep, StepStatus
+from .outbox_service import OutboxService, get_outbox_dispatcher
+
+# Configuration
+APPROVAL_SLA_ENABLED = os.getenv("APPROVAL_SLA_ENABLED", "true").lower() == "true"
+APPROVAL_SLA_DEFAULT_TIMEOUT_HOURS = int(os.getenv("APPROVAL_SLA_DEFAULT_TIMEOUT_HOURS", "24"))
+APPROVAL_SLA_BATCH_SIZE = int(os.getenv("APPROVAL_SLA_BATCH_SIZE", "100"))
+APPROVAL_SLA_QUEUE_SIZE = int(os.getenv("APPROVAL_SLA_QUEUE_SIZE", "10000"))
+APPROVAL_SLA_RESYNC_SECONDS = float(os.getenv("APPROVAL_SLA_RESYNC_SECONDS", "300"))
+# Vai trò nhận bước quá hạn ở mỗi cấp leo thang
+APPROVAL_SLA_ESCALATION_CHAIN = [
+    role.strip() for role in os.getenv("APPROVAL_SLA_ESCALATION_CHAIN", "quan_ly,admin").split(",") if role.strip()
+]
+
+# Hạn xử lý mới chờ đưa vào hàng đợi sau khi session commit: [(step_id, due_at)]
+PENDING_KEY = "approval_sla_pending"
+
+class ApprovalSlaService:
+
+    @staticmethod
+    def assign(
+        db: Session,
+        step: ApprovalStep,
+        approver_id: Optional[Any] = None,
+        approver_role: Optional[str] = None,
+        now: Optional[datetime] = None
+    ) -> ApprovalStep:
+        """Giao bước cho người/vai trò duyệt và đặt hạn xử lý = bây giờ + timeout_hours"""
+        now = now or datetime.utcnow()
+        if step.id is None:
+            step.id = uuid.uuid4()
+        step.approver_id = str(approver_id) if approver_id else None
+        step.approver_role = approver_role
+        step.status = StepStatus.PENDING
+        step.assigned_at = now.isoformat()
+        step.due_at = now + timedelta(hours=step.timeout_hours or APPROVAL_SLA_DEFAULT_TIMEOUT_HOURS)
+
+        db.info.setdefault(PENDING_KEY, []).append((str(step.id), step.due_at))
+        return step
+
+    @staticmethod
+    def open_step(
+        db: Session,
+        approval_id: Any,
+        step_name: str = "Duyệt yêu cầu",
+        approver_role: Optional[str] = None,
+        step_order: int = 1,
+        timeout_hours: int = APPROVAL_SLA_DEFAULT_TIMEOUT_HOURS
+    ) -> ApprovalStep:
+        """Tạo bước phê duyệt mới đã được giao và có hạn xử lý"""
+        step = ApprovalStep(
+            approval_id=str(approval_id),
+            step_order=step_order,
+            step_name=step_name,
+            timeout_hours=timeout_hours,
+            escalation_level=0
+        )
+        db.add(step)
+        return ApprovalSlaService.assign(
+            db, step, approver_role=approver_role or (APPROVAL_SLA_ESCALATION_CHAIN[0] if APPROVAL_SLA_ESCALATION_CHAIN else None)
+        )
+
+    @staticmethod
+    def close_steps(
+        db: Session,
+        approval_ids: List[Any],
+        step_status: StepStatus,
+        approver_id: Any,
+        approver_name: Optional[str] = None
+    ) -> int:
+        """Đóng các bước đang chờ của phê duyệt (một câu UPDATE); bước đã đóng rời hàng đợi SLA"""
+        if not approval_ids:
+            return 0
+        result = db.execute(
+            update(ApprovalStep).where(
+                ApprovalStep.approval_id.in_([str(approval_id) for approval_id in approval_ids]),
+                ApprovalStep.status == StepStatus.PENDING
+            ).values(
+                status=step_status,
+                decision=step_status.value,
+                approver_id=str(approver_id),
+                approver_name=approver_name,
+                processed_at=datetime.utcnow().isoformat(),
+                due_at=None
+            ),
+            execution_options={"synchronize_session": False}
+        )
+        return result.rowcount
+
+    @staticmethod
+    def next_due(db: Session, limit: int = APPROVAL_SLA_QUEUE_SIZE) -> List[Tuple[str, datetime]]:
+        """Các hạn xử lý gần nhất theo index (status, due_at)"""
+        rows = db.query(ApprovalStep.id, ApprovalStep.due_at).filter(
+            ApprovalStep.status == StepStatus.PENDING,
+            ApprovalStep.due_at.isnot(None)
+        ).order_by(ApprovalStep.due_at).limit(limit).all()
+        return [(str(step_id), due_at) for step_id, due_at in rows]
+
+    @staticmethod
+    def escalate_due(db: Session, now: datetime, limit: int = APPROVAL_SLA_BATCH_SIZE) -> List[Dict[str, Any]]:
+        """
+        Leo thang một lô bước quá hạn bằng một câu UPDATE ... RETURNING: giao
+        lại cho vai trò cấp kế tiếp trong APPROVAL_SLA_ESCALATION_CHAIN với
+        hạn mới; hết cấp thì ngừng theo dõi (due_at = NULL). Các bước đang bị
+        tiến trình khác giữ được bỏ qua (SKIP LOCKED). Không commit.
+        """
+        due_ids = select(ApprovalStep.id).where(
+            ApprovalStep.status == StepStatus.PENDING,
+            ApprovalStep.due_at <= now
+        ).order_by(ApprovalStep.due_at).limit(limit).with_for_update(skip_locked=True).scalar_subquery()
+
+        chain = APPROVAL_SLA_ESCALATION_CHAIN
+        next_level = ApprovalStep.escalation_level + 1
+        timeout = func.coalesce(ApprovalStep.timeout_hours, APPROVAL_SLA_DEFAULT_TIMEOUT_HOURS)
+
+        rows = db.execute(
+            update(ApprovalStep).where(ApprovalStep.id.in_(due_ids)).values(
+                escalation_level=next_level,
+                approver_role=case(
+                    {level: role for level, role in enumerate(chain, start=1)},
+                    value=next_level,
+                    else_=ApprovalStep.approver_role
+                ),
+                approver_id=None,
+                approver_name=None,
+                assigned_at=now.isoformat(),
+                due_at=case(
+                    (next_level > len(chain), null()),
+                    else_=literal(now, DateTime) + func.make_interval(0, 0, 0, 0, timeout)
+                )
+            ).returning(
+                ApprovalStep.id,
+                ApprovalStep.approval_id,
+                ApprovalStep.escalation_level,
+                ApprovalStep.approver_role,
+                ApprovalStep.due_at
+            ),
+            execution_options={"synchronize_session": False}
+        ).mappings().all()
+
+        escalated = [dict(row) for row in rows]
+        for row in escalated:
+            OutboxService.record(
+                db, "phe_duyet", row["approval_id"], "phe_duyet.qua_han",
+                {
+                    "id": row["approval_id"],
+                    "buoc_id": row["id"],
+                    "cap_leo_thang": row["escalation_level"],
+                    "vai_tro_duyet": row["approver_role"],
+                    "han_xu_ly": row["due_at"],
+                    "het_cap": row["due_at"] is None
+                }
+            )
+        return escalated
+
+class ApprovalSlaScheduler:
+    """
+    Hàng đợi ưu tiên (heap) theo hạn xử lý của các bước đang chờ.
+
+    Vòng lặp ngủ đúng tới hạn gần nhất rồi leo thang các bước quá hạn theo
+    lô. Heap chỉ giữ APPROVAL_SLA_QUEUE_SIZE hạn gần nhất và được dựng lại
+    từ index (status, due_at) khi khởi động, khi phần đã nạp cạn, khi có sự
+    kiện phê duyệt từ tiến trình khác và định kỳ mỗi APPROVAL_SLA_RESYNC_SECONDS.
+    Bước được giao trong tiến trình này vào heap ngay sau khi commit.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = APPROVAL_SLA_BATCH_SIZE,
+        queue_size: int = APPROVAL_SLA_QUEUE_SIZE,
+        resync_seconds: float = APPROVAL_SLA_RESYNC_SECONDS
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.resync_seconds = resync_seconds
+        self._heap: List[Tuple[datetime, str]] = []
+        # Hạn hiện hành của từng bước; mục heap khác giá trị này là mục cũ và bị bỏ qua
+        self._due: Dict[str, datetime] = {}
+        # Heap bị cắt ở queue_size: các hạn sau mốc này chưa được nạp
+        self._loaded_until: Optional[datetime] = None
+        self._resync_requested = True
+        self._last_resync = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats = {"resyncs": 0, "batches": 0, "escalated": 0, "exhausted": 0}
+
+    async def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    def schedule(self, step_id: str, due_at: Optional[datetime]):
+        """Đưa hạn xử lý vào heap (gọi được từ thread khác)"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._push, step_id, due_at)
+
+    def request_resync(self):
+        """Yêu cầu dựng lại heap từ database (gọi được từ thread khác)"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._set_resync)
+
+    async def on_approval_event(self, outbox_event: Dict[str, Any]):
+        """Subscriber broadcast: phê duyệt được tạo hoặc leo thang ở tiến trình khác"""
+        if outbox_event.get("event_type") in ("phe_duyet.tao_moi", "phe_duyet.qua_han"):
+            self._set_resync()
+
+    def _set_resync(self):
+        self._resync_requested = True
+        self._wakeup.set()
+
+    def _push(self, step_id: str, due_at: Optional[datetime]):
+        if due_at is None:
+            self._due.pop(step_id, None)
+            return
+        if self._loaded_until is not None and due_at > self._loaded_until:
+            # Ngoài phần đã nạp: sẽ có mặt ở lần dựng lại kế tiếp
+            return
+        self._due[step_id] = due_at
+        heapq.heappush(self._heap, (due_at, step_id))
+        if self._heap[0][1] == step_id:
+            self._wakeup.set()
+
+    def _peek(self) -> Optional[datetime]:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _load(self) -> List[Tuple[str, datetime]]:
+        db = self.session_factory()
+        try:
+            return ApprovalSlaService.next_due(db, self.queue_size)
+        finally:
+            db.close()
+
+    def _escalate(self, now: datetime) -> List[Dict[str, Any]]:
+        db = self.session_factory()
+        try:
+            escalated = ApprovalSlaService.escalate_due(db, now, self.batch_size)
+            db.commit()
+            return escalated
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _resync(self):
+        loop = asyncio.get_running_loop()
+        entries = await loop.run_in_executor(None, self._load)
+        self._due = {step_id: due_at for step_id, due_at in entries}
+        self._heap = [(due_at, step_id) for step_id, due_at in entries]
+        heapq.heapify(self._heap)
+        self._loaded_until = entries[-1][1] if len(entries) >= self.queue_size else None
+        self._resync_requested = False
+        self._last_resync = loop.time()
+        self.stats["resyncs"] += 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                next_due = self._peek()
+                if (
+                    self._resync_requested
+                    or loop.time() - self._last_resync >= self.resync_seconds
+                    or (next_due is None and self._loaded_until is not None)
+                ):
+                    await self._resync()
+                    next_due = self._peek()
+
+                now = datetime.utcnow()
+                if next_due is not None and next_due <= now:
+                    escalated = await loop.run_in_executor(None, self._escalate, now)
+                    self.stats["batches"] += 1
+                    self.stats["escalated"] += len(escalated)
+
+                    # Mọi mục đã tới hạn rời heap: đã leo thang, đã được xử lý, hoặc tiến trình khác đang giữ
+                    while self._heap and self._heap[0][0] <= now:
+                        due_at, step_id = heapq.heappop(self._heap)
+                        if self._due.get(step_id) == due_at:
+                            del self._due[step_id]
+                    for row in escalated:
+                        if row["due_at"] is None:
+                            self.stats["exhausted"] += 1
+                        self._push(str(row["id"]), row["due_at"])
+
+                    # Lô đầy: còn bước quá hạn, xử lý tiếp ngay
+                    if len(escalated) >= self.batch_size:
+                        self._resync_requested = True
+                        continue
+
+                timeout = self.resync_seconds - (loop.time() - self._last_resync)
+                next_due = self._peek()
+                if next_due is not None:
+                    timeout = min(timeout, (next_due - datetime.utcnow()).total_seconds())
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+            except Exception as e:
+                print(f"Approval SLA scheduler error: {str(e)}")
+                await asyncio.sleep(5)
+
+@event.listens_for(Session, "after_commit")
+def _schedule_after_commit(session):
+    """Đưa hạn xử lý của các bước vừa được giao vào heap"""
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending and approval_sla_scheduler is not None:
+        for step_id, due_at in pending:
+            approval_sla_scheduler.schedule(step_id, due_at)
+
+@event.listens_for(Session, "after_rollback")
+def _clear_schedule_after_rollback(session):
+    session.info.pop(PENDING_KEY, None)
+
+approval_sla_scheduler: Optional[ApprovalSlaScheduler] = None
+
+def get_approval_sla_scheduler() -> Optional[ApprovalSlaScheduler]:
+    """Get SLA scheduler (None if disabled)"""
+    return approval_sla_scheduler
+
+async def start_approval_sla_scheduler(session_factory: Callable[[], Session]):
+    """Khởi động bộ lập lịch nếu APPROVAL_SLA_ENABLED=true; heap được dựng lại từ database"""
+    global approval_sla_scheduler
+    if APPROVAL_SLA_ENABLED:
+        approval_sla_scheduler = ApprovalSlaScheduler(session_factory)
+        await approval_sla_scheduler.start()
+        dispatcher = get_outbox_dispatcher()
+        if dispatcher is not None:
+            dispatcher.subscribe_broadcast("approval_sla", approval_sla_scheduler.on_approval_event, ["phe_duyet"])
+        print("✅ Approval SLA scheduler started")
+
+async def stop_approval_sla_scheduler():
+    global approval_sla_scheduler
+    if approval_sla_scheduler is not None:
+        await approval_sla_scheduler.stop()
+        approval_sla_scheduler = None
@@ -0,0 +1,355 @@
+"""
+Auto approval service - quy tắc tự động duyệt được biên dịch thành predicate trong bộ nhớ
+"""
+
+import os
+import time
+import uuid
+import threading
+import operator
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from decimal import Decimal
+from datetime import datetime, timedelta
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from ..models.agents import Agent
+from ..models.users import User, Staff
+from ..models.approvals import Approval, AutoApprovalRule
+from ..models.transactions import Transaction
+from ..models.audit import AuditAction
+
+# Configuration
+AUTO_APPROVAL_ENABLED = os.getenv("AUTO_APPROVAL_ENABLED", "true").lower() == "true"
+AUTO_APPROVAL_RULES_CACHE_TTL = int(os.getenv("AUTO_APPROVAL_RULES_CACHE_TTL", "30"))
+AUTO_APPROVAL_VELOCITY_HOURS = int(os.getenv("AUTO_APPROVAL_VELOCITY_HOURS", "24"))
+
+# Điều kiện -> (dữ kiện, chuyển đổi ngưỡng, phép so sánh dữ kiện với ngưỡng).
+# Thứ tự khai báo là thứ tự đánh giá: điều kiện không cần truy vấn đứng trước,
+# dữ kiện chỉ được tải khi có điều kiện cần tới.
+AUTO_APPROVAL_CONDITIONS: Dict[str, Tuple[str, Callable[[Any], Any], Callable[[Any, Any], bool]]] = {
+    "allowed_fields": ("changed_fields", frozenset, operator.le),
+    "max_amount": ("amount", lambda v: Decimal(str(v)), operator.le),
+    "min_agent_tenure_days": ("agent_tenure_days", int, operator.ge),
+    "max_daily_count": ("daily_count", int, operator.le),
+    "max_daily_amount": ("daily_amount", lambda v: Decimal(str(v)), operator.le)
+}
+
+# Quyền của nhân viên ủy quyền cần có theo loại phê duyệt
+REQUIRED_PERMISSIONS = {
+    "dang_ky_dai_ly": "can_approve_agents",
+    "rut_tien": "can_approve_transactions"
+}
+
+class AutoApprovalFacts:
+    """Dữ kiện của một yêu cầu phê duyệt, tải lười và chỉ một lần"""
+
+    def __init__(self, db: Session, approval: Approval):
+        self.db = db
+        self.approval = approval
+        self.values: Dict[str, Any] = {}
+
+    def get(self, name: str) -> Any:
+        if name not in self.values:
+            getattr(self, f"_load_{name}")()
+        return self.values.get(name)
+
+    def _transaction(self) -> Optional[Transaction]:
+        if "_transaction" not in self.values:
+            transaction = None
+            if self.approval.loai_duyet == 'rut_tien':
+                transaction = self.db.query(Transaction).filter(Transaction.id == self.approval.doi_tuong_id).first()
+            self.values["_transaction"] = transaction
+        return self.values["_transaction"]
+
+    def _agent_id(self) -> Optional[str]:
+        if "_agent_id" not in self.values:
+            transaction = self._transaction()
+            if transaction is not None:
+                agent_id = transaction.dai_ly_id
+            elif self.approval.loai_duyet == 'dang_ky_dai_ly':
+                agent_id = self.approval.doi_tuong_id
+            else:
+                agent_id = self.db.query(Agent.id).filter(Agent.user_id == str(self.approval.nguoi_gui_id)).scalar()
+            self.values["_agent_id"] = str(agent_id) if agent_id else None
+        return self.values["_agent_id"]
+
+    def _load_changed_fields(self):
+        self.values["changed_fields"] = frozenset((self.approval.du_lieu_moi or {}).keys())
+
+    def _load_amount(self):
+        transaction = self._transaction()
+        if transaction is not None:
+            amount = transaction.so_tien
+        else:
+            amount = (self.approval.du_lieu_moi or {}).get("so_tien")
+        self.values["amount"] = Decimal(str(amount)) if amount is not None else None
+
+    def _load_agent_tenure_days(self):
+        agent_id = self._agent_id()
+        created_at = self.db.query(Agent.created_at).filter(Agent.id == agent_id).scalar() if agent_id else None
+        self.values["agent_tenure_days"] = (datetime.utcnow() - created_at).days if created_at else None
+
+    def _load_daily_count(self):
+        """Số lượng và tổng tiền rút đã duyệt trong cửa sổ vận tốc, tính cả yêu cầu này"""
+        agent_id = self._agent_id()
+        amount = self.get("amount")
+        if not agent_id or amount is None:
+            self.values["daily_count"] = self.values["daily_amount"] = None
+            return
+
+        # Khóa dòng đại lý để hai yêu cầu đồng thời không cùng lọt qua hạn mức
+        self.db.query(Agent.id).filter(Agent.id == agent_id).with_for_update().first()
+        count, total = self.db.query(
+            func.count(Transaction.id),
+            func.coalesce(func.sum(Transaction.so_tien), 0)
+        ).filter(
+            Transaction.dai_ly_id == agent_id,
+            Transaction.loai_giao_dich == 'rut_tien',
+            Transaction.trang_thai.in_(['da_duyet', 'thanh_cong']),
+            Transaction.created_at >= datetime.utcnow() - timedelta(hours=AUTO_APPROVAL_VELOCITY_HOURS)
+        ).one()
+        self.values["daily_count"] = count + 1
+        self.values["daily_amount"] = Decimal(total) + amount
+
+    def _load_daily_amount(self):
+        self._load_daily_count()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Dữ kiện đã tải (ghi vào nhật ký kiểm toán)"""
+        return {
+            name: sorted(value) if isinstance(value, frozenset) else value
+            for name, value in self.values.items() if not name.startswith("_")
+        }
+
+class CompiledAutoApprovalRule:
+    """
+    Quy tắc đã biên dịch: danh sách (điều kiện, dữ kiện, ngưỡng, phép so
+    sánh) đánh giá tuần tự, dừng ở điều kiện đầu tiên không thỏa. Ngưỡng
+    số tiền bị chặn bởi hạn mức duyệt của nhân viên ủy quyền.
+    """
+
+    def __init__(self, rule_id: Any, name: str, version: int, approval_type: str, priority: int,
+                 conditions: Dict[str, Any], staff: Staff, acting_name: Optional[str] = None):
+        unknown = set(conditions) - set(AUTO_APPROVAL_CONDITIONS)
+        if unknown:
+            raise ValueError(f"Điều kiện không hỗ trợ: {', '.join(sorted(unknown))}")
+        if not conditions:
+            raise ValueError("Quy tắc phải có ít nhất một điều kiện")
+
+        permission = REQUIRED_PERMISSIONS.get(approval_type)
+        if permission and getattr(staff, permission) != "true":
+            raise ValueError(f"Nhân viên ủy quyền không có quyền {permission}")
+        if approval_type == 'rut_tien':
+            if "max_amount" not in conditions:
+                raise ValueError("Quy tắc rút tiền phải có max_amount")
+            if Decimal(str(conditions["max_amount"])) > Decimal(str(staff.max_approval_amount or 0)):
+                raise ValueError("max_amount vượt hạn mức duyệt của nhân viên ủy quyền")
+        if approval_type == 'cap_nhat_thong_tin' and "allowed_fields" not in conditions:
+            raise ValueError("Quy tắc cập nhật thông tin phải có allowed_fields")
+
+        self.rule_id = str(rule_id) if rule_id else None
+        self.name = name
+        self.version = version
+        self.approval_type = approval_type
+        self.priority = priority
+        self.acting_user_id = staff.user_id
+        self.acting_name = acting_name
+        self.checks = [
+            (condition, fact, convert(conditions[condition]), compare)
+            for condition, (fact, convert, compare) in AUTO_APPROVAL_CONDITIONS.items()
+            if condition in conditions
+        ]
+
+    def evaluate(self, facts: AutoApprovalFacts) -> Tuple[bool, List[Dict[str, Any]]]:
+        """(khớp hay không, vết đánh giá từng điều kiện)"""
+        trace = []
+        for condition, fact, limit, compare in self.checks:
+            value = facts.get(fact)
+            passed = value is not None and compare(value, limit)
+            trace.append({"dieu_kien": condition, "gia_tri": value, "nguong": limit, "dat": passed})
+            if not passed:
+                return False, trace
+        return True, trace
+
+class AutoApprovalService:
+    """
+    Quy tắc tự duyệt theo loại phê duyệt, được biên dịch một lần và cache;
+    sau AUTO_APPROVAL_RULES_CACHE_TTL giây chỉ kiểm tra chữ ký (số quy tắc,
+    thời điểm cập nhật cuối của quy tắc, của nhân viên ủy quyền và tài khoản
+    của họ), chỉ biên dịch lại khi chữ ký đổi. Quyền và hạn mức duyệt của
+    nhân viên được đưa vào lúc biên dịch nên thu hồi quyền, giảm hạn mức
+    hay khóa tài khoản có hiệu lực sau tối đa một TTL.
+    """
+
+    _cache: Optional[Tuple[float, Any, Dict[str, List[CompiledAutoApprovalRule]]]] = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _active_rules(db: Session):
+        """Quy tắc đang bật của nhân viên ủy quyền còn hoạt động"""
+        return db.query(AutoApprovalRule).join(
+            Staff, Staff.id == AutoApprovalRule.acting_staff_id
+        ).join(
+            User, User.id == Staff.user_id
+        ).filter(
+            AutoApprovalRule.is_active == True,
+            AutoApprovalRule.deleted_at.is_(None),
+            Staff.is_active == True,
+            Staff.deleted_at.is_(None),
+            User.is_active == True,
+            User.deleted_at.is_(None)
+        )
+
+    @staticmethod
+    def get_rules(db: Session) -> Dict[str, List[CompiledAutoApprovalRule]]:
+        """Quy tắc đã biên dịch theo loại phê duyệt, sắp theo ưu tiên"""
+        now = time.monotonic()
+        with AutoApprovalService._lock:
+            entry = AutoApprovalService._cache
+        if entry and entry[0] > now:
+            return entry[2]
+
+        signature = tuple(AutoApprovalService._active_rules(db).with_entities(
+            func.count(AutoApprovalRule.id),
+            func.max(AutoApprovalRule.updated_at),
+            func.max(Staff.updated_at),
+            func.max(User.updated_at)
+        ).one())
+        if entry and entry[1] == signature:
+            compiled = entry[2]
+        else:
+            compiled = {}
+            rows = AutoApprovalService._active_rules(db).with_entities(
+                AutoApprovalRule, Staff, User.full_name
+            ).order_by(AutoApprovalRule.priority, AutoApprovalRule.name).all()
+            for rule, staff, acting_name in rows:
+                try:
+                    compiled.setdefault(rule.approval_type, []).append(CompiledAutoApprovalRule(
+                        rule.id, rule.name, rule.version, rule.approval_type, rule.priority,
+                        rule.conditions or {}, staff, acting_name
+                    ))
+                except (ValueError, ArithmeticError) as e:
+                    # Quyền của nhân viên ủy quyền có thể đã bị thu hồi sau khi lưu quy tắc
+                    print(f"Auto approval rule {rule.name} skipped: {str(e)}")
+
+        with AutoApprovalService._lock:
+            AutoApprovalService._cache = (now + AUTO_APPROVAL_RULES_CACHE_TTL, signature, compiled)
+        return compiled
+
+    @staticmethod
+    def invalidate_rules():
+        """Bỏ cache quy tắc trong tiến trình hiện tại"""
+        with AutoApprovalService._lock:
+            AutoApprovalService._cache = None
+
+    @staticmethod
+    def save_rule(
+        db: Session,
+        name: str,
+        approval_type: str,
+        conditions: Dict[str, Any],
+        acting_staff_id: str,
+        priority: int = 100,
+        description: Optional[str] = None
+    ) -> Tuple[AutoApprovalRule, Optional[Dict[str, Any]]]:
+        """
+        Tạo hoặc cập nhật quy tắc (kiểm tra bằng cách biên dịch thử, không
+        commit). Trả về quy tắc và giá trị cũ (None nếu tạo mới).
+        """
+        staff = db.query(Staff).filter(Staff.id == acting_staff_id, Staff.is_active == True).first()
+        if staff is None:
+            raise ValueError("Không tìm thấy nhân viên ủy quyền")
+        CompiledAutoApprovalRule(None, name, 0, approval_type, priority, conditions, staff)
+
+        rule = db.query(AutoApprovalRule).filter(AutoApprovalRule.name == name).with_for_update().first()
+        old_values = None
+        if rule:
+            old_values = AutoApprovalService.rule_values(rule)
+            rule.version = rule.version + 1
+            rule.is_active = True
+            rule.deleted_at = None
+        else:
+            rule = AutoApprovalRule(name=name, version=1)
+            db.add(rule)
+        rule.approval_type = approval_type
+        rule.conditions = conditions
+        rule.acting_staff_id = acting_staff_id
+        rule.priority = priority
+        if description is not None:
+            rule.description = description
+
+        AutoApprovalService.invalidate_rules()
+        return rule, old_values
+
+    @staticmethod
+    def rule_values(rule: AutoApprovalRule) -> Dict[str, Any]:
+        return jsonable_encoder({
+            "id": rule.id,
+            "name": rule.name,
+            "description": rule.description,
+            "approval_type": rule.approval_type,
+            "priority": rule.priority,
+            "conditions": rule.conditions,
+            "acting_staff_id": rule.acting_staff_id,
+            "version": rule.version,
+            "is_active": rule.is_active
+        })
+
+    @staticmethod
+    def evaluate(db: Session, approval: Approval) -> Optional[Dict[str, Any]]:
+        """
+        Đánh giá yêu cầu vừa tạo với các quy tắc cùng loại; trả về quyết định
+        của quy tắc khớp đầu tiên hoặc None. Lỗi khi đánh giá không làm hỏng
+        việc tạo yêu cầu (yêu cầu ở lại hàng đợi duyệt tay).
+        """
+        if not AUTO_APPROVAL_ENABLED:
+            return None
+        try:
+            rules = AutoApprovalService.get_rules(db).get(approval.loai_duyet)
+            if not rules:
+                return None
+
+            started = time.perf_counter()
+            facts = AutoApprovalFacts(db, approval)
+            traces = []
+            with db.begin_nested():
+                for rule in rules:
+                    matched, trace = rule.evaluate(facts)
+                    traces.append({"quy_tac": rule.name, "phien_ban": rule.version, "khop": matched, "dieu_kien": trace})
+                    if matched:
+                        return {
+                            "rule": rule,
+                            "facts": facts.snapshot(),
+                            "traces": traces,
+                            "elapsed_us": int((time.perf_counter() - started) * 1_000_000)
+                        }
+            return None
+        except Exception as e:
+            print(f"Auto approval evaluation error: {str(e)}")
+            return None
+
+    @staticmethod
+    def audit_values(approval: Approval, decision: Dict[str, Any]) -> Dict[str, Any]:
+        """Nhật ký kiểm toán cho yêu cầu được tự duyệt: quy tắc, phiên bản, dữ kiện và vết đánh giá"""
+        rule: CompiledAutoApprovalRule = decision["rule"]
+        return {
+            "id": uuid.uuid4(),
+            "user_id": rule.acting_user_id,
+            "user_name": rule.acting_name,
+            "user_role": "tu_dong",
+            "action": AuditAction.APPROVE,
+            "action_description": f"Tự động duyệt theo quy tắc {rule.name} (v{rule.version})",
+            "target_type": "phe_duyet",
+            "target_id": str(approval.id),
+            "target_name": approval.loai_duyet,
+            "new_values": jsonable_encoder(decision["facts"]),
+            "changes": jsonable_encoder({
+                "quy_tac_id": rule.rule_id,
+                "phien_ban": rule.version,
+                "danh_gia": decision["traces"]
+            }),
+            "timestamp": datetime.utcnow().isoformat(),
+            "duration_ms": str(round(decision["elapsed_us"] / 1000, 3))
+        }
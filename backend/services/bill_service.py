@@ -13,6 +13,7 @@ import os
 
 from ..models.bills import ElectricBill, Provider
 from ..models.customers import Customer
+from .outbox_service import OutboxService
 
 class BillService:
     def __init__(self, db: Session):
@@ -216,6 +217,12 @@ class BillService:
         )
         
         self.db.add(bill)
+        self.db.flush()
+        
+        OutboxService.record(
+            self.db, "hoa_don", bill.id, "hoa_don.tao_moi",
+            {"id": bill.id, "customer_code": customer_code, "provider_id": provider_id, "status": bill.status}
+        )
         self.db.commit()
         self.db.refresh(bill)
         
@@ -244,6 +251,10 @@ class BillService:
         bill.exported_to_id = customer_id
         bill.exported_to_name = customer.full_name
         
+        OutboxService.record(
+            self.db, "hoa_don", bill.id, "hoa_don.da_ban",
+            {"id": bill.id, "status": bill.status, "exported_to_id": customer_id}
+        )
         self.db.commit()
         
         return {
@@ -279,6 +290,10 @@ class BillService:
         
         # Update bill with image URL
         bill.receipt_image_url = f"/uploads/receipts/{filename}"
+        OutboxService.record(
+            self.db, "hoa_don", bill.id, "hoa_don.cap_nhat_bien_nhan",
+            {"id": bill.id, "receipt_image_url": bill.receipt_image_url, "exported_to_id": bill.exported_to_id}
+        )
         self.db.commit()
         
         return {
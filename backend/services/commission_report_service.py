@@ -0,0 +1,199 @@
+"""
+Commission report service - báo cáo hoa hồng tổng hợp bằng SQL, phân trang keyset và xuất CSV dạng luồng
+"""
+
+import io
+import csv
+import json
+import base64
+from uuid import UUID
+from typing import List, Optional, Dict, Any, Iterator, Tuple
+from decimal import Decimal
+from datetime import date, datetime
+from sqlalchemy import and_, func, select, tuple_, literal_column
+from sqlalchemy.orm import Session
+
+from ..database import SessionLocal
+from ..models.transactions import Transaction
+from .partition_service import created_range
+
+# Đơn vị nhóm hợp lệ cho date_trunc
+REPORT_PERIODS = ("day", "week", "month")
+# SQLite (database dự phòng khi không kết nối được PostgreSQL) không có date_trunc; tuần bắt đầu thứ Hai như PostgreSQL
+SQLITE_PERIOD_MODIFIERS = {
+    "day": (),
+    "week": ("weekday 0", "-6 days"),
+    "month": ("start of month",)
+}
+CSV_BATCH_SIZE = 1000
+
+CSV_HEADER = ["Mã giao dịch", "Loại giao dịch", "Số tiền", "Hoa hồng", "Khách hàng", "Thời gian tạo"]
+
+def encode_cursor(created_at: datetime, transaction_id: Any) -> str:
+    """Cursor keyset (created_at, id) của dòng cuối trang"""
+    raw = json.dumps([created_at.isoformat(), str(transaction_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    """Giải mã cursor; ValueError nếu cursor không hợp lệ"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, transaction_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(created_at), UUID(transaction_id)
+    except Exception:
+        raise ValueError("Cursor không hợp lệ")
+
+def _period_expression(db: Session, group_by: str):
+    """Đầu kỳ của created_at theo dialect của kết nối"""
+    if db.get_bind().dialect.name == "sqlite":
+        return func.date(Transaction.created_at, *SQLITE_PERIOD_MODIFIERS[group_by])
+    # Đơn vị là hằng trong danh sách cho phép, đặt trực tiếp để SELECT và GROUP BY cùng một biểu thức
+    return func.date_trunc(literal_column(f"'{group_by}'"), Transaction.created_at)
+
+def _period_date(value: Any) -> date:
+    # PostgreSQL trả về timestamp, SQLite trả về chuỗi 'YYYY-MM-DD'
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+class CommissionReportService:
+    """
+    Báo cáo hoa hồng của đại lý. Tổng hợp theo kỳ và loại giao dịch được
+    tính trong database; chi tiết chỉ đọc các cột cần thiết, phân trang
+    theo (created_at, id) nên chi phí mỗi trang không phụ thuộc vị trí.
+    """
+
+    @staticmethod
+    def _conditions(agent_id: Any, from_date: Optional[date], to_date: Optional[date]) -> List[Any]:
+        return [
+            Transaction.dai_ly_id == agent_id,
+            Transaction.trang_thai == 'thanh_cong',
+            Transaction.hoa_hong > 0,
+            *created_range(Transaction.created_at, from_date, to_date)
+        ]
+
+    @staticmethod
+    def summary(
+        db: Session,
+        agent_id: Any,
+        from_date: Optional[date] = None,
+        to_date: Optional[date] = None,
+        group_by: str = "day"
+    ) -> Dict[str, Any]:
+        """Tổng hoa hồng và doanh số theo kỳ (day/week/month) và loại giao dịch"""
+        if group_by not in REPORT_PERIODS:
+            raise ValueError(f"group_by phải là một trong {', '.join(REPORT_PERIODS)}")
+
+        period = _period_expression(db, group_by).label("period")
+        rows = db.query(
+            period,
+            Transaction.loai_giao_dich,
+            func.count(Transaction.id),
+            func.sum(Transaction.hoa_hong),
+            func.sum(Transaction.so_tien)
+        ).filter(
+            and_(*CommissionReportService._conditions(agent_id, from_date, to_date))
+        ).group_by(
+            period, Transaction.loai_giao_dich
+        ).order_by(
+            period.desc(), Transaction.loai_giao_dich
+        ).all()
+
+        breakdown = [
+            {
+                "period": _period_date(period_start),
+                "loai_giao_dich": transaction_type,
+                "total_transactions": count,
+                "total_commission": commission or Decimal('0'),
+                "total_amount": amount or Decimal('0')
+            }
+            for period_start, transaction_type, count, commission, amount in rows
+        ]
+
+        return {
+            "group_by": group_by,
+            "total_commission": sum((item["total_commission"] for item in breakdown), Decimal('0')),
+            "total_transactions": sum(item["total_transactions"] for item in breakdown),
+            "breakdown": breakdown
+        }
+
+    @staticmethod
+    def _detail_query(agent_id: Any, from_date: Optional[date], to_date: Optional[date]):
+        return select(
+            Transaction.id,
+            Transaction.ma_giao_dich,
+            Transaction.loai_giao_dich,
+            Transaction.so_tien,
+            Transaction.hoa_hong,
+            Transaction.khach_hang_id,
+            Transaction.created_at.label("thoi_gian_tao")
+        ).where(
+            *CommissionReportService._conditions(agent_id, from_date, to_date)
+        ).order_by(
+            Transaction.created_at.desc(), Transaction.id.desc()
+        )
+
+    @staticmethod
+    def transactions_page(
+        db: Session,
+        agent_id: Any,
+        from_date: Optional[date] = None,
+        to_date: Optional[date] = None,
+        limit: int = 50,
+        cursor: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Một trang giao dịch hoa hồng, mới nhất trước; next_cursor là None ở trang cuối"""
+        query = CommissionReportService._detail_query(agent_id, from_date, to_date)
+        if cursor:
+            created_at, transaction_id = decode_cursor(cursor)
+            query = query.where(
+                tuple_(Transaction.created_at, Transaction.id) < tuple_(created_at, transaction_id)
+            )
+
+        rows = db.execute(query.limit(limit + 1)).mappings().all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        return {
+            "transactions": [dict(row) for row in rows],
+            "next_cursor": encode_cursor(rows[-1]["thoi_gian_tao"], rows[-1]["id"]) if has_more else None,
+            "limit": limit
+        }
+
+    @staticmethod
+    def stream_csv(agent_id: Any, from_date: Optional[date] = None, to_date: Optional[date] = None) -> Iterator[str]:
+        """
+        Xuất toàn bộ giao dịch hoa hồng của kỳ dưới dạng CSV theo từng khối.
+        Dùng session riêng vì generator chạy sau khi endpoint đã trả về.
+        """
+        db = SessionLocal()
+        try:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            # BOM để Excel đọc đúng tiếng Việt
+            buffer.write("\ufeff")
+            writer.writerow(CSV_HEADER)
+
+            result = db.execute(
+                CommissionReportService._detail_query(agent_id, from_date, to_date).execution_options(yield_per=CSV_BATCH_SIZE)
+            )
+            for rows in result.partitions():
+                for row in rows:
+                    writer.writerow([
+                        row.ma_giao_dich,
+                        row.loai_giao_dich,
+                        str(row.so_tien),
+                        str(row.hoa_hong),
+                        row.khach_hang_id or "",
+                        row.thoi_gian_tao.strftime("%Y-%m-%d %H:%M:%S")
+                    ])
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+
+            if buffer.tell():
+                yield buffer.getvalue()
+        finally:
+            db.close()
@@ -0,0 +1,414 @@
+"""
+Commission service - bộ máy quy tắc hoa hồng, tính theo lô và ghi hoa hồng hàng loạt
+"""
+
+import os
+import time
+import threading
+from bisect import bisect_right
+from typing import List, Optional, Dict, Any, Sequence, Tuple
+from decimal import Decimal, ROUND_HALF_UP
+from datetime import datetime
+from sqlalchemy import String, cast, exists, func, insert, select
+from sqlalchemy.orm import Session
+
+from ..models.agents import Agent
+from ..models.bills import Bill
+from ..models.users import User
+from ..models.transactions import Transaction, Commission, CommissionRuleSet
+
+# numpy là tùy chọn: nếu không có thì tính theo lô bằng vòng lặp số nguyên (cùng kết quả)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Configuration
+COMMISSION_RULES_CACHE_TTL = int(os.getenv("COMMISSION_RULES_CACHE_TTL", "60"))
+COMMISSION_BATCH_SIZE = int(os.getenv("COMMISSION_BATCH_SIZE", "50000"))
+
+# Loại giao dịch được tính hoa hồng (đại lý thu hộ thanh toán). Nạp/rút ví, hoàn tiền... không
+# nằm trong cơ sở tính hoa hồng lẫn doanh số tháng dùng cho thưởng theo doanh số
+COMMISSIONABLE_TRANSACTION_TYPES = ("thanh_toan", "thanh_toan_hoa_don")
+
+# Tỷ lệ lưu dạng phần triệu (ppm), số tiền là đồng: mọi phép tính đều là số nguyên
+RATE_SCALE = 1_000_000
+INT64_MAX = 2 ** 63 - 1
+
+# Bộ quy tắc dùng khi chưa cấu hình trong database (bốn cấp đại lý như trước)
+DEFAULT_RULES = {
+    "default_rate": "0.02",
+    "level_rates": {
+        "basic": "0.02",
+        "silver": "0.025",
+        "gold": "0.03",
+        "platinum": "0.035"
+    }
+}
+
+def to_ppm(rate: Any) -> int:
+    """Tỷ lệ thập phân (0.025) sang phần triệu (25000)"""
+    value = (Decimal(str(rate)) * RATE_SCALE).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+    if value < 0 or value > RATE_SCALE:
+        raise ValueError(f"Tỷ lệ hoa hồng không hợp lệ: {rate}")
+    return int(value)
+
+def to_dong(amount: Any) -> int:
+    """Số tiền sang số nguyên đồng (làm tròn nửa lên)"""
+    return int(Decimal(str(amount)).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def format_rate(ppm: int) -> str:
+    """Phần triệu sang phần trăm dạng chuỗi (25000 -> '2.5')"""
+    percent = Decimal(ppm) / (RATE_SCALE // 100)
+    return format(percent.normalize(), 'f')
+
+class CompiledRuleSet:
+    """
+    Bộ quy tắc đã biên dịch. Thứ tự ưu tiên của tỷ lệ: nhà cung cấp > loại
+    giao dịch > bậc số tiền > cấp đại lý > mặc định; sau đó cộng thưởng theo
+    doanh số tháng của đại lý và áp mức tối thiểu/tối đa mỗi giao dịch.
+
+    Hoa hồng = (số tiền * tỷ lệ ppm + 500000) // 1000000, tức làm tròn nửa
+    lên tới đồng, giống nhau giữa tính từng giao dịch và tính theo lô.
+    """
+
+    def __init__(self, name: str, version: int, rules: Dict[str, Any]):
+        self.name = name
+        self.version = version
+        self.default_rate = to_ppm(rules.get("default_rate", "0"))
+        self.level_rates = {level: to_ppm(rate) for level, rate in (rules.get("level_rates") or {}).items()}
+        self.provider_rates = {provider: to_ppm(rate) for provider, rate in (rules.get("provider_rates") or {}).items()}
+        self.type_rates = {
+            transaction_type: to_ppm(rate)
+            for transaction_type, rate in (rules.get("transaction_type_rates") or {}).items()
+        }
+
+        amount_tiers = sorted((to_dong(tier["min_amount"]), to_ppm(tier["rate"])) for tier in rules.get("amount_tiers") or [])
+        self.amount_thresholds = [threshold for threshold, _ in amount_tiers]
+        self.amount_rates = [rate for _, rate in amount_tiers]
+
+        volume_bonus = sorted((to_dong(tier["min_volume"]), to_ppm(tier["bonus_rate"])) for tier in rules.get("volume_bonus") or [])
+        self.volume_thresholds = [threshold for threshold, _ in volume_bonus]
+        self.volume_bonus = [bonus for _, bonus in volume_bonus]
+
+        self.min_commission = to_dong(rules.get("min_commission") or 0)
+        self.max_commission = to_dong(rules["max_commission"]) if rules.get("max_commission") is not None else None
+
+        self.max_rate = max(
+            [self.default_rate, *self.level_rates.values(), *self.provider_rates.values(),
+             *self.type_rates.values(), *self.amount_rates]
+        ) + max(self.volume_bonus, default=0)
+
+    def rate(
+        self,
+        amount: int,
+        transaction_type: Optional[str] = None,
+        provider: Optional[str] = None,
+        level: Optional[str] = None,
+        volume: int = 0
+    ) -> int:
+        """Tỷ lệ (ppm) áp cho một giao dịch; 0 với loại giao dịch không tính hoa hồng"""
+        if transaction_type is not None and transaction_type not in COMMISSIONABLE_TRANSACTION_TYPES:
+            return 0
+        if provider in self.provider_rates:
+            rate = self.provider_rates[provider]
+        elif transaction_type in self.type_rates:
+            rate = self.type_rates[transaction_type]
+        else:
+            index = bisect_right(self.amount_thresholds, amount) - 1
+            if index >= 0:
+                rate = self.amount_rates[index]
+            else:
+                rate = self.level_rates.get(level, self.default_rate)
+
+        index = bisect_right(self.volume_thresholds, volume) - 1
+        if index >= 0:
+            rate += self.volume_bonus[index]
+        return rate
+
+    def _clamp(self, commission: int, rate: int) -> int:
+        if rate > 0 and commission < self.min_commission:
+            commission = self.min_commission
+        if self.max_commission is not None and commission > self.max_commission:
+            commission = self.max_commission
+        return commission
+
+    def commission(self, amount: int, **attributes) -> int:
+        """Hoa hồng (đồng) của một giao dịch"""
+        rate = self.rate(amount, **attributes)
+        return self._clamp((amount * rate + RATE_SCALE // 2) // RATE_SCALE, rate)
+
+    def compute_batch(
+        self,
+        amounts: Sequence[int],
+        transaction_types: Optional[Sequence[Optional[str]]] = None,
+        providers: Optional[Sequence[Optional[str]]] = None,
+        levels: Optional[Sequence[Optional[str]]] = None,
+        volumes: Optional[Sequence[int]] = None
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Tỷ lệ và hoa hồng cho cả cột giao dịch. Dùng numpy (int64) khi có và
+        khi số tiền lớn nhất nhân tỷ lệ lớn nhất không tràn int64; nếu không
+        thì tính từng dòng bằng số nguyên Python.
+        """
+        if not amounts:
+            return [], []
+
+        if np is not None:
+            try:
+                amount_array = np.asarray(amounts, dtype=np.int64)
+            except OverflowError:
+                amount_array = None
+            if (amount_array is not None and int(amount_array.min()) >= 0
+                    and int(amount_array.max()) * self.max_rate + RATE_SCALE <= INT64_MAX):
+                return self._compute_vectorized(amount_array, transaction_types, providers, levels, volumes)
+
+        rates = [
+            self.rate(
+                amount,
+                transaction_types[i] if transaction_types is not None else None,
+                providers[i] if providers is not None else None,
+                levels[i] if levels is not None else None,
+                volumes[i] if volumes is not None else 0
+            )
+            for i, amount in enumerate(amounts)
+        ]
+        commissions = [
+            self._clamp((amount * rate + RATE_SCALE // 2) // RATE_SCALE, rate)
+            for amount, rate in zip(amounts, rates)
+        ]
+        return rates, commissions
+
+    @staticmethod
+    def _lookup(keys: Sequence[Optional[str]], mapping: Dict[str, int], fallback):
+        """Ánh xạ cột khóa sang tỷ lệ; khóa không có trong mapping giữ giá trị fallback"""
+        get = mapping.get
+        mapped = np.fromiter((get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+        return np.where(mapped >= 0, mapped, fallback)
+
+    def _compute_vectorized(self, amounts, transaction_types, providers, levels, volumes) -> Tuple[List[int], List[int]]:
+        # Áp theo thứ tự ưu tiên tăng dần, mức sau ghi đè mức trước
+        rates = np.full(len(amounts), self.default_rate, dtype=np.int64)
+        if levels is not None and self.level_rates:
+            rates = self._lookup(levels, self.level_rates, rates)
+        if self.amount_thresholds:
+            index = np.searchsorted(np.asarray(self.amount_thresholds, dtype=np.int64), amounts, side="right") - 1
+            tier_rates = np.asarray(self.amount_rates, dtype=np.int64)[np.maximum(index, 0)]
+            rates = np.where(index >= 0, tier_rates, rates)
+        if transaction_types is not None and self.type_rates:
+            rates = self._lookup(transaction_types, self.type_rates, rates)
+        if providers is not None and self.provider_rates:
+            rates = self._lookup(providers, self.provider_rates, rates)
+        if volumes is not None and self.volume_thresholds:
+            volume_array = np.asarray(volumes, dtype=np.int64)
+            index = np.searchsorted(np.asarray(self.volume_thresholds, dtype=np.int64), volume_array, side="right") - 1
+            bonus = np.asarray(self.volume_bonus, dtype=np.int64)[np.maximum(index, 0)]
+            rates = rates + np.where(index >= 0, bonus, 0)
+        if transaction_types is not None:
+            excluded = np.fromiter(
+                (t is not None and t not in COMMISSIONABLE_TRANSACTION_TYPES for t in transaction_types),
+                dtype=bool, count=len(transaction_types)
+            )
+            rates = np.where(excluded, 0, rates)
+
+        commissions = (amounts * rates + RATE_SCALE // 2) // RATE_SCALE
+        if self.min_commission:
+            commissions = np.where((rates > 0) & (commissions < self.min_commission), self.min_commission, commissions)
+        if self.max_commission is not None:
+            commissions = np.minimum(commissions, self.max_commission)
+        return rates.tolist(), commissions.tolist()
+
+BUILTIN_RULESET = CompiledRuleSet("mac_dinh", 0, DEFAULT_RULES)
+
+class CommissionService:
+    """
+    Tính hoa hồng theo bộ quy tắc. Bộ quy tắc được biên dịch một lần và
+    cache theo tên; sau COMMISSION_RULES_CACHE_TTL giây chỉ kiểm tra lại
+    phiên bản, chỉ biên dịch lại khi phiên bản đổi.
+    """
+
+    _cache: Dict[str, Tuple[float, CompiledRuleSet]] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_ruleset(db: Session, name: Optional[str] = None) -> CompiledRuleSet:
+        """Bộ quy tắc theo tên, hoặc bộ mặc định (is_default) nếu không truyền tên"""
+        key = name or ""
+        now = time.monotonic()
+        with CommissionService._lock:
+            entry = CommissionService._cache.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        query = db.query(CommissionRuleSet.id, CommissionRuleSet.name, CommissionRuleSet.version).filter(
+            CommissionRuleSet.is_active == True,
+            CommissionRuleSet.deleted_at.is_(None)
+        )
+        query = query.filter(CommissionRuleSet.name == name) if name else query.filter(CommissionRuleSet.is_default == True)
+        row = query.first()
+
+        if row is None:
+            if name:
+                raise ValueError(f"Không tìm thấy bộ quy tắc hoa hồng: {name}")
+            compiled = BUILTIN_RULESET
+        elif entry and entry[1].name == row.name and entry[1].version == row.version:
+            compiled = entry[1]
+        else:
+            rules = db.query(CommissionRuleSet.rules).filter(CommissionRuleSet.id == row.id).scalar()
+            compiled = CompiledRuleSet(row.name, row.version, rules or {})
+
+        with CommissionService._lock:
+            CommissionService._cache[key] = (now + COMMISSION_RULES_CACHE_TTL, compiled)
+        return compiled
+
+    @staticmethod
+    def invalidate_rulesets():
+        """Bỏ cache bộ quy tắc trong tiến trình hiện tại"""
+        with CommissionService._lock:
+            CommissionService._cache.clear()
+
+    @staticmethod
+    def save_ruleset(
+        db: Session,
+        name: str,
+        rules: Dict[str, Any],
+        description: Optional[str] = None,
+        is_default: bool = False
+    ) -> CommissionRuleSet:
+        """Tạo hoặc cập nhật bộ quy tắc (kiểm tra bằng cách biên dịch thử, không commit)"""
+        CompiledRuleSet(name, 0, rules)
+
+        ruleset = db.query(CommissionRuleSet).filter(CommissionRuleSet.name == name).with_for_update().first()
+        if ruleset:
+            ruleset.rules = rules
+            ruleset.version = ruleset.version + 1
+            if description is not None:
+                ruleset.description = description
+        else:
+            ruleset = CommissionRuleSet(name=name, rules=rules, description=description, version=1)
+            db.add(ruleset)
+
+        if is_default:
+            db.query(CommissionRuleSet).filter(
+                CommissionRuleSet.is_default == True,
+                CommissionRuleSet.name != name
+            ).update({"is_default": False}, synchronize_session=False)
+        ruleset.is_default = is_default or ruleset.is_default
+
+        db.flush()
+        CommissionService.invalidate_rulesets()
+        return ruleset
+
+    @staticmethod
+    def calculate(amount: Any, ruleset: Optional[CompiledRuleSet] = None, **attributes) -> Decimal:
+        """Hoa hồng của một giao dịch (attributes: transaction_type, provider, level, volume)"""
+        return Decimal((ruleset or BUILTIN_RULESET).commission(to_dong(amount), **attributes))
+
+    @staticmethod
+    def compute_for_period(
+        db: Session,
+        period_start: datetime,
+        period_end: datetime,
+        ruleset_name: Optional[str] = None,
+        agent_ids: Optional[List[Any]] = None,
+        write: bool = True,
+        status: str = "pending",
+        paid_at: Optional[datetime] = None
+    ) -> Dict[str, Any]:
+        """
+        Tính hoa hồng cho mọi giao dịch thành công thuộc COMMISSIONABLE_TRANSACTION_TYPES
+        trong [period_start, period_end) chưa có bản ghi hoa hồng. Doanh số tháng của từng đại lý được tổng hợp
+        bằng SQL trước để áp thưởng theo doanh số; giao dịch được đọc theo khối
+        COMMISSION_BATCH_SIZE dòng, tính theo lô và ghi Commission bằng một lệnh
+        INSERT nhiều dòng mỗi khối. Không commit.
+        """
+        ruleset = CommissionService.get_ruleset(db, ruleset_name)
+
+        conditions = [
+            Transaction.trang_thai == 'thanh_cong',
+            Transaction.dai_ly_id.isnot(None),
+            Transaction.loai_giao_dich.in_(COMMISSIONABLE_TRANSACTION_TYPES),
+            Transaction.created_at >= period_start,
+            Transaction.created_at < period_end
+        ]
+        if agent_ids is not None:
+            conditions.append(Transaction.dai_ly_id.in_(agent_ids))
+
+        volumes = {
+            agent_id: to_dong(volume or 0)
+            for agent_id, volume in db.query(
+                Transaction.dai_ly_id, func.sum(Transaction.so_tien)
+            ).filter(*conditions).group_by(Transaction.dai_ly_id).all()
+        }
+
+        already_paid = exists().where(Commission.transaction_id == cast(Transaction.id, String))
+        query = select(
+            Transaction.id,
+            Transaction.dai_ly_id,
+            Transaction.so_tien,
+            Transaction.loai_giao_dich,
+            Bill.provider_code,
+            Agent.level,
+            Agent.nguoi_dung_id,
+            User.ho_ten
+        ).join(
+            Agent, Agent.id == Transaction.dai_ly_id
+        ).join(
+            User, User.id == Agent.nguoi_dung_id
+        ).outerjoin(
+            Bill, Bill.id == Transaction.hoa_don_id
+        ).where(
+            *conditions, ~already_paid
+        ).execution_options(yield_per=COMMISSION_BATCH_SIZE)
+
+        agents: Dict[Any, Dict[str, Any]] = {}
+        total_transactions = 0
+        total_commission = 0
+
+        for rows in db.execute(query).partitions():
+            amounts = [to_dong(row.so_tien) for row in rows]
+            rates, commissions = ruleset.compute_batch(
+                amounts,
+                transaction_types=[row.loai_giao_dich for row in rows],
+                providers=[row.provider_code for row in rows],
+                levels=[row.level for row in rows],
+                volumes=[volumes.get(row.dai_ly_id, 0) for row in rows]
+            )
+
+            records = []
+            for row, amount, rate, commission in zip(rows, amounts, rates, commissions):
+                summary = agents.setdefault(row.dai_ly_id, {"transactions": 0, "base_amount": 0, "commission": 0})
+                summary["transactions"] += 1
+                summary["base_amount"] += amount
+                summary["commission"] += commission
+                records.append({
+                    "transaction_id": str(row.id),
+                    "recipient_id": str(row.nguoi_dung_id),
+                    "recipient_type": "agent",
+                    "recipient_name": row.ho_ten,
+                    "commission_type": "giao_dich",
+                    "base_amount": str(amount),
+                    "commission_rate": format_rate(rate),
+                    "commission_amount": str(commission),
+                    "status": status,
+                    "paid_at": paid_at.isoformat() if paid_at else None,
+                    "notes": f"{ruleset.name} v{ruleset.version}"
+                })
+
+            if write and records:
+                db.execute(insert(Commission), records)
+            total_transactions += len(records)
+            total_commission += sum(commissions)
+
+        return {
+            "ruleset": ruleset.name,
+            "ruleset_version": ruleset.version,
+            "period_start": period_start,
+            "period_end": period_end,
+            "total_transactions": total_transactions,
+            "total_commission": Decimal(total_commission),
+            "agents": {
+                agent_id: {**summary, "volume": volumes.get(agent_id, 0)}
+                for agent_id, summary in agents.items()
+            }
+        }
@@ -0,0 +1,195 @@
+"""
+Dashboard service - gom dữ liệu khởi động của PWA đại lý vào một lần gọi
+"""
+
+import os
+import asyncio
+from typing import List, Dict, Any
+from decimal import Decimal
+from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, func, case
+
+from ..database import SessionLocal
+from ..models.agents import Agent
+from ..models.customers import Customer
+from ..models.transactions import Transaction
+from ..models.bills import Bill
+from .agent_aggregate_service import PENDING_BILL_STATUS
+from .ledger_service import LedgerService
+from .section_cache import SectionCache
+
+# Configuration
+AGENT_DASHBOARD_CACHE_TTL = int(os.getenv("AGENT_DASHBOARD_CACHE_TTL", "30"))
+DASHBOARD_TRANSACTIONS_LIMIT = 50
+
+agent_dashboard_cache = SectionCache("agent_dashboard", AGENT_DASHBOARD_CACHE_TTL)
+
+# Section bị ảnh hưởng khi giao dịch của đại lý thay đổi
+TRANSACTION_SECTIONS = ("stats", "wallet", "transactions")
+
+class AgentDashboardService:
+    """
+    Dashboard đại lý: hồ sơ, thống kê, ví và giao dịch gần đây.
+
+    Đại lý được xác định một lần bởi endpoint; các section còn thiếu trong
+    cache được tải song song, mỗi section dùng một session riêng trong
+    threadpool (Session không dùng chung được giữa các thread).
+    """
+
+    @staticmethod
+    def _profile(current_user: Any, agent: Agent) -> Dict[str, Any]:
+        return {
+            "user_info": {
+                "id": current_user.id,
+                "ho_ten": current_user.ho_ten,
+                "so_dien_thoai": current_user.so_dien_thoai,
+                "email": current_user.email,
+                "vai_tro": current_user.vai_tro
+            },
+            "agent_info": {column.key: getattr(agent, column.key) for column in Agent.__table__.columns}
+        }
+
+    @staticmethod
+    def _transaction_totals(agent_id: Any) -> Dict[str, Any]:
+        """Số giao dịch, tổng hoa hồng và doanh thu tháng trong một lần quét"""
+        month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        successful = Transaction.trang_thai == 'thanh_cong'
+
+        db = SessionLocal()
+        try:
+            total_transactions, total_commission, monthly_revenue = db.query(
+                func.count(Transaction.id),
+                func.coalesce(func.sum(case((successful, Transaction.hoa_hong), else_=0)), 0),
+                func.coalesce(func.sum(case(
+                    (and_(successful, Transaction.created_at >= month_start), Transaction.so_tien),
+                    else_=0
+                )), 0)
+            ).filter(Transaction.dai_ly_id == agent_id).one()
+        finally:
+            db.close()
+
+        return {
+            "total_transactions": total_transactions,
+            "total_commission": Decimal(total_commission),
+            "monthly_revenue": Decimal(monthly_revenue)
+        }
+
+    @staticmethod
+    def _customer_count(agent_id: Any) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            return {"total_customers": db.query(Customer).filter(Customer.dai_ly_id == agent_id).count()}
+        finally:
+            db.close()
+
+    @staticmethod
+    def _pending_bills(agent_id: Any) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            pending_bills = db.query(Bill).join(Customer).filter(
+                and_(
+                    Customer.dai_ly_id == agent_id,
+                    Bill.trang_thai == PENDING_BILL_STATUS
+                )
+            ).count()
+        finally:
+            db.close()
+        return {"pending_bills": pending_bills}
+
+    @staticmethod
+    def _wallet(agent_id: Any) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            wallet = LedgerService.get_agent_wallet(db, agent_id)
+            if not wallet:
+                return {
+                    "current_balance": Decimal('0'),
+                    "total_income": Decimal('0'),
+                    "total_expense": Decimal('0'),
+                    "last_updated": None
+                }
+            return {
+                "current_balance": wallet.balance,
+                "total_income": wallet.total_deposits + wallet.total_commissions,
+                "total_expense": wallet.total_withdrawals,
+                "last_updated": wallet.updated_at
+            }
+        finally:
+            db.close()
+
+    @staticmethod
+    def _recent_transactions(agent_id: Any) -> List[Dict[str, Any]]:
+        db = SessionLocal()
+        try:
+            transactions = db.query(Transaction).filter(
+                Transaction.dai_ly_id == agent_id
+            ).order_by(Transaction.created_at.desc()).limit(DASHBOARD_TRANSACTIONS_LIMIT).all()
+            return [
+                {
+                    "id": t.id,
+                    "ma_giao_dich": t.ma_giao_dich,
+                    "loai_giao_dich": t.loai_giao_dich,
+                    "so_tien": t.so_tien,
+                    "hoa_hong": t.hoa_hong,
+                    "trang_thai": t.trang_thai,
+                    "thoi_gian_tao": t.created_at
+                }
+                for t in transactions
+            ]
+        finally:
+            db.close()
+
+    @staticmethod
+    async def _stats(agent_id: Any) -> Dict[str, Any]:
+        totals, customers, bills = await asyncio.gather(
+            run_in_threadpool(AgentDashboardService._transaction_totals, agent_id),
+            run_in_threadpool(AgentDashboardService._customer_count, agent_id),
+            run_in_threadpool(AgentDashboardService._pending_bills, agent_id)
+        )
+        return {**customers, **totals, **bills}
+
+    @staticmethod
+    async def build(current_user: Any, agent: Agent, transactions_limit: int) -> Dict[str, Any]:
+        """Dữ liệu dashboard; chỉ các section hết hạn cache mới chạm database"""
+        agent_id = agent.id
+        loaders = {
+            "stats": lambda: AgentDashboardService._stats(agent_id),
+            "wallet": lambda: run_in_threadpool(AgentDashboardService._wallet, agent_id),
+            "transactions": lambda: run_in_threadpool(AgentDashboardService._recent_transactions, agent_id)
+        }
+
+        sections = {}
+        cached_sections = []
+        for section in loaders:
+            value = agent_dashboard_cache.get(agent_id, section)
+            if value is not None:
+                sections[section] = value
+                cached_sections.append(section)
+
+        missing = [section for section in loaders if section not in sections]
+        if missing:
+            results = await asyncio.gather(*(loaders[section]() for section in missing))
+            for section, value in zip(missing, results):
+                sections[section] = agent_dashboard_cache.set(agent_id, section, value)
+
+        return {
+            "agent_id": agent_id,
+            "profile": AgentDashboardService._profile(current_user, agent),
+            "stats": sections["stats"],
+            "wallet": sections["wallet"],
+            "recent_transactions": sections["transactions"][:transactions_limit],
+            "cached_sections": cached_sections,
+            "generated_at": datetime.utcnow()
+        }
+
+    @staticmethod
+    def invalidate(agent_id: Any, sections=TRANSACTION_SECTIONS):
+        """Xóa cache dashboard của đại lý"""
+        agent_dashboard_cache.invalidate(agent_id, sections)
+
+async def invalidate_agent_dashboard(outbox_event: Dict[str, Any]):
+    """Subscriber outbox: giao dịch của đại lý thay đổi thì bỏ cache thống kê, ví và giao dịch"""
+    agent_id = (outbox_event.get("payload") or {}).get("dai_ly_id")
+    if outbox_event["aggregate_type"] == "giao_dich" and agent_id:
+        AgentDashboardService.invalidate(agent_id)
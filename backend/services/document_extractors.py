@@ -0,0 +1,122 @@
+"""
+Document extractors - trích xuất văn bản và số tiền từ biên nhận, chạy trong tiến trình con của DocumentProcessor
+
+Module này không import gì từ package để tiến trình con nạp nhanh. Bộ
+trích xuất là một hàm extract(path, mime_type) -> dict, chọn bằng biến môi
+trường DOCUMENT_EXTRACTOR dạng "module:function".
+"""
+
+import re
+import importlib
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+# Pillow và pytesseract là tùy chọn: không có thì chỉ đọc được tệp văn bản
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+OCR_LANGUAGES = "vie+eng"
+MAX_TEXT_LENGTH = 100_000
+
+# Số tiền kiểu Việt Nam: 1.250.000 đ / 1,250,000 VND / 250000₫
+AMOUNT_PATTERN = re.compile(
+    r"(\d{1,3}(?:[.,]\d{3})+|\d{4,})\s*(đ|₫|vnđ|vnd|dong|đồng)?",
+    re.IGNORECASE
+)
+TOTAL_KEYWORDS = ("tổng tiền", "tong tien", "tổng cộng", "tong cong", "thành tiền", "thanh tien", "số tiền", "so tien", "total")
+
+_extractors: Dict[str, Callable[[str, str], Dict[str, Any]]] = {}
+
+def load_extractor(path: str) -> Callable[[str, str], Dict[str, Any]]:
+    """Nạp bộ trích xuất theo "module:function" (cache trong tiến trình)"""
+    if path not in _extractors:
+        module_name, _, function_name = path.partition(":")
+        _extractors[path] = getattr(importlib.import_module(module_name), function_name)
+    return _extractors[path]
+
+def run_extractor(path: str, file_path: str, mime_type: str) -> Dict[str, Any]:
+    """Điểm vào của tiến trình con"""
+    return load_extractor(path)(file_path, mime_type)
+
+def parse_amount(raw: str) -> Optional[int]:
+    digits = re.sub(r"[.,]", "", raw)
+    return int(digits) if digits.isdigit() else None
+
+def find_amounts(text: str) -> Dict[str, Any]:
+    """
+    Các số tiền trong văn bản; tổng tiền ưu tiên số trên dòng có từ khóa tổng.
+    Không có dòng tổng thì lấy số lớn nhất trong các số có đơn vị tiền hoặc
+    dấu phân cách nghìn, để số hóa đơn, mã khách hàng hay năm không bị nhận nhầm.
+    """
+    amounts: List[int] = []
+    money_amounts: List[int] = []
+    total = None
+    for line in text.splitlines():
+        line_amounts = []
+        for match in AMOUNT_PATTERN.finditer(line):
+            amount = parse_amount(match.group(1))
+            if not amount:
+                continue
+            line_amounts.append(amount)
+            if match.group(2) or not match.group(1).isdigit():
+                money_amounts.append(amount)
+        amounts.extend(line_amounts)
+        if line_amounts and any(keyword in line.lower() for keyword in TOTAL_KEYWORDS):
+            total = line_amounts[-1]
+    if total is None and money_amounts:
+        total = max(money_amounts)
+    return {"amounts": amounts[:50], "total_amount": total}
+
+def _read_text(file_path: str, mime_type: str) -> Dict[str, Any]:
+    suffix = Path(file_path).suffix.lower()
+    metadata: Dict[str, Any] = {}
+
+    if mime_type.startswith("text/") or suffix == ".txt":
+        with open(file_path, "rb") as stream:
+            return {"engine": "text", "text": stream.read(MAX_TEXT_LENGTH).decode("utf-8", errors="replace"), "metadata": metadata}
+
+    if mime_type == "application/pdf" or suffix == ".pdf":
+        if PdfReader is None:
+            return {"engine": "none", "text": "", "metadata": metadata}
+        reader = PdfReader(file_path)
+        metadata["pages"] = len(reader.pages)
+        text = "\n".join(page.extract_text() or "" for page in reader.pages[:20])
+        return {"engine": "pdf", "text": text[:MAX_TEXT_LENGTH], "metadata": metadata}
+
+    if mime_type.startswith("image/") and Image is not None:
+        with Image.open(file_path) as image:
+            metadata.update({"width": image.width, "height": image.height, "format": image.format})
+            if pytesseract is None:
+                return {"engine": "none", "text": "", "metadata": metadata}
+            text = pytesseract.image_to_string(image.convert("L"), lang=OCR_LANGUAGES)
+            return {"engine": "tesseract", "text": text[:MAX_TEXT_LENGTH], "metadata": metadata}
+
+    return {"engine": "none", "text": "", "metadata": metadata}
+
+def receipt_extractor(file_path: str, mime_type: str) -> Dict[str, Any]:
+    """
+    Bộ trích xuất mặc định: đọc văn bản (tệp văn bản, PDF có lớp chữ, OCR
+    ảnh bằng Tesseract nếu có) rồi tìm số tiền trên biên nhận.
+    """
+    extracted = _read_text(file_path, mime_type or "")
+    amounts = find_amounts(extracted["text"])
+    return {
+        "engine": extracted["engine"],
+        "ocr_text": extracted["text"],
+        "metadata": extracted["metadata"],
+        "amounts": amounts["amounts"],
+        "total_amount": str(Decimal(amounts["total_amount"])) if amounts["total_amount"] is not None else None
+    }
@@ -0,0 +1,284 @@
+"""
+Document processing service - hàng đợi xử lý tệp (OCR, trích xuất số tiền) chạy trên process pool nền
+"""
+
+import os
+import asyncio
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from ..models.files import FileUpload, FileStatus
+from .file_storage_service import get_file_storage
+from . import document_extractors
+
+# Configuration
+DOCUMENT_PROCESSING_ENABLED = os.getenv("DOCUMENT_PROCESSING_ENABLED", "true").lower() == "true"
+DOCUMENT_PROCESSING_WORKERS = int(os.getenv("DOCUMENT_PROCESSING_WORKERS", str(max((os.cpu_count() or 2) // 2, 1))))
+# Số tệp tối đa đang xử lý hoặc chờ trong pool; tệp còn lại nằm trong database tới khi có chỗ
+DOCUMENT_PROCESSING_MAX_IN_FLIGHT = int(os.getenv("DOCUMENT_PROCESSING_MAX_IN_FLIGHT", str(DOCUMENT_PROCESSING_WORKERS * 2)))
+DOCUMENT_PROCESSING_POLL_SECONDS = float(os.getenv("DOCUMENT_PROCESSING_POLL_SECONDS", "30"))
+DOCUMENT_PROCESSING_TIMEOUT_SECONDS = float(os.getenv("DOCUMENT_PROCESSING_TIMEOUT_SECONDS", "120"))
+DOCUMENT_PROCESSING_MAX_ATTEMPTS = int(os.getenv("DOCUMENT_PROCESSING_MAX_ATTEMPTS", "3"))
+DOCUMENT_EXTRACTOR = os.getenv("DOCUMENT_EXTRACTOR", f"{document_extractors.__name__}:receipt_extractor")
+
+# Loại tệp được đưa vào hàng đợi xử lý
+PROCESSABLE_MIME_PREFIXES = ("image/", "text/", "application/pdf")
+
+def _transition(processing_result: Optional[Dict[str, Any]], status: FileStatus, **fields) -> Dict[str, Any]:
+    """processing_result mới kèm lịch sử chuyển trạng thái"""
+    result = dict(processing_result or {})
+    result.update(fields)
+    result["transitions"] = list(result.get("transitions") or []) + [
+        {"status": status.value, "at": datetime.utcnow().isoformat()}
+    ]
+    return result
+
+class DocumentProcessor:
+    """
+    Xử lý tệp đã tải lên trên ProcessPoolExecutor, không chạy trên worker
+    phục vụ request. Database là hàng đợi: tệp ở trạng thái da_tai_len được
+    nhận theo lô bằng FOR UPDATE SKIP LOCKED và chuyển sang dang_xu_ly, rồi
+    da_xu_ly hoặc that_bai (thử lại tới DOCUMENT_PROCESSING_MAX_ATTEMPTS lần).
+
+    Backpressure: chỉ nhận thêm tệp khi số tệp đang xử lý dưới
+    DOCUMENT_PROCESSING_MAX_IN_FLIGHT, nên pool không bao giờ có hàng đợi
+    dài trong bộ nhớ; tệp dồn lại chỉ nằm trong database. Tệp kẹt ở
+    dang_xu_ly quá thời gian chờ (tiến trình chết giữa chừng) được trả về
+    hàng đợi khi khởi động.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        workers: int = DOCUMENT_PROCESSING_WORKERS,
+        max_in_flight: int = DOCUMENT_PROCESSING_MAX_IN_FLIGHT,
+        extractor: str = DOCUMENT_EXTRACTOR
+    ):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.max_in_flight = max(max_in_flight, workers)
+        self.extractor = extractor
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats = {"claimed": 0, "processed": 0, "failed": 0, "retried": 0, "timed_out": 0, "pool_restarts": 0}
+
+    async def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def notify(self):
+        """Có tệp mới chờ xử lý (gọi được từ thread khác)"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "in_flight": len(self._in_flight), "max_in_flight": self.max_in_flight, "workers": self.workers}
+
+    def _recover_stale(self) -> int:
+        """Trả các tệp kẹt ở dang_xu_ly quá thời gian chờ về hàng đợi"""
+        db = self.session_factory()
+        try:
+            recovered = db.query(FileUpload).filter(
+                FileUpload.status == FileStatus.PROCESSING,
+                FileUpload.updated_at < datetime.utcnow() - timedelta(seconds=DOCUMENT_PROCESSING_TIMEOUT_SECONDS * 2)
+            ).update({FileUpload.status: FileStatus.UPLOADED}, synchronize_session=False)
+            db.commit()
+            return recovered
+        finally:
+            db.close()
+
+    def _claim(self, limit: int) -> List[Dict[str, Any]]:
+        """Nhận tối đa limit tệp chờ xử lý và chuyển sang dang_xu_ly"""
+        db = self.session_factory()
+        try:
+            files = db.query(FileUpload).filter(
+                FileUpload.status == FileStatus.UPLOADED,
+                FileUpload.deleted_at.is_(None),
+                or_(*[FileUpload.mime_type.startswith(prefix) for prefix in PROCESSABLE_MIME_PREFIXES])
+            ).order_by(FileUpload.created_at).limit(limit).with_for_update(skip_locked=True).all()
+
+            claimed = []
+            for file in files:
+                attempts = (file.processing_result or {}).get("attempts", 0) + 1
+                file.status = FileStatus.PROCESSING
+                file.processing_result = _transition(file.processing_result, FileStatus.PROCESSING, attempts=attempts)
+                claimed.append({
+                    "id": file.id,
+                    "key": file.file_path,
+                    "mime_type": file.mime_type,
+                    "extension": file.file_extension,
+                    "attempts": attempts
+                })
+            db.commit()
+            return claimed
+        finally:
+            db.close()
+
+    def _finish(self, item: Dict[str, Any], result: Optional[Dict[str, Any]], error: Optional[str]):
+        db = self.session_factory()
+        try:
+            file = db.query(FileUpload).filter(FileUpload.id == item["id"]).with_for_update().first()
+            if file is None or file.status != FileStatus.PROCESSING:
+                return
+            if error is None:
+                file.status = FileStatus.PROCESSED
+                file.ocr_text = result.pop("ocr_text", None)
+                file.processing_result = _transition(
+                    file.processing_result, FileStatus.PROCESSED,
+                    extractor=self.extractor, error=None, **result
+                )
+                self.stats["processed"] += 1
+            elif item["attempts"] < DOCUMENT_PROCESSING_MAX_ATTEMPTS:
+                # Trả về hàng đợi để thử lại
+                file.status = FileStatus.UPLOADED
+                file.processing_result = _transition(file.processing_result, FileStatus.UPLOADED, error=error)
+                self.stats["retried"] += 1
+            else:
+                file.status = FileStatus.FAILED
+                file.processing_result = _transition(file.processing_result, FileStatus.FAILED, error=error)
+                self.stats["failed"] += 1
+            db.commit()
+        finally:
+            db.close()
+
+    def _local_copy(self, item: Dict[str, Any]) -> Tuple[str, bool]:
+        """Đường dẫn cục bộ cho tiến trình con; tải về tệp tạm nếu kho không phải đĩa"""
+        storage = get_file_storage()
+        path = storage.local_path(item["key"])
+        if path is not None:
+            return str(path), False
+        with tempfile.NamedTemporaryFile(suffix=item["extension"] or "", delete=False) as temp:
+            for chunk in storage.iter_chunks(item["key"]):
+                temp.write(chunk)
+        return temp.name, True
+
+    async def _process(self, item: Dict[str, Any]):
+        loop = asyncio.get_running_loop()
+        result, error, temp_path, future = None, None, None, None
+        pool = self._pool
+        try:
+            path, is_temp = await loop.run_in_executor(None, self._local_copy, item)
+            temp_path = path if is_temp else None
+            future = loop.run_in_executor(pool, document_extractors.run_extractor, self.extractor, path, item["mime_type"])
+            # asyncio.wait không hủy future khi hết giờ (hủy cũng không dừng được tiến trình con)
+            done, _ = await asyncio.wait({future}, timeout=DOCUMENT_PROCESSING_TIMEOUT_SECONDS)
+            if done:
+                result = future.result()
+            else:
+                error = f"Quá thời gian xử lý ({DOCUMENT_PROCESSING_TIMEOUT_SECONDS:.0f}s)"
+                self.stats["timed_out"] += 1
+        except BrokenProcessPool:
+            # Tiến trình con chết (hết bộ nhớ, lỗi thư viện OCR...): dựng lại pool
+            error = "Tiến trình xử lý bị dừng đột ngột"
+            self._restart_pool(pool)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+
+        try:
+            await loop.run_in_executor(None, self._finish, item, result, error)
+        except Exception as e:
+            print(f"Document processing result error: {str(e)}")
+
+        try:
+            if future is not None and not future.done():
+                # Tiến trình con vẫn chiếm một worker: giữ chỗ trong _in_flight tới khi nó xong; treo thêm
+                # một lần thời gian chờ nữa thì dựng pool mới và dừng hẳn các tiến trình của pool cũ
+                done, _ = await asyncio.wait({future}, timeout=DOCUMENT_PROCESSING_TIMEOUT_SECONDS)
+                if not done:
+                    self._restart_pool(pool, terminate=True)
+                await asyncio.gather(future, return_exceptions=True)
+        finally:
+            if temp_path:
+                await loop.run_in_executor(None, os.unlink, temp_path)
+
+    def _restart_pool(self, pool: ProcessPoolExecutor, terminate: bool = False):
+        """Thay pool hỏng; nhiều tệp cùng báo lỗi của một pool thì chỉ dựng lại một lần"""
+        if pool is self._pool:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.stats["pool_restarts"] += 1
+        if terminate:
+            # shutdown không dừng tiến trình đang chạy; tệp khác trên pool cũ nhận BrokenProcessPool và được thử lại
+            for process in list((getattr(pool, "_processes", None) or {}).values()):
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, task: asyncio.Task):
+        self._in_flight.discard(task)
+        # Có chỗ trống: nhận thêm tệp
+        self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._recover_stale)
+        except Exception as e:
+            print(f"Document processing recovery error: {str(e)}")
+
+        while not self._stopping:
+            try:
+                free = self.max_in_flight - len(self._in_flight)
+                if free > 0:
+                    claimed = await loop.run_in_executor(None, self._claim, free)
+                    self.stats["claimed"] += len(claimed)
+                    for item in claimed:
+                        task = asyncio.create_task(self._process(item))
+                        self._in_flight.add(task)
+                        task.add_done_callback(self._done)
+                    # Nhận đủ lô: có thể còn tệp chờ, vòng sau nhận tiếp khi có chỗ
+                    if claimed and len(claimed) == free:
+                        self._wakeup.clear()
+                        continue
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), DOCUMENT_PROCESSING_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            except Exception as e:
+                print(f"Document processor error: {str(e)}")
+                await asyncio.sleep(5)
+
+document_processor: Optional[DocumentProcessor] = None
+
+def get_document_processor() -> Optional[DocumentProcessor]:
+    """Get document processor (None if disabled)"""
+    return document_processor
+
+async def start_document_processor(session_factory: Callable[[], Session]):
+    """Khởi động process pool nếu DOCUMENT_PROCESSING_ENABLED=true"""
+    global document_processor
+    if DOCUMENT_PROCESSING_ENABLED:
+        document_processor = DocumentProcessor(session_factory)
+        await document_processor.start()
+        print(f"✅ Document processor started ({document_processor.workers} workers)")
+
+async def stop_document_processor():
+    global document_processor
+    if document_processor is not None:
+        await document_processor.stop()
+        document_processor = None
@@ -0,0 +1,137 @@
+"""
+Download counter service - đếm lượt tải trong bộ nhớ, ghi xuống database theo lô định kỳ
+"""
+
+import os
+import asyncio
+import threading
+from typing import Callable, Dict, Optional, Tuple
+from datetime import datetime
+from sqlalchemy import bindparam, func, update
+from sqlalchemy.orm import Session
+
+from ..models.files import FileRecord
+
+# Configuration
+FILE_DOWNLOAD_FLUSH_SECONDS = float(os.getenv("FILE_DOWNLOAD_FLUSH_SECONDS", "10"))
+# Số tệp khác nhau đang chờ ghi vượt ngưỡng này thì ghi sớm
+FILE_DOWNLOAD_MAX_PENDING = int(os.getenv("FILE_DOWNLOAD_MAX_PENDING", "5000"))
+
+class DownloadCounter:
+    """
+    Lượt tải được cộng dồn theo file trong bộ nhớ (so_lan_tai, lan_tai_cuoi)
+    và ghi bằng một câu UPDATE executemany mỗi FILE_DOWNLOAD_FLUSH_SECONDS
+    giây, nên tải file chỉ còn là thao tác đọc. Mỗi tiến trình cộng phần của
+    mình (so_lan_tai = so_lan_tai + n) nên nhiều worker không ghi đè nhau.
+    Lượt tải chưa kịp ghi khi tiến trình chết đột ngột sẽ mất (chấp nhận được
+    với số liệu thống kê).
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], flush_seconds: float = FILE_DOWNLOAD_FLUSH_SECONDS):
+        self.session_factory = session_factory
+        self.flush_seconds = flush_seconds
+        self._pending: Dict[str, Tuple[int, datetime]] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats = {"flushes": 0, "rows": 0, "downloads": 0}
+
+    async def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Dừng vòng lặp và ghi nốt các lượt tải còn trong bộ nhớ"""
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    def record(self, file_id: str):
+        """Ghi nhận một lượt tải (không truy cập database)"""
+        now = datetime.utcnow()
+        with self._lock:
+            count, _ = self._pending.get(file_id, (0, now))
+            self._pending[file_id] = (count + 1, now)
+            overflow = len(self._pending) >= FILE_DOWNLOAD_MAX_PENDING
+        if overflow and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def flush(self) -> int:
+        """Ghi các lượt tải đang chờ trong một transaction; trả về số file được cập nhật"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        rows = [
+            {"b_id": file_id, "b_count": count, "b_last": last}
+            for file_id, (count, last) in sorted(pending.items())
+        ]
+        # Câu UPDATE Core với executemany (dạng ORM với danh sách tham số là bulk-by-PK, không nhận WHERE riêng)
+        table = FileRecord.__table__
+        db = self.session_factory()
+        try:
+            db.execute(
+                update(table).where(table.c.id == bindparam("b_id")).values(
+                    so_lan_tai=func.coalesce(table.c.so_lan_tai, 0) + bindparam("b_count"),
+                    lan_tai_cuoi=bindparam("b_last")
+                ),
+                rows
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Trả lại các lượt tải để lần sau ghi tiếp
+            with self._lock:
+                for file_id, (count, last) in pending.items():
+                    current, current_last = self._pending.get(file_id, (0, last))
+                    self._pending[file_id] = (current + count, max(last, current_last))
+            raise
+        finally:
+            db.close()
+
+        self.stats["flushes"] += 1
+        self.stats["rows"] += len(rows)
+        self.stats["downloads"] += sum(count for count, _ in pending.values())
+        return len(rows)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                if not self._stopping:
+                    await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                print(f"Download counter flush error: {str(e)}")
+                await asyncio.sleep(5)
+
+download_counter: Optional[DownloadCounter] = None
+
+def get_download_counter() -> Optional[DownloadCounter]:
+    """Get download counter (None if not started)"""
+    return download_counter
+
+async def start_download_counter(session_factory: Callable[[], Session]):
+    global download_counter
+    download_counter = DownloadCounter(session_factory)
+    await download_counter.start()
+    print("✅ Download counter started")
+
+async def stop_download_counter():
+    global download_counter
+    if download_counter is not None:
+        await download_counter.stop()
+        download_counter = None
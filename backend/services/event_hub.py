@@ -0,0 +1,82 @@
+"""
+WebSocket event hub - đẩy sự kiện thay đổi tới dashboard thay cho polling /stats
+"""
+
+import asyncio
+from typing import Dict, Any, Optional, Set
+from fastapi import WebSocket
+
+# Vai trò nhận toàn bộ sự kiện
+STAFF_ROLES = {'admin', 'quan_ly', 'nhan_vien'}
+
+# Số sự kiện tối đa chờ gửi cho mỗi kết nối; client chậm bị ngắt thay vì làm chậm hub
+CLIENT_QUEUE_SIZE = 256
+
+class EventConnection:
+    """Một kết nối WebSocket cùng hàng đợi gửi riêng"""
+
+    def __init__(self, websocket: WebSocket, user_id: str, role: str, topics: Optional[Set[str]] = None):
+        self.websocket = websocket
+        self.user_id = str(user_id)
+        self.role = role
+        self.topics = topics
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+
+    def accepts(self, event: Dict[str, Any]) -> bool:
+        """Kết nối có quyền và có đăng ký nhận sự kiện này không"""
+        if self.topics and event["aggregate_type"] not in self.topics:
+            return False
+        if self.role in STAFF_ROLES:
+            return True
+        return self.user_id in (event.get("recipients") or [])
+
+class EventHub:
+    """Quản lý các kết nối WebSocket trong tiến trình hiện tại"""
+
+    def __init__(self):
+        self._connections: Set[EventConnection] = set()
+
+    @property
+    def connection_count(self) -> int:
+        return len(self._connections)
+
+    def register(self, connection: EventConnection):
+        self._connections.add(connection)
+
+    def unregister(self, connection: EventConnection):
+        self._connections.discard(connection)
+
+    async def publish(self, event: Dict[str, Any]):
+        """Đưa sự kiện vào hàng đợi của các kết nối phù hợp (không chờ gửi xong)"""
+        for connection in list(self._connections):
+            if not connection.accepts(event):
+                continue
+            try:
+                connection.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Client không đọc kịp: ngắt để client kết nối lại và tải lại số liệu
+                self.unregister(connection)
+                asyncio.create_task(connection.websocket.close(code=1013))
+
+    async def serve(self, connection: EventConnection):
+        """Gửi sự kiện từ hàng đợi tới client cho tới khi kết nối đóng"""
+        self.register(connection)
+        sender = asyncio.create_task(self._send_loop(connection))
+        try:
+            # Đọc để phát hiện client ngắt kết nối (tin nhắn từ client được bỏ qua)
+            while True:
+                await connection.websocket.receive_text()
+        finally:
+            sender.cancel()
+            self.unregister(connection)
+
+    async def _send_loop(self, connection: EventConnection):
+        while True:
+            event = await connection.queue.get()
+            await connection.websocket.send_json(event)
+
+event_hub = EventHub()
+
+def get_event_hub() -> EventHub:
+    """Get event hub instance"""
+    return event_hub
@@ -0,0 +1,292 @@
+"""
+File storage service - lưu tệp theo lô nhỏ ngoài event loop, định địa chỉ theo nội dung (SHA-256), cây thư mục phân mảnh
+"""
+
+import os
+import uuid
+import asyncio
+import hashlib
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Optional
+
+# boto3 là tùy chọn: chỉ cần khi FILE_STORAGE_BACKEND=s3
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = Exception
+
+# Configuration
+FILE_STORAGE_BACKEND = os.getenv("FILE_STORAGE_BACKEND", "local")
+FILE_STORAGE_DIR = os.getenv("FILE_STORAGE_DIR", "uploads")
+FILE_STORAGE_CHUNK_SIZE = int(os.getenv("FILE_STORAGE_CHUNK_SIZE", str(1024 * 1024)))
+# Số cấp thư mục, mỗi cấp 2 ký tự hex của mã băm (2 cấp = 65536 thư mục lá)
+FILE_STORAGE_SHARD_DEPTH = int(os.getenv("FILE_STORAGE_SHARD_DEPTH", "2"))
+
+# S3 hoặc dịch vụ tương thích (MinIO...): đặt S3_ENDPOINT_URL để trỏ tới máy chủ riêng
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_BUCKET = os.getenv("S3_BUCKET", "7ty-uploads")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+
+class FileTooLargeError(ValueError):
+    """Tệp vượt quá kích thước cho phép (phát hiện khi đang đọc, không cần đọc hết tệp)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        super().__init__(f"File quá lớn. Kích thước tối đa: {max_size // (1024 * 1024)}MB")
+
+def content_key(digest: str, depth: int = FILE_STORAGE_SHARD_DEPTH) -> str:
+    """Khóa lưu trữ từ mã băm: ab/cd/abcd...; cùng nội dung luôn cùng khóa"""
+    shards = [digest[i * 2:i * 2 + 2] for i in range(depth)]
+    return "/".join(shards + [digest])
+
+class FileStorage(ABC):
+    """
+    Giao diện chung của các kho lưu trữ. Các phương thức là đồng bộ (I/O
+    chặn) và được FileStorageService gọi qua thread pool.
+    """
+
+    name = "base"
+
+    def temp_dir(self) -> Optional[str]:
+        """Thư mục cho tệp tạm khi đang nhận upload (None = thư mục tạm hệ thống)"""
+        return None
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def store(self, temp_path: str, key: str) -> bool:
+        """Đưa tệp tạm vào kho dưới khóa key; trả về True nếu nội dung đã có sẵn (không ghi lại)"""
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    def local_path(self, key: str) -> Optional[Path]:
+        """Đường dẫn trên đĩa nếu kho là thư mục cục bộ (để trả tệp trực tiếp)"""
+        return None
+
+    def iter_chunks(self, key: str, chunk_size: int = FILE_STORAGE_CHUNK_SIZE) -> Iterator[bytes]:
+        with self.open(key) as stream:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_range(self, key: str, start: int, end: int, chunk_size: int = FILE_STORAGE_CHUNK_SIZE) -> Iterator[bytes]:
+        """Nội dung từ byte start tới end (tính cả end)"""
+        with self._open_range(key, start, end) as stream:
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def _open_range(self, key: str, start: int, end: int) -> BinaryIO:
+        stream = self.open(key)
+        # Kho không hỗ trợ seek: đọc bỏ phần đầu
+        skip = start
+        while skip > 0:
+            skipped = stream.read(min(FILE_STORAGE_CHUNK_SIZE, skip))
+            if not skipped:
+                break
+            skip -= len(skipped)
+        return stream
+
+class LocalFileStorage(FileStorage):
+    """Kho trên đĩa: <root>/ab/cd/<sha256>, ghi bằng os.replace nên tệp luôn đầy đủ"""
+
+    name = "local"
+
+    def __init__(self, root: str = FILE_STORAGE_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._tmp = self.root / ".tmp"
+        self._tmp.mkdir(exist_ok=True)
+
+    def temp_dir(self) -> Optional[str]:
+        # Cùng hệ thống tệp với kho để os.replace là thao tác đổi tên nguyên tử
+        return str(self._tmp)
+
+    def _path(self, key: str) -> Path:
+        path = self.root / key
+        if not path.exists() and Path(key).exists():
+            # Bản ghi cũ lưu đường dẫn đầy đủ (uploads/<uuid>.<ext>)
+            return Path(key)
+        return path
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def store(self, temp_path: str, key: str) -> bool:
+        path = self.root / key
+        if path.exists():
+            return True
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(temp_path, path)
+        return False
+
+    def size(self, key: str) -> int:
+        return self._path(key).stat().st_size
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), "rb")
+
+    def _open_range(self, key: str, start: int, end: int) -> BinaryIO:
+        stream = self.open(key)
+        stream.seek(start)
+        return stream
+
+    def delete(self, key: str):
+        path = self._path(key)
+        if path.exists():
+            path.unlink()
+
+    def local_path(self, key: str) -> Optional[Path]:
+        path = self._path(key)
+        return path if path.exists() else None
+
+class S3FileStorage(FileStorage):
+    """Kho S3 hoặc tương thích S3; upload_file tự chia multipart cho tệp lớn"""
+
+    name = "s3"
+
+    def __init__(
+        self,
+        bucket: str = S3_BUCKET,
+        endpoint_url: Optional[str] = S3_ENDPOINT_URL,
+        prefix: str = S3_PREFIX,
+        client: Any = None
+    ):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("FILE_STORAGE_BACKEND=s3 cần thư viện boto3")
+            client = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                region_name=S3_REGION,
+                aws_access_key_id=S3_ACCESS_KEY,
+                aws_secret_access_key=S3_SECRET_KEY
+            )
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _head(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as e:
+            if str(getattr(e, "response", {}).get("Error", {}).get("Code")) in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def store(self, temp_path: str, key: str) -> bool:
+        if self.exists(key):
+            return True
+        self.client.upload_file(temp_path, self.bucket, self._object_key(key))
+        return False
+
+    def size(self, key: str) -> int:
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return head["ContentLength"]
+
+    def open(self, key: str) -> BinaryIO:
+        return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))["Body"]
+
+    def _open_range(self, key: str, start: int, end: int) -> BinaryIO:
+        # Chỉ tải phần được yêu cầu từ kho
+        return self.client.get_object(
+            Bucket=self.bucket, Key=self._object_key(key), Range=f"bytes={start}-{end}"
+        )["Body"]
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+_storage: Optional[FileStorage] = None
+
+def get_file_storage() -> FileStorage:
+    """Kho lưu trữ theo FILE_STORAGE_BACKEND (khởi tạo lần đầu khi dùng)"""
+    global _storage
+    if _storage is None:
+        _storage = S3FileStorage() if FILE_STORAGE_BACKEND == "s3" else LocalFileStorage()
+    return _storage
+
+def _write_chunk(stream: BinaryIO, hasher: Any, chunk: bytes):
+    # hashlib nhả GIL với khối lớn nên băm và ghi đều không giữ event loop
+    hasher.update(chunk)
+    stream.write(chunk)
+
+def _discard_temp(temp: Any):
+    if not temp.closed:
+        temp.close()
+    if os.path.exists(temp.name):
+        os.unlink(temp.name)
+
+class FileStorageService:
+
+    @staticmethod
+    async def save_upload(
+        upload: Any,
+        max_size: int,
+        storage: Optional[FileStorage] = None,
+        chunk_size: int = FILE_STORAGE_CHUNK_SIZE
+    ) -> Dict[str, Any]:
+        """
+        Đọc upload theo từng khối, băm SHA-256 và ghi ra tệp tạm trong thread
+        pool, rồi đưa vào kho dưới khóa định địa chỉ theo nội dung. Nội dung
+        đã có trong kho thì không ghi lại (deduplicated=True). Dừng ngay khi
+        vượt max_size (FileTooLargeError).
+        """
+        storage = storage or get_file_storage()
+        loop = asyncio.get_running_loop()
+        hasher = hashlib.sha256()
+        size = 0
+
+        temp = await loop.run_in_executor(
+            None, lambda: tempfile.NamedTemporaryFile(dir=storage.temp_dir(), prefix=f"{uuid.uuid4().hex}-", delete=False)
+        )
+        try:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLargeError(max_size)
+                await loop.run_in_executor(None, _write_chunk, temp, hasher, chunk)
+            await loop.run_in_executor(None, temp.close)
+
+            digest = hasher.hexdigest()
+            key = content_key(digest)
+            deduplicated = await loop.run_in_executor(None, storage.store, temp.name, key)
+        finally:
+            await loop.run_in_executor(None, _discard_temp, temp)
+
+        return {"key": key, "sha256": digest, "size": size, "deduplicated": deduplicated, "backend": storage.name}
@@ -0,0 +1,181 @@
+"""
+Group-commit write-behind queue - gom các INSERT của nhiều request vào một lần commit
+"""
+
+import os
+import uuid
+import asyncio
+from collections import defaultdict
+from typing import List, Optional, Dict, Any, Tuple, Callable
+from sqlalchemy.engine import Engine
+
+# Configuration
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "5"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "500"))
+
+class GroupCommitWriter:
+    """
+    Hàng đợi ghi gom nhóm.
+
+    Request gọi `await writer.write(Model, values)`, hoặc
+    `await writer.write_many([(Model, values), ...])` cho các dòng phải ghi
+    cùng nhau (giao dịch + nhật ký + outbox); các đơn vị đến trong cùng cửa
+    sổ vài mili-giây được INSERT nhiều dòng theo từng bảng và commit một
+    lần. Coroutine của request chỉ hoàn thành sau khi lô chứa nó đã commit,
+    nên kết quả trả về là xác nhận bền vững. Nếu cả lô lỗi, từng đơn vị được
+    ghi lại trong transaction riêng: một đơn vị hỏng không làm hỏng đơn vị
+    khác, và các dòng của một đơn vị luôn cùng được ghi hoặc cùng bị bỏ.
+
+    on_insert() đăng ký hook chạy trong cùng transaction sau khi INSERT các
+    dòng của một bảng (ví dụ tăng phiên bản danh sách theo dòng outbox).
+    """
+
+    def __init__(self, engine: Engine, window_ms: float = GROUP_COMMIT_WINDOW_MS, max_batch: int = GROUP_COMMIT_MAX_BATCH):
+        self.engine = engine
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "rows": 0, "failed_rows": 0}
+        self._hooks: Dict[str, List[Callable]] = defaultdict(list)
+
+    def on_insert(self, model, hook: Callable[[Any, List[Dict[str, Any]]], None]):
+        """Đăng ký hook(connection, rows) cho các dòng INSERT vào bảng của model"""
+        self._hooks[model.__table__.name].append(hook)
+
+    def _insert(self, conn, table, rows: List[Dict[str, Any]]):
+        conn.execute(table.insert(), rows)
+        for hook in self._hooks.get(table.name, []):
+            hook(conn, rows)
+
+    async def start(self):
+        """Khởi động vòng lặp gom lô"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Ghi nốt các dòng đang chờ rồi dừng"""
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+
+    async def write(self, model, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Đưa một dòng vào hàng đợi và chờ tới khi lô chứa nó đã commit"""
+        rows = await self.write_many([(model, values)])
+        return rows[0]
+
+    async def write_many(self, items: List[Tuple[Any, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Đưa các dòng của một request vào hàng đợi như một đơn vị (cùng commit hoặc cùng lỗi)"""
+        if self._task is None:
+            raise RuntimeError("Group-commit writer chưa được khởi động")
+
+        unit = []
+        for model, values in items:
+            row = dict(values)
+            row.setdefault("id", uuid.uuid4())
+            unit.append((model.__table__, row))
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((unit, future))
+        await future
+        return [row for _, row in unit]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.window
+
+            # Gom thêm các dòng đến trong cửa sổ thời gian
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    # Hết cửa sổ: chỉ lấy nốt các dòng đã có sẵn trong hàng đợi
+                    if self._queue.empty():
+                        break
+                    item = self._queue.get_nowait()
+                else:
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            # Commit chạy ngoài event loop; trong lúc đó lô kế tiếp tiếp tục được gom
+            errors = await loop.run_in_executor(None, self._flush, [unit for unit, _ in batch])
+
+            for (_, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    def _insert_units(self, conn, units: List[List[Tuple[Any, Dict[str, Any]]]]):
+        """Mỗi bảng một câu INSERT nhiều dòng, theo thứ tự bảng xuất hiện đầu tiên"""
+        groups = defaultdict(list)
+        for unit in units:
+            for table, row in unit:
+                groups[(table, tuple(sorted(row)))].append(row)
+        for (table, _), rows in groups.items():
+            self._insert(conn, table, rows)
+
+    def _flush(self, batch: List[List[Tuple[Any, Dict[str, Any]]]]) -> List[Optional[Exception]]:
+        """Ghi một lô đơn vị trong một lần commit; trả về lỗi theo từng đơn vị"""
+        try:
+            with self.engine.begin() as conn:
+                self._insert_units(conn, batch)
+            self.stats["batches"] += 1
+            self.stats["rows"] += sum(len(unit) for unit in batch)
+            return [None] * len(batch)
+        except Exception:
+            pass
+
+        # Cô lập đơn vị lỗi: ghi lại từng đơn vị (mọi dòng của một request) trong transaction riêng
+        errors = []
+        for unit in batch:
+            try:
+                with self.engine.begin() as conn:
+                    self._insert_units(conn, [unit])
+                self.stats["rows"] += len(unit)
+                errors.append(None)
+            except Exception as e:
+                self.stats["failed_rows"] += len(unit)
+                errors.append(e)
+        return errors
+
+group_commit_writer: Optional[GroupCommitWriter] = None
+
+def get_group_commit_writer() -> Optional[GroupCommitWriter]:
+    """Get group-commit writer (None if disabled)"""
+    return group_commit_writer
+
+async def start_group_commit_writer(engine: Engine, hooks: Optional[List[Tuple[Any, Callable]]] = None):
+    """Khởi động writer nếu GROUP_COMMIT_ENABLED=true; hooks là các cặp (model, hook) cho on_insert()"""
+    global group_commit_writer
+    if GROUP_COMMIT_ENABLED:
+        group_commit_writer = GroupCommitWriter(engine)
+        for model, hook in hooks or []:
+            group_commit_writer.on_insert(model, hook)
+        await group_commit_writer.start()
+        print(f"✅ Group-commit writer started (window {GROUP_COMMIT_WINDOW_MS}ms)")
+
+async def stop_group_commit_writer():
+    """Dừng writer và ghi nốt các dòng đang chờ"""
+    global group_commit_writer
+    if group_commit_writer is not None:
+        await group_commit_writer.stop()
+        group_commit_writer = None
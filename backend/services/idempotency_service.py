@@ -0,0 +1,204 @@
+"""
+Idempotency-Key service - chống tạo trùng giao dịch khi client gửi lại yêu cầu
+"""
+
+import os
+import json
+import hashlib
+from typing import Optional, Dict, Any
+from datetime import datetime, timedelta
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from ..cache import get_redis
+from ..models.idempotency import IdempotencyKey
+
+# Configuration
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+MAX_KEY_LENGTH = 100
+
+class IdempotencyService:
+    """
+    Lưu khóa Idempotency-Key và phản hồi tương ứng.
+
+    Trình tự sử dụng trong một endpoint:
+        replay = idem.begin(payload)      # trước khi ghi dữ liệu
+        ...                               # xử lý nghiệp vụ
+        idem.save_response(response)      # trước db.commit()
+        db.commit()
+    và gọi idem.release() khi xử lý lỗi.
+
+    Với database, khóa được INSERT trong cùng transaction nghiệp vụ nên
+    luồng bình thường không tốn thêm lần commit nào; yêu cầu trùng chạy
+    song song sẽ chờ unique index rồi nhận lại phản hồi đã lưu. Với Redis,
+    khóa được giữ bằng SET NX và phản hồi chỉ được ghi sau khi commit.
+    """
+
+    def __init__(self, db: Session, key: Optional[str], user_id: str, request_path: str):
+        self.db = db
+        self.key = key
+        self.user_id = str(user_id)
+        self.request_path = request_path
+        self.redis = get_redis()
+        self._record: Optional[IdempotencyKey] = None
+        self._fingerprint: Optional[str] = None
+        self._reserved = False
+
+        if key is not None and (not key or len(key) > MAX_KEY_LENGTH):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Idempotency-Key không hợp lệ (tối đa {MAX_KEY_LENGTH} ký tự)"
+            )
+
+    @property
+    def _redis_key(self) -> str:
+        return f"idem:{self.user_id}:{self.key}"
+
+    def _make_fingerprint(self, payload: Dict[str, Any]) -> str:
+        """Băm nội dung yêu cầu để phát hiện khóa bị dùng lại cho yêu cầu khác"""
+        raw = json.dumps(
+            {"path": self.request_path, "payload": jsonable_encoder(payload)},
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _replay(self, fingerprint: str, response_code: Optional[int], response_body: Any) -> JSONResponse:
+        """Trả lại phản hồi đã lưu cho yêu cầu lặp"""
+        if fingerprint != self._fingerprint:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Idempotency-Key đã được sử dụng cho một yêu cầu khác"
+            )
+
+        if response_body is None:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Yêu cầu với Idempotency-Key này đang được xử lý"
+            )
+
+        return JSONResponse(
+            status_code=response_code or status.HTTP_200_OK,
+            content=response_body,
+            headers={"Idempotent-Replayed": "true"}
+        )
+
+    def begin(self, payload: Dict[str, Any]) -> Optional[JSONResponse]:
+        """Giữ khóa cho yêu cầu; trả về phản hồi cũ nếu yêu cầu đã được xử lý"""
+        if self.key is None:
+            return None
+
+        self._fingerprint = self._make_fingerprint(payload)
+
+        if self.redis is not None:
+            return self._begin_redis()
+        return self._begin_db()
+
+    def _begin_redis(self) -> Optional[JSONResponse]:
+        ttl_seconds = IDEMPOTENCY_TTL_HOURS * 3600
+        reserved = self.redis.set(
+            self._redis_key,
+            json.dumps({"hash": self._fingerprint}),
+            nx=True,
+            ex=ttl_seconds
+        )
+        if reserved:
+            self._reserved = True
+            return None
+
+        stored = json.loads(self.redis.get(self._redis_key) or "{}")
+        return self._replay(stored.get("hash"), stored.get("code"), stored.get("body"))
+
+    def _begin_db(self) -> Optional[JSONResponse]:
+        now = datetime.utcnow()
+
+        for _ in range(2):
+            record = IdempotencyKey(
+                idempotency_key=self.key,
+                user_id=self.user_id,
+                request_path=self.request_path,
+                request_hash=self._fingerprint,
+                expires_at=now + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+            )
+            try:
+                # Savepoint: lỗi trùng khóa không làm hỏng transaction nghiệp vụ
+                with self.db.begin_nested():
+                    self.db.add(record)
+                self._record = record
+                self._reserved = True
+                return None
+            except IntegrityError:
+                existing = self.db.query(IdempotencyKey).filter(
+                    IdempotencyKey.user_id == self.user_id,
+                    IdempotencyKey.idempotency_key == self.key
+                ).first()
+
+                if existing is None:
+                    continue
+
+                if existing.expires_at < now:
+                    # Khóa đã hết hạn: xóa và giữ lại từ đầu
+                    self.db.delete(existing)
+                    self.db.flush()
+                    continue
+
+                return self._replay(existing.request_hash, existing.response_code, existing.response_body)
+
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Yêu cầu với Idempotency-Key này đang được xử lý"
+        )
+
+    def save_response(self, response: Dict[str, Any], status_code: int = status.HTTP_200_OK):
+        """Lưu phản hồi để phát lại; gọi trước db.commit()"""
+        if not self._reserved:
+            return
+
+        body = jsonable_encoder(response)
+
+        if self.redis is None:
+            if self._record is not None:
+                self._record.response_code = status_code
+                self._record.response_body = body
+            return
+
+        value = json.dumps({"hash": self._fingerprint, "code": status_code, "body": body})
+        # Chỉ một trong hai sự kiện được xử lý cho transaction hiện tại
+        settled = {"done": False}
+
+        def _store_after_commit(session):
+            if not settled["done"]:
+                settled["done"] = True
+                self.redis.set(self._redis_key, value, xx=True, keepttl=True)
+
+        def _release_after_rollback(session):
+            if not settled["done"]:
+                settled["done"] = True
+                self.redis.delete(self._redis_key)
+
+        event.listen(self.db, "after_commit", _store_after_commit)
+        event.listen(self.db, "after_rollback", _release_after_rollback)
+
+    def release(self):
+        """Nhả khóa do chính yêu cầu này giữ khi xử lý thất bại để client có thể thử lại"""
+        if not self._reserved:
+            return
+
+        if self.redis is not None:
+            self.redis.delete(self._redis_key)
+        # Với database, bản ghi khóa bị hủy cùng db.rollback()
+        self._record = None
+        self._reserved = False
+
+    @staticmethod
+    def purge_expired(db: Session) -> int:
+        """Xóa các khóa đã hết hạn (chạy định kỳ)"""
+        deleted = db.query(IdempotencyKey).filter(
+            IdempotencyKey.expires_at < datetime.utcnow()
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
@@ -0,0 +1,359 @@
+"""
+Ledger service - sổ cái kế toán kép và số dư ví đọc O(1)
+"""
+
+import uuid
+from collections import defaultdict
+from typing import List, Optional, Dict, Any, Tuple
+from decimal import Decimal
+from datetime import datetime
+from sqlalchemy.orm import Session
+from sqlalchemy import func, update
+
+from ..models.ledger import LedgerEntry, LedgerAccountType
+from ..models.agents import AgentWallet
+from ..models.customers import Customer
+from ..models.transactions import Transaction
+
+# Tài khoản hệ thống (đối ứng cho ví đại lý/khách hàng)
+SYSTEM_CASH_IN = "tien_nap"
+SYSTEM_CASH_OUT = "tien_rut"
+SYSTEM_BILL_COLLECTION = "thu_ho_hoa_don"
+SYSTEM_COMMISSION_EXPENSE = "chi_hoa_hong"
+SYSTEM_OPENING_BALANCE = "so_du_dau_ky"
+
+# Cột cộng dồn trên ví đại lý tương ứng với từng loại nghiệp vụ
+AGENT_TOTAL_COLUMNS = {
+    'nap_tien': 'total_deposits',
+    'hoa_hong': 'total_commissions',
+    'rut_tien': 'total_withdrawals',
+    'thanh_toan': 'total_withdrawals'
+}
+
+CENT = Decimal('0.01')
+
+Leg = Tuple[LedgerAccountType, str, Decimal]
+
+class InsufficientFundsError(ValueError):
+    """Số dư ví không đủ cho khoản trừ (câu UPDATE có điều kiện không cập nhật dòng nào)"""
+
+    def __init__(self, account_type: LedgerAccountType, account_id: str, amount: Decimal):
+        self.account_type = account_type
+        self.account_id = account_id
+        self.amount = amount
+        super().__init__("Số dư ví không đủ để thực hiện giao dịch")
+
+class LedgerService:
+
+    @staticmethod
+    def post(
+        db: Session,
+        entry_type: str,
+        legs: List[Leg],
+        transaction_id: Optional[str] = None,
+        description: Optional[str] = None,
+        allow_overdraft: bool = False
+    ) -> Dict[str, Decimal]:
+        """
+        Ghi một chứng từ vào sổ cái trong transaction hiện tại (không commit).
+
+        Mỗi chân (loại tài khoản, ID, số tiền) cập nhật số dư bằng một câu
+        UPDATE ... RETURNING có điều kiện: khoản trừ chỉ thành công khi số dư
+        đủ (InsufficientFundsError nếu không), không cần đọc và kiểm tra số dư
+        trước. Tổng các chân phải bằng 0. Trả về số dư mới của các tài khoản
+        không phải hệ thống.
+        """
+        legs = [(account_type, str(account_id), Decimal(amount).quantize(CENT)) for account_type, account_id, amount in legs]
+
+        if len(legs) < 2 or sum(amount for _, _, amount in legs) != 0:
+            raise ValueError("Chứng từ sổ cái không cân đối")
+
+        journal_id = str(uuid.uuid4())
+        balances = {}
+        total_column = AGENT_TOTAL_COLUMNS.get(entry_type)
+
+        # Khóa các dòng số dư theo thứ tự cố định để tránh deadlock
+        legs = sorted(legs, key=lambda leg: (leg[0].value, leg[1]))
+        for account_type, account_id, amount in legs:
+            if account_type != LedgerAccountType.SYSTEM:
+                totals = {total_column: abs(amount)} if total_column else None
+                balances[account_id] = LedgerService._apply_balance(
+                    db, account_type, account_id, amount, totals, allow_overdraft
+                )
+
+        # Bút toán chỉ được thêm khi mọi chân đã cập nhật số dư thành công
+        for account_type, account_id, amount in legs:
+            db.add(LedgerEntry(
+                journal_id=journal_id,
+                entry_type=entry_type,
+                account_type=account_type,
+                account_id=account_id,
+                amount=amount,
+                balance_after=balances.get(account_id) if account_type != LedgerAccountType.SYSTEM else None,
+                transaction_id=str(transaction_id) if transaction_id else None,
+                description=description
+            ))
+
+        return balances
+
+    @staticmethod
+    def _apply_balance(
+        db: Session,
+        account_type: LedgerAccountType,
+        account_id: str,
+        amount: Decimal,
+        totals: Optional[Dict[str, Decimal]] = None,
+        allow_overdraft: bool = False
+    ) -> Decimal:
+        """
+        Cộng số tiền vào số dư đang lưu và trả về số dư mới, trong một câu
+        UPDATE ... WHERE balance >= :amt RETURNING với khoản trừ. Dòng chỉ bị
+        khóa từ câu UPDATE tới khi commit.
+        """
+        debit = amount < 0 and not allow_overdraft
+
+        if account_type == LedgerAccountType.AGENT:
+            values = {"balance": AgentWallet.balance + amount}
+            for column, delta in (totals or {}).items():
+                values[column] = getattr(AgentWallet, column) + delta
+
+            stmt = update(AgentWallet).where(AgentWallet.agent_id == account_id)
+            if debit:
+                stmt = stmt.where(AgentWallet.balance >= -amount)
+            stmt = stmt.values(**values).returning(AgentWallet.balance)
+
+            balance = db.execute(stmt, execution_options={"synchronize_session": False}).scalar()
+            if balance is None:
+                if db.query(AgentWallet.id).filter(AgentWallet.agent_id == account_id).first():
+                    raise InsufficientFundsError(account_type, account_id, -amount)
+                # Đại lý chưa có ví: tạo ví rỗng rồi ghi lại
+                db.add(AgentWallet(agent_id=account_id))
+                db.flush()
+                balance = db.execute(stmt, execution_options={"synchronize_session": False}).scalar()
+                if balance is None:
+                    raise InsufficientFundsError(account_type, account_id, -amount)
+            return balance
+
+        current_balance = func.coalesce(Customer.so_du_vi, 0)
+        stmt = update(Customer).where(Customer.id == account_id)
+        if debit:
+            stmt = stmt.where(current_balance >= -amount)
+        stmt = stmt.values(so_du_vi=current_balance + amount).returning(Customer.so_du_vi)
+
+        balance = db.execute(stmt, execution_options={"synchronize_session": False}).scalar()
+        if balance is None:
+            if db.query(Customer.id).filter(Customer.id == account_id).first():
+                raise InsufficientFundsError(account_type, account_id, -amount)
+            raise ValueError("Không tìm thấy khách hàng")
+        return balance
+
+    @staticmethod
+    def _transaction_legs(transaction: Transaction) -> Optional[List[Leg]]:
+        """Các chân bút toán của một giao dịch đại lý đã thành công"""
+        if not transaction.dai_ly_id:
+            return None
+
+        agent_id = str(transaction.dai_ly_id)
+        loai = transaction.loai_giao_dich
+
+        if loai == 'hoa_hong':
+            amount = Decimal(transaction.hoa_hong or 0)
+            counter_account = SYSTEM_COMMISSION_EXPENSE
+        elif loai == 'nap_tien':
+            amount = Decimal(transaction.so_tien)
+            counter_account = SYSTEM_CASH_IN
+        elif loai in ('rut_tien', 'thanh_toan'):
+            amount = -Decimal(transaction.so_tien)
+            counter_account = SYSTEM_CASH_OUT
+        else:
+            return None
+
+        if amount == 0:
+            return None
+
+        return [
+            (LedgerAccountType.AGENT, agent_id, amount.quantize(CENT)),
+            (LedgerAccountType.SYSTEM, counter_account, -amount.quantize(CENT))
+        ]
+
+    @staticmethod
+    def post_transaction(db: Session, transaction: Transaction) -> Optional[Dict[str, Decimal]]:
+        """Ghi sổ cho giao dịch của đại lý khi giao dịch chuyển sang thành công"""
+        legs = LedgerService._transaction_legs(transaction)
+        if not legs:
+            return None
+
+        return LedgerService.post(
+            db,
+            transaction.loai_giao_dich,
+            legs,
+            transaction_id=transaction.id,
+            description=transaction.ma_giao_dich
+        )
+
+    @staticmethod
+    def post_transactions(db: Session, transactions: List[Transaction]) -> Dict[str, Decimal]:
+        """
+        Ghi sổ nhiều giao dịch cùng lúc (không commit).
+
+        Mỗi giao dịch vẫn là một chứng từ riêng, nhưng số dư của mỗi tài
+        khoản chỉ được cập nhật bằng một câu UPDATE cho cả lô.
+        """
+        journals = []
+        account_deltas = defaultdict(Decimal)
+        account_totals = defaultdict(lambda: defaultdict(Decimal))
+
+        for transaction in transactions:
+            legs = LedgerService._transaction_legs(transaction)
+            if not legs:
+                continue
+            journals.append((transaction, legs))
+
+            total_column = AGENT_TOTAL_COLUMNS.get(transaction.loai_giao_dich)
+            for account_type, account_id, amount in legs:
+                if account_type == LedgerAccountType.SYSTEM:
+                    continue
+                account_deltas[(account_type, account_id)] += amount
+                if total_column:
+                    account_totals[(account_type, account_id)][total_column] += abs(amount)
+
+        # Cập nhật số dư theo thứ tự cố định để tránh deadlock
+        final_balances = {}
+        for account in sorted(account_deltas, key=lambda acc: (acc[0].value, acc[1])):
+            final_balances[account] = LedgerService._apply_balance(
+                db, account[0], account[1], account_deltas[account], dict(account_totals[account])
+            )
+
+        # Tính số dư sau từng bút toán bằng cách lùi từ số dư cuối
+        running = dict(final_balances)
+        entries = []
+        for transaction, legs in reversed(journals):
+            journal_id = str(uuid.uuid4())
+            for account_type, account_id, amount in legs:
+                balance_after = None
+                if account_type != LedgerAccountType.SYSTEM:
+                    balance_after = running[(account_type, account_id)]
+                    running[(account_type, account_id)] = balance_after - amount
+
+                entries.append(LedgerEntry(
+                    journal_id=journal_id,
+                    entry_type=transaction.loai_giao_dich,
+                    account_type=account_type,
+                    account_id=account_id,
+                    amount=amount,
+                    balance_after=balance_after,
+                    transaction_id=str(transaction.id),
+                    description=transaction.ma_giao_dich
+                ))
+
+        entries.reverse()
+        db.add_all(entries)
+
+        return {account_id: balance for (_, account_id), balance in final_balances.items()}
+
+    @staticmethod
+    def get_agent_wallet(db: Session, agent_id: str) -> Optional[AgentWallet]:
+        """Đọc ví đại lý (một dòng, không tính lại từ lịch sử)"""
+        return db.query(AgentWallet).filter(AgentWallet.agent_id == str(agent_id)).first()
+
+    @staticmethod
+    def backfill_opening_balances(db: Session) -> int:
+        """Ghi bút toán số dư đầu kỳ cho các tài khoản có số dư nhưng chưa có sổ cái"""
+        created = 0
+        accounts = [
+            (LedgerAccountType.AGENT, agent_id, balance)
+            for agent_id, balance in db.query(AgentWallet.agent_id, AgentWallet.balance).all()
+        ] + [
+            (LedgerAccountType.CUSTOMER, str(customer_id), balance)
+            for customer_id, balance in db.query(Customer.id, Customer.so_du_vi).all()
+        ]
+
+        for account_type, account_id, balance in accounts:
+            balance = Decimal(balance or 0).quantize(CENT)
+            if balance == 0:
+                continue
+
+            has_entries = db.query(LedgerEntry.id).filter(
+                LedgerEntry.account_type == account_type,
+                LedgerEntry.account_id == str(account_id)
+            ).first()
+            if has_entries:
+                continue
+
+            # Số dư đã có sẵn trên dòng tài khoản, chỉ ghi bút toán, không cộng lại
+            journal_id = str(uuid.uuid4())
+            db.add_all([
+                LedgerEntry(
+                    journal_id=journal_id,
+                    entry_type=SYSTEM_OPENING_BALANCE,
+                    account_type=account_type,
+                    account_id=str(account_id),
+                    amount=balance,
+                    balance_after=balance,
+                    description="Số dư đầu kỳ"
+                ),
+                LedgerEntry(
+                    journal_id=journal_id,
+                    entry_type=SYSTEM_OPENING_BALANCE,
+                    account_type=LedgerAccountType.SYSTEM,
+                    account_id=SYSTEM_OPENING_BALANCE,
+                    amount=-balance,
+                    description="Số dư đầu kỳ"
+                )
+            ])
+            created += 1
+
+        db.commit()
+        return created
+
+    @staticmethod
+    def reconcile(db: Session) -> Dict[str, Any]:
+        """Đối soát sổ cái với số dư đang lưu trên ví đại lý và khách hàng"""
+        ledger_totals = {
+            (account_type, account_id): Decimal(total or 0)
+            for account_type, account_id, total in db.query(
+                LedgerEntry.account_type,
+                LedgerEntry.account_id,
+                func.sum(LedgerEntry.amount)
+            ).filter(
+                LedgerEntry.account_type != LedgerAccountType.SYSTEM
+            ).group_by(LedgerEntry.account_type, LedgerEntry.account_id).all()
+        }
+
+        stored_balances = {
+            (LedgerAccountType.AGENT, str(agent_id)): Decimal(balance or 0)
+            for agent_id, balance in db.query(AgentWallet.agent_id, AgentWallet.balance).all()
+        }
+        stored_balances.update({
+            (LedgerAccountType.CUSTOMER, str(customer_id)): Decimal(balance or 0)
+            for customer_id, balance in db.query(Customer.id, Customer.so_du_vi).all()
+        })
+
+        mismatches = []
+        for account in set(ledger_totals) | set(stored_balances):
+            ledger_balance = ledger_totals.get(account, Decimal('0'))
+            stored_balance = stored_balances.get(account, Decimal('0'))
+            if ledger_balance != stored_balance:
+                mismatches.append({
+                    "account_type": account[0].value,
+                    "account_id": account[1],
+                    "ledger_balance": ledger_balance,
+                    "stored_balance": stored_balance,
+                    "difference": stored_balance - ledger_balance
+                })
+
+        # Chứng từ không cân đối (tổng các bút toán khác 0)
+        unbalanced_journals = [
+            journal_id for journal_id, _ in db.query(
+                LedgerEntry.journal_id,
+                func.sum(LedgerEntry.amount)
+            ).group_by(LedgerEntry.journal_id).having(func.sum(LedgerEntry.amount) != 0).all()
+        ]
+
+        return {
+            "checked_accounts": len(set(ledger_totals) | set(stored_balances)),
+            "mismatches": mismatches,
+            "unbalanced_journals": unbalanced_journals,
+            "is_consistent": not mismatches and not unbalanced_journals,
+            "checked_at": datetime.utcnow()
+        }
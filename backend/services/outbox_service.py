@@ -0,0 +1,519 @@
+"""
+Outbox service - ghi sự kiện thay đổi cùng transaction nghiệp vụ và phân phối tới subscriber
+"""
+
+import os
+import json
+import hmac
+import uuid
+import socket
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Callable, Awaitable, Set, Tuple
+from datetime import datetime, timedelta
+import httpx
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import Session
+
+from ..cache import get_redis
+from ..models.outbox import OutboxEvent, OutboxStatus
+from .event_hub import get_event_hub
+from .dashboard_service import invalidate_agent_dashboard
+from .resource_version_service import ResourceVersionService
+from .agent_aggregate_service import AgentAggregateService
+
+# Configuration
+OUTBOX_DISPATCHER_ENABLED = os.getenv("OUTBOX_DISPATCHER_ENABLED", "true").lower() == "true"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL_MS = int(os.getenv("OUTBOX_POLL_INTERVAL_MS", "1000"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+WEBHOOK_URLS = [url.strip() for url in os.getenv("WEBHOOK_URLS", "").split(",") if url.strip()]
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "5"))
+
+# Kênh Redis để mọi tiến trình cùng nhận sự kiện broadcast (WebSocket, cache nội bộ)
+BROADCAST_CHANNEL = "outbox:events"
+
+# Khóa cache Redis bị xóa khi đối tượng thay đổi
+CACHE_INVALIDATION_PATTERNS = {
+    "giao_dich": ["cache:stats:*", "cache:giao_dich:{aggregate_id}"],
+    "hoa_don": ["cache:stats:*", "cache:hoa_don:{aggregate_id}"],
+    "phe_duyet": ["cache:stats:*", "cache:phe_duyet:{aggregate_id}"]
+}
+
+# Các cột giao dịch gửi kèm sự kiện
+TRANSACTION_SNAPSHOT_FIELDS = (
+    "id", "ma_giao_dich", "loai_giao_dich", "trang_thai", "so_tien", "hoa_hong", "dai_ly_id", "khach_hang_id", "hoa_don_id"
+)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+class OutboxService:
+
+    @staticmethod
+    def record(
+        db: Session,
+        aggregate_type: str,
+        aggregate_id: Any,
+        event_type: str,
+        payload: Optional[Dict[str, Any]] = None,
+        recipients: Optional[List[Any]] = None
+    ) -> OutboxEvent:
+        """
+        Thêm sự kiện vào hộp thư đi trong transaction hiện tại (không commit).
+
+        Sự kiện chỉ tồn tại nếu transaction nghiệp vụ commit, nên subscriber
+        không bao giờ nhận thay đổi đã bị rollback. Phiên bản (ETag) của các
+        danh sách liên quan và bảng tổng hợp đại lý được cập nhật trong cùng
+        transaction.
+        """
+        outbox_event = OutboxEvent(
+            aggregate_type=aggregate_type,
+            aggregate_id=str(aggregate_id),
+            event_type=event_type,
+            payload=jsonable_encoder(payload or {}),
+            recipients=[str(r) for r in recipients if r] if recipients else None
+        )
+        db.add(outbox_event)
+        db.info["outbox_pending"] = True
+        ResourceVersionService.touch(db, ResourceVersionService.event_keys(aggregate_type, outbox_event.payload))
+        AgentAggregateService.project_event(db, event_type, payload)
+        return outbox_event
+
+    @staticmethod
+    def outbox_values(
+        aggregate_type: str,
+        aggregate_id: Any,
+        event_type: str,
+        payload: Optional[Dict[str, Any]] = None,
+        recipients: Optional[List[Any]] = None
+    ) -> Dict[str, Any]:
+        """Dữ liệu dòng outbox cho các đường ghi không qua Session (group-commit)"""
+        return {
+            "aggregate_type": aggregate_type,
+            "aggregate_id": str(aggregate_id),
+            "event_type": event_type,
+            "payload": jsonable_encoder(payload or {}),
+            "recipients": [str(r) for r in recipients if r] if recipients else None,
+            "status": OutboxStatus.PENDING
+        }
+
+    @staticmethod
+    def transaction_snapshot(transaction: Any, **overrides) -> Dict[str, Any]:
+        """Dữ liệu giao dịch gửi kèm sự kiện (đối tượng ORM hoặc dict giá trị cột)"""
+        if isinstance(transaction, dict):
+            snapshot = {field: transaction.get(field) for field in TRANSACTION_SNAPSHOT_FIELDS}
+        else:
+            snapshot = {field: getattr(transaction, field) for field in TRANSACTION_SNAPSHOT_FIELDS}
+        snapshot.update(overrides)
+        return snapshot
+
+    @staticmethod
+    def record_transaction(
+        db: Session,
+        transaction: Any,
+        event_type: str,
+        recipients: Optional[List[Any]] = None,
+        **overrides
+    ) -> OutboxEvent:
+        """Ghi sự kiện thay đổi của một giao dịch (mặc định gửi cho người tạo)"""
+        return OutboxService.record(
+            db,
+            "giao_dich",
+            transaction.id,
+            event_type,
+            OutboxService.transaction_snapshot(transaction, **overrides),
+            recipients=recipients or [transaction.nguoi_tao_id]
+        )
+
+    @staticmethod
+    def purge_delivered(db: Session, days: int = OUTBOX_RETENTION_DAYS) -> int:
+        """Xóa các sự kiện đã giao quá hạn lưu (chạy định kỳ)"""
+        deleted = db.query(OutboxEvent).filter(
+            OutboxEvent.status == OutboxStatus.DELIVERED,
+            OutboxEvent.delivered_at < datetime.utcnow() - timedelta(days=days)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+@event.listens_for(Session, "after_commit")
+def _wake_dispatcher_after_commit(session):
+    """Đánh thức dispatcher ngay khi có sự kiện mới được commit"""
+    if session.info.pop("outbox_pending", False) and outbox_dispatcher is not None:
+        outbox_dispatcher.notify()
+
+@event.listens_for(Session, "after_rollback")
+def _clear_pending_after_rollback(session):
+    session.info.pop("outbox_pending", None)
+
+class OutboxDispatcher:
+    """
+    Đọc hộp thư đi theo lô và giao sự kiện ít nhất một lần.
+
+    Có hai loại subscriber:
+      - subscribe(): chỉ một tiến trình giao (webhook, xóa cache Redis).
+        Lô được giữ bằng lease (locked_until) nên nhiều worker có thể cùng
+        chạy dispatcher; một sự kiện lỗi được thử lại với backoff.
+      - subscribe_broadcast(): mọi tiến trình đều nhận (WebSocket, cache
+        trong bộ nhớ), phát qua Redis pub/sub khi có Redis.
+
+    Thứ tự được giữ theo từng đối tượng: một đối tượng chỉ được nhận lô khi
+    sự kiện chờ sớm nhất của nó nằm trong lô, và khi một sự kiện lỗi thì
+    các sự kiện sau của cùng đối tượng được trả lại để giao sau.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        poll_interval_ms: int = OUTBOX_POLL_INTERVAL_MS,
+        lease_seconds: int = OUTBOX_LEASE_SECONDS,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval_ms / 1000
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self.dispatcher_id = f"{socket.gethostname()}:{os.getpid()}"[:50]
+        self.redis = get_redis()
+        self._handlers: List[Tuple[str, Handler, Optional[Set[str]]]] = []
+        self._broadcast_handlers: List[Tuple[str, Handler, Optional[Set[str]]]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pubsub_thread = None
+        self._stopping = False
+        self.stats = {"batches": 0, "delivered": 0, "failed": 0, "dead": 0}
+
+    def subscribe(self, name: str, handler: Handler, aggregate_types: Optional[List[str]] = None):
+        """Đăng ký subscriber chỉ cần giao một lần cho toàn hệ thống"""
+        self._handlers.append((name, handler, set(aggregate_types) if aggregate_types else None))
+
+    def subscribe_broadcast(self, name: str, handler: Handler, aggregate_types: Optional[List[str]] = None):
+        """Đăng ký subscriber chạy trong mọi tiến trình"""
+        self._broadcast_handlers.append((name, handler, set(aggregate_types) if aggregate_types else None))
+
+    def notify(self):
+        """Đánh thức vòng lặp (gọi được từ thread khác)"""
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self, poll: bool = True):
+        """Khởi động listener broadcast và (nếu poll=True) vòng lặp đọc outbox"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+        if self.redis is not None:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{BROADCAST_CHANNEL: self._on_broadcast_message})
+            self._pubsub_thread = pubsub.run_in_thread(sleep_time=0.5, daemon=True)
+
+        if poll and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Dừng vòng lặp sau lô đang xử lý"""
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                claimed = await self.dispatch_once()
+            except Exception as e:
+                print(f"Outbox dispatcher error: {str(e)}")
+                claimed = 0
+
+            # Lô đầy: còn sự kiện chờ, đọc tiếp ngay
+            if claimed >= self.batch_size:
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def dispatch_once(self) -> int:
+        """Nhận một lô, giao theo từng đối tượng, rồi ghi kết quả. Trả về số sự kiện đã nhận"""
+        loop = asyncio.get_running_loop()
+        events = await loop.run_in_executor(None, self._claim_batch)
+        if not events:
+            return 0
+
+        by_entity: Dict[Tuple[str, str], List[Dict[str, Any]]] = OrderedDict()
+        for outbox_event in events:
+            by_entity.setdefault((outbox_event["aggregate_type"], outbox_event["aggregate_id"]), []).append(outbox_event)
+
+        results: Dict[str, Optional[str]] = {}
+
+        async def deliver_entity(entity_events: List[Dict[str, Any]]):
+            # Tuần tự trong một đối tượng, song song giữa các đối tượng
+            for outbox_event in entity_events:
+                error = await self._deliver(outbox_event)
+                results[outbox_event["id"]] = error
+                if error is not None:
+                    break
+
+        await asyncio.gather(*(deliver_entity(entity_events) for entity_events in by_entity.values()))
+
+        # Sự kiện phía sau một sự kiện lỗi chưa được giao: trả lại lease
+        skipped = [e["id"] for e in events if e["id"] not in results]
+        await loop.run_in_executor(None, self._complete, results, skipped)
+
+        self.stats["batches"] += 1
+        return len(events)
+
+    async def _deliver(self, outbox_event: Dict[str, Any]) -> Optional[str]:
+        """Giao cho các subscriber; trả về thông báo lỗi hoặc None"""
+        for name, handler, aggregate_types in self._handlers:
+            if aggregate_types and outbox_event["aggregate_type"] not in aggregate_types:
+                continue
+            try:
+                await handler(outbox_event)
+            except Exception as e:
+                return f"{name}: {str(e)}"
+
+        try:
+            await self._broadcast(outbox_event)
+        except Exception as e:
+            return f"broadcast: {str(e)}"
+        return None
+
+    async def _broadcast(self, outbox_event: Dict[str, Any]):
+        if self.redis is not None:
+            message = json.dumps(outbox_event, ensure_ascii=False)
+            await asyncio.get_running_loop().run_in_executor(None, self.redis.publish, BROADCAST_CHANNEL, message)
+        else:
+            await self._deliver_local(outbox_event)
+
+    def _on_broadcast_message(self, message):
+        """Nhận sự kiện từ Redis (thread pub/sub) và chuyển vào event loop"""
+        if self._loop is None:
+            return
+        outbox_event = json.loads(message["data"])
+        asyncio.run_coroutine_threadsafe(self._deliver_local(outbox_event), self._loop)
+
+    async def _deliver_local(self, outbox_event: Dict[str, Any]):
+        for name, handler, aggregate_types in self._broadcast_handlers:
+            if aggregate_types and outbox_event["aggregate_type"] not in aggregate_types:
+                continue
+            try:
+                await handler(outbox_event)
+            except Exception as e:
+                print(f"Outbox broadcast subscriber {name} error: {str(e)}")
+
+    def _claim_batch(self) -> List[Dict[str, Any]]:
+        """Giữ một lô sự kiện đang chờ bằng lease và trả về bản sao dữ liệu"""
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            candidates = db.query(OutboxEvent).filter(
+                OutboxEvent.status == OutboxStatus.PENDING,
+                or_(OutboxEvent.next_attempt_at.is_(None), OutboxEvent.next_attempt_at <= now),
+                or_(OutboxEvent.locked_until.is_(None), OutboxEvent.locked_until < now)
+            ).order_by(
+                OutboxEvent.created_at, OutboxEvent.id
+            ).limit(self.batch_size).with_for_update(skip_locked=True).all()
+
+            if not candidates:
+                db.commit()
+                return []
+
+            # Sự kiện chờ sớm nhất của từng đối tượng (kể cả sự kiện đang bị giữ hoặc chờ thử lại)
+            earliest = {
+                (aggregate_type, aggregate_id): first_created
+                for aggregate_type, aggregate_id, first_created in db.query(
+                    OutboxEvent.aggregate_type,
+                    OutboxEvent.aggregate_id,
+                    func.min(OutboxEvent.created_at)
+                ).filter(
+                    OutboxEvent.status == OutboxStatus.PENDING,
+                    OutboxEvent.aggregate_id.in_({c.aggregate_id for c in candidates})
+                ).group_by(OutboxEvent.aggregate_type, OutboxEvent.aggregate_id).all()
+            }
+
+            claimed = []
+            claimed_entities = set()
+            blocked = set()
+            for candidate in candidates:
+                entity = (candidate.aggregate_type, candidate.aggregate_id)
+                if entity in blocked:
+                    continue
+                if entity not in claimed_entities and earliest.get(entity, candidate.created_at) < candidate.created_at:
+                    # Sự kiện trước đó của đối tượng chưa giao xong: chờ lượt sau
+                    blocked.add(entity)
+                    continue
+                claimed.append(candidate)
+                claimed_entities.add(entity)
+
+            if claimed:
+                db.query(OutboxEvent).filter(
+                    OutboxEvent.id.in_([c.id for c in claimed])
+                ).update({
+                    OutboxEvent.locked_until: now + self.lease,
+                    OutboxEvent.locked_by: self.dispatcher_id
+                }, synchronize_session=False)
+
+            snapshot = [
+                {
+                    "id": str(c.id),
+                    "aggregate_type": c.aggregate_type,
+                    "aggregate_id": c.aggregate_id,
+                    "event_type": c.event_type,
+                    "payload": c.payload or {},
+                    "recipients": c.recipients,
+                    "attempt": c.attempts + 1,
+                    "created_at": c.created_at.isoformat()
+                }
+                for c in claimed
+            ]
+            db.commit()
+            return snapshot
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _complete(self, results: Dict[str, Optional[str]], skipped: List[str]):
+        """Ghi kết quả giao; chỉ cập nhật các dòng dispatcher này còn giữ lease"""
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            owned = OutboxEvent.locked_by == self.dispatcher_id
+
+            delivered = [uuid.UUID(event_id) for event_id, error in results.items() if error is None]
+            if delivered:
+                db.query(OutboxEvent).filter(OutboxEvent.id.in_(delivered), owned).update({
+                    OutboxEvent.status: OutboxStatus.DELIVERED,
+                    OutboxEvent.delivered_at: now,
+                    OutboxEvent.attempts: OutboxEvent.attempts + 1,
+                    OutboxEvent.locked_until: None,
+                    OutboxEvent.locked_by: None
+                }, synchronize_session=False)
+                self.stats["delivered"] += len(delivered)
+
+            for event_id, error in results.items():
+                if error is None:
+                    continue
+                outbox_event = db.query(OutboxEvent).filter(OutboxEvent.id == uuid.UUID(event_id), owned).first()
+                if outbox_event is None:
+                    continue
+                outbox_event.attempts += 1
+                outbox_event.last_error = error
+                outbox_event.locked_until = None
+                outbox_event.locked_by = None
+                if outbox_event.attempts >= self.max_attempts:
+                    # Ngừng thử: các sự kiện sau của đối tượng được giao tiếp
+                    outbox_event.status = OutboxStatus.DEAD
+                    self.stats["dead"] += 1
+                else:
+                    outbox_event.next_attempt_at = now + timedelta(seconds=min(2 ** outbox_event.attempts, 300))
+                self.stats["failed"] += 1
+
+            if skipped:
+                db.query(OutboxEvent).filter(OutboxEvent.id.in_([uuid.UUID(event_id) for event_id in skipped]), owned).update({
+                    OutboxEvent.locked_until: None,
+                    OutboxEvent.locked_by: None
+                }, synchronize_session=False)
+
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+class WebhookSubscriber:
+    """Gửi sự kiện tới các webhook đã cấu hình, ký HMAC-SHA256 nếu có WEBHOOK_SECRET"""
+
+    def __init__(self, urls: List[str], secret: str = WEBHOOK_SECRET, timeout: float = WEBHOOK_TIMEOUT_SECONDS):
+        self.urls = urls
+        self.secret = secret
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def __call__(self, outbox_event: Dict[str, Any]):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+
+        body = json.dumps(outbox_event, ensure_ascii=False).encode('utf-8')
+        headers = {
+            "Content-Type": "application/json",
+            # Bên nhận dùng X-Event-Id để bỏ qua sự kiện bị giao lặp
+            "X-Event-Id": outbox_event["id"],
+            "X-Event-Type": outbox_event["event_type"]
+        }
+        if self.secret:
+            signature = hmac.new(self.secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+            headers["X-Signature"] = f"sha256={signature}"
+
+        for url in self.urls:
+            response = await self._client.post(url, content=body, headers=headers)
+            response.raise_for_status()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+async def invalidate_cache(outbox_event: Dict[str, Any]):
+    """Xóa các khóa cache Redis liên quan tới đối tượng vừa thay đổi"""
+    redis_client = get_redis()
+    patterns = CACHE_INVALIDATION_PATTERNS.get(outbox_event["aggregate_type"])
+    if redis_client is None or not patterns:
+        return
+
+    def _delete():
+        for pattern in patterns:
+            pattern = pattern.format(aggregate_id=outbox_event["aggregate_id"])
+            keys = list(redis_client.scan_iter(match=pattern)) if '*' in pattern else [pattern]
+            if keys:
+                redis_client.delete(*keys)
+
+    await asyncio.get_running_loop().run_in_executor(None, _delete)
+
+outbox_dispatcher: Optional[OutboxDispatcher] = None
+webhook_subscriber: Optional[WebhookSubscriber] = None
+
+def get_outbox_dispatcher() -> Optional[OutboxDispatcher]:
+    """Get outbox dispatcher instance"""
+    return outbox_dispatcher
+
+async def start_outbox_dispatcher(session_factory: Callable[[], Session]):
+    """Khởi động dispatcher; vòng lặp đọc outbox chỉ chạy khi OUTBOX_DISPATCHER_ENABLED=true"""
+    global outbox_dispatcher, webhook_subscriber
+
+    outbox_dispatcher = OutboxDispatcher(session_factory)
+    outbox_dispatcher.subscribe("cache", invalidate_cache)
+    if WEBHOOK_URLS:
+        webhook_subscriber = WebhookSubscriber(WEBHOOK_URLS)
+        outbox_dispatcher.subscribe("webhook", webhook_subscriber)
+    outbox_dispatcher.subscribe_broadcast("websocket", get_event_hub().publish)
+    outbox_dispatcher.subscribe_broadcast("agent_dashboard", invalidate_agent_dashboard, ["giao_dich"])
+
+    await outbox_dispatcher.start(poll=OUTBOX_DISPATCHER_ENABLED)
+    print("✅ Outbox dispatcher started")
+
+async def stop_outbox_dispatcher():
+    """Dừng dispatcher"""
+    global outbox_dispatcher, webhook_subscriber
+    if outbox_dispatcher is not None:
+        await outbox_dispatcher.stop()
+        outbox_dispatcher = None
+    if webhook_subscriber is not None:
+        await webhook_subscriber.close()
+        webhook_subscriber = None
@@ -0,0 +1,96 @@
+"""
+Partition service - quản lý phân vùng theo tháng của bảng giao_dich (PostgreSQL)
+"""
+
+import os
+from typing import List, Optional, Dict, Any
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# Configuration
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_ARCHIVE_SCHEMA = os.getenv("PARTITION_ARCHIVE_SCHEMA", "luu_tru")
+
+def created_range(column, from_date: Optional[date] = None, to_date: Optional[date] = None) -> List[Any]:
+    """
+    Điều kiện lọc theo ngày dạng khoảng nửa mở trên chính cột thời gian:
+    column >= đầu ngày from_date và column < đầu ngày sau to_date.
+
+    Khác với func.date(column) >= ..., cột không bị bọc trong hàm nên
+    PostgreSQL loại bỏ được các phân vùng ngoài khoảng và dùng được index.
+    """
+    conditions = []
+    if from_date:
+        conditions.append(column >= datetime.combine(from_date, time.min))
+    if to_date:
+        conditions.append(column < datetime.combine(to_date + timedelta(days=1), time.min))
+    return conditions
+
+class PartitionService:
+
+    @staticmethod
+    def is_partitioned(engine: Engine) -> bool:
+        """giao_dich đã được phân vùng (migration 004) hay chưa"""
+        if engine.dialect.name != "postgresql":
+            return False
+        with engine.connect() as conn:
+            return conn.execute(text(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt "
+                "JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = 'giao_dich')"
+            )).scalar()
+
+    @staticmethod
+    def ensure_partitions(engine: Engine, months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+        """Tạo phân vùng cho tháng hiện tại và các tháng kế tiếp nếu chưa có"""
+        with engine.begin() as conn:
+            return list(conn.execute(
+                text("SELECT dam_bao_phan_vung_giao_dich(:months)"),
+                {"months": months_ahead}
+            ).scalars())
+
+    @staticmethod
+    def list_partitions(engine: Engine) -> List[Dict[str, Any]]:
+        """Danh sách phân vùng đang gắn với giao_dich cùng khoảng giá trị và kích thước"""
+        with engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), "
+                "pg_total_relation_size(c.oid), c.reltuples::BIGINT "
+                "FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'giao_dich' ORDER BY c.relname"
+            )).all()
+        return [
+            {"name": name, "bounds": bounds, "size_bytes": size, "estimated_rows": rows_estimate}
+            for name, bounds, size, rows_estimate in rows
+        ]
+
+    @staticmethod
+    def archive_partitions(engine: Engine, keep_months: int, archive_schema: str = PARTITION_ARCHIVE_SCHEMA) -> List[str]:
+        """Tách các phân vùng cũ hơn keep_months tháng sang schema lưu trữ; trả về tên bảng đã tách"""
+        if keep_months < 1:
+            raise ValueError("Phải giữ lại ít nhất 1 tháng")
+        with engine.begin() as conn:
+            return list(conn.execute(
+                text("SELECT tach_phan_vung_giao_dich(:keep_months, :schema)"),
+                {"keep_months": keep_months, "schema": archive_schema}
+            ).scalars())
+
+    @staticmethod
+    def drop_archived(engine: Engine, table_name: str, archive_schema: str = PARTITION_ARCHIVE_SCHEMA):
+        """Xóa một bảng đã lưu trữ (sau khi đã sao lưu)"""
+        schema, _, table = table_name.rpartition(".")
+        if schema != archive_schema or not table.startswith("giao_dich_"):
+            raise ValueError(f"Chỉ xóa được bảng giao_dich_* trong schema {archive_schema}")
+        with engine.begin() as conn:
+            conn.execute(text(f'DROP TABLE "{schema}"."{table}"'))
+
+def ensure_transaction_partitions(engine: Engine):
+    """Gọi khi khởi động: tạo trước phân vùng các tháng tới (bỏ qua nếu chưa phân vùng)"""
+    try:
+        if PartitionService.is_partitioned(engine):
+            created = PartitionService.ensure_partitions(engine)
+            print(f"✅ Transaction partitions ready: {', '.join(created)}")
+    except Exception as e:
+        print(f"⚠️ Could not ensure transaction partitions: {str(e)}")
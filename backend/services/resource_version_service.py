@@ -0,0 +1,146 @@
+"""
+Resource version service - ETag cho danh sách bằng bộ đếm phiên bản, trả 304 trước khi chạy truy vấn danh sách
+"""
+
+import uuid
+import hashlib
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from datetime import datetime
+from fastapi import Request, Response
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from ..models.versions import ResourceVersion
+
+# Danh sách được đánh phiên bản
+CUSTOMER_BILLS = "khach_hang.hoa_don"
+CUSTOMER_TRANSACTIONS = "khach_hang.giao_dich"
+AGENT_TRANSACTIONS = "dai_ly.giao_dich"
+
+# Sự kiện outbox -> (danh sách, trường trong payload chứa chủ sở hữu)
+EVENT_SCOPES = {
+    "giao_dich": [(CUSTOMER_TRANSACTIONS, "khach_hang_id"), (AGENT_TRANSACTIONS, "dai_ly_id")],
+    "hoa_don": [(CUSTOMER_BILLS, "khach_hang_id"), (CUSTOMER_BILLS, "exported_to_id")]
+}
+
+# Danh sách cần tăng phiên bản khi session commit
+PENDING_KEY = "resource_versions_pending"
+
+VersionKey = Tuple[str, str]
+
+class ResourceVersionService:
+    """
+    Mỗi danh sách (scope, chủ sở hữu) có một bộ đếm, tăng trong cùng
+    transaction với thay đổi nên ETag không bao giờ cũ hơn dữ liệu đã
+    commit. Endpoint chỉ đọc một dòng theo khóa duy nhất để dựng ETag và
+    trả 304 nếu client đã có bản mới nhất, không chạy count() và truy vấn
+    danh sách.
+    """
+
+    @staticmethod
+    def event_keys(aggregate_type: str, payload: Optional[Dict[str, Any]]) -> Set[VersionKey]:
+        """Các danh sách bị ảnh hưởng bởi một sự kiện outbox"""
+        keys = set()
+        for scope, field in EVENT_SCOPES.get(aggregate_type, []):
+            owner_id = (payload or {}).get(field)
+            if owner_id:
+                keys.add((scope, str(owner_id)))
+        return keys
+
+    @staticmethod
+    def touch(db: Session, keys: Iterable[VersionKey]):
+        """Đánh dấu danh sách thay đổi; phiên bản được tăng ngay trước khi commit"""
+        db.info.setdefault(PENDING_KEY, set()).update(keys)
+
+    @staticmethod
+    def bump(connection: Any, keys: Iterable[VersionKey]):
+        """
+        Tăng phiên bản bằng một câu INSERT ... ON CONFLICT nhiều dòng.
+        Khóa được sắp xếp để các transaction đồng thời khóa dòng theo cùng thứ tự.
+        """
+        keys = sorted(set(keys))
+        if not keys:
+            return
+
+        now = datetime.utcnow()
+        stmt = insert(ResourceVersion).values([
+            {
+                "id": uuid.uuid4(),
+                "scope": scope,
+                "owner_id": owner_id,
+                "version": 1,
+                "created_at": now,
+                "updated_at": now,
+                "is_active": True
+            }
+            for scope, owner_id in keys
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ResourceVersion.scope, ResourceVersion.owner_id],
+            set_={"version": ResourceVersion.version + 1, "updated_at": now}
+        )
+        connection.execute(stmt)
+
+    @staticmethod
+    def bump_outbox_rows(connection: Any, rows: List[Dict[str, Any]]):
+        """Hook cho group-commit: tăng phiên bản trong cùng lô với các dòng outbox"""
+        keys = set()
+        for row in rows:
+            keys |= ResourceVersionService.event_keys(row["aggregate_type"], row.get("payload"))
+        ResourceVersionService.bump(connection, keys)
+
+    @staticmethod
+    def current(db: Session, scope: str, owner_id: Any) -> int:
+        """Phiên bản hiện tại (0 nếu danh sách chưa từng thay đổi)"""
+        return db.query(ResourceVersion.version).filter(
+            ResourceVersion.scope == scope,
+            ResourceVersion.owner_id == str(owner_id)
+        ).scalar() or 0
+
+    @staticmethod
+    def etag(db: Session, scope: str, owner_id: Any, request: Request) -> str:
+        """ETag yếu gồm phiên bản danh sách và tham số truy vấn (trang, bộ lọc)"""
+        version = ResourceVersionService.current(db, scope, owner_id)
+        params = "&".join(f"{key}={value}" for key, value in sorted(request.query_params.multi_items()))
+        digest = hashlib.sha1(f"{scope}:{owner_id}?{params}".encode()).hexdigest()[:16]
+        return f'W/"{version}-{digest}"'
+
+    @staticmethod
+    def not_modified(request: Request, etag: str) -> bool:
+        """If-None-Match khớp ETag hiện tại (so sánh yếu)"""
+        header = request.headers.get("if-none-match")
+        if not header:
+            return False
+        current = etag[2:] if etag.startswith("W/") else etag
+        for candidate in header.split(","):
+            candidate = candidate.strip()
+            if candidate == "*" or (candidate[2:] if candidate.startswith("W/") else candidate) == current:
+                return True
+        return False
+
+    @staticmethod
+    def conditional(db: Session, scope: str, owner_id: Any, request: Request, response: Response) -> Optional[Response]:
+        """
+        Gắn ETag vào phản hồi; trả về phản hồi 304 nếu client đã có bản mới
+        nhất (endpoint trả ngay, không chạy truy vấn danh sách).
+        """
+        etag = ResourceVersionService.etag(db, scope, owner_id, request)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if ResourceVersionService.not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        return None
+
+@event.listens_for(Session, "before_commit")
+def _bump_versions_before_commit(session):
+    """Tăng phiên bản các danh sách đã thay đổi trong cùng transaction"""
+    keys = session.info.pop(PENDING_KEY, None)
+    if keys:
+        ResourceVersionService.bump(session, keys)
+
+@event.listens_for(Session, "after_transaction_end")
+def _clear_versions_after_transaction(session, transaction):
+    # Chỉ xóa khi transaction ngoài cùng kết thúc (savepoint rollback vẫn giữ các thay đổi trước đó)
+    if transaction.parent is None:
+        session.info.pop(PENDING_KEY, None)
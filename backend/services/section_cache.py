@@ -0,0 +1,91 @@
+"""
+Section cache - cache TTL ngắn theo từng phần dữ liệu của một đối tượng (Redis hoặc bộ nhớ)
+"""
+
+import json
+import time
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+from fastapi.encoders import jsonable_encoder
+
+from ..cache import get_redis
+
+class SectionCache:
+    """
+    Cache các phần (section) dữ liệu của một đối tượng, ví dụ các khối của
+    dashboard đại lý. Mỗi section hết hạn và bị xóa độc lập nên một thay
+    đổi ví không làm mất cache hồ sơ.
+
+    Giá trị được lưu dạng JSON (cả Redis lẫn bộ nhớ) nên dữ liệu đọc từ
+    cache có cùng kiểu với dữ liệu đã trả về lần đầu.
+    """
+
+    def __init__(self, namespace: str, ttl_seconds: int, max_local_entries: int = 10000):
+        self.namespace = namespace
+        self.ttl = ttl_seconds
+        self.max_local_entries = max_local_entries
+        self.redis = get_redis()
+        self._local: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, owner_id: Any, section: str) -> str:
+        return f"cache:{self.namespace}:{owner_id}:{section}"
+
+    def get(self, owner_id: Any, section: str) -> Optional[Any]:
+        if self.ttl <= 0:
+            return None
+
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(self._key(owner_id, section))
+            except Exception:
+                return None
+            return json.loads(raw) if raw is not None else None
+
+        with self._lock:
+            entry = self._local.get((str(owner_id), section))
+            if entry is None:
+                return None
+            expires_at, raw = entry
+            if expires_at < time.monotonic():
+                del self._local[(str(owner_id), section)]
+                return None
+        return json.loads(raw)
+
+    def set(self, owner_id: Any, section: str, value: Any) -> Any:
+        """Lưu và trả về giá trị đã chuẩn hóa JSON"""
+        encoded = jsonable_encoder(value)
+        if self.ttl <= 0:
+            return encoded
+
+        raw = json.dumps(encoded, ensure_ascii=False)
+        if self.redis is not None:
+            try:
+                self.redis.set(self._key(owner_id, section), raw, ex=self.ttl)
+            except Exception:
+                pass
+            return encoded
+
+        with self._lock:
+            now = time.monotonic()
+            if len(self._local) >= self.max_local_entries:
+                # Dọn các mục đã hết hạn; nếu vẫn đầy thì bỏ toàn bộ cache cục bộ
+                self._local = {k: v for k, v in self._local.items() if v[0] >= now}
+                if len(self._local) >= self.max_local_entries:
+                    self._local.clear()
+            self._local[(str(owner_id), section)] = (now + self.ttl, raw)
+        return encoded
+
+    def invalidate(self, owner_id: Any, sections: Iterable[str]):
+        """Xóa các section của một đối tượng"""
+        sections = list(sections)
+        if self.redis is not None:
+            try:
+                self.redis.delete(*[self._key(owner_id, section) for section in sections])
+            except Exception:
+                pass
+            return
+
+        with self._lock:
+            for section in sections:
+                self._local.pop((str(owner_id), section), None)
@@ -0,0 +1,380 @@
+"""
+Settlement service - quyết toán hoa hồng cuối tháng, chia phân vùng chạy song song và khôi phục được
+"""
+
+import os
+import time
+import zlib
+import multiprocessing
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Dict, Any, Tuple
+from decimal import Decimal
+from datetime import date, datetime
+from uuid import UUID
+from sqlalchemy import Numeric, String, bindparam, cast, create_engine, func, insert, text, update
+from sqlalchemy.orm import Session, sessionmaker
+
+from ..models.agents import Agent
+from ..models.ledger import LedgerAccountType
+from ..models.transactions import Transaction
+from ..models.settlement import SettlementRun, SettlementPartition, SettlementAgent, SettlementStatus
+from .commission_service import COMMISSIONABLE_TRANSACTION_TYPES, CommissionService
+from .ledger_service import LedgerService, SYSTEM_COMMISSION_EXPENSE
+
+# Configuration
+SETTLEMENT_PARTITIONS = int(os.getenv("SETTLEMENT_PARTITIONS", "8"))
+SETTLEMENT_WORKERS = int(os.getenv("SETTLEMENT_WORKERS", str(min(os.cpu_count() or 1, 8))))
+SETTLEMENT_CHUNK_SIZE = int(os.getenv("SETTLEMENT_CHUNK_SIZE", "200"))
+
+def month_bounds(period: date) -> Tuple[datetime, datetime]:
+    """Khoảng nửa mở [đầu tháng, đầu tháng sau) để lọc trực tiếp trên phân vùng giao_dich"""
+    start = datetime(period.year, period.month, 1)
+    end = datetime(period.year + 1, 1, 1) if period.month == 12 else datetime(period.year, period.month + 1, 1)
+    return start, end
+
+def partition_of(agent_id: Any, partitions: int) -> int:
+    """Phân vùng của đại lý: băm ổn định theo id nên không đổi giữa các lần chạy lại"""
+    return zlib.crc32(str(agent_id).encode()) % partitions
+
+def _add_timing(timings: Dict[str, float], phase: str, started: float) -> float:
+    now = time.perf_counter()
+    timings[phase] += now - started
+    return now
+
+class SettlementService:
+    """
+    Quyết toán một tháng: tính hoa hồng (CommissionService.compute_for_period),
+    chi trả vào ví đại lý qua sổ cái và cộng dồn doanh số/hoa hồng của đại lý.
+
+    Đại lý có giao dịch trong kỳ được chia vào các phân vùng theo băm id; mỗi
+    phân vùng chạy trong một tiến trình riêng và xử lý đại lý theo khối. Mỗi
+    khối (hoa hồng, bút toán, tổng đại lý, kết quả theo đại lý và điểm khôi
+    phục last_agent_id) nằm trong một transaction: khi tiến trình chết giữa
+    chừng, khối dở dang bị rollback và lần chạy lại tiếp tục sau điểm khôi
+    phục, nên không đại lý nào được trả hai lần.
+    """
+
+    @staticmethod
+    def prepare_run(db: Session, period: date, partitions: int, ruleset: Optional[str] = None) -> SettlementRun:
+        """Tạo kỳ quyết toán (hoặc mở lại kỳ đang dở) cùng các dòng phân vùng"""
+        period = period.replace(day=1)
+        run = db.query(SettlementRun).filter(SettlementRun.period == period).with_for_update().first()
+
+        if run is None:
+            run = SettlementRun(period=period, partitions=partitions, ruleset=ruleset)
+            db.add(run)
+            db.flush()
+            db.add_all([
+                SettlementPartition(run_id=str(run.id), partition_no=partition_no)
+                for partition_no in range(partitions)
+            ])
+        elif run.status == SettlementStatus.COMPLETED:
+            return run
+        elif run.partitions != partitions:
+            # Số phân vùng quyết định đại lý thuộc phân vùng nào, không đổi được khi chạy lại
+            print(f"⚠️ Kỳ {period:%m/%Y} đã chia {run.partitions} phân vùng, bỏ qua giá trị {partitions}")
+
+        run.status = SettlementStatus.RUNNING
+        run.started_at = datetime.utcnow()
+        run.attempts = (run.attempts or 0) + 1
+        db.query(SettlementPartition).filter(
+            SettlementPartition.run_id == str(run.id),
+            SettlementPartition.status == SettlementStatus.FAILED
+        ).update({"status": SettlementStatus.PENDING, "error": None}, synchronize_session=False)
+        db.commit()
+        return run
+
+    @staticmethod
+    def partition_agents(db: Session, run: SettlementRun, partition_no: int) -> List[Any]:
+        """Đại lý có giao dịch tính hoa hồng thành công trong kỳ thuộc phân vùng, theo thứ tự id"""
+        start, end = month_bounds(run.period)
+        # Cùng điều kiện với compute_for_period: đại lý chỉ nạp/rút ví trong kỳ không vào quyết toán
+        agent_ids = db.query(Transaction.dai_ly_id).filter(
+            Transaction.trang_thai == 'thanh_cong',
+            Transaction.dai_ly_id.isnot(None),
+            Transaction.loai_giao_dich.in_(COMMISSIONABLE_TRANSACTION_TYPES),
+            Transaction.created_at >= start,
+            Transaction.created_at < end
+        ).distinct().all()
+        return sorted(
+            (agent_id for (agent_id,) in agent_ids if partition_of(agent_id, run.partitions) == partition_no),
+            key=str
+        )
+
+    @staticmethod
+    def settle_chunk(
+        db: Session,
+        run: SettlementRun,
+        partition: SettlementPartition,
+        agent_ids: List[Any],
+        timings: Dict[str, float]
+    ):
+        """Quyết toán một khối đại lý và ghi điểm khôi phục (không commit)"""
+        start, end = month_bounds(run.period)
+        started = time.perf_counter()
+
+        result = CommissionService.compute_for_period(
+            db, start, end,
+            ruleset_name=run.ruleset,
+            agent_ids=agent_ids,
+            status="paid",
+            paid_at=datetime.utcnow()
+        )
+        started = _add_timing(timings, "commission", started)
+
+        agents = sorted(result["agents"].items(), key=lambda item: str(item[0]))
+        for agent_id, summary in agents:
+            if summary["commission"] <= 0:
+                continue
+            amount = Decimal(summary["commission"])
+            LedgerService.post(
+                db,
+                'hoa_hong',
+                [
+                    (LedgerAccountType.AGENT, str(agent_id), amount),
+                    (LedgerAccountType.SYSTEM, SYSTEM_COMMISSION_EXPENSE, -amount)
+                ],
+                description=f"Quyết toán hoa hồng {run.period:%m/%Y}"
+            )
+        started = _add_timing(timings, "ledger", started)
+
+        if agents:
+            # Tổng của đại lý lưu dạng chuỗi: cộng dồn trong SQL, một câu UPDATE cho cả khối
+            agent_table = Agent.__table__
+            db.connection().execute(
+                update(agent_table).where(
+                    agent_table.c.id == bindparam("b_agent_id")
+                ).values(
+                    total_sales=cast(func.coalesce(cast(agent_table.c.total_sales, Numeric(18, 2)), 0) + bindparam("b_volume"), String),
+                    total_commission=cast(func.coalesce(cast(agent_table.c.total_commission, Numeric(18, 2)), 0) + bindparam("b_commission"), String),
+                    total_transactions=func.coalesce(agent_table.c.total_transactions, 0) + bindparam("b_transactions")
+                ),
+                [
+                    {
+                        "b_agent_id": agent_id,
+                        "b_volume": summary["volume"],
+                        "b_commission": summary["commission"],
+                        "b_transactions": summary["transactions"]
+                    }
+                    for agent_id, summary in agents
+                ]
+            )
+            db.execute(insert(SettlementAgent), [
+                {
+                    "run_id": str(run.id),
+                    "agent_id": str(agent_id),
+                    "partition_no": partition.partition_no,
+                    "transactions": summary["transactions"],
+                    "volume": summary["volume"],
+                    "commission": summary["commission"]
+                }
+                for agent_id, summary in agents
+            ])
+        started = _add_timing(timings, "agent_totals", started)
+
+        partition.last_agent_id = str(agent_ids[-1])
+        partition.processed_agents += len(agent_ids)
+        partition.total_transactions += result["total_transactions"]
+        partition.total_commission = Decimal(partition.total_commission or 0) + result["total_commission"]
+        partition.timings = {phase: round(seconds, 3) for phase, seconds in timings.items()}
+
+    @staticmethod
+    def report(db: Session, run: SettlementRun, top_agents: Optional[int] = None) -> Dict[str, Any]:
+        """Tổng hợp kỳ quyết toán: trạng thái, thời gian từng phân vùng và kết quả theo đại lý"""
+        partitions = db.query(SettlementPartition).filter(
+            SettlementPartition.run_id == str(run.id)
+        ).order_by(SettlementPartition.partition_no).all()
+
+        agents_query = db.query(SettlementAgent).filter(
+            SettlementAgent.run_id == str(run.id)
+        ).order_by(SettlementAgent.commission.desc())
+        if top_agents:
+            agents_query = agents_query.limit(top_agents)
+
+        return {
+            "run_id": str(run.id),
+            "period": run.period,
+            "status": run.status,
+            "attempts": run.attempts,
+            "ruleset": run.ruleset,
+            "total_agents": run.total_agents,
+            "total_transactions": run.total_transactions,
+            "total_commission": run.total_commission,
+            "timings": run.timings or {},
+            "partitions": [
+                {
+                    "partition_no": partition.partition_no,
+                    "status": partition.status,
+                    "processed_agents": partition.processed_agents,
+                    "total_transactions": partition.total_transactions,
+                    "total_commission": partition.total_commission,
+                    "timings": partition.timings or {},
+                    "error": partition.error
+                }
+                for partition in partitions
+            ],
+            "agents": [
+                {
+                    "agent_id": agent.agent_id,
+                    "partition_no": agent.partition_no,
+                    "transactions": agent.transactions,
+                    "volume": agent.volume,
+                    "commission": agent.commission
+                }
+                for agent in agents_query.all()
+            ]
+        }
+
+    @staticmethod
+    def run(
+        database_url: str,
+        period: date,
+        partitions: int = SETTLEMENT_PARTITIONS,
+        workers: int = SETTLEMENT_WORKERS,
+        ruleset: Optional[str] = None,
+        chunk_size: int = SETTLEMENT_CHUNK_SIZE
+    ) -> Dict[str, Any]:
+        """Chạy (hoặc chạy tiếp) quyết toán một tháng; trả về báo cáo của kỳ"""
+        timings = {}
+        started = time.perf_counter()
+        engine = create_engine(database_url)
+        SessionFactory = sessionmaker(bind=engine)
+
+        # Khóa tư vấn giữ suốt lần chạy: hai tiến trình không cùng quyết toán một kỳ
+        lock_conn = engine.connect()
+        lock_key = zlib.crc32(f"quyet_toan:{period:%Y-%m}".encode())
+        if engine.dialect.name == "postgresql" and not lock_conn.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": lock_key}
+        ).scalar():
+            lock_conn.close()
+            engine.dispose()
+            raise RuntimeError(f"Kỳ {period:%m/%Y} đang được quyết toán ở tiến trình khác")
+
+        try:
+            with SessionFactory() as db:
+                run = SettlementService.prepare_run(db, period, partitions, ruleset)
+                if run.status == SettlementStatus.COMPLETED:
+                    return SettlementService.report(db, run)
+                run_id = str(run.id)
+                pending = [
+                    partition_no for (partition_no,) in db.query(SettlementPartition.partition_no).filter(
+                        SettlementPartition.run_id == run_id,
+                        SettlementPartition.status != SettlementStatus.COMPLETED
+                    ).order_by(SettlementPartition.partition_no).all()
+                ]
+            timings["prepare"] = round(time.perf_counter() - started, 3)
+
+            partitions_started = time.perf_counter()
+            if workers <= 1 or len(pending) <= 1:
+                results = [process_partition(database_url, run_id, partition_no, chunk_size) for partition_no in pending]
+            else:
+                # spawn: tiến trình con tự tạo engine, không dùng chung kết nối với tiến trình cha
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=context) as pool:
+                    futures = [
+                        pool.submit(process_partition, database_url, run_id, partition_no, chunk_size)
+                        for partition_no in pending
+                    ]
+                    results = [future.result() for future in as_completed(futures)]
+            timings["partitions"] = round(time.perf_counter() - partitions_started, 3)
+
+            finalize_started = time.perf_counter()
+            with SessionFactory() as db:
+                run = db.get(SettlementRun, UUID(run_id))
+                statuses = [status for (status,) in db.query(SettlementPartition.status).filter(
+                    SettlementPartition.run_id == run_id
+                ).all()]
+
+                if all(status == SettlementStatus.COMPLETED for status in statuses):
+                    total_agents, total_transactions, total_commission = db.query(
+                        func.count(SettlementAgent.id),
+                        func.coalesce(func.sum(SettlementAgent.transactions), 0),
+                        func.coalesce(func.sum(SettlementAgent.commission), 0)
+                    ).filter(SettlementAgent.run_id == run_id).one()
+                    run.total_agents = total_agents
+                    run.total_transactions = total_transactions
+                    run.total_commission = total_commission
+                    run.status = SettlementStatus.COMPLETED
+                    run.finished_at = datetime.utcnow()
+                else:
+                    run.status = SettlementStatus.FAILED
+
+                timings["finalize"] = round(time.perf_counter() - finalize_started, 3)
+                timings["total"] = round(time.perf_counter() - started, 3)
+                timings["workers"] = {str(result["partition_no"]): result["seconds"] for result in results}
+                run.timings = timings
+                db.commit()
+
+                return SettlementService.report(db, run)
+        finally:
+            lock_conn.close()
+            engine.dispose()
+
+def process_partition(database_url: str, run_id: str, partition_no: int, chunk_size: int = SETTLEMENT_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Xử lý một phân vùng (chạy trong tiến trình con). Mỗi khối khóa dòng phân
+    vùng, đọc lại điểm khôi phục rồi mới chọn đại lý, nên kể cả khi hai tiến
+    trình cùng nhận một phân vùng thì khối sau chỉ bắt đầu sau khối trước.
+    """
+    started = time.perf_counter()
+    timings = defaultdict(float)
+    engine = create_engine(database_url, pool_size=2, max_overflow=0)
+    db = sessionmaker(bind=engine)()
+
+    try:
+        run = db.get(SettlementRun, UUID(run_id))
+        phase_started = time.perf_counter()
+        agent_ids = SettlementService.partition_agents(db, run, partition_no)
+        agent_keys = [str(agent_id) for agent_id in agent_ids]
+        _add_timing(timings, "load_agents", phase_started)
+        db.commit()
+
+        while True:
+            phase_started = time.perf_counter()
+            partition = db.query(SettlementPartition).filter(
+                SettlementPartition.run_id == run_id,
+                SettlementPartition.partition_no == partition_no
+            ).with_for_update().one()
+            if partition.status == SettlementStatus.COMPLETED:
+                db.rollback()
+                break
+            _add_timing(timings, "checkpoint", phase_started)
+
+            position = bisect_right(agent_keys, partition.last_agent_id) if partition.last_agent_id else 0
+            chunk = agent_ids[position:position + chunk_size]
+            if not chunk:
+                partition.status = SettlementStatus.COMPLETED
+                partition.finished_at = datetime.utcnow()
+                partition.timings = {phase: round(seconds, 3) for phase, seconds in timings.items()}
+                db.commit()
+                break
+
+            partition.status = SettlementStatus.RUNNING
+            SettlementService.settle_chunk(db, run, partition, chunk, timings)
+            phase_started = time.perf_counter()
+            db.commit()
+            _add_timing(timings, "commit", phase_started)
+
+        return {
+            "partition_no": partition_no,
+            "status": SettlementStatus.COMPLETED.value,
+            "seconds": round(time.perf_counter() - started, 3)
+        }
+    except Exception as e:
+        db.rollback()
+        db.query(SettlementPartition).filter(
+            SettlementPartition.run_id == run_id,
+            SettlementPartition.partition_no == partition_no
+        ).update({"status": SettlementStatus.FAILED, "error": str(e)[:2000]}, synchronize_session=False)
+        db.commit()
+        return {
+            "partition_no": partition_no,
+            "status": SettlementStatus.FAILED.value,
+            "error": str(e),
+            "seconds": round(time.perf_counter() - started, 3)
+        }
+    finally:
+        db.close()
+        engine.dispose()
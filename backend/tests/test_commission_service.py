@@ -0,0 +1,102 @@
+"""
+Tính hoa hồng theo lô (compute_batch) phải cho cùng kết quả với tính từng giao dịch (CommissionService.calculate)
+"""
+
+import random
+from decimal import Decimal
+
+import pytest
+
+from backend.services import commission_service
+from backend.services.commission_service import (
+    COMMISSIONABLE_TRANSACTION_TYPES, CommissionService, CompiledRuleSet, DEFAULT_RULES
+)
+
+RULES = {
+    "default_rate": "0.02",
+    "level_rates": {"basic": "0.02", "silver": "0.025", "gold": "0.03", "platinum": "0.035"},
+    "provider_rates": {"EVN_HCM": "0.015"},
+    "transaction_type_rates": {"thanh_toan": "0.005"},
+    "amount_tiers": [{"min_amount": "50000000", "rate": "0.01"}],
+    "volume_bonus": [{"min_volume": "100000000", "bonus_rate": "0.002"}],
+    "min_commission": "1000",
+    "max_commission": "2000000"
+}
+
+LEVELS = [None, "basic", "silver", "gold", "platinum", "khong_ton_tai"]
+TYPES = [None, "thanh_toan", "thanh_toan_hoa_don", "nap_tien", "rut_tien", "hoan_tien"]
+PROVIDERS = [None, "EVN_HCM", "EVN_HN"]
+
+def _inputs(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    return (
+        [rng.choice([0, 1, 999, rng.randint(1, 10 ** 6), rng.randint(1, 10 ** 9)]) for _ in range(count)],
+        [rng.choice(TYPES) for _ in range(count)],
+        [rng.choice(PROVIDERS) for _ in range(count)],
+        [rng.choice(LEVELS) for _ in range(count)],
+        [rng.choice([0, 10 ** 8, rng.randint(0, 10 ** 9)]) for _ in range(count)]
+    )
+
+def _expected(ruleset, amounts, transaction_types, providers, levels, volumes):
+    return [
+        CommissionService.calculate(
+            amount, ruleset,
+            transaction_type=transaction_type, provider=provider, level=level, volume=volume
+        )
+        for amount, transaction_type, provider, level, volume
+        in zip(amounts, transaction_types, providers, levels, volumes)
+    ]
+
+@pytest.mark.parametrize("rules", [DEFAULT_RULES, RULES])
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_compute_batch_matches_calculate(monkeypatch, rules, vectorized):
+    if vectorized and commission_service.np is None:
+        pytest.skip("numpy chưa được cài")
+    if not vectorized:
+        monkeypatch.setattr(commission_service, "np", None)
+
+    ruleset = CompiledRuleSet("kiem_tra", 1, rules)
+    amounts, transaction_types, providers, levels, volumes = _inputs(2000)
+    _, commissions = ruleset.compute_batch(
+        amounts,
+        transaction_types=transaction_types,
+        providers=providers,
+        levels=levels,
+        volumes=volumes
+    )
+
+    assert [Decimal(commission) for commission in commissions] == _expected(
+        ruleset, amounts, transaction_types, providers, levels, volumes
+    )
+
+def test_compute_batch_applies_agent_level():
+    ruleset = CompiledRuleSet("kiem_tra", 1, DEFAULT_RULES)
+    _, commissions = ruleset.compute_batch([1_000_000] * 4, levels=["basic", "silver", "gold", "platinum"])
+
+    assert commissions == [20_000, 25_000, 30_000, 35_000]
+    assert commissions[3] == CommissionService.calculate(1_000_000, level="platinum")
+
+@pytest.mark.parametrize("rules", [DEFAULT_RULES, RULES])
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_deposits_and_withdrawals_earn_no_commission(monkeypatch, rules, vectorized):
+    if vectorized and commission_service.np is None:
+        pytest.skip("numpy chưa được cài")
+    if not vectorized:
+        monkeypatch.setattr(commission_service, "np", None)
+
+    ruleset = CompiledRuleSet("kiem_tra", 1, rules)
+    transaction_types = ["nap_tien", "rut_tien", "thanh_toan_hoa_don"]
+    rates, commissions = ruleset.compute_batch(
+        [5_000_000] * 3,
+        transaction_types=transaction_types,
+        providers=["EVN_HCM"] * 3,
+        levels=["platinum"] * 3,
+        volumes=[10 ** 9] * 3
+    )
+
+    assert rates[:2] == [0, 0] and commissions[:2] == [0, 0]
+    assert commissions[2] > 0
+    assert "nap_tien" not in COMMISSIONABLE_TRANSACTION_TYPES
+    assert "rut_tien" not in COMMISSIONABLE_TRANSACTION_TYPES
+    for transaction_type in ("nap_tien", "rut_tien"):
+        assert CommissionService.calculate(5_000_000, ruleset, transaction_type=transaction_type, level="platinum") == 0
@@ -0,0 +1,16 @@
+"""
+Tìm số tiền trên biên nhận: số hóa đơn, mã khách hàng hay năm không được nhận nhầm là tổng tiền
+"""
+
+from backend.services.document_extractors import find_amounts
+
+def test_total_keyword_line_wins():
+    assert find_amounts("Mã KH 99887766\nTổng tiền: 1.250.000 VND")["total_amount"] == 1_250_000
+
+def test_fallback_ignores_bare_numbers():
+    text = "Ngày 15/10/2024\nHóa đơn số 12345678\nGiá 250.000đ"
+    assert find_amounts(text)["total_amount"] == 250_000
+    assert find_amounts("Hóa đơn số 12345678\nGiá 250000 đ")["total_amount"] == 250_000
+
+def test_fallback_without_money_like_number():
+    assert find_amounts("Hóa đơn số 12345678")["total_amount"] is None
@@ -0,0 +1,125 @@
+"""
+Kho lưu trữ tệp: giao diện FileStorage và S3FileStorage với client giả (không cần boto3 hay máy chủ S3)
+"""
+
+import io
+import asyncio
+import hashlib
+
+import pytest
+
+from backend.services import file_storage_service
+from backend.services.file_storage_service import (
+    FileStorage, FileStorageService, FileTooLargeError, LocalFileStorage, S3FileStorage, content_key
+)
+
+class FakeClientError(file_storage_service.ClientError):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+class FakeS3Client:
+    """Các lệnh boto3 mà S3FileStorage dùng, lưu đối tượng trong bộ nhớ"""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = 0
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError("404")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as source:
+            self.objects[(Bucket, Key)] = source.read()
+        self.uploads += 1
+
+    def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError("NoSuchKey")
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = (int(value) for value in Range[len("bytes="):].split("-"))
+            data = data[start:end + 1]
+        return {"Body": io.BytesIO(data)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+class FakeUpload:
+    """Tối thiểu của UploadFile mà save_upload cần"""
+
+    def __init__(self, data: bytes):
+        self._stream = io.BytesIO(data)
+
+    async def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+@pytest.fixture
+def client():
+    return FakeS3Client()
+
+@pytest.fixture
+def storage(client):
+    return S3FileStorage(bucket="kiem-tra", prefix="/tep/", client=client)
+
+def test_file_storage_is_abstract():
+    with pytest.raises(TypeError):
+        FileStorage()
+
+    class Incomplete(FileStorage):
+        def exists(self, key):
+            return False
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_s3_store_uses_injected_client(storage, client, tmp_path):
+    source = tmp_path / "hoa_don.txt"
+    source.write_bytes(b"0123456789")
+    key = content_key(hashlib.sha256(b"0123456789").hexdigest())
+
+    assert storage.exists(key) is False
+    assert storage.store(str(source), key) is False
+    assert ("kiem-tra", f"tep/{key}") in client.objects
+    # Cùng nội dung: không tải lên lại
+    assert storage.store(str(source), key) is True
+    assert client.uploads == 1
+
+    assert storage.size(key) == 10
+    assert b"".join(storage.iter_chunks(key, chunk_size=3)) == b"0123456789"
+    assert b"".join(storage.iter_range(key, 2, 5)) == b"2345"
+    assert storage.local_path(key) is None
+
+    storage.delete(key)
+    assert storage.exists(key) is False
+    with pytest.raises(FileNotFoundError):
+        storage.size(key)
+
+def test_s3_head_reraises_other_errors(storage, client):
+    def denied(Bucket, Key):
+        raise FakeClientError("403")
+
+    client.head_object = denied
+    with pytest.raises(FakeClientError):
+        storage.exists("ab/cd/abcd")
+
+def test_save_upload_to_s3_deduplicates(storage, client):
+    data = b"bien nhan" * 1000
+
+    first = asyncio.run(FileStorageService.save_upload(FakeUpload(data), 1024 * 1024, storage=storage, chunk_size=4096))
+    second = asyncio.run(FileStorageService.save_upload(FakeUpload(data), 1024 * 1024, storage=storage, chunk_size=4096))
+
+    digest = hashlib.sha256(data).hexdigest()
+    assert first == {"key": content_key(digest), "sha256": digest, "size": len(data), "deduplicated": False, "backend": "s3"}
+    assert second["deduplicated"] is True
+    assert client.uploads == 1
+
+def test_save_upload_rejects_oversized_file(tmp_path):
+    storage = LocalFileStorage(str(tmp_path / "kho"))
+
+    with pytest.raises(FileTooLargeError):
+        asyncio.run(FileStorageService.save_upload(FakeUpload(b"x" * 10), 5, storage=storage, chunk_size=4))
+    # Tệp tạm đã được dọn
+    assert list((tmp_path / "kho" / ".tmp").iterdir()) == []
@@ -0,0 +1,193 @@
+-- =====================================================
+-- MIGRATION 004: Monthly Partitioning for giao_dich
+-- Created: 2025-02-10
+-- Description: Phân vùng bảng giao_dich theo tháng (RANGE created_at),
+--              index BRIN trên thời gian, hàm tự tạo phân vùng và
+--              hàm tách/lưu trữ phân vùng cũ
+-- =====================================================
+-- Lưu ý:
+--   * Khóa chính và ràng buộc UNIQUE trên bảng phân vùng phải chứa khóa
+--     phân vùng, nên trở thành (id, created_at) và (ma_giao_dich, created_at).
+--     tao_ma_giao_dich() vẫn kiểm tra trùng mã trước khi cấp.
+--   * Truy vấn cần lọc trực tiếp trên created_at (created_at >= ... AND
+--     created_at < ...), không bọc trong DATE(), để PostgreSQL loại bỏ
+--     các phân vùng không liên quan.
+
+BEGIN;
+
+-- Bảng cũ được giữ tới khi chép xong dữ liệu
+ALTER TABLE giao_dich RENAME TO giao_dich_cu;
+ALTER TABLE giao_dich_cu RENAME CONSTRAINT giao_dich_pkey TO giao_dich_cu_pkey;
+DROP TRIGGER IF EXISTS trigger_giao_dich_updated_at ON giao_dich_cu;
+DROP INDEX IF EXISTS idx_giao_dich_ma_giao_dich;
+DROP INDEX IF EXISTS idx_giao_dich_nguoi_dung_id;
+DROP INDEX IF EXISTS idx_giao_dich_loai_giao_dich;
+DROP INDEX IF EXISTS idx_giao_dich_trang_thai;
+DROP INDEX IF EXISTS idx_giao_dich_created_at;
+DROP INDEX IF EXISTS idx_giao_dich_composite_user_date;
+DROP INDEX IF EXISTS idx_giao_dich_cho_xu_ly;
+DROP INDEX IF EXISTS idx_giao_dich_thong_tin_ngan_hang;
+
+-- Bảng giao dịch phân vùng theo tháng
+CREATE TABLE giao_dich (
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    ma_giao_dich VARCHAR(50) NOT NULL,
+    loai_giao_dich loai_giao_dich NOT NULL,
+    nguoi_dung_id UUID NOT NULL REFERENCES nguoi_dung(id),
+    so_tien DECIMAL(15,2) NOT NULL,
+    phi_giao_dich DECIMAL(15,2) DEFAULT 0,
+    so_tien_thuc_nhan DECIMAL(15,2) GENERATED ALWAYS AS (so_tien - phi_giao_dich) STORED,
+    noi_dung TEXT,
+    thong_tin_ngan_hang JSONB,
+    trang_thai trang_thai_giao_dich NOT NULL DEFAULT 'cho_xu_ly',
+    hoa_don_dien_id UUID REFERENCES hoa_don_dien(id),
+    nguoi_xu_ly_id UUID REFERENCES nguoi_dung(id),
+    ngay_xu_ly TIMESTAMP,
+    ghi_chu TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at),
+    UNIQUE (ma_giao_dich, created_at),
+    CONSTRAINT chk_so_tien_giao_dich CHECK (so_tien > 0)
+) PARTITION BY RANGE (created_at);
+
+-- Phân vùng mặc định: chỉ nhận dòng nằm ngoài các tháng đã tạo
+CREATE TABLE giao_dich_mac_dinh PARTITION OF giao_dich DEFAULT;
+
+-- Indexes trên bảng cha được tạo tự động cho mọi phân vùng
+CREATE INDEX idx_giao_dich_created_at_brin ON giao_dich USING BRIN (created_at) WITH (pages_per_range = 32);
+CREATE INDEX idx_giao_dich_ma_giao_dich ON giao_dich(ma_giao_dich);
+CREATE INDEX idx_giao_dich_nguoi_dung_id ON giao_dich(nguoi_dung_id);
+CREATE INDEX idx_giao_dich_loai_giao_dich ON giao_dich(loai_giao_dich);
+CREATE INDEX idx_giao_dich_trang_thai ON giao_dich(trang_thai);
+CREATE INDEX idx_giao_dich_composite_user_date ON giao_dich(nguoi_dung_id, created_at DESC);
+CREATE INDEX idx_giao_dich_cho_xu_ly ON giao_dich(created_at) WHERE trang_thai = 'cho_xu_ly';
+CREATE INDEX idx_giao_dich_thong_tin_ngan_hang ON giao_dich USING GIN(thong_tin_ngan_hang);
+
+CREATE TRIGGER trigger_giao_dich_updated_at
+    BEFORE UPDATE ON giao_dich
+    FOR EACH ROW
+    EXECUTE FUNCTION cap_nhat_updated_at();
+
+-- Tạo phân vùng cho một tháng (bỏ qua nếu đã có).
+-- Dòng của tháng đó đã lỡ rơi vào phân vùng mặc định được chuyển sang phân vùng mới.
+CREATE OR REPLACE FUNCTION tao_phan_vung_giao_dich(thang DATE)
+RETURNS TEXT AS $$
+DECLARE
+    bat_dau DATE := date_trunc('month', thang)::DATE;
+    ket_thuc DATE := (date_trunc('month', thang) + INTERVAL '1 month')::DATE;
+    ten_phan_vung TEXT := 'giao_dich_' || to_char(date_trunc('month', thang), 'YYYY_MM');
+    danh_sach_cot TEXT;
+    so_dong_lech BIGINT;
+BEGIN
+    IF to_regclass(ten_phan_vung) IS NOT NULL THEN
+        RETURN ten_phan_vung;
+    END IF;
+
+    SELECT COUNT(*) INTO so_dong_lech
+    FROM giao_dich_mac_dinh
+    WHERE created_at >= bat_dau AND created_at < ket_thuc;
+
+    IF so_dong_lech > 0 THEN
+        -- Cột sinh tự động (so_tien_thuc_nhan) không được chèn trực tiếp
+        SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position)
+        INTO danh_sach_cot
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'giao_dich'
+          AND is_generated = 'NEVER';
+
+        EXECUTE format(
+            'CREATE TEMP TABLE giao_dich_chuyen ON COMMIT DROP AS SELECT %s FROM giao_dich_mac_dinh WHERE created_at >= %L AND created_at < %L',
+            danh_sach_cot, bat_dau, ket_thuc
+        );
+        EXECUTE format(
+            'DELETE FROM giao_dich_mac_dinh WHERE created_at >= %L AND created_at < %L',
+            bat_dau, ket_thuc
+        );
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF giao_dich FOR VALUES FROM (%L) TO (%L)',
+        ten_phan_vung, bat_dau, ket_thuc
+    );
+
+    IF so_dong_lech > 0 THEN
+        EXECUTE format('INSERT INTO giao_dich (%s) SELECT %s FROM giao_dich_chuyen', danh_sach_cot, danh_sach_cot);
+        DROP TABLE giao_dich_chuyen;
+    END IF;
+
+    RETURN ten_phan_vung;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Bảo đảm có phân vùng cho tháng hiện tại và so_thang_toi tháng kế tiếp
+CREATE OR REPLACE FUNCTION dam_bao_phan_vung_giao_dich(so_thang_toi INTEGER DEFAULT 3)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    i INTEGER;
+BEGIN
+    FOR i IN 0..so_thang_toi LOOP
+        RETURN NEXT tao_phan_vung_giao_dich((date_trunc('month', CURRENT_DATE) + make_interval(months => i))::DATE);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Tách các phân vùng cũ hơn so_thang_giu tháng khỏi giao_dich và chuyển sang schema lưu trữ.
+-- Bảng đã tách vẫn truy vấn được (luu_tru.giao_dich_YYYY_MM) cho tới khi được sao lưu và xóa.
+CREATE OR REPLACE FUNCTION tach_phan_vung_giao_dich(so_thang_giu INTEGER, schema_luu_tru TEXT DEFAULT 'luu_tru')
+RETURNS SETOF TEXT AS $$
+DECLARE
+    moc DATE := (date_trunc('month', CURRENT_DATE) - make_interval(months => so_thang_giu))::DATE;
+    phan_vung RECORD;
+BEGIN
+    EXECUTE format('CREATE SCHEMA IF NOT EXISTS %I', schema_luu_tru);
+
+    FOR phan_vung IN
+        SELECT c.relname AS ten
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'giao_dich'
+          AND c.relname ~ '^giao_dich_[0-9]{4}_[0-9]{2}$'
+          AND to_date(substring(c.relname FROM 11), 'YYYY_MM') < moc
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE giao_dich DETACH PARTITION %I', phan_vung.ten);
+        EXECUTE format('ALTER TABLE %I SET SCHEMA %I', phan_vung.ten, schema_luu_tru);
+        RETURN NEXT schema_luu_tru || '.' || phan_vung.ten;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Tạo phân vùng cho toàn bộ khoảng thời gian đã có dữ liệu rồi chép dữ liệu cũ
+DO $$
+DECLARE
+    thang DATE;
+BEGIN
+    SELECT date_trunc('month', COALESCE(MIN(created_at), CURRENT_TIMESTAMP))::DATE INTO thang FROM giao_dich_cu;
+    WHILE thang <= date_trunc('month', CURRENT_DATE)::DATE LOOP
+        PERFORM tao_phan_vung_giao_dich(thang);
+        thang := (thang + INTERVAL '1 month')::DATE;
+    END LOOP;
+END;
+$$;
+
+SELECT dam_bao_phan_vung_giao_dich(3);
+
+INSERT INTO giao_dich (
+    id, ma_giao_dich, loai_giao_dich, nguoi_dung_id, so_tien, phi_giao_dich,
+    noi_dung, thong_tin_ngan_hang, trang_thai, hoa_don_dien_id, nguoi_xu_ly_id,
+    ngay_xu_ly, ghi_chu, created_at, updated_at
+)
+SELECT
+    id, ma_giao_dich, loai_giao_dich, nguoi_dung_id, so_tien, phi_giao_dich,
+    noi_dung, thong_tin_ngan_hang, trang_thai, hoa_don_dien_id, nguoi_xu_ly_id,
+    ngay_xu_ly, ghi_chu, COALESCE(created_at, CURRENT_TIMESTAMP), updated_at
+FROM giao_dich_cu;
+
+DROP TABLE giao_dich_cu;
+
+COMMENT ON TABLE giao_dich IS 'Bảng lưu thông tin các giao dịch tài chính (phân vùng theo tháng trên created_at)';
+
+COMMIT;
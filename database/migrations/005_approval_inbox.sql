@@ -0,0 +1,41 @@
+-- =====================================================
+-- MIGRATION 005: Approval Inbox Keyset Indexes and Counters
+-- Created: 2025-02-24
+-- Description: Index keyset (trang_thai, created_at, id) cho hộp duyệt và
+--              danh sách yêu cầu của người gửi; bảng đếm dem_phe_duyet
+--              theo (ngày tạo, trạng thái) cho /api/approvals/stats
+-- =====================================================
+-- Lưu ý:
+--   * Bảng đếm được cập nhật trong cùng transaction với thay đổi phê duyệt
+--     (ApprovalInboxService). Có thể tính lại bất cứ lúc nào bằng
+--     POST /api/approvals/stats/rebuild.
+
+BEGIN;
+
+-- Index cũ (trang_thai, loai_phe_duyet, created_at DESC) vẫn phục vụ lọc theo loại
+CREATE INDEX IF NOT EXISTS idx_phe_duyet_inbox
+    ON phe_duyet(trang_thai, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_phe_duyet_requester_inbox
+    ON phe_duyet(nguoi_yeu_cau_id, trang_thai, created_at, id);
+
+CREATE TABLE IF NOT EXISTS dem_phe_duyet (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    bucket_date DATE NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    deleted_at TIMESTAMP,
+    is_active BOOLEAN NOT NULL DEFAULT TRUE,
+    CONSTRAINT uq_dem_phe_duyet_ngay_trang_thai UNIQUE (bucket_date, status)
+);
+
+INSERT INTO dem_phe_duyet (bucket_date, status, count)
+SELECT created_at::DATE, trang_thai::TEXT, COUNT(*)
+FROM phe_duyet
+GROUP BY created_at::DATE, trang_thai
+ON CONFLICT (bucket_date, status) DO UPDATE SET count = EXCLUDED.count, updated_at = CURRENT_TIMESTAMP;
+
+COMMENT ON TABLE dem_phe_duyet IS 'Số yêu cầu phê duyệt theo ngày tạo và trạng thái hiện tại';
+
+COMMIT;
@@ -0,0 +1,32 @@
+-- =====================================================
+-- MIGRATION 006: Approval Step SLA Due Times
+-- Created: 2025-02-25
+-- Description: Hạn xử lý (due_at) và cấp leo thang cho buoc_phe_duyet,
+--              index (status, due_at) cho bộ lập lịch SLA
+-- =====================================================
+-- Lưu ý:
+--   * buoc_phe_duyet do ORM tạo (init_database), nên chỉ thay đổi khi bảng
+--     đã tồn tại.
+--   * ApprovalSlaScheduler dựng hàng đợi từ index này khi khởi động; không
+--     quét toàn bảng phe_duyet.
+
+BEGIN;
+
+ALTER TABLE IF EXISTS buoc_phe_duyet ADD COLUMN IF NOT EXISTS due_at TIMESTAMP;
+ALTER TABLE IF EXISTS buoc_phe_duyet ADD COLUMN IF NOT EXISTS escalation_level INTEGER NOT NULL DEFAULT 0;
+
+DO $$
+BEGIN
+    IF to_regclass('buoc_phe_duyet') IS NOT NULL THEN
+        -- Bước đang chờ có sẵn: hạn = thời điểm giao + timeout_hours
+        UPDATE buoc_phe_duyet
+        SET due_at = COALESCE(NULLIF(assigned_at, '')::timestamp, created_at)
+                     + make_interval(hours => COALESCE(timeout_hours, 24))
+        WHERE status = 'PENDING' AND due_at IS NULL;  -- Enum(StepStatus) lưu tên thành viên
+
+        CREATE INDEX IF NOT EXISTS idx_buoc_phe_duyet_han_xu_ly
+            ON buoc_phe_duyet(status, due_at);
+    END IF;
+END $$;
+
+COMMIT;
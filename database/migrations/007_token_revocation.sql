@@ -0,0 +1,38 @@
+-- =====================================================
+-- MIGRATION 007: Token Security Version & Revocation
+-- Created: 2025-03-04
+-- Description: Phiên bản bảo mật của người dùng (claim sv trong JWT) và
+--              bảng token bị thu hồi (đăng xuất) cho TokenState
+-- =====================================================
+-- Lưu ý:
+--   * nguoi_dung.updated_at được TokenState dùng làm mốc đọc tăng dần nên
+--     cần index.
+--   * token_thu_hoi chỉ giữ token chưa hết hạn; TokenState tự xóa dòng quá
+--     expires_at khi dựng lại bộ lọc Bloom.
+
+BEGIN;
+
+ALTER TABLE IF EXISTS nguoi_dung ADD COLUMN IF NOT EXISTS security_version INTEGER NOT NULL DEFAULT 1;
+
+DO $$
+BEGIN
+    IF to_regclass('nguoi_dung') IS NOT NULL THEN
+        CREATE INDEX IF NOT EXISTS idx_nguoi_dung_updated_at ON nguoi_dung(updated_at);
+    END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS token_thu_hoi (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    jti VARCHAR(64) NOT NULL UNIQUE,
+    user_id VARCHAR NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    deleted_at TIMESTAMP,
+    is_active BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+CREATE INDEX IF NOT EXISTS idx_token_thu_hoi_expires_at ON token_thu_hoi(expires_at);
+CREATE INDEX IF NOT EXISTS idx_token_thu_hoi_created_at ON token_thu_hoi(created_at);
+
+COMMIT;
@@ -0,0 +1,48 @@
+-- =====================================================
+-- MIGRATION 008: Agent Wallet Numeric Balances
+-- Created: 2025-03-05
+-- Description: Chuyển số dư và các cột tổng của vi_dai_ly từ VARCHAR sang
+--              NUMERIC(18,2) để sổ cái (balance + :amt) và trừ ví có điều
+--              kiện (balance >= :amt) so sánh và cộng trừ theo số
+-- =====================================================
+-- Lưu ý:
+--   * init_database (create_all) không thay đổi kiểu cột của bảng đã có,
+--     nên database cũ cần chạy migration này.
+--   * Giá trị rỗng hoặc không phải số được coi là 0. Cột đã là NUMERIC thì
+--     bỏ qua (chạy lại an toàn).
+
+BEGIN;
+
+DO $$
+DECLARE
+    col TEXT;
+BEGIN
+    IF to_regclass('vi_dai_ly') IS NULL THEN
+        RETURN;
+    END IF;
+
+    FOREACH col IN ARRAY ARRAY['balance', 'total_deposits', 'total_withdrawals', 'total_commissions']
+    LOOP
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'vi_dai_ly' AND column_name = col
+              AND data_type IN ('character varying', 'text')
+        ) THEN
+            EXECUTE format(
+                'ALTER TABLE vi_dai_ly ALTER COLUMN %1$I DROP DEFAULT, '
+                'ALTER COLUMN %1$I TYPE NUMERIC(18,2) USING COALESCE(NULLIF(regexp_replace(%1$I, ''[^0-9.-]'', '''', ''g''), '''')::numeric, 0), '
+                'ALTER COLUMN %1$I SET DEFAULT 0, '
+                'ALTER COLUMN %1$I SET NOT NULL',
+                col
+            );
+        ELSIF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'vi_dai_ly' AND column_name = col
+              AND data_type = 'numeric' AND numeric_precision < 18
+        ) THEN
+            EXECUTE format('ALTER TABLE vi_dai_ly ALTER COLUMN %I TYPE NUMERIC(18,2)', col);
+        END IF;
+    END LOOP;
+END $$;
+
+COMMIT;
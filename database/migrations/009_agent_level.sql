@@ -0,0 +1,16 @@
+-- =====================================================
+-- MIGRATION 009: Agent Level
+-- Created: 2025-03-06
+-- Description: Cấp đại lý (dai_ly.level) để tính hoa hồng theo lô
+--              (CommissionService.compute_for_period) dùng cùng tỷ lệ
+--              level_rates như tính từng giao dịch
+-- =====================================================
+-- Lưu ý:
+--   * Đại lý hiện có nhận cấp 'basic' (trước đây mọi đại lý tính theo
+--     cấp này).
+
+BEGIN;
+
+ALTER TABLE IF EXISTS dai_ly ADD COLUMN IF NOT EXISTS level VARCHAR(20) NOT NULL DEFAULT 'basic';
+
+COMMIT;